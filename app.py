@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import base64
 import bcrypt
+import csv
 import io
 import json
 import logging
@@ -16,14 +17,15 @@ from translations import TRANSLATIONS
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal, getcontext, InvalidOperation
 from functools import wraps
+from itertools import chain, islice
 import pytz
 
 from dotenv import load_dotenv
 from flask import (Flask, render_template, request, jsonify, redirect,
                    url_for, render_template_string, send_from_directory,
-                   session, abort, flash)
+                   session, abort, flash, Response, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, select
+from sqlalchemy import text, tuple_
 from sqlalchemy.exc import (
     OperationalError,      # Database connection muammolari
     TimeoutError,          # Database timeout
@@ -32,62 +34,15 @@ from sqlalchemy.exc import (
 )
 from werkzeug.exceptions import BadRequest
 from werkzeug.security import check_password_hash
-from rapidfuzz import process as fuzz_process, fuzz as rfuzz
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import re
 
-def normalize_search(text):
-    """
-    Qidiruv matnini normalizatsiya qilish:
-    - faqat 2+ harfli guruh oldida/keyin raqam bo'lsa ajratish: "zimmerE8" → "zimmer E8"
-      (yakkа harfli tokenlar yaratilmaydi: "50*30m" → "50*30m", "e8h7" → "e8h7")
-    - pastki chiziqni bo'sh joy bilan almashtirish: "pro_h7" → "pro h7"
-    """
-    text = text.replace('_', ' ')
-    text = re.sub(r'([a-zA-Z]{2,})(\d)', r'\1 \2', text)
-    text = re.sub(r'(\d)([a-zA-Z]{2,})', r'\1 \2', text)
-    # digit->yakka harf->digit: "h11e8" -> "h11 e8", "e8h7" -> "e8 h7"
-    text = re.sub(r'(\d)([a-zA-Z])(\d)', r'\1 \2\3', text)
-    text = re.sub(r'(\d)([a-zA-Z])(\d)', r'\1 \2\3', text)
-    return re.sub(r'\s+', ' ', text).lower().strip()
-
-def fuzzy_score(query, name):
-    """
-    So'z darajasida moslik (substring OR ratio>=60%) + fuzzy ball + raqam bonusi.
-    - coverage: query tokenlarining qanchasi nomda mos keladi
-    - digit_bonus: query va nom umumiy raqamlari (+10 har biri)
-      "zmre8h7" → digits={8,7}; E8 PRO-H7 → {8,7} → +20; E9 PRO-H7 → {9,7} → +10
-    Shu bonus E8 vs E9 farqini aniq ajratadi.
-    """
-    q = normalize_search(query)
-    n = normalize_search(name)
-    q_words = [w for w in q.split() if len(w) >= 2]
-    n_words = [w for w in n.split() if len(w) >= 2]
-    if not q_words or not n_words:
-        return 0
-
-    def word_match(qw, n_words):
-        if any(qw in nw for nw in n_words):
-            return True
-        return max((rfuzz.ratio(qw, nw) for nw in n_words), default=0) >= 60
-
-    word_hits = sum(1 for qw in q_words if word_match(qw, n_words))
-    coverage = word_hits / len(q_words)
-    if coverage == 0:
-        return 0
-
-    s1 = rfuzz.partial_ratio(q, n)
-    s2 = rfuzz.token_set_ratio(q, n)
-    s3 = rfuzz.partial_token_set_ratio(q, n)
-
-    # Umumiy raqam tokenlar bonusi: "8","7" mos → +20; faqat "7" mos → +10
-    q_digits = set(re.findall(r'\d+', query))
-    n_digits = set(re.findall(r'\d+', name))
-    digit_bonus = len(q_digits & n_digits) * 10
+# Xotiradagi mahsulot qidiruv indeksi
+from product_search import product_index, rank_order
 
-    return coverage * 60 + max(s1, s2, s3) * 0.4 + digit_bonus
+# Qidiruv natijasida ko'rib chiqiladigan maksimal mahsulotlar soni
+PRODUCT_SEARCH_LIMIT = 500
 
 
 # Windows console uchun UTF-8 qo'llab-quvvatlash
@@ -104,11 +59,7 @@ from database import (  # noqa: E402
     db,
     get_tashkent_time,
     TASHKENT_TZ,
-    CACHE_DURATION,
     DEFAULT_PHONE_PLACEHOLDER,
-    _get_location_name_cached,
-    _location_name_cache,
-    _location_name_cache_time,
 )
 
 # Flask app yaratish
@@ -205,33 +156,102 @@ db.init_app(app)
 # CSRF himoya - barcha POST/PUT/DELETE so'rovlari uchun
 csrf = CSRFProtect(app)
 
+# Workerlar uchun umumiy kesh (limiter hisoblagichlari ham shu yerda)
+import shared_cache  # noqa: E402
+
 # Rate limiting - brute-force hujumlaridan himoya
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=[],  # Global limit yo'q - faqat belgilangan routelarda
-    storage_uri="memory://",
+    storage_uri="shared://",  # shared_cache.SharedCacheStorage - limitlar barcha workerlarda umumiy
+    in_memory_fallback_enabled=True,  # kesh backend'i ishlamasa - worker xotirasida
 )
 
+# SQL profiler - boshqa before_request hook'laridan oldin (ularning so'rovlari ham hisoblansin)
+import query_profiler  # noqa: E402
+query_profiler.init_app(app)
+
+# Prometheus metrikalari (/metrics) - barcha workerlar bo'yicha
+import metrics  # noqa: E402
+metrics.init_app(app, db)
+
 # Modellarni import qilish (db.init_app dan keyin)
 from models import (  # noqa: E402
     Category, Product, Order, Warehouse, Store, WarehouseStock, StoreStock,
-    Transfer, PendingTransfer, PendingProductBatch, Customer, DebtPayment,
-    DebtReminder, CustomerTimelineSnapshot, User, ApiOperation, OperationHistory,
+    Transfer, PendingTransfer, PendingTransferItem, PendingProductBatch, Customer, DebtPayment,
+    DebtReminder, CustomerTimelineSnapshot, User, ApiOperation, ApiOperationKey, OperationHistory,
     UserSession, Settings, StockCheckSession, StockCheckItem, SaleItem, Sale,
     StockChange, ProductAddHistory, CurrencyRate, Expense, HostingClient,
     HostingPaymentOrder, HostingPayment, ManualDebt, ReserveFund, FinalReportSnapshot,
+    CustomerDebtSummary, serialize_sales,
+)
+
+# /api/sales-history statistikasi (guruhlangan so'rovlar + filtrlar bo'yicha kesh)
+from sales_statistics import (  # noqa: E402
+    compute_sales_statistics, get_cached_statistics, store_cached_statistics,
+)
+
+# Dashboard grafiklari uchun kunlik/soatlik savdo yig'indilari (Sale eventlari bilan yangilanadi)
+import sales_rollup  # noqa: E402
+
+# Mijozlar qarzi yig'indisi (customer_debt_summary, Sale eventlari bilan yangilanadi)
+import debt_ledger  # noqa: E402
+
+# Korzina stock rezervlari (batch rezerv + muddati o'tganlarni qaytarish)
+import stock_reservations  # noqa: E402
+
+# Savdo korzinasini oldindan yuklash (mahsulot/stock/joylashuvlar IN so'rovlari bilan)
+from sale_cart import SaleCartError, load_sale_cart  # noqa: E402
+
+# Telegram xabarlari navbati (yuborish run_telegram_bot.py jarayonida)
+import notification_queue  # noqa: E402
+
+# Menyu nishonlari hisoblagichlari keshi (shared_cache)
+import badge_counters  # noqa: E402
+
+# Settings jadvali keshi (worker xotirasida, LISTEN/NOTIFY bilan yangilanadi)
+import settings_service  # noqa: E402
+
+# Foydalanuvchi (rol, session, joylashuv ruxsatlari) keshi
+import principal_cache  # noqa: E402
+import user_locations  # noqa: E402
+
+# Do'kon/ombor ma'lumotnomasi (nomlar, ro'yxatlar) - barcha workerlarda yangilanadi
+import location_directory  # noqa: E402
+
+# Polling qilinadigan JSON API lar uchun ETag / 304 (resurs versiyalari shared_cache da)
+from response_cache import etag_cached  # noqa: E402
+import response_cache  # noqa: E402
+
+# O'zgarishlar oqimi: commit'da NOTIFY, brauzerlarga sse_server.py orqali (SSE)
+import change_feed  # noqa: E402
+
+# Transferlarni to'plam holida bajarish (bitta FOR UPDATE, ON CONFLICT upsert)
+import transfer_engine  # noqa: E402
+
+# Tarix jadvallarining oylik bo'laklari va arxivi (eski oylar .jsonl.gz fayllarda)
+import history_archive  # noqa: E402
+
+# Amaliyotlar tarixi buferi (commit bilan bitta INSERT, commit'dan keyingilari so'rov oxirida)
+import audit_log  # noqa: E402
+audit_log.init_app(app)
+
+# Kursor (keyset) sahifalash - OFFSET/COUNT(*) siz chuqur sahifalar
+from pagination import (  # noqa: E402
+    InvalidCursor, decode_cursor, encode_cursor, keyset_paginate, parse_count_mode,
+)
+
+# pg_trgm qidiruv backend'i (search_name/search_text ustunlari va GIN indekslar)
+from search_backend import (  # noqa: E402
+    product_search_condition, product_similarity,
+    customer_search_condition, customer_similarity,
 )
 
 # Decimal aniqlik o'rnatish
 getcontext().prec = 10
 
-# Vaqt zonasi, kesh helperlari va konstantalar database.py ga ko'chirildi.
-# Quyidagi keshlar faqat app.py ichida ishlatiladi:
-_locations_cache = None
-_locations_cache_time = None
-_all_locations_cache = None
-_all_locations_cache_time = None
+# Vaqt zonasi va konstantalar database.py da, joylashuvlar keshi - location_directory.py da
 
 
 # Timeout monitoring decorator
@@ -274,6 +294,27 @@ def timeout_monitor(max_seconds=5, operation_name=None):
     return decorator
 
 
+def _claim_idempotency_key(idempotency_key, operation_type):
+    """Kalitni joriy tranzaksiyada band qilish (api_operation_keys, bo'laklanmagan).
+
+    INSERT ... ON CONFLICT DO NOTHING RETURNING: True - birinchi so'rov, False -
+    kalit allaqachon bor. Parallel dublikat birinchisining commit/rollback'ini
+    kutadi; tranzaksiya bekor bo'lsa claim ham bekor bo'ladi (qayta urinish mumkin).
+    """
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    table = ApiOperationKey.__table__
+    insert = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    claimed = db.session.execute(
+        insert(table)
+        .values(idempotency_key=idempotency_key, operation_type=operation_type,
+                created_at=get_tashkent_time())
+        .on_conflict_do_nothing(index_elements=['idempotency_key'])
+        .returning(table.c.idempotency_key)
+    ).first()
+    return claimed is not None
+
+
 # Idempotency key tekshirish uchun funksiya
 def check_idempotency(operation_type):
     """Idempotency key orqali takroriy so'rovlarni oldini olish"""
@@ -288,29 +329,29 @@ def check_idempotency(operation_type):
                 data = request.get_json() or {}
                 idempotency_key = data.get('idempotency_key')
 
-            if idempotency_key:
-                # Avval bajarilgan operatsiyani tekshirish
+            # Kalit asosiy o'zgarish bilan bir commit'da band qilinadi (parallel dublikat ham aniqlanadi)
+            if idempotency_key and not _claim_idempotency_key(idempotency_key, operation_type):
+                # Avval bajarilgan operatsiya natijasi
                 existing = ApiOperation.query.filter_by(
                     idempotency_key=idempotency_key,
                     operation_type=operation_type
                 ).first()
 
-                if existing:
-                    logger.warning(
-                        f"⚠️ Duplicate request detected: {operation_type} - {idempotency_key}"
-                    )
+                logger.warning(
+                    f"⚠️ Duplicate request detected: {operation_type} - {idempotency_key}"
+                )
 
-                    # Oldingi natijani qaytarish
-                    if existing.result_data:
-                        result = json.loads(existing.result_data)
-                        result['already_processed'] = True
-                        return jsonify(result)
+                # Oldingi natijani qaytarish
+                if existing and existing.result_data:
+                    result = json.loads(existing.result_data)
+                    result['already_processed'] = True
+                    return jsonify(result)
 
-                    return jsonify({
-                        'success': True,
-                        'already_processed': True,
-                        'message': 'Bu operatsiya allaqachon bajarilgan'
-                    })
+                return jsonify({
+                    'success': True,
+                    'already_processed': True,
+                    'message': 'Bu operatsiya allaqachon bajarilgan'
+                })
 
             # Yangi operatsiya - bajarish
             result = f(*args, **kwargs)
@@ -477,6 +518,9 @@ def log_operation(operation_type, table_name=None, record_id=None, description=N
         location_type: 'store' yoki 'warehouse'
         location_name: Joylashuv nomi
         amount: Summa
+
+    Yozuv audit_log buferiga qo'shiladi va joriy tranzaksiya bilan birga
+    commit bo'ladi - chaqiruvni asosiy commit'dan oldin qo'ying.
     """
     try:
         current_user = get_current_user()
@@ -486,8 +530,8 @@ def log_operation(operation_type, table_name=None, record_id=None, description=N
         if ip_address and ',' in ip_address:
             ip_address = ip_address.split(',')[0].strip()
 
-        log_entry = OperationHistory(
-            operation_type=operation_type,
+        entry = audit_log.record(
+            operation_type,
             table_name=table_name,
             record_id=record_id,
             user_id=current_user.id if current_user else None,
@@ -502,15 +546,11 @@ def log_operation(operation_type, table_name=None, record_id=None, description=N
             amount=float(amount) if amount else None
         )
 
-        db.session.add(log_entry)
-        db.session.commit()
-
-        logger.info(f"📝 Operation logged: {operation_type} by {log_entry.username}")
+        logger.info(f"📝 Operation logged: {operation_type} by {entry['username']}")
 
     except Exception as e:
+        # Loglash xatosi asosiy amaliyotni to'xtatmasligi kerak (sessiyaga tegilmaydi)
         logger.error(f"❌ Operatsiyani loglashda xatolik: {str(e)}")
-        # Loglash xatosi asosiy amaliyotni to'xtatmasligi kerak
-        db.session.rollback()
 
 
 # Role-based access control decorator
@@ -535,6 +575,10 @@ def role_required(*allowed_roles):
                 return redirect(url_for('login_page'))
 
             user_role = session.get('role')
+            # Rol keshdan - update_user rolni o'zgartirsa session'dagi eski rol ishlatilmaydi
+            principal = principal_cache.get_principal(session['user_id'])
+            if principal and principal.role != user_role:
+                user_role = session['role'] = principal.role
             if not user_role:
                 if request.path.startswith('/api/'):
                     return jsonify({'error': 'Login required'}), 401
@@ -570,9 +614,9 @@ def location_permission_required(
             # Sotuvchi uchun joylashuv ruxsatini tekshirish
             if user_role == 'sotuvchi':
                 user_id = session.get('user_id')
-                user = User.query.get(user_id)
+                principal = principal_cache.get_principal(user_id)
 
-                if not user or not user.allowed_locations:
+                if not principal or not principal.locations['allowed']:
                     abort(403)  # Ruxsat etilgan joylashuvlar yo'q
 
                 # URL'dan joylashuv ID'sini olish
@@ -580,19 +624,9 @@ def location_permission_required(
                 if not location_id:
                     abort(400)  # Joylashuv ID'si topilmadi
 
-                # Joylashuv ruxsat etilganligini tekshirish
-                # Eski format [{'id': 1, 'type': 'store'}, ...] va yangi format [1, 2, 3, ...] ni qo'llab-quvvatlash
-                allowed_location_ids = []
-                for loc in user.allowed_locations:
-                    if isinstance(loc, dict) and 'id' in loc:
-                        # Eski format: {'id': 1, 'type': 'store'}
-                        allowed_location_ids.append(loc['id'])
-                    elif isinstance(loc, int):
-                        # Yangi format: [1, 2, 3, ...]
-                        allowed_location_ids.append(loc)
-
-                logger.debug(f"Location permission check: location_id={location_id}, allowed={allowed_location_ids}")
-                if location_id not in allowed_location_ids:
+                # Joylashuv ruxsat etilganligini tekshirish (oldindan ajratilgan to'plamdan)
+                logger.debug(f"Location permission check: location_id={location_id}, user_id={user_id}")
+                if not principal.allows_id('allowed', location_id):
                     logger.warning(f"Access denied to location {location_id} for user {user_id}")
                     abort(403)  # Bu joylashuvga ruxsat yo'q
 
@@ -622,42 +656,14 @@ def get_current_user():
     return request._cached_user
 
 
-def extract_location_ids(locations, location_type):
+def user_location_ids(user, scope, location_type, fallback=False):
     """
-    Allowed_locations dan ID'larni olish - eski va yangi formatlarni qo'llab-quvvatlash
-    locations: list - allowed_locations yoki transfer_locations
-    location_type: str - 'store' yoki 'warehouse'
+    Foydalanuvchiga ruxsat etilgan joylashuv ID'lari - principal_cache dan (DB so'rovisiz)
+    scope: 'allowed', 'transfer' yoki 'stock_check' (user_locations jadvali)
+    fallback: scope bo'sh bo'lsa allowed_locations ishlatiladi
     """
-    logger.debug(f"🔍 extract_location_ids called: locations={locations}, type={location_type}")
-
-    if not locations:
-        logger.debug("🔍 extract_location_ids: locations is empty, returning []")
-        return []
-
-    # Eski format (ID'lar ro'yxati) tekshirish
-    if isinstance(locations[0], int):
-        logger.debug("🔍 extract_location_ids: Old format detected (int list)")
-        # Eski format: [1, 2, 3]
-        # Type bo'yicha filtrlash uchun ma'lumotlar bazasidan tekshirish kerak
-
-        if location_type == 'store':
-            # Faqat store ID'larni olish
-            existing_store_ids = [s.id for s in Store.query.filter(Store.id.in_(locations)).all()]
-            logger.debug(f"🔍 extract_location_ids: Store IDs from DB: {existing_store_ids}")
-            return existing_store_ids
-        else:  # warehouse
-            # Faqat warehouse ID'larni olish
-            existing_warehouse_ids = [w.id for w in Warehouse.query.filter(Warehouse.id.in_(locations)).all()]
-            logger.debug(f"🔍 extract_location_ids: Warehouse IDs from DB: {existing_warehouse_ids}")
-            return existing_warehouse_ids
-
-    # Yangi format: [{'id': 1, 'type': 'store'}, {'id': 2, 'type':
-    # 'warehouse'}]
-    logger.debug("🔍 extract_location_ids: New format detected (dict list)")
-    result = [loc['id'] for loc in locations if isinstance(
-        loc, dict) and loc.get('type') == location_type]
-    logger.debug(f"🔍 extract_location_ids: Result: {result}")
-    return result
+    principal = principal_cache.get_principal(user.id)
+    return principal.location_ids(scope, location_type, fallback) if principal else []
 
 
 # Helper funksiya: Transfer boshqarish ruxsatini tekshirish
@@ -678,81 +684,33 @@ def user_can_manage_transfer(user, pending_transfer):
         return True
 
     # 2. FROM yoki TO joylashuvlaridan biriga ruxsati bo'lsa (transfer_locations yoki allowed_locations)
-    # Transfer locations dan tekshirish (transfer qilish huquqi)
-    transfer_locations = user.transfer_locations or []
-    if not transfer_locations:
-        transfer_locations = user.allowed_locations or []
-
-    # Allowed locations dan ham tekshirish (umuman joylashuvga ruxsat)
-    allowed_locations = user.allowed_locations or []
-
-    # Barcha mavjud joylashuvlarni birlashtirish
-    all_user_locations = transfer_locations + allowed_locations
-
-    logger.debug(f"   User locations: {all_user_locations}")
-
-    if not all_user_locations:
+    principal = principal_cache.get_principal(user.id)
+    if not principal:
         logger.debug("   ❌ NO LOCATIONS")
         return False
 
-    # FROM joylashuv
-    from_type = pending_transfer.from_location_type
-    from_id = pending_transfer.from_location_id
-
-    # TO joylashuv
-    to_type = pending_transfer.to_location_type
-    to_id = pending_transfer.to_location_id
-
-    # Joylashuvlarni tekshirish (yangi va eski formatni qo'llab-quvvatlash)
-    has_from_permission = False
-    has_to_permission = False
-
-    for loc in all_user_locations:
-        # Yangi format: {'id': 1, 'type': 'warehouse'}
-        if isinstance(loc, dict):
-            loc_id = loc.get('id')
-            loc_type = loc.get('type')
-            # int/str type mismatch oldini olish
-            try:
-                loc_id = int(loc_id)
-            except (TypeError, ValueError):
-                pass
-
-            if loc_id == from_id and loc_type == from_type:
-                has_from_permission = True
-                logger.debug(f"   ✅ FROM permission: {from_type}_{from_id}")
-            if loc_id == to_id and loc_type == to_type:
-                has_to_permission = True
-                logger.debug(f"   ✅ TO permission: {to_type}_{to_id}")
-
-        # Eski format: integer (faqat id)
-        elif isinstance(loc, int):
-            if loc == from_id:
-                has_from_permission = True
-                logger.debug(f"   ✅ FROM permission (old format): {from_id}")
-            if loc == to_id:
-                has_to_permission = True
-                logger.debug(f"   ✅ TO permission (old format): {to_id}")
-        # String format
-        elif isinstance(loc, str):
-            try:
-                loc_int = int(loc)
-                if loc_int == from_id:
-                    has_from_permission = True
-                if loc_int == to_id:
-                    has_to_permission = True
-            except (ValueError, TypeError):
-                pass
-
-    # Kamida biriga ruxsat bo'lsa yetarli
-    if has_from_permission or has_to_permission:
-        logger.debug(f"   ✅ ACCESS GRANTED (from={has_from_permission}, to={has_to_permission})")
-        return True
+    for location_type, location_id in (
+            (pending_transfer.from_location_type, pending_transfer.from_location_id),
+            (pending_transfer.to_location_type, pending_transfer.to_location_id)):
+        if (principal.can('transfer', location_type, location_id, fallback=True)
+                or principal.can('allowed', location_type, location_id)):
+            logger.debug(f"   ✅ ACCESS GRANTED ({location_type}_{location_id})")
+            return True
 
     logger.debug("   ❌ ACCESS DENIED")
     return False
 
 
+def pending_transfer_lines(pending_id):
+    """Pending transfer qatorlari [(product_id, quantity), ...] - bitta so'rov, JSON parse qilinmaydi"""
+    return db.session.query(
+        PendingTransferItem.product_id, PendingTransferItem.quantity
+    ).filter(
+        PendingTransferItem.pending_transfer_id == pending_id,
+        PendingTransferItem.product_id.isnot(None)
+    ).order_by(PendingTransferItem.position, PendingTransferItem.id).all()
+
+
 # API Test sahifasi
 @app.route('/api_test.html')
 def api_test():
@@ -950,22 +908,6 @@ def api_products():
         db.joinedload(Product.category)
     )
 
-    # Search filter - nom yoki barcode bo'yicha qidirish
-    if search:
-        # Normalizatsiya: "e8h7" → "e8 h7", "pro_h7" → "pro h7"
-        norm_search = normalize_search(search)
-        search_words = [w for w in norm_search.split() if w]
-        if search_words:
-            # Har bir so'z uchun AND sharti: barcha so'zlar bo'lsa topadi (qisman so'z qidiruv)
-            word_conditions = [
-                db.or_(
-                    Product.name.ilike(f'%{word}%'),
-                    Product.barcode.ilike(f'%{word}%')
-                )
-                for word in search_words
-            ]
-            query = query.filter(db.and_(*word_conditions))
-
     # Saralash uchun location ma'lumotlarini saqlash
     final_loc_type = None
     final_loc_id = None
@@ -1020,23 +962,60 @@ def api_products():
     if category_id_filter:
         query = query.filter(Product.category_id == category_id_filter)
 
+    # Search filter - nom yoki barcode bo'yicha qidirish (xotiradagi indeks, fuzzy tartib).
+    # Joylashuv/kategoriya filtri bo'lsa - mos ID lar indeksga beriladi, limit ulardan keyin
+    search_ids = None
+    if search:
+        candidate_ids = None
+        if final_loc_id or category_id_filter:
+            candidate_ids = {product_id for (product_id,) in query.with_entities(Product.id)}
+        search_ids = product_index.search(search, limit=PRODUCT_SEARCH_LIMIT, candidates=candidate_ids)
+        query = query.filter(Product.id.in_(search_ids))
+
     # Saralash: Eng ko'p sotilgan mahsulotlar birinchi bo'lishi uchun
     from sqlalchemy import desc, func
 
-    # LEFT JOIN aggregate: barcha sotuvlarni BIR MARTA COUNT qiladi
-    # (Correlated subquery edi - har mahsulot uchun alohida COUNT = juda sekin!)
-    sale_count_q = db.session.query(
-        SaleItem.product_id,
-        func.count(SaleItem.id).label('cnt')
-    )
-    if final_loc_type and final_loc_id:
-        sale_count_q = sale_count_q.filter(
-            SaleItem.source_type == final_loc_type,
-            SaleItem.source_id == final_loc_id
+    if search_ids is not None:
+        # Qidiruvda - fuzzy_score bo'yicha indeks bergan tartib
+        sort_keys = (rank_order(Product.id, search_ids), Product.id)
+        sort_descending = False
+        query = query.order_by(rank_order(Product.id, search_ids))
+    else:
+        # LEFT JOIN aggregate: barcha sotuvlarni BIR MARTA COUNT qiladi
+        # (Correlated subquery edi - har mahsulot uchun alohida COUNT = juda sekin!)
+        sale_count_q = db.session.query(
+            SaleItem.product_id,
+            func.count(SaleItem.id).label('cnt')
         )
-    sale_count_sq = sale_count_q.group_by(SaleItem.product_id).subquery()
-    query = query.outerjoin(sale_count_sq, Product.id == sale_count_sq.c.product_id)
-    query = query.order_by(desc(func.coalesce(sale_count_sq.c.cnt, 0)))
+        if final_loc_type and final_loc_id:
+            sale_count_q = sale_count_q.filter(
+                SaleItem.source_type == final_loc_type,
+                SaleItem.source_id == final_loc_id
+            )
+        sale_count_sq = sale_count_q.group_by(SaleItem.product_id).subquery()
+        query = query.outerjoin(sale_count_sq, Product.id == sale_count_sq.c.product_id)
+        sort_keys = (func.coalesce(sale_count_sq.c.cnt, 0), Product.id)
+        sort_descending = True
+        query = query.order_by(desc(sort_keys[0]), desc(Product.id))
+
+    # Kursor rejimi (?cursor=) - OFFSET va COUNT(*) siz keyingi sahifa
+    if 'cursor' in request.args:
+        try:
+            keyset_page = keyset_paginate(
+                query, sort_keys, cursor=request.args.get('cursor'), per_page=per_page,
+                descending=sort_descending,
+                count=parse_count_mode(request.args.get('count'), default='none'))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({
+            'products': [product.to_dict() for product in keyset_page.items],
+            'pagination': keyset_page.meta(per_page),
+            'filters': {
+                'search': search,
+                'location': location_filter
+            }
+        })
 
     # Get paginated results
     paginated = query.paginate(
@@ -1097,7 +1076,6 @@ def api_locations():
 
         logger.debug(
             f"🔍 API Locations - User: {current_user.username}, Role: {current_user.role}")
-        logger.debug(f"🔍 allowed_locations RAW: {current_user.allowed_locations}")
 
         # Foydalanuvchi huquqlarini tekshirish
         if current_user.role == 'admin':
@@ -1108,14 +1086,11 @@ def api_locations():
         else:
             # Oddiy foydalanuvchilar faqat allowed_locations dan ruxsat etilgan
             # joylashuvlarni ko'radi (savdo uchun)
-            allowed_locations = current_user.allowed_locations or []
-            logger.debug(f" Raw allowed_locations: {allowed_locations}")
             logger.debug("🔍 Non-admin user - filtering locations")
-            logger.debug(f"🔍 allowed_locations: {allowed_locations}")
 
             # Helper funksiya bilan ID'larni olish (eski va yangi formatlar uchun)
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            allowed_warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
 
             logger.debug(f"🔍 Filtered store IDs: {allowed_store_ids}")
             logger.debug(f"🔍 Filtered warehouse IDs: {allowed_warehouse_ids}")
@@ -1169,23 +1144,11 @@ def api_locations():
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
 def api_all_locations():
     """Mahsulotlar sahifasi uchun barcha joylashuvlar (filterlashsiz)"""
-    global _all_locations_cache, _all_locations_cache_time
-
-    # ✅ Cache tekshirish
-    if _all_locations_cache and _all_locations_cache_time:
-        elapsed = (datetime.now() - _all_locations_cache_time).total_seconds()
-        if elapsed < CACHE_DURATION:
-            logger.debug(f"📦 All-locations cache hit - {int(CACHE_DURATION - elapsed)}s qoldi")
-            return jsonify(_all_locations_cache)
-
-    logger.debug(" All Locations API - Barcha foydalanuvchilar uchun barcha joylashuvlar")
-
+    # location_directory - barcha workerlar uchun create/edit/delete da yangilanadi
     locations = []
 
     # Barcha omborlarni qo'shish
-    warehouses = Warehouse.query.all()
-    for warehouse in warehouses:
-        logger.debug(f" Including warehouse {warehouse.id} ({warehouse.name})")
+    for warehouse in location_directory.all_locations('warehouse'):
         locations.append({
             'type': 'warehouse',
             'id': warehouse.id,
@@ -1194,9 +1157,7 @@ def api_all_locations():
         })
 
     # Barcha do'konlarni qo'shish
-    stores = Store.query.all()
-    for store in stores:
-        logger.debug(f" Including store {store.id} ({store.name})")
+    for store in location_directory.all_locations('store'):
         locations.append({
             'type': 'store',
             'id': store.id,
@@ -1204,12 +1165,7 @@ def api_all_locations():
             'display': f'🏪 {store.name} (Do\'kon)'
         })
 
-    logger.info(f" Total locations for products page: {len(locations)}")
-
-    # ✅ Cache'ga saqlash
-    _all_locations_cache = locations
-    _all_locations_cache_time = datetime.now()
-    logger.debug("💾 All-locations cached")
+    logger.debug(f" Total locations for products page: {len(locations)}")
     return jsonify(locations)
 
 
@@ -1231,9 +1187,11 @@ def api_search_products_by_location(location_type, location_id):
             ).filter(WarehouseStock.warehouse_id == location_id)
 
             if search_term:
-                search_words = [w for w in normalize_search(search_term).split() if w]
-                if search_words:
-                    query = query.filter(db.and_(*[Product.name.ilike(f'%{w}%') for w in search_words]))
+                # Faqat shu joylashuvdagi mahsulotlar orasidan qidirish (limit filtrdan keyin)
+                candidate_ids = {product_id for (product_id,) in query.with_entities(Product.id)}
+                search_ids = product_index.search(search_term, limit=limit, candidates=candidate_ids)
+                query = query.filter(Product.id.in_(search_ids)).order_by(
+                    rank_order(Product.id, search_ids))
 
             stocks = query.limit(limit).all()
 
@@ -1253,9 +1211,11 @@ def api_search_products_by_location(location_type, location_id):
             ).filter(StoreStock.store_id == location_id)
 
             if search_term:
-                search_words = [w for w in normalize_search(search_term).split() if w]
-                if search_words:
-                    query = query.filter(db.and_(*[Product.name.ilike(f'%{w}%') for w in search_words]))
+                # Faqat shu joylashuvdagi mahsulotlar orasidan qidirish (limit filtrdan keyin)
+                candidate_ids = {product_id for (product_id,) in query.with_entities(Product.id)}
+                search_ids = product_index.search(search_term, limit=limit, candidates=candidate_ids)
+                query = query.filter(Product.id.in_(search_ids)).order_by(
+                    rank_order(Product.id, search_ids))
 
             stocks = query.limit(limit).all()
 
@@ -1792,7 +1752,7 @@ def api_add_product():
                     elif location_type_str == 'warehouse':
                         location_id_int = int(location_value.replace('warehouse_', ''))
 
-                    operation = OperationHistory(
+                    audit_log.record(
                         operation_type='add_product',
                         table_name='products',
                         record_id=product.id,
@@ -1814,7 +1774,6 @@ def api_add_product():
                         location_name=location_name,
                         amount=float(cost_price * Decimal(str(quantity)))  # Jami summa
                     )
-                    db.session.add(operation)
 
                     logger.info(f"✅ History yozuvi yaratildi: {product.name}, {quantity} ta, {location_name}")
                 else:
@@ -1983,9 +1942,7 @@ def api_batch_products():
             location_name = ''
 
             if location_type == 'warehouse':
-                warehouse = Warehouse.query.get(location_id)
-                if warehouse:
-                    location_name = warehouse.name
+                location_name = location_directory.resolve('warehouse', location_id, '')
 
                 stock = WarehouseStock.query.filter_by(
                     warehouse_id=location_id,
@@ -2008,9 +1965,7 @@ def api_batch_products():
                     db.session.add(stock)
 
             elif location_type == 'store':
-                store = Store.query.get(location_id)
-                if store:
-                    location_name = store.name
+                location_name = location_directory.resolve('store', location_id, '')
 
                 stock = StoreStock.query.filter_by(
                     store_id=location_id,
@@ -2052,7 +2007,7 @@ def api_batch_products():
                 db.session.add(history)
 
                 # OperationHistory ga ham yozish
-                operation = OperationHistory(
+                audit_log.record(
                     operation_type='add_product',
                     table_name='products',
                     record_id=product.id,
@@ -2074,7 +2029,6 @@ def api_batch_products():
                     location_name=location_name,
                     amount=float(cost_price * quantity)
                 )
-                db.session.add(operation)
 
             created_count += 1
 
@@ -2164,15 +2118,14 @@ def search_product(product_name):
     try:
         logger.debug(f"🔍 Qidiruv so'rovi: '{product_name}'")
 
-        # Optimized query - qisman so'zlar bilan qidiruv (har bir so'z alohida)
-        words = product_name.split()
-        filters = [Product.name.ilike(f'%{w}%') for w in words]
+        # Xotiradagi indeks - fuzzy_score bo'yicha eng mos 10 ta mahsulot
+        search_ids = product_index.search(product_name, limit=10)
         products = Product.query.filter(
-            db.and_(*filters)
+            Product.id.in_(search_ids)
         ).options(
             db.joinedload(Product.warehouse_stocks).joinedload(WarehouseStock.warehouse),
             db.joinedload(Product.store_stocks).joinedload(StoreStock.store)
-        ).limit(10).all()  # Faqat birinchi 10 ta natija
+        ).order_by(rank_order(Product.id, search_ids)).all()
 
         if not products:
             logger.debug(f"❌ Mahsulot topilmadi: '{product_name}'")
@@ -2338,11 +2291,10 @@ def api_customer_balances():
         store_filter_sql = ""
         bind_params = {}
         if current_user.role == 'sotuvchi':
-            allowed_locations = current_user.allowed_locations or []
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            if allowed_store_ids:
-                store_filter_sql = "WHERE c.store_id = ANY(:store_ids)"
-                bind_params['store_ids'] = allowed_store_ids
+            if user_location_ids(current_user, 'allowed', 'store'):
+                store_filter_sql = f"WHERE c.store_id IN {user_locations.LOCATION_IDS_SQL}"
+                bind_params.update(user_locations.location_params(
+                    user_location_ids(current_user, 'allowed', 'store')))
             else:
                 # Hech qanday do'kon ruxsati yo'q — bo'sh qaytarish
                 return jsonify({'success': True, 'customers': [], 'exchange_rate': float(exchange_rate)})
@@ -2369,6 +2321,8 @@ def api_customer_balances():
                      c.last_debt_payment_usd, c.last_debt_payment_date
             ORDER BY debt_usd DESC, c.name ASC
         """)
+        if store_filter_sql:
+            query = user_locations.expand_location_ids(query)
 
         result = db.session.execute(query, bind_params)
 
@@ -2417,8 +2371,6 @@ def api_update_customer_balance(customer_id):
 
         old_balance = float(customer.balance or 0)
         customer.balance = new_balance
-        db.session.commit()
-        logger.info(f"Mijoz #{customer_id} balansi tahrirlandi: ${old_balance} \u2192 ${float(new_balance)}")
         log_operation(
             operation_type='edit',
             table_name='customers',
@@ -2428,6 +2380,8 @@ def api_update_customer_balance(customer_id):
             new_data={'balance': float(new_balance), 'customer_name': customer.name},
             amount=float(new_balance)
         )
+        db.session.commit()
+        logger.info(f"Mijoz #{customer_id} balansi tahrirlandi: ${old_balance} \u2192 ${float(new_balance)}")
         return jsonify({'success': True, 'new_balance': float(new_balance)})
     except Exception as e:
         db.session.rollback()
@@ -2457,8 +2411,6 @@ def api_add_customer_balance(customer_id):
 
         old_balance = Decimal(str(customer.balance or 0))
         customer.balance = old_balance + amount
-        db.session.commit()
-        logger.info(f"Mijoz #{customer_id} balansiga ${amount} qo'shildi (yangi: ${float(customer.balance)})")
         log_operation(
             operation_type='payment',
             table_name='customers',
@@ -2468,6 +2420,8 @@ def api_add_customer_balance(customer_id):
             new_data={'balance': float(customer.balance), 'added': float(amount), 'customer_name': customer.name},
             amount=float(amount)
         )
+        db.session.commit()
+        logger.info(f"Mijoz #{customer_id} balansiga ${amount} qo'shildi (yangi: ${float(customer.balance)})")
         return jsonify({'success': True, 'new_balance': float(customer.balance)})
     except Exception as e:
         db.session.rollback()
@@ -2682,13 +2636,20 @@ def api_customer_timeline(customer_id):
                 'has_snapshot': False
             })
 
-        # Qaytarilgan mahsulotlar (operation_history)
+        # Qaytarilgan mahsulotlar (operation_history - issiq bo'laklar + arxiv)
         all_sale_ids = list(snap_sale_ids) + [s.id for s in legacy_sales]
         if all_sale_ids:
             returns = OperationHistory.query.filter(
                 OperationHistory.operation_type == 'return',
                 OperationHistory.record_id.in_(all_sale_ids)
             ).order_by(OperationHistory.created_at.desc()).all()
+            # Qaytarish savdodan keyin bo'ladi - arxiv eng eski savdo oyidan o'qiladi
+            first_sale_date = db.session.query(db.func.min(Sale.sale_date)).filter(
+                Sale.id.in_(all_sale_ids)).scalar()
+            sale_id_set = set(all_sale_ids)
+            returns += history_archive.archived_rows(
+                'operations_history', since=first_sale_date,
+                where=lambda op: op.operation_type == 'return' and op.record_id in sale_id_set)
             for r in returns:
                 nd = r.new_data or {}
                 events.append({
@@ -3195,13 +3156,8 @@ def transfer_session():
             allowed_store_ids = None
             allowed_warehouse_ids = None
         else:
-            transfer_locs = current_user.transfer_locations or []
-            if transfer_locs and isinstance(transfer_locs[0], int):
-                allowed_store_ids = transfer_locs
-                allowed_warehouse_ids = transfer_locs
-            else:
-                allowed_store_ids = extract_location_ids(transfer_locs, 'store')
-                allowed_warehouse_ids = extract_location_ids(transfer_locs, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'transfer', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'transfer', 'warehouse')
 
         stores = (Store.query.all() if allowed_store_ids is None
                   else (Store.query.filter(Store.id.in_(allowed_store_ids)).all()
@@ -3446,13 +3402,11 @@ def api_return_product():
             # Amaliyotlar tarixiga yozish (har bir mahsulot uchun)
             location_name = None
             if location_type == 'store':
-                store = Store.query.get(location_id)
-                location_name = store.name if store else 'Noma\'lum do\'kon'
+                location_name = location_directory.resolve('store', location_id, 'Noma\'lum do\'kon')
             elif location_type == 'warehouse':
-                warehouse = Warehouse.query.get(location_id)
-                location_name = warehouse.name if warehouse else 'Noma\'lum ombor'
+                location_name = location_directory.resolve('warehouse', location_id, 'Noma\'lum ombor')
 
-            operation = OperationHistory(
+            audit_log.record(
                 operation_type='return',
                 table_name='sale_items',
                 record_id=sale_id,
@@ -3477,7 +3431,6 @@ def api_return_product():
                 location_name=location_name,
                 amount=float(returned_usd * sale.currency_rate)  # Amount UZS da saqlanadi
             )
-            db.session.add(operation)
 
         # Sale jami summasini yangilash (USD da)
         if total_returned_usd > 0:
@@ -3498,7 +3451,7 @@ def api_return_product():
                     old_balance = Decimal(str(customer.balance or 0))
                     customer.balance = old_balance + total_returned_usd
                     logger.info(f"🏦 Mijoz #{customer.id} balansiga ${total_returned_usd} qo'shildi (yangi balans: ${customer.balance})")
-                    refund_operation = OperationHistory(
+                    audit_log.record(
                         operation_type='payment_refund',
                         table_name='sales',
                         record_id=sale_id,
@@ -3518,7 +3471,6 @@ def api_return_product():
                         location_name=location_name,
                         amount=float(total_returned_usd * sale.currency_rate)
                     )
-                    db.session.add(refund_operation)
                 else:
                     logger.warning("⚠️ Savdoda mijoz yo'q, balans o'rniga naqd qaytarish amalga oshiriladi")
                     refund_type = 'cash'  # Fallback to cash
@@ -3578,7 +3530,7 @@ def api_return_product():
                     customer.balance = Decimal(str(customer.balance or 0)) + Decimal(str(remaining_to_deduct))
                     logger.info(f"🏦 Ortiqcha ${remaining_to_deduct:.2f} balansga qo'shildi")
 
-                refund_operation = OperationHistory(
+                audit_log.record(
                     operation_type='payment_refund',
                     table_name='sales',
                     record_id=sale_id,
@@ -3597,7 +3549,6 @@ def api_return_product():
                     location_name=location_name,
                     amount=float(total_returned_usd * sale.currency_rate)
                 )
-                db.session.add(refund_operation)
 
             if refund_type == 'cash':
                 # Smart Logic: avval qarz, keyin naqd, click, terminal
@@ -3643,7 +3594,7 @@ def api_return_product():
 
                 # Qaytarilgan to'lovlarni operation_history ga yozish
                 for payment_type, refund_amount in refunded_payments:
-                    refund_operation = OperationHistory(
+                    audit_log.record(
                         operation_type='payment_refund',
                         table_name='sales',
                         record_id=sale_id,
@@ -3663,7 +3614,6 @@ def api_return_product():
                         location_name=location_name,
                         amount=-float(Decimal(str(refund_amount)) * sale.currency_rate)
                     )
-                    db.session.add(refund_operation)
 
             logger.info(f"Mahsulot qaytarildi: {len(returned_items)} ta")
 
@@ -3811,38 +3761,84 @@ def api_operations_history():
         user_id = request.args.get('user_id', type=int)
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 50, type=int)
+        per_page = max(1, min(per_page, 500))
+        # Kursor rejimi: ?cursor= (birinchi sahifa uchun bo'sh) - OFFSET va COUNT(*) siz
+        use_cursor = 'cursor' in request.args
 
         # Query yaratish
         query = OperationHistory.query
+        # Arxiv qatorlari uchun xuddi shu filtrlar (Python'da)
+        start_datetime = None
+        end_datetime = None
+        archive_filters = []
 
         # Filterlarni qo'llash
         if start_date:
-            query = query.filter(OperationHistory.created_at >= start_date)
+            start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+            query = query.filter(OperationHistory.created_at >= start_datetime)
         if end_date:
             # End date'ga 1 kun qo'shish (oxirgi kunni ham qamrab olish uchun)
             end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
             query = query.filter(OperationHistory.created_at < end_datetime)
         if operation_type:
             query = query.filter(OperationHistory.operation_type == operation_type)
+            archive_filters.append(lambda op: op.operation_type == operation_type)
         if user_id:
             # user_id bo'yicha filter (username orqali ham qo'llab-quvvatlash)
             user = User.query.get(user_id)
             if user:
+                usernames = {user.username, f"{user.first_name} {user.last_name}"}
                 query = query.filter(
                     db.or_(
                         OperationHistory.user_id == user_id,
-                        OperationHistory.username == user.username,
-                        OperationHistory.username == f"{user.first_name} {user.last_name}"
+                        OperationHistory.username.in_(usernames)
                     )
                 )
+                archive_filters.append(lambda op: op.user_id == user_id or op.username in usernames)
 
-        # Pagination
-        query = query.order_by(OperationHistory.created_at.desc())
-        paginated = query.paginate(page=page, per_page=per_page, error_out=False)
+        def archive_filter(op):
+            return all(check(op) for check in archive_filters)
+
+        archive_range = {
+            'since': start_datetime,
+            'until': end_datetime,
+            'where': archive_filter if archive_filters else None,
+        }
+
+        if request.args.get('export') == 'excel':
+            return _operations_history_export(query, archive_range)
+
+        # Pagination (issiq bo'laklar tugagach history_archive arxividan davom etadi)
+        if use_cursor:
+            # (created_at, id) bo'yicha keyset - chuqur sahifalar ham indeksdan boshlanadi
+            cursor = request.args.get('cursor')
+            count_mode = parse_count_mode(request.args.get('count'), default='none')
+            paginated = keyset_paginate(
+                query, (OperationHistory.created_at, OperationHistory.id),
+                cursor=cursor, per_page=per_page, count=count_mode)
+            paginated = history_archive.continue_keyset_page(
+                paginated, 'operations_history', decode_cursor(cursor, size=2), per_page,
+                count=count_mode, **archive_range)
+            page_items = paginated.items
+        else:
+            query = query.order_by(OperationHistory.created_at.desc(), OperationHistory.id.desc())
+            paginated = query.paginate(page=page, per_page=per_page, error_out=False)
+            page_items = list(paginated.items)
+            total = paginated.total
+            # Arxiv fayllari ochilmaydi - history_archives.row_count bo'yicha taxminiy son
+            archived_total, total_is_estimate = history_archive.archived_count(
+                'operations_history', estimate=True, **archive_range)
+            if archived_total:
+                total += archived_total
+                if len(page_items) < per_page:
+                    offset = max(0, (page - 1) * per_page - paginated.total)
+                    page_items += history_archive.archived_page(
+                        'operations_history', limit=per_page - len(page_items), offset=offset,
+                        **archive_range)
 
         # Ma'lumotlarni formatlash
         operations = []
-        for op in paginated.items:
+        for op in page_items:
             operations.append({
                 'id': op.id,
                 'operation_type': op.operation_type,
@@ -3857,19 +3853,65 @@ def api_operations_history():
                 'new_data': op.new_data
             })
 
+        if use_cursor:
+            return jsonify({
+                'success': True,
+                'operations': operations,
+                'pagination': paginated.meta(per_page)
+            })
+
         return jsonify({
             'success': True,
             'operations': operations,
-            'total': paginated.total,
-            'pages': paginated.pages,
+            'total': total,
+            'total_is_estimate': total_is_estimate,
+            'pages': (total + per_page - 1) // per_page,
             'current_page': page
         })
 
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Operations history API xatosi: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def _operations_history_export(query, archive_range):
+    """Amaliyotlar tarixini CSV (Excel) sifatida oqim bilan yuborish.
+
+    Oldindan sanalmaydi: issiq qatorlar yield_per bilan, keyin arxiv oyma-oy.
+    """
+    hot_rows = query.order_by(
+        OperationHistory.created_at.desc(), OperationHistory.id.desc()
+    ).yield_per(500)
+    columns = ('id', 'created_at', 'operation_type', 'username', 'location_name',
+               'table_name', 'record_id', 'amount', 'description')
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')  # Excel UTF-8 ni to'g'ri ochishi uchun BOM
+        writer.writerow(columns)
+        archived = history_archive.archived_rows('operations_history', **archive_range)
+        for count, op in enumerate(chain(hot_rows, archived), 1):
+            writer.writerow([
+                op.id,
+                op.created_at.strftime('%Y-%m-%d %H:%M:%S') if op.created_at else '',
+                op.operation_type, op.username or '', op.location_name or '',
+                op.table_name or '', op.record_id or '',
+                float(op.amount) if op.amount else '', op.description or '',
+            ])
+            if count % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    filename = f"amaliyotlar_tarixi_{get_tashkent_time().strftime('%Y%m%d_%H%M')}.csv"
+    return Response(stream_with_context(generate()), mimetype='text/csv; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
 @app.route('/api/operations-history/users')
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
 def api_operations_history_users():
@@ -3949,6 +3991,31 @@ def api_product_operations(product_id):
             or_(*conditions)
         ).order_by(OperationHistory.created_at.desc()).limit(200).all()
 
+        if len(ops) < 200 and product.created_at:
+            # Issiq bo'laklar tugadi - qolgani arxivdan (xuddi shu shartlar Python'da).
+            # Mahsulot yaratilgan oydan eski arxivlar ochilmaydi
+            warehouse_stock_set, store_stock_set = set(warehouse_stock_ids), set(store_stock_ids)
+            sale_id_set = set(sale_ids_old)
+            product_name = (product.name or '').lower()
+
+            def _archived_match(op):
+                new_data = op.new_data if isinstance(op.new_data, dict) else {}
+                if op.table_name == 'products' and op.record_id == product_id:
+                    return True
+                if str(new_data.get('product_id')) == str(product_id):
+                    return True
+                if op.table_name == 'warehouse_stock' and op.record_id in warehouse_stock_set:
+                    return True
+                if op.table_name in ('store_stocks', 'store_stock') and op.record_id in store_stock_set:
+                    return True
+                return (op.table_name == 'sales' and op.record_id in sale_id_set
+                        and op.operation_type in ('sale', 'return', 'sale_edit', 'payment_refund')
+                        and product_name in (op.description or '').lower())
+
+            ops += islice(history_archive.archived_rows('operations_history', since=product.created_at,
+                                                        where=_archived_match),
+                          200 - len(ops))
+
         op_labels = {
             'sale': '🛒 Sotish',
             'sale_edit': '✏️ Savdo tahrirlash',
@@ -4060,18 +4127,14 @@ def api_product_operations(product_id):
             # Joylashuv
             loc_name = ''
             if si.source_type == 'store' and si.source_id:
-                s_obj = Store.query.get(si.source_id)
-                loc_name = s_obj.name if s_obj else ''
+                loc_name = location_directory.resolve('store', si.source_id, '')
             elif si.source_type == 'warehouse' and si.source_id:
-                w_obj = Warehouse.query.get(si.source_id)
-                loc_name = w_obj.name if w_obj else ''
+                loc_name = location_directory.resolve('warehouse', si.source_id, '')
             elif sale.location_id and sale.location_type:
                 if sale.location_type == 'store':
-                    s_obj = Store.query.get(sale.location_id)
-                    loc_name = s_obj.name if s_obj else ''
+                    loc_name = location_directory.resolve('store', sale.location_id, '')
                 else:
-                    w_obj = Warehouse.query.get(sale.location_id)
-                    loc_name = w_obj.name if w_obj else ''
+                    loc_name = location_directory.resolve('warehouse', sale.location_id, '')
             # Sotuvchi
             seller = sale.seller
             si_user_role = None
@@ -4135,8 +4198,7 @@ def check_stock():
 
         # Sotuvchi uchun qo'shimcha sozlamani tekshirish (omborchi uchun emas)
         if current_user.role == 'sotuvchi':
-            setting = Settings.query.filter_by(key='stock_check_visible').first()
-            if setting and setting.value.lower() == 'false':
+            if not settings_service.get_bool('stock_check_visible', True):
                 abort(403)  # Sahifa yashirilgan
 
     return render_template('check_stock.html')
@@ -4144,6 +4206,7 @@ def check_stock():
 
 @app.route('/api/check_stock_locations')
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
+@etag_cached('locations', 'stock_check_sessions', 'users')
 def api_check_stock_locations():
     """Qoldiqni tekshirish uchun ruxsat etilgan joylashuvlarni qaytarish"""
     try:
@@ -4162,14 +4225,9 @@ def api_check_stock_locations():
         else:
             # Oddiy foydalanuvchilar faqat stock_check_locations dan ruxsat etilgan joylashuvlarni ko'radi
             # Agar stock_check_locations bo'sh bo'lsa, allowed_locations dan fallback
-            stock_check_locs = current_user.stock_check_locations or []
-            if not stock_check_locs:
-                stock_check_locs = current_user.allowed_locations or []
-            logger.debug(f"📍 User stock_check_locations: {stock_check_locs}")
-
             # Helper funksiya bilan ID'larni olish (eski va yangi formatlar uchun)
-            allowed_store_ids = extract_location_ids(stock_check_locs, 'store')
-            allowed_warehouse_ids = extract_location_ids(stock_check_locs, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'stock_check', 'store', fallback=True)
+            allowed_warehouse_ids = user_location_ids(current_user, 'stock_check', 'warehouse', fallback=True)
 
             logger.debug(f"🏪 Filtered store IDs: {allowed_store_ids}")
             logger.debug(f"🏭 Filtered warehouse IDs: {allowed_warehouse_ids}")
@@ -4216,6 +4274,7 @@ def api_check_stock_locations():
 
 @app.route('/api/check_stock/active_sessions')
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
+@etag_cached('stock_check_sessions', 'users')
 def api_check_stock_active_sessions():
     """Joriy (active) tekshiruv sessiyalarini olish - faqat ruxsat etilgan joylashuvlar"""
     try:
@@ -4233,11 +4292,8 @@ def api_check_stock_active_sessions():
         # Foydalanuvchi huquqlarini tekshirish
         if current_user.role != 'admin':
             # Oddiy foydalanuvchilar faqat ruxsat etilgan joylashuvlardagi sessiyalarni ko'radi
-            allowed_locations = current_user.allowed_locations or []
-            logger.debug(f"📍 User allowed_locations: {allowed_locations}")
-
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            allowed_warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
 
             logger.debug(f"🏪 Allowed store IDs: {allowed_store_ids}")
             logger.debug(f"🏭 Allowed warehouse IDs: {allowed_warehouse_ids}")
@@ -4318,11 +4374,8 @@ def api_check_stock_completed_sessions():
         # Foydalanuvchi huquqlarini tekshirish
         if current_user.role != 'admin':
             # Oddiy foydalanuvchilar faqat ruxsat etilgan joylashuvlardagi sessiyalarni ko'radi
-            allowed_locations = current_user.allowed_locations or []
-            logger.debug(f"📍 User allowed_locations: {allowed_locations}")
-
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            allowed_warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
 
             logger.debug(f"🏪 Allowed store IDs: {allowed_store_ids}")
             logger.debug(f"🏭 Allowed warehouse IDs: {allowed_warehouse_ids}")
@@ -4404,22 +4457,17 @@ def api_start_check_stock():
 
         # M4 fix: Foydalanuvchi bu joylashuvga ruxsati borligini tekshirish (admin uchun o'tkazib yuboriladi)
         if current_user.role != 'admin':
-            stock_check_locs = current_user.stock_check_locations or []
-            if not stock_check_locs:
-                stock_check_locs = current_user.allowed_locations or []
-            allowed_ids = extract_location_ids(stock_check_locs, location_type)
-            if allowed_ids is not None and int(location_id) not in allowed_ids:
+            principal = principal_cache.get_principal(current_user.id)
+            if not principal or not principal.can('stock_check', location_type, location_id, fallback=True):
                 logger.warning(f"⛔ User {current_user.username} tried to start stock check for unauthorized location: {location_type}#{location_id}")
                 return jsonify({'success': False, 'message': 'Bu joylashuv uchun ruxsatingiz yo\'q'}), 403
 
         # Joylashuv nomini olish
         location_name = ''
         if location_type == 'store':
-            store = Store.query.get(location_id)
-            location_name = store.name if store else f'Do\'kon #{location_id}'
+            location_name = location_directory.resolve('store', location_id, f'Do\'kon #{location_id}')
         else:
-            warehouse = Warehouse.query.get(location_id)
-            location_name = warehouse.name if warehouse else f'Ombor #{location_id}'
+            location_name = location_directory.resolve('warehouse', location_id, f'Ombor #{location_id}')
 
         # Sessiyani database'ga saqlash
         session = StockCheckSession(
@@ -4430,6 +4478,7 @@ def api_start_check_stock():
             status='active'
         )
         db.session.add(session)
+        change_feed.publish('stock_check')
         db.session.commit()
 
         return jsonify({
@@ -4509,29 +4558,27 @@ def api_check_stock_search():
         if not query or not location_type or not location_id:
             return jsonify({'success': False, 'message': 'Qidiruv parametrlari to\'liq emas'}), 400
 
-        # Mahsulotlarni qidirish (nom yoki barkod bo'yicha)
-        products = Product.query.filter(
-            db.or_(
-                Product.name.ilike(f'%{query}%'),
-                Product.barcode.ilike(f'%{query}%')
-            )
-        ).limit(50).all()
+        # Mahsulotlarni qidirish (nom yoki barkod bo'yicha, xotiradagi indeks)
+        search_ids = product_index.search(query, limit=50)
+        products = Product.query.filter(Product.id.in_(search_ids)).order_by(
+            rank_order(Product.id, search_ids)).all()
+
+        # Joylashuvdagi qoldiqlarni bitta so'rovda olish
+        if location_type == 'store':
+            stocks = StoreStock.query.filter(
+                StoreStock.product_id.in_(search_ids),
+                StoreStock.store_id == location_id
+            ).all()
+        else:
+            stocks = WarehouseStock.query.filter(
+                WarehouseStock.product_id.in_(search_ids),
+                WarehouseStock.warehouse_id == location_id
+            ).all()
+        stock_map = {stock.product_id: stock.quantity for stock in stocks}
 
         products_data = []
         for product in products:
-            # Joylashuvdagi qoldiqni olish
-            if location_type == 'store':
-                stock = StoreStock.query.filter_by(
-                    product_id=product.id,
-                    store_id=location_id
-                ).first()
-            else:
-                stock = WarehouseStock.query.filter_by(
-                    product_id=product.id,
-                    warehouse_id=location_id
-                ).first()
-
-            system_quantity = stock.quantity if stock else 0
+            system_quantity = stock_map.get(product.id, 0)
 
             products_data.append({
                 'id': product.id,
@@ -4639,6 +4686,7 @@ def api_check_stock_add_item():
                 existing.actual_quantity = actual_quantity
                 existing.difference = difference
                 existing.status = status
+                change_feed.publish('stock_check', session_id=session_id, items=True)
                 db.session.commit()
                 return jsonify({
                     'success': True,
@@ -4658,6 +4706,7 @@ def api_check_stock_add_item():
                 status=status
             )
             db.session.add(item)
+            change_feed.publish('stock_check', session_id=session_id, items=True)
             db.session.commit()
 
             # Session updated_at ni yangilash
@@ -4718,6 +4767,7 @@ def api_check_stock_add_item():
 
 @app.route('/api/check_stock/items/<int:session_id>')
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
+@etag_cached('stock_check_items', scope='session_id')
 def api_check_stock_items(session_id):
     """Session'dagi barcha tekshirilgan mahsulotlarni olish"""
     try:
@@ -4766,6 +4816,7 @@ def api_check_stock_remove_item():
         item = StockCheckItem.query.filter_by(session_id=session_id, product_id=product_id).first()
         if item:
             db.session.delete(item)
+            change_feed.publish('stock_check', session_id=session_id, items=True)
             db.session.commit()
 
         return jsonify({'success': True})
@@ -4799,11 +4850,9 @@ def api_check_stock_finish():
         # Sotuvchi esa o'sha joylashuvga stock_check ruxsati bo'lsa yakunlay oladi
         # (user_id emas, joylashuv ruxsatiga qarab — sessiyani boshqasi boshlagan bo'lsa ham)
         if current_user.role not in ('admin', 'kassir'):
-            stock_check_locs = current_user.stock_check_locations or []
-            if not stock_check_locs:
-                stock_check_locs = current_user.allowed_locations or []
-            allowed_ids = extract_location_ids(stock_check_locs, session_obj.location_type)
-            if allowed_ids is not None and int(session_obj.location_id) not in allowed_ids:
+            principal = principal_cache.get_principal(current_user.id)
+            if not principal or not principal.can(
+                    'stock_check', session_obj.location_type, session_obj.location_id, fallback=True):
                 logger.warning(
                     f"⛔ Unauthorized finish attempt: user={current_user.username} "
                     f"has no permission for {session_obj.location_type}#{session_obj.location_id}"
@@ -4831,6 +4880,7 @@ def api_check_stock_finish():
             WHERE id = :session_id AND status IN ('active', 'in_progress')
         """), {'session_id': session_id})
         db.session.flush()
+        badge_counters.invalidate()  # Xom SQL - ORM eventlari ishlamaydi
 
         if lock_result.rowcount == 0:
             # Sessiya completed yoki boshqa noma'lum holatda
@@ -4884,6 +4934,7 @@ def api_check_stock_finish():
         # Sessiyani yakunlash
         session_obj.status = 'completed'
         session_obj.completed_by_user_id = current_user.id
+        change_feed.publish('stock_check', session_id=session_id)
         db.session.commit()
 
         logger.info(f"✅ Check stock finished: session_id={session_id}, user={current_user.username}, "
@@ -4925,9 +4976,11 @@ def api_check_stock_delete_session():
 
         # Sessiya bilan bog'liq itemlarni o'chirish
         StockCheckItem.query.filter_by(session_id=session_id).delete()
+        response_cache.bump('stock_check_items', session_id)  # Bulk delete - ORM eventlari ishlamaydi
 
         # Sessiyani o'chirish
         db.session.delete(session)
+        change_feed.publish('stock_check', session_id=session_id)
         db.session.commit()
 
         logger.info(f"Check stock session deleted: session_id={session_id}, deleted_by={current_user.username}")
@@ -5068,10 +5121,10 @@ def api_create_store():
 
         new_store = Store(name=name, address=address, manager_name=manager_name, phone=phone)
         db.session.add(new_store)
-        db.session.commit()
+        db.session.flush()  # yangi id tarix yozuvi uchun
 
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='create_store',
                 table_name='stores',
                 record_id=new_store.id,
@@ -5086,15 +5139,11 @@ def api_create_store():
                 location_name=name,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
+        db.session.commit()
+
         return jsonify({'success': True, 'store_id': new_store.id})
 
     except Exception as e:
@@ -5121,11 +5170,11 @@ def add_store():
             )
 
             db.session.add(new_store)
-            db.session.commit()
+            db.session.flush()  # yangi id tarix yozuvi uchun
 
             # OperationHistory logini yozish
             try:
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='create_store',
                     table_name='stores',
                     record_id=new_store.id,
@@ -5140,11 +5189,11 @@ def add_store():
                     location_name=name,
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('stores'))
 
         except Exception as e:
@@ -5227,19 +5276,15 @@ def api_store_stock(store_id):
         # Base query
         query = StoreStock.query.filter_by(store_id=store_id)
 
-        # Search filter - qisman so'zlar bilan qidirish
-        if search:
-            query = query.join(Product)
-            # Qidiruv so'zlarini bo'laklarga ajratish
-            search_words = search.lower().split()
-            # Har bir so'z uchun filter qo'shish
-            for word in search_words:
-                if word:  # Bo'sh so'zlarni o'tkazib yuborish
-                    query = query.filter(Product.name.ilike(f'%{word}%'))
+        # Search filter - qisman so'zlar bilan qidirish (trigram indeks, o'xshashlik tartibi)
+        search_condition = product_search_condition(search, include_barcode=False)
+        if search_condition is not None:
+            query = query.join(Product).filter(search_condition).order_by(
+                product_similarity(search).desc(), StoreStock.id)
 
         # Category filter
         if category_id:
-            if not search:  # join faqat bir marta bo'lsin
+            if search_condition is None:  # join faqat bir marta bo'lsin
                 query = query.join(Product)
             query = query.filter(Product.category_id == category_id)
 
@@ -5362,16 +5407,10 @@ def api_store_stock_export(store_id):
 
         query = StoreStock.query.filter_by(store_id=store_id)
 
-        if search:
-            query = query.join(Product)
-            for word in search.lower().split():
-                if word:
-                    query = query.filter(
-                        db.or_(
-                            Product.name.ilike(f'%{word}%'),
-                            Product.barcode.ilike(f'%{word}%')
-                        )
-                    )
+        search_condition = product_search_condition(search)
+        if search_condition is not None:
+            query = query.join(Product).filter(search_condition).order_by(
+                product_similarity(search).desc(), StoreStock.id)
 
         stocks = query.all()
         stock_info = []
@@ -5435,10 +5474,9 @@ def api_edit_store(store_id):
         store.address = address
         store.manager_name = manager_name
         store.phone = phone
-        db.session.commit()
 
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_store',
                 table_name='stores',
                 record_id=store.id,
@@ -5453,15 +5491,11 @@ def api_edit_store(store_id):
                 location_name=store.name,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
+        db.session.commit()
+
         return jsonify({'success': True})
 
     except Exception as e:
@@ -5489,11 +5523,9 @@ def edit_store(store_id):
             store.manager_name = request.form['manager_name']
             store.phone = request.form.get('phone', '')
 
-            db.session.commit()
-
             # OperationHistory logini yozish
             try:
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='edit_store',
                     table_name='stores',
                     record_id=store.id,
@@ -5508,11 +5540,11 @@ def edit_store(store_id):
                     location_name=store.name,
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('stores'))
 
         except Exception as e:
@@ -5582,11 +5614,10 @@ def api_delete_store(store_id):
         store_name = store.name
         store_address = store.address
         db.session.delete(store)
-        db.session.commit()
 
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='delete_store',
                 table_name='stores',
                 record_id=store_id,
@@ -5601,11 +5632,11 @@ def api_delete_store(store_id):
                 location_name=store_name,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         message = f'Do\'kon "{store_name}" muvaffaqiyatli o\'chirildi'
         if sales_count > 0:
             message += f' (Savdo tarixi saqlanadi: {sales_count} ta savdo)'
@@ -5614,10 +5645,6 @@ def api_delete_store(store_id):
 
         logger.info(f" Store muvaffaqiyatli o'chirildi: {store_name}")
         logger.info(f" O'chirilgan stocklar: {deleted_stocks_count} ta, mahsulotlar: {deleted_products_count} ta")
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
         return jsonify({
             'success': True,
             'message': message,
@@ -5649,19 +5676,15 @@ def api_warehouse_stock(warehouse_id):
         # Base query
         query = WarehouseStock.query.filter_by(warehouse_id=warehouse_id)
 
-        # Search filter - qisman so'zlar bilan qidirish
-        if search:
-            query = query.join(Product)
-            # Qidiruv so'zlarini bo'laklarga ajratish
-            search_words = search.lower().split()
-            # Har bir so'z uchun filter qo'shish
-            for word in search_words:
-                if word:  # Bo'sh so'zlarni o'tkazib yuborish
-                    query = query.filter(Product.name.ilike(f'%{word}%'))
+        # Search filter - qisman so'zlar bilan qidirish (trigram indeks, o'xshashlik tartibi)
+        search_condition = product_search_condition(search, include_barcode=False)
+        if search_condition is not None:
+            query = query.join(Product).filter(search_condition).order_by(
+                product_similarity(search).desc(), WarehouseStock.id)
 
         # Category filter
         if category_id:
-            if not search:  # join faqat bir marta bo'lsin
+            if search_condition is None:  # join faqat bir marta bo'lsin
                 query = query.join(Product)
             query = query.filter(Product.category_id == category_id)
 
@@ -5792,9 +5815,9 @@ def api_create_warehouse():
             return jsonify({'success': False, 'error': 'Barcha majburiy maydonlarni to\'ldiring'}), 400
         new_warehouse = Warehouse(name=name, address=address, manager_name=manager_name, phone=phone)
         db.session.add(new_warehouse)
-        db.session.commit()
+        db.session.flush()  # yangi id tarix yozuvi uchun
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='create_warehouse', table_name='warehouses',
                 record_id=new_warehouse.id, user_id=session.get('user_id'),
                 username=session.get('username', 'Unknown'),
@@ -5804,14 +5827,10 @@ def api_create_warehouse():
                 ip_address=request.remote_addr,
                 location_id=new_warehouse.id, location_type='warehouse', location_name=name, amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f'OperationHistory log xatoligi: {log_error}')
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
+
+        db.session.commit()
         return jsonify({'success': True, 'warehouse_id': new_warehouse.id})
     except Exception as e:
         db.session.rollback()
@@ -5836,9 +5855,8 @@ def api_edit_warehouse(warehouse_id):
         warehouse.address = address
         warehouse.manager_name = manager_name
         warehouse.phone = phone
-        db.session.commit()
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_warehouse', table_name='warehouses',
                 record_id=warehouse.id, user_id=session.get('user_id'),
                 username=session.get('username', 'Unknown'),
@@ -5849,14 +5867,10 @@ def api_edit_warehouse(warehouse_id):
                 ip_address=request.remote_addr,
                 location_id=warehouse.id, location_type='warehouse', location_name=warehouse.name, amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f'OperationHistory log xatoligi: {log_error}')
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
+
+        db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -5881,11 +5895,11 @@ def add_warehouse():
             )
 
             db.session.add(new_warehouse)
-            db.session.commit()
+            db.session.flush()  # yangi id tarix yozuvi uchun
 
             # OperationHistory logini yozish
             try:
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='create_warehouse',
                     table_name='warehouses',
                     record_id=new_warehouse.id,
@@ -5900,11 +5914,11 @@ def add_warehouse():
                     location_name=name,
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('warehouses'))
 
         except Exception as e:
@@ -5933,11 +5947,9 @@ def edit_warehouse(warehouse_id):
             warehouse.manager_name = request.form['manager_name']
             warehouse.phone = request.form.get('phone', '')
 
-            db.session.commit()
-
             # OperationHistory logini yozish
             try:
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='edit_warehouse',
                     table_name='warehouses',
                     record_id=warehouse.id,
@@ -5952,11 +5964,11 @@ def edit_warehouse(warehouse_id):
                     location_name=warehouse.name,
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('warehouses'))
 
         except Exception as e:
@@ -5986,13 +5998,8 @@ def api_warehouses():
         else:
             # Oddiy foydalanuvchilar faqat allowed_locations dan ruxsat etilgan
             # omborlarni ko'radi (savdo uchun)
-            allowed_locations = current_user.allowed_locations or []
-            logger.debug(
-                f"🔍 User allowed locations for warehouses: {allowed_locations}")
-
             # Helper funksiya bilan warehouse ID'larni olish
-            allowed_warehouse_ids = extract_location_ids(
-                allowed_locations, 'warehouse')
+            allowed_warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
             logger.debug(f" Allowed warehouse IDs: {allowed_warehouse_ids}")
 
             if allowed_warehouse_ids:
@@ -6033,12 +6040,8 @@ def api_stores():
         else:
             # Oddiy foydalanuvchilar faqat allowed_locations dan ruxsat etilgan
             # do'konlarni ko'radi (savdo uchun)
-            allowed_locations = current_user.allowed_locations or []
-            logger.debug(f" User allowed locations for stores: {allowed_locations}")
-
             # Helper funksiya bilan store ID'larni olish
-            allowed_store_ids = extract_location_ids(
-                allowed_locations, 'store')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
             logger.debug(f" Allowed store IDs: {allowed_store_ids}")
 
             if allowed_store_ids:
@@ -6076,11 +6079,9 @@ def api_stores_warehouses():
             allowed_warehouse_ids = None
         else:
             # Oddiy foydalanuvchilar faqat allowed_locations dan ruxsat etilgan joylashuvlarni ko'radi
-            allowed_locations = current_user.allowed_locations or []
-
             # Helper funksiya bilan ID'larni olish (eski va yangi formatlar uchun)
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            allowed_warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
 
         # Do'konlarni qo'shish
         if allowed_store_ids is None:
@@ -6158,24 +6159,9 @@ def api_transfer_locations():
         else:
             # Oddiy foydalanuvchilar faqat transfer_locations dan ruxsat
             # etilgan joylashuvlarni ko'radi
-            transfer_locations = current_user.transfer_locations or []
-            logger.debug(f" User transfer_locations: {transfer_locations}")
-            logger.debug(f" Type of transfer_locations: {type(transfer_locations)}")
-
-            # Transfer_locations eski format (faqat ID'lar) bo'lgani uchun
-            # hamma ID'larni store va warehouse sifatida tekshiramiz
-            if transfer_locations and isinstance(transfer_locations[0], int):
-                # Eski format: barcha ID'larni har ikki tipga qo'llamiz
-                logger.debug(
-                    "🔍 Using old format for transfer_locations - checking all IDs as both stores and warehouses")
-                allowed_store_ids = transfer_locations
-                allowed_warehouse_ids = transfer_locations
-            else:
-                # Yangi format
-                allowed_store_ids = extract_location_ids(
-                    transfer_locations, 'store')
-                allowed_warehouse_ids = extract_location_ids(
-                    transfer_locations, 'warehouse')
+            # Eski format (faqat ID'lar) user_locations da turlarga ajratilgan
+            allowed_store_ids = user_location_ids(current_user, 'transfer', 'store')
+            allowed_warehouse_ids = user_location_ids(current_user, 'transfer', 'warehouse')
 
             logger.debug(f" Final store IDs for transfer: {allowed_store_ids}")
             logger.debug(
@@ -6345,7 +6331,9 @@ def api_delete_warehouse(warehouse_id):
                     for sale_item in sale_items:
                         sale_item.product_id = None
 
-                    # Mahsulot bilan bog'liq transferlarni o'chirish
+                    # Mahsulot bilan bog'liq transferlarni o'chirish (FK products/warehouses).
+                    # Arxivlangan transferlar o'zgarmas jsonl.gz nusxa - FK yo'q, ular
+                    # tarix sifatida qoladi (product_id/nomi bilan), o'chirish shart emas
                     product_transfers = Transfer.query.filter(
                         db.or_(
                             Transfer.product_id == product_id,
@@ -6374,11 +6362,10 @@ def api_delete_warehouse(warehouse_id):
 
         # Omborni o'chirish
         db.session.delete(warehouse)
-        db.session.commit()
 
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='delete_warehouse',
                 table_name='warehouses',
                 record_id=warehouse_id,
@@ -6393,11 +6380,11 @@ def api_delete_warehouse(warehouse_id):
                 location_name=warehouse_name,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         message = f'"{warehouse_name}" ombori muvaffaqiyatli o\'chirildi'
         if deleted_stocks_count > 0:
             message += f' ({deleted_stocks_count} ta stock ma\'lumoti o\'chirildi)'
@@ -6408,10 +6395,6 @@ def api_delete_warehouse(warehouse_id):
 
         logger.info(f" Warehouse muvaffaqiyatli o'chirildi: {warehouse_name}")
         logger.info(f" O'chirilgan stocklar: {deleted_stocks_count} ta, mahsulotlar: {deleted_products_count} ta, transferlar: {deleted_transfers_count} ta")
-        global _locations_cache, _all_locations_cache
-        _locations_cache = None
-        _all_locations_cache = None
-        _location_name_cache.clear()
         return jsonify({
             'success': True,
             'message': message,
@@ -6438,6 +6421,30 @@ def users():
         icon='👤')
 
 
+# Qarzlar ro'yxati - customer_debt_summary (debt_ledger.py) bo'yicha, faqat qarzdorlar
+_DEBTS_LIST_SQL = """
+    SELECT
+        c.id as customer_id,
+        c.name as customer_name,
+        c.phone as customer_phone,
+        c.address as customer_address,
+        d.debt_usd as total_debt,
+        0 as paid_amount,
+        d.debt_usd as remaining_debt,
+        d.debt_uzs as remaining_debt_uzs,
+        c.last_debt_payment_date as last_payment_date,
+        COALESCE(c.last_debt_payment_usd, 0) as last_payment_amount,
+        COALESCE(c.last_debt_payment_rate, 13000) as last_payment_rate,
+        COALESCE(c.last_debt_payment_uzs, 0) as last_payment_uzs,
+        d.nearest_due_date as nearest_due_date,
+        d.last_sale_date as last_sale_date
+    FROM customer_debt_summary d
+    JOIN customers c ON c.id = d.customer_id
+    WHERE d.debt_usd > 0 {where}
+    ORDER BY GREATEST(COALESCE(d.last_sale_date, '1970-01-01'), COALESCE(c.last_debt_payment_date, '1970-01-01')) DESC
+"""
+
+
 # Qarzlar API
 @app.route('/api/debts')
 @role_required('admin', 'kassir', 'sotuvchi')
@@ -6464,8 +6471,8 @@ def api_debts():
             allowed_locations = current_user.allowed_locations or []
             if allowed_locations:
                 # Store va warehouse ID'larni olish
-                store_ids = extract_location_ids(allowed_locations, 'store')
-                warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+                store_ids = user_location_ids(current_user, 'allowed', 'store')
+                warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
 
                 # Barcha ruxsat etilgan location ID'larni birlashtirish
                 allowed_location_ids = []
@@ -6488,29 +6495,7 @@ def api_debts():
             if location_type == 'warehouse':
                 return jsonify({'success': True, 'debts': [], 'exchange_rate': exchange_rate})
 
-            query = text("""
-                SELECT
-                    c.id as customer_id,
-                    c.name as customer_name,
-                    c.phone as customer_phone,
-                    c.address as customer_address,
-                    COALESCE(SUM(s.debt_usd), 0) as total_debt,
-                    0 as paid_amount,
-                    COALESCE(SUM(s.debt_usd), 0) as remaining_debt,
-                    COALESCE(SUM(s.debt_amount), 0) as remaining_debt_uzs,
-                    c.last_debt_payment_date as last_payment_date,
-                    COALESCE(c.last_debt_payment_usd, 0) as last_payment_amount,
-                    COALESCE(c.last_debt_payment_rate, 13000) as last_payment_rate,
-                    COALESCE(c.last_debt_payment_uzs, 0) as last_payment_uzs,
-                    MIN(s.payment_due_date) as nearest_due_date,
-                    MAX(s.sale_date) as last_sale_date
-                FROM customers c
-                LEFT JOIN sales s ON c.id = s.customer_id AND s.debt_usd > 0
-                WHERE c.store_id = :location_id
-                GROUP BY c.id, c.name, c.phone, c.address, c.last_debt_payment_date, c.last_debt_payment_usd, c.last_debt_payment_rate, c.last_debt_payment_uzs
-                HAVING COALESCE(SUM(s.debt_usd), 0) > 0
-                ORDER BY GREATEST(COALESCE(MAX(s.sale_date), '1970-01-01'), COALESCE(c.last_debt_payment_date, '1970-01-01')) DESC
-            """)
+            query = text(_DEBTS_LIST_SQL.format(where="AND c.store_id = :location_id"))
             result = db.session.execute(query, {'location_id': location_id})
         else:
             # Location tanlanmagan - barcha ruxsat etilgan locationlar
@@ -6521,63 +6506,19 @@ def api_debts():
                     return jsonify({'success': True, 'debts': [], 'exchange_rate': exchange_rate})
 
                 # Faqat store ID larini olish (customers.store_id faqat stores ga reference)
-                allowed_store_ids = extract_location_ids(
-                    current_user.allowed_locations or [], 'store')
+                allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
                 if not allowed_store_ids:
                     # Faqat warehouse larga ruxsat bor, customers warehouse ga tegishli emas
                     return jsonify({'success': True, 'debts': [], 'exchange_rate': exchange_rate})
 
                 logger.info(f"🔍 Debts query store_ids: {allowed_store_ids}")
 
-                from sqlalchemy import bindparam
-                query = text("""
-                    SELECT
-                        c.id as customer_id,
-                        c.name as customer_name,
-                        c.phone as customer_phone,
-                        c.address as customer_address,
-                        COALESCE(SUM(s.debt_usd), 0) as total_debt,
-                        0 as paid_amount,
-                        COALESCE(SUM(s.debt_usd), 0) as remaining_debt,
-                        COALESCE(SUM(s.debt_amount), 0) as remaining_debt_uzs,
-                        c.last_debt_payment_date as last_payment_date,
-                        COALESCE(c.last_debt_payment_usd, 0) as last_payment_amount,
-                        COALESCE(c.last_debt_payment_rate, 13000) as last_payment_rate,
-                        COALESCE(c.last_debt_payment_uzs, 0) as last_payment_uzs,
-                        MIN(s.payment_due_date) as nearest_due_date,
-                        MAX(s.sale_date) as last_sale_date
-                    FROM customers c
-                    LEFT JOIN sales s ON c.id = s.customer_id AND s.debt_usd > 0
-                    WHERE c.store_id IN :store_ids
-                    GROUP BY c.id, c.name, c.phone, c.address, c.last_debt_payment_date, c.last_debt_payment_usd, c.last_debt_payment_rate, c.last_debt_payment_uzs
-                    HAVING COALESCE(SUM(s.debt_usd), 0) > 0
-                    ORDER BY GREATEST(COALESCE(MAX(s.sale_date), '1970-01-01'), COALESCE(c.last_debt_payment_date, '1970-01-01')) DESC
-                """).bindparams(bindparam('store_ids', expanding=True))
-                result = db.session.execute(query, {'store_ids': allowed_store_ids})
+                query = user_locations.expand_location_ids(text(_DEBTS_LIST_SQL.format(
+                    where=f"AND c.store_id IN {user_locations.LOCATION_IDS_SQL}")))
+                result = db.session.execute(query, user_locations.location_params(allowed_store_ids))
             else:
                 # Admin - barcha qarzlar
-                query = text("""
-                    SELECT
-                        c.id as customer_id,
-                        c.name as customer_name,
-                        c.phone as customer_phone,
-                        c.address as customer_address,
-                        COALESCE(SUM(s.debt_usd), 0) as total_debt,
-                        0 as paid_amount,
-                        COALESCE(SUM(s.debt_usd), 0) as remaining_debt,
-                        COALESCE(SUM(s.debt_amount), 0) as remaining_debt_uzs,
-                        c.last_debt_payment_date as last_payment_date,
-                        COALESCE(c.last_debt_payment_usd, 0) as last_payment_amount,
-                        COALESCE(c.last_debt_payment_rate, 13000) as last_payment_rate,
-                        COALESCE(c.last_debt_payment_uzs, 0) as last_payment_uzs,
-                        MIN(s.payment_due_date) as nearest_due_date,
-                        MAX(s.sale_date) as last_sale_date
-                    FROM customers c
-                    LEFT JOIN sales s ON c.id = s.customer_id AND s.debt_usd > 0
-                    GROUP BY c.id, c.name, c.phone, c.address, c.last_debt_payment_date, c.last_debt_payment_usd, c.last_debt_payment_rate, c.last_debt_payment_uzs
-                    HAVING COALESCE(SUM(s.debt_usd), 0) > 0
-                    ORDER BY GREATEST(COALESCE(MAX(s.sale_date), '1970-01-01'), COALESCE(c.last_debt_payment_date, '1970-01-01')) DESC
-                """)
+                query = text(_DEBTS_LIST_SQL.format(where=""))
                 result = db.session.execute(query)
 
         debts = []
@@ -6710,8 +6651,8 @@ def api_paid_debts():
         if current_user.role != 'admin':
             allowed_locations = current_user.allowed_locations or []
             if allowed_locations:
-                store_ids = extract_location_ids(allowed_locations, 'store')
-                warehouse_ids = extract_location_ids(allowed_locations, 'warehouse')
+                store_ids = user_location_ids(current_user, 'allowed', 'store')
+                warehouse_ids = user_location_ids(current_user, 'allowed', 'warehouse')
                 allowed_location_ids = []
                 if store_ids:
                     allowed_location_ids.extend(store_ids)
@@ -6756,13 +6697,11 @@ def api_paid_debts():
                     return jsonify({'success': True, 'paid_debts': []})
 
                 # Faqat store ID larini olish
-                allowed_store_ids = extract_location_ids(
-                    current_user.allowed_locations or [], 'store')
+                allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
                 if not allowed_store_ids:
                     return jsonify({'success': True, 'paid_debts': []})
 
-                from sqlalchemy import bindparam
-                query = text("""
+                query = text(f"""
                 SELECT
                     s.id as sale_id,
                     MAX(dp.payment_date) as payment_date,
@@ -6777,13 +6716,14 @@ def api_paid_debts():
                 JOIN debt_payments dp ON dp.sale_id = s.id
                 WHERE s.payment_status = 'paid'
                     AND s.debt_usd = 0
-                    AND s.location_id IN :store_ids
+                    AND s.location_id IN {user_locations.LOCATION_IDS_SQL}
                     AND s.location_type = 'store'
                 GROUP BY s.id, c.name, s.created_at, s.total_amount, s.cash_usd, s.click_usd, s.terminal_usd
                 ORDER BY MAX(dp.payment_date) DESC
                 LIMIT 200
-            """).bindparams(bindparam('store_ids', expanding=True))
-                result = db.session.execute(query, {'store_ids': allowed_store_ids})
+            """)
+                query = user_locations.expand_location_ids(query)
+                result = db.session.execute(query, user_locations.location_params(allowed_store_ids))
             else:
                 # Admin - barcha qarzlarni ko'radi
                 query = text("""
@@ -6849,8 +6789,7 @@ def api_debt_payment_history():
         # Sotuvchi uchun ruxsat berilgan do'konlar bo'yicha filter
         allowed_store_ids = None
         if current_user.role == 'sotuvchi':
-            allowed_locations = current_user.allowed_locations or []
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
             if not allowed_store_ids:
                 return jsonify({'success': True, 'payments': []})
 
@@ -6860,8 +6799,8 @@ def api_debt_payment_history():
 
         if allowed_store_ids is not None:
             # Sotuvchi: faqat o'z do'konlaridagi mijozlarning to'lovlari
-            location_filter = "AND c.store_id = ANY(:store_ids)"
-            params['store_ids'] = allowed_store_ids
+            location_filter = f"AND c.store_id IN {user_locations.LOCATION_IDS_SQL}"
+            params.update(user_locations.location_params(allowed_store_ids))
         elif location_id:
             location_filter = "AND (s.location_id = :location_id OR dp.sale_id IS NULL)"
             params['location_id'] = location_id
@@ -6886,6 +6825,8 @@ def api_debt_payment_history():
             GROUP BY dp.customer_id, c.name, dp.payment_date, dp.received_by
             ORDER BY dp.payment_date DESC
         """)
+        if allowed_store_ids is not None:
+            sql = user_locations.expand_location_ids(sql)
 
         result = db.session.execute(sql, params)
 
@@ -7038,6 +6979,10 @@ def api_update_due_date():
 
             updated_count += updated
 
+        # Bulk UPDATE sessiya hodisalarini chetlab o'tadi - nearest_due_date ni qo'lda yangilash
+        if updated_count:
+            debt_ledger.refresh_customers(db.session.connection(), [customer_id])
+
         db.session.commit()
 
         return jsonify({
@@ -7416,13 +7361,8 @@ def api_debt_payment():
         # Mijozning oxirgi to'lov ma'lumotlarini yangilash
         customer = Customer.query.get(customer_id)
         if customer:
-            # Mijozning qolgan umumiy qarzini tekshirish
-            total_remaining_debt = db.session.query(
-                db.func.sum(Sale.debt_usd)
-            ).filter(
-                Sale.customer_id == customer_id,
-                Sale.debt_usd > 0
-            ).scalar() or 0
+            # Mijozning qolgan umumiy qarzini tekshirish - shu tranzaksiyadagi to'lovlar bilan (qulfsiz)
+            total_remaining_debt, _ = debt_ledger.current_totals(customer.id)
 
             # Avvalgi qarzni hisoblash (to'lovdan oldin)
             previous_total_debt = total_remaining_debt + (payment_usd - remaining_payment)
@@ -7487,11 +7427,35 @@ def api_debt_payment():
             )
             db.session.add(debt_payment)
 
-        db.session.commit()
+        # Telegram orqali mijozga xabar (navbatga - run_telegram_bot.py worker'i yuboradi).
+        # Outbox yozuvi to'lov bilan BIR commit'da saqlanadi.
+        if customer and customer.telegram_chat_id:
+            try:
+                notification_queue.enqueue(
+                    'payment_confirmation',
+                    chat_id=customer.telegram_chat_id,
+                    customer_name=customer.name,
+                    previous_debt_usd=float(previous_total_debt),
+                    previous_debt_uzs=0,  # Not used anymore
+                    paid_usd=float(payment_usd - remaining_payment),
+                    paid_uzs=0,  # Not used anymore
+                    remaining_usd=float(total_remaining_debt),
+                    remaining_uzs=0,  # Not used anymore
+                    customer_id=customer_id,
+                    cash_uzs=float(cash_usd),  # Actually USD
+                    click_uzs=float(click_usd),  # Actually USD
+                    terminal_uzs=float(terminal_usd)  # Actually USD
+                )
+                logger.info(f"📨 To'lov tasdiq xabari navbatga qo'yildi: {customer.name}")
+
+            except Exception as e:
+                logger.error(f"❌ Telegram xabarni navbatga qo'yishda xatolik: {e}")
+
+        db.session.flush()  # yangi id tarix yozuvi uchun
 
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='debt_payment',
                 table_name='debt_payments',
                 record_id=debt_payment.id,
@@ -7513,40 +7477,10 @@ def api_debt_payment():
                 location_name=None,
                 amount=float(payment_usd - remaining_payment)
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
-        # Telegram orqali mijozga xabar yuborish
-        if customer and customer.telegram_chat_id:
-            try:
-                from debt_scheduler import get_scheduler_instance
-
-                scheduler = get_scheduler_instance(app, db)
-
-                telegram_result = scheduler.bot.send_payment_confirmation_sync(
-                    chat_id=customer.telegram_chat_id,
-                    customer_name=customer.name,
-                    previous_debt_usd=float(previous_total_debt),
-                    previous_debt_uzs=0,  # Not used anymore
-                    paid_usd=float(payment_usd - remaining_payment),
-                    paid_uzs=0,  # Not used anymore
-                    remaining_usd=float(total_remaining_debt),
-                    remaining_uzs=0,  # Not used anymore
-                    customer_id=customer_id,
-                    cash_uzs=float(cash_usd),  # Actually USD
-                    click_uzs=float(click_usd),  # Actually USD
-                    terminal_uzs=float(terminal_usd)  # Actually USD
-                )
-
-                if telegram_result:
-                    logger.info(f"✅ To'lov tasdiq xabari yuborildi: {customer.name}")
-                else:
-                    logger.warning(f"⚠️ To'lov tasdiq xabari yuborilmadi: {customer.name}")
-
-            except Exception as e:
-                logger.error(f"❌ Telegram xabar yuborishda xatolik: {e}")
+        db.session.commit()
 
         # CustomerTimelineSnapshot: bitta umumiy payment yozuvi
         try:
@@ -7644,11 +7578,11 @@ def load_user_language():
             # Static fayllar uchun tekshirmash
             if request.endpoint and request.endpoint == 'static':
                 return
-            user_lang = Settings.query.filter_by(key=f'user_language_{user_id}').first()
-            if user_lang and user_lang.value in ('uz_latin', 'uz_cyrillic', 'ru'):
-                if session.get('language') != user_lang.value:
-                    logger.info(f"🌐 Til tuzatildi: session={session.get('language')} -> DB={user_lang.value} (user_id={user_id})")
-                    session['language'] = user_lang.value
+            user_lang = settings_service.user_language(user_id)
+            if user_lang:
+                if session.get('language') != user_lang:
+                    logger.info(f"🌐 Til tuzatildi: session={session.get('language')} -> DB={user_lang} (user_id={user_id})")
+                    session['language'] = user_lang
                     session.modified = True
     except Exception as e:
         logger.error(f"🌐 Til yuklashda xato: {e}")
@@ -7670,25 +7604,14 @@ def check_user_status():
                          or request.endpoint == 'api_login')):
                 return
 
-            # P3 fix: Har so'rovda DB ga bormaslik - 10 soniyalik cache
-            # (admin bloklasa, max 10 soniya ichida foydalanuvchi chiqariladi)
-            import time as _time
-            _now = _time.time()
-            _last_checked = session.get('_session_checked_at', 0)
-            if _now - _last_checked < 10:
-                return  # 10 soniya ichida allaqachon tekshirilgan
-            session['_session_checked_at'] = _now
+            # Har so'rovda DB ga bormaslik - principal_cache (worker xotirasi).
+            # Admin bloklasa yoki session bekor bo'lsa kesh commit'dan keyin tozalanadi
+            principal = principal_cache.get_principal(user_id)
 
             # Session ID mavjudligini tekshirish
             if session_id:
-                # Database'dan session holatini tekshirish
-                user_session = UserSession.query.filter_by(
-                    session_id=session_id,
-                    user_id=user_id
-                ).first()
-
                 # Agar session topilmasa yoki faol bo'lmasa - logout
-                if not user_session or not user_session.is_active:
+                if not principal or session_id not in principal.session_ids:
                     username = session.get('username', 'Unknown')
                     app.logger.info(f"🚫 Session bekor qilingan yoki faol emas: {username} (ID: {user_id})")
 
@@ -7705,9 +7628,7 @@ def check_user_status():
                         return redirect('/login?message=session_expired')
 
             # Foydalanuvchi faol ekanligini tekshirish
-            user = User.query.get(user_id)
-
-            if not user or not user.is_active:
+            if not principal or not principal.is_active:
                 # Foydalanuvchi faol emas - logout qilish
                 username = session.get('username', 'Unknown')
                 app.logger.info(f"🚫 Faol emas foydalanuvchi avtomatik logout: {username} (ID: {user_id})")
@@ -7826,11 +7747,8 @@ def edit_stock(warehouse_id, product_id):
             old_quantity = stock.quantity
             stock.quantity = new_quantity
 
-            db.session.commit()
-
             # OperationHistory logini yozish
             try:
-                warehouse = Warehouse.query.get(warehouse_id)
                 _wh_diff = float(new_quantity) - float(old_quantity)
                 if _wh_diff > 0:
                     _wh_qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}+{_wh_diff:.0f}={float(new_quantity):.0f})"
@@ -7838,7 +7756,7 @@ def edit_stock(warehouse_id, product_id):
                     _wh_qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}{_wh_diff:.0f}={float(new_quantity):.0f})"
                 else:
                     _wh_qty_str = f"{float(new_quantity):.0f} (o'zgarmadi)"
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='edit_stock',
                     table_name='warehouse_stock',
                     record_id=stock.id,
@@ -7850,14 +7768,14 @@ def edit_stock(warehouse_id, product_id):
                     ip_address=request.remote_addr,
                     location_id=warehouse_id,
                     location_type='warehouse',
-                    location_name=warehouse.name if warehouse else 'Unknown',
+                    location_name=location_directory.resolve('warehouse', warehouse_id, 'Unknown'),
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('warehouse_detail',
                                     warehouse_id=warehouse_id))
 
@@ -8048,11 +7966,8 @@ def edit_store_stock(store_id, product_id):
             old_quantity = stock.quantity
             stock.quantity = new_quantity
 
-            db.session.commit()
-
             # OperationHistory logini yozish
             try:
-                store = Store.query.get(store_id)
                 _st_diff = float(new_quantity) - float(old_quantity)
                 if _st_diff > 0:
                     _st_qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}+{_st_diff:.0f}={float(new_quantity):.0f})"
@@ -8060,7 +7975,7 @@ def edit_store_stock(store_id, product_id):
                     _st_qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}{_st_diff:.0f}={float(new_quantity):.0f})"
                 else:
                     _st_qty_str = f"{float(new_quantity):.0f} (o'zgarmadi)"
-                history = OperationHistory(
+                audit_log.record(
                     operation_type='edit_stock',
                     table_name='store_stock',
                     record_id=stock.id,
@@ -8072,14 +7987,14 @@ def edit_store_stock(store_id, product_id):
                     ip_address=request.remote_addr,
                     location_id=store_id,
                     location_type='store',
-                    location_name=store.name if store else 'Unknown',
+                    location_name=location_directory.resolve('store', store_id, 'Unknown'),
                     amount=None
                 )
-                db.session.add(history)
-                db.session.commit()
             except Exception as log_error:
                 logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+            db.session.commit()
+
             return redirect(url_for('store_detail',
                                     store_id=store_id))
 
@@ -8164,13 +8079,11 @@ def api_edit_store_stock(store_id, product_id):
         stock.product.sell_price = Decimal(str(new_sell_price))
         stock.product.category_id = int(new_category_id) if new_category_id else None
         stock.quantity = new_quantity
-        db.session.commit()
 
         try:
-            store = Store.query.get(store_id)
             _diff = float(new_quantity) - float(old_quantity)
             qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}{'+' if _diff >= 0 else ''}{_diff:.0f}={float(new_quantity):.0f})"
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_stock', table_name='store_stock',
                 record_id=stock.id, user_id=session.get('user_id'),
                 username=session.get('username', 'Unknown'),
@@ -8178,13 +8091,13 @@ def api_edit_store_stock(store_id, product_id):
                 old_data={'quantity': str(old_quantity), 'cost_price': str(cost_price), 'sell_price': str(sell_price)},
                 new_data={'quantity': str(new_quantity), 'cost_price': str(new_cost_price), 'sell_price': str(new_sell_price)},
                 ip_address=request.remote_addr, location_id=store_id,
-                location_type='store', location_name=store.name if store else 'Unknown', amount=None
+                location_type='store', location_name=location_directory.resolve('store', store_id, 'Unknown'), amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_err:
             logger.error(f"OperationHistory log xatoligi: {log_err}")
 
+        db.session.commit()
+
         return jsonify({'success': True, 'message': f'{new_product_name} muvaffaqiyatli yangilandi'})
 
     except Exception as e:
@@ -8240,13 +8153,11 @@ def api_edit_warehouse_stock(warehouse_id, product_id):
         stock.product.sell_price = Decimal(str(new_sell_price))
         stock.product.category_id = int(new_category_id) if new_category_id else None
         stock.quantity = new_quantity
-        db.session.commit()
 
         try:
-            warehouse = Warehouse.query.get(warehouse_id)
             _diff = float(new_quantity) - float(old_quantity)
             qty_str = f"{float(new_quantity):.0f} ({float(old_quantity):.0f}{'+' if _diff >= 0 else ''}{_diff:.0f}={float(new_quantity):.0f})"
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_stock', table_name='warehouse_stock',
                 record_id=stock.id, user_id=session.get('user_id'),
                 username=session.get('username', 'Unknown'),
@@ -8254,13 +8165,13 @@ def api_edit_warehouse_stock(warehouse_id, product_id):
                 old_data={'quantity': str(old_quantity), 'cost_price': str(cost_price), 'sell_price': str(sell_price)},
                 new_data={'quantity': str(new_quantity), 'cost_price': str(new_cost_price), 'sell_price': str(new_sell_price)},
                 ip_address=request.remote_addr, location_id=warehouse_id,
-                location_type='warehouse', location_name=warehouse.name if warehouse else 'Unknown', amount=None
+                location_type='warehouse', location_name=location_directory.resolve('warehouse', warehouse_id, 'Unknown'), amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_err:
             logger.error(f"OperationHistory log xatoligi: {log_err}")
 
+        db.session.commit()
+
         return jsonify({'success': True, 'message': f'{new_product_name} muvaffaqiyatli yangilandi'})
 
     except Exception as e:
@@ -8299,15 +8210,10 @@ def update_store_stock_quantity(store_id, product_id):
         # Stock miqdorini yangilash
         old_quantity = float(stock.quantity)
         stock.quantity = new_quantity
-        db.session.commit()
-
-        logger.debug(
-            f"✅ API: {stock.product.name} stock yangilandi: {old_quantity} -> {new_quantity}")
 
         # OperationHistory logini yozish
         try:
-            store = Store.query.get(store_id)
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_stock',
                 table_name='store_stock',
                 record_id=stock.id,
@@ -8319,14 +8225,17 @@ def update_store_stock_quantity(store_id, product_id):
                 ip_address=request.remote_addr,
                 location_id=store_id,
                 location_type='store',
-                location_name=store.name if store else 'Unknown',
+                location_name=location_directory.resolve('store', store_id, 'Unknown'),
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
+        logger.debug(
+            f"✅ API: {stock.product.name} stock yangilandi: {old_quantity} -> {new_quantity}")
+
         return jsonify({
             'success': True,
             'message': f'{stock.product.name} miqdori yangilandi',
@@ -8371,15 +8280,10 @@ def update_warehouse_stock_quantity(warehouse_id, product_id):
         # Stock miqdorini yangilash
         old_quantity = float(stock.quantity)
         stock.quantity = new_quantity
-        db.session.commit()
-
-        logger.debug(
-            f"✅ API: {stock.product.name} stock yangilandi: {old_quantity} -> {new_quantity}")
 
         # OperationHistory logini yozish
         try:
-            warehouse = Warehouse.query.get(warehouse_id)
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_stock',
                 table_name='warehouse_stock',
                 record_id=stock.id,
@@ -8391,14 +8295,17 @@ def update_warehouse_stock_quantity(warehouse_id, product_id):
                 ip_address=request.remote_addr,
                 location_id=warehouse_id,
                 location_type='warehouse',
-                location_name=warehouse.name if warehouse else 'Unknown',
+                location_name=location_directory.resolve('warehouse', warehouse_id, 'Unknown'),
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
+        logger.debug(
+            f"✅ API: {stock.product.name} stock yangilandi: {old_quantity} -> {new_quantity}")
+
         return jsonify({
             'success': True,
             'message': f'{stock.product.name} miqdori yangilandi',
@@ -8459,6 +8366,9 @@ def start_stock_check():
             'location_type': location_type,
             'location_name': location_name
         })
+        badge_counters.invalidate()
+        response_cache.bump('stock_check_sessions')
+        change_feed.publish('stock_check')
         db.session.commit()
 
         logger.info(f"✅ Stock check session boshlandi: {location_name} ({location_type} #{location_id}) - User: {session.get('user_id')}")
@@ -8536,6 +8446,7 @@ def update_stock_check_session():
             'location_id': location_id,
             'location_type': location_type
         })
+        response_cache.bump('stock_check_sessions')  # Xom SQL - ORM eventlari ishlamaydi
         db.session.commit()
 
         return jsonify({'success': True}), 200
@@ -8580,6 +8491,9 @@ def end_stock_check():
             'status': status,
             'completed_by_user_id': current_user_id
         })
+        badge_counters.invalidate()
+        response_cache.bump('stock_check_sessions')
+        change_feed.publish('stock_check')
         db.session.commit()
 
         logger.info(f"✅ Stock check session tugatildi: {location_type} #{location_id} - Status: {status}")
@@ -8609,6 +8523,9 @@ def cleanup_old_sessions():
             RETURNING id, location_name
         """))
         closed_sessions = result.fetchall()
+        badge_counters.invalidate()
+        response_cache.bump('stock_check_sessions')
+        change_feed.publish('stock_check')
         db.session.commit()
 
         count = len(closed_sessions)
@@ -8671,12 +8588,9 @@ def delete_store_stock(store_id, product_id):
         if deleted_completely:
             db.session.delete(product)
 
-        db.session.commit()
-
         # OperationHistory logini yozish
         try:
-            store = Store.query.get(store_id)
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='delete_stock',
                 table_name='store_stock',
                 record_id=stock.id,
@@ -8688,14 +8602,14 @@ def delete_store_stock(store_id, product_id):
                 ip_address=request.remote_addr,
                 location_id=store_id,
                 location_type='store',
-                location_name=store.name if store else 'Unknown',
+                location_name=location_directory.resolve('store', store_id, 'Unknown'),
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         if deleted_completely:
             return jsonify({
                 'success': True,
@@ -8764,12 +8678,9 @@ def delete_warehouse_stock(warehouse_id, product_id):
             # Keyin productni ham o'chirish
             db.session.delete(product)
 
-        db.session.commit()
-
         # OperationHistory logini yozish
         try:
-            warehouse = Warehouse.query.get(warehouse_id)
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='delete_stock',
                 table_name='warehouse_stock',
                 record_id=stock.id,
@@ -8781,14 +8692,14 @@ def delete_warehouse_stock(warehouse_id, product_id):
                 ip_address=request.remote_addr,
                 location_id=warehouse_id,
                 location_type='warehouse',
-                location_name=warehouse.name if warehouse else 'Unknown',
+                location_name=location_directory.resolve('warehouse', warehouse_id, 'Unknown'),
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         if deleted_completely:
             return jsonify({
                 'success': True,
@@ -9013,15 +8924,10 @@ def process_transfers():
                 return jsonify(
                     {'error': 'Transfer qilish huquqingiz yo\'q'}), 403
 
-            # Transfer joylashuvlari - agar bo'sh bo'lsa, allowed_locations dan foydalanish
-            transfer_locations = current_user.transfer_locations or []
-
-            # Agar transfer_locations bo'sh bo'lsa, allowed_locations dan foydalanish
-            if not transfer_locations:
-                transfer_locations = current_user.allowed_locations or []
-                logger.debug(f"ℹ️ Transfer locations bo'sh, allowed_locations ishlatilmoqda: {transfer_locations}")
-
-            logger.debug(f" User transfer locations: {transfer_locations}")
+            # Transfer joylashuvlari - bo'sh bo'lsa allowed_locations (principal_cache, int ID lar)
+            principal = principal_cache.get_principal(current_user.id)
+            transfer_locations = principal.location_set('transfer', fallback=True) if principal else frozenset()
+            logger.debug(f" User transfer locations: {sorted(transfer_locations)}")
 
             # Agar ikkala list ham bo'sh bo'lsa, faqat o'shanda xatolik qaytarish
             if not transfer_locations:
@@ -9039,207 +8945,76 @@ def process_transfers():
             logger.error(" No transfers provided")
             return jsonify({'error': 'Transfer ro\'yxati bo\'sh'}), 400
 
-        for transfer in transfers:
-            logger.info(f" Processing transfer: {transfer}")
-            product_id = transfer['product_id']
-            from_location = transfer['from_location']
-            to_location = transfer['to_location']
-            quantity = Decimal(str(transfer['quantity']))  # Decimal ishlatish (0.5 litr uchun)
-            logger.debug(
-                f"📦 Transfer: {product_id} from {from_location} to {to_location}, qty: {quantity}")
-
-            # Sotuvchi va omborchi uchun from_location ruxsatini tekshirish
-            if current_user.role in ('sotuvchi', 'omborchi'):
-                from_type, from_id = from_location.split('_')
-                from_location_id = int(from_id)
-
-                # Transfer_locations yoki allowed_locations dan foydalanish
-                transfer_locations = current_user.transfer_locations or []
-                if not transfer_locations:
-                    transfer_locations = current_user.allowed_locations or []
-
-                # Ruxsat borligini tekshirish (yangi va eski formatni qo'llab-quvvatlash)
-                if transfer_locations:
-                    has_permission = False
-
-                    for loc in transfer_locations:
-                        # Yangi format: {'id': 1, 'type': 'warehouse'}
-                        if isinstance(loc, dict):
-                            if loc.get('id') == from_location_id and loc.get('type') == from_type:
-                                has_permission = True
-                                logger.debug(f"✅ Transfer permission granted: {from_type}_{from_location_id} matches {loc}")
-                                break
-                        # Eski format: integer (faqat id, type noma'lum)
-                        elif isinstance(loc, int):
-                            if loc == from_location_id:
-                                has_permission = True
-                                logger.debug(f"✅ Transfer permission granted (old format): location ID {from_location_id}")
-                                break
-
-                    if not has_permission:
-                        logger.debug(
-                            f"❌ User {current_user.username} cannot transfer from location {from_location} (type: {from_type}, id: {from_location_id})")
-                        logger.debug(f"❌ Available transfer locations: {transfer_locations}")
-                        return jsonify({
-                            'error': f'Bu joylashuvdan ({from_location}) transfer qilish huquqingiz yo\'q. Ruxsat etilgan joylashuvlar: {transfer_locations}'
-                        }), 403
-
-            # Transfer tarixiga saqlash
-            from_type, from_id = from_location.split('_')
-            to_type, to_id = to_location.split('_')
-
-            transfer_record = Transfer(
-                product_id=product_id,
-                from_location_type=from_type,
-                from_location_id=int(from_id),
-                to_location_type=to_type,
-                to_location_id=int(to_id),
-                quantity=quantity,
-                user_name='Admin'
-            )
-            db.session.add(transfer_record)
-
-            # From location dan miqdorni kamaytirish
-            before_from_qty = 0
-            if from_location.startswith('store_'):
-                store_id = int(from_location.replace('store_', ''))
-                store_stock = StoreStock.query.filter_by(
-                    store_id=store_id,
-                    product_id=product_id
-                ).with_for_update().first()  # Row-level lock
-
-                if not store_stock or store_stock.quantity < quantity:
-                    return jsonify(
-                        {'error': 'Do\'konda yetarli miqdor yo\'q'}), 400
-
-                before_from_qty = float(store_stock.quantity)
-                store_stock.quantity -= quantity
-                # Miqdor 0 bo'lsa ham stockni saqlab qolamiz (o'chirmaymiz)
-
-            elif from_location.startswith('warehouse_'):
-                warehouse_id = int(from_location.replace('warehouse_', ''))
-                warehouse_stock = WarehouseStock.query.filter_by(
-                    warehouse_id=warehouse_id,
-                    product_id=product_id
-                ).with_for_update().first()  # Row-level lock
-
-                if not warehouse_stock or warehouse_stock.quantity < quantity:
-                    return jsonify(
-                        {'error': 'Omborda yetarli miqdor yo\'q'}), 400
-
-                before_from_qty = float(warehouse_stock.quantity)
-                warehouse_stock.quantity -= quantity
-                # Miqdor 0 bo'lsa ham stockni saqlab qolamiz (o'chirmaymiz)
-
-            # To location ga miqdorni qo'shish
-            before_to_qty = 0
-            if to_location.startswith('store_'):
-                store_id = int(to_location.replace('store_', ''))
-                store_stock = StoreStock.query.filter_by(
-                    store_id=store_id,
-                    product_id=product_id
-                ).first()
+        lines = transfer_engine.parse_lines(transfers)
 
-                if store_stock:
-                    before_to_qty = float(store_stock.quantity)
-                    store_stock.quantity += quantity
-                else:
-                    # Yangi stock yaratish (StoreStock da cost_price va
-                    # sell_price yo'q)
-                    before_to_qty = 0
-                    new_stock = StoreStock(
-                        store_id=store_id,
-                        product_id=product_id,
-                        quantity=quantity
-                    )
-                    db.session.add(new_stock)
+        # Sotuvchi va omborchi uchun from_location ruxsatini tekshirish
+        if current_user.role in ('sotuvchi', 'omborchi'):
+            for line in lines:
+                if not principal.can('transfer', line.from_type, line.from_id, fallback=True):
+                    from_location = f"{line.from_type}_{line.from_id}"
+                    allowed = ', '.join(f"{loc_type}_{loc_id}" for loc_type, loc_id in sorted(transfer_locations))
+                    logger.debug(
+                        f"❌ User {current_user.username} cannot transfer from location {from_location}")
+                    return jsonify({
+                        'error': f'Bu joylashuvdan ({from_location}) transfer qilish huquqingiz yo\'q. Ruxsat etilgan joylashuvlar: {allowed}'
+                    }), 403
 
-            elif to_location.startswith('warehouse_'):
-                warehouse_id = int(to_location.replace('warehouse_', ''))
-                warehouse_stock = WarehouseStock.query.filter_by(
-                    warehouse_id=warehouse_id,
-                    product_id=product_id
-                ).first()
+        # Stock qulflash, ayirish/qo'shish va Transfer yozuvlari - bir nechta so'rovda
+        transfer_engine.apply_transfers(lines)
 
-                if warehouse_stock:
-                    before_to_qty = float(warehouse_stock.quantity)
-                    warehouse_stock.quantity += quantity
-                else:
-                    # Yangi stock yaratish (WarehouseStock da cost_price va
-                    # sell_price yo'q)
-                    before_to_qty = 0
-                    new_stock = WarehouseStock(
-                        warehouse_id=warehouse_id,
-                        product_id=product_id,
-                        quantity=quantity
-                    )
-                    db.session.add(new_stock)
+        # OperationHistory ga transfer yozish (bitta flush'da to'plab yuboriladi)
+        for line in lines:
+            from_location_name = location_directory.resolve(line.from_type, line.from_id, '')
+            to_location_name = location_directory.resolve(line.to_type, line.to_id, '')
 
-            # OperationHistory ga transfer yozish
-            product = Product.query.get(product_id)
-            from_location_name = ''
-            to_location_name = ''
-
-            if from_type == 'store':
-                from_store = Store.query.get(int(from_id))
-                if from_store:
-                    from_location_name = from_store.name
-            elif from_type == 'warehouse':
-                from_warehouse = Warehouse.query.get(int(from_id))
-                if from_warehouse:
-                    from_location_name = from_warehouse.name
-
-            if to_type == 'store':
-                to_store = Store.query.get(int(to_id))
-                if to_store:
-                    to_location_name = to_store.name
-            elif to_type == 'warehouse':
-                to_warehouse = Warehouse.query.get(int(to_id))
-                if to_warehouse:
-                    to_location_name = to_warehouse.name
-
-            _qty = float(quantity)
+            _qty = float(line.quantity)
+            before_from_qty = float(line.from_before)
+            before_to_qty = float(line.to_before)
             _from_after = before_from_qty - _qty
             _to_after = before_to_qty + _qty
             transfer_desc = (
-                f"Transfer: {product.name} - "
+                f"Transfer: {line.product_name} - "
                 f"{from_location_name} {before_from_qty:.0f}-{_qty:.0f}={_from_after:.0f}"
                 f" → {to_location_name} {before_to_qty:.0f}+{_qty:.0f}={_to_after:.0f}"
             )
-            operation = OperationHistory(
+            audit_log.record(
                 operation_type='transfer',
                 table_name='transfers',
-                record_id=transfer_record.id,
+                record_id=line.transfer_id,
                 user_id=session.get('user_id'),
                 username=session.get('username') or 'Admin',
                 description=transfer_desc,
                 old_data={
                     'from_location': from_location_name,
-                    'from_location_type': from_type,
+                    'from_location_type': line.from_type,
                     'from_qty_before': before_from_qty,
                     'to_qty_before': before_to_qty
                 },
                 new_data={
-                    'product_id': product_id,
-                    'product_name': product.name,
-                    'quantity': float(quantity),
+                    'product_id': line.product_id,
+                    'product_name': line.product_name,
+                    'quantity': _qty,
                     'to_location': to_location_name,
-                    'to_location_type': to_type,
-                    'from_qty_after': before_from_qty - float(quantity),
-                    'to_qty_after': before_to_qty + float(quantity)
+                    'to_location_type': line.to_type,
+                    'from_qty_after': _from_after,
+                    'to_qty_after': _to_after
                 },
                 ip_address=request.remote_addr,
-                location_id=int(to_id),
-                location_type=to_type,
+                location_id=line.to_id,
+                location_type=line.to_type,
                 location_name=to_location_name,
                 amount=None
             )
-            db.session.add(operation)
 
+        change_feed.publish('transfers')
         db.session.commit()
         return jsonify(
             {'message': 'Transferlar muvaffaqiyatli amalga oshirildi'})
 
+    except transfer_engine.TransferError as e:
+        db.session.rollback()
+        logger.debug(f"❌ Transfer rad etildi: {e}")
+        return jsonify({'error': str(e)}), e.status
     except TimeoutError:
         db.session.rollback()
         logger.error("⏱️ Database timeout in transfer")
@@ -9289,13 +9064,11 @@ def get_transfer_history():
     try:
         from datetime import datetime, timedelta
 
-        # Avval eski ma'lumotlarni tozalash
-        cleanup_old_transfers()
-
         # 40 kun oldini hisoblash
         forty_days_ago = get_tashkent_time() - timedelta(days=40)
 
         # Faqat so'nggi 40 kun ichidagi transferlarni olish
+        # (eski oylar history_archive arxivida - tozalash scheduler'da, so'rovda emas)
         transfers = Transfer.query.filter(
             Transfer.created_at >= forty_days_ago
         ).order_by(Transfer.created_at.desc()).all()
@@ -9304,63 +9077,34 @@ def get_transfer_history():
         for transfer in transfers:
             history_data.append(transfer.to_dict())
 
+        # Issiq muddat 40 kundan qisqa bo'lsa - qolgani arxivdan
+        archived = list(history_archive.archived_rows('transfers', since=forty_days_ago))
+        if archived:
+            product_names = dict(db.session.query(Product.id, Product.name).filter(
+                Product.id.in_({t.product_id for t in archived})).all())
+            for transfer in archived:
+                item = transfer.to_dict()
+                item['product_name'] = product_names.get(transfer.product_id, item['product_name'])
+                history_data.append(item)
+
         return jsonify(history_data)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-def cleanup_old_transfers():
-    """40 kundan eski transferlarni o'chirish"""
-    try:
-        # 40 kun oldini hisoblash
-        forty_days_ago = get_tashkent_time() - timedelta(days=40)
-
-        # Eski transferlarni topish
-        old_transfers = Transfer.query.filter(
-            Transfer.created_at < forty_days_ago
-        ).all()
-
-        # Eski transferlarni o'chirish
-        for transfer in old_transfers:
-            db.session.delete(transfer)
-
-        # O'zgarishlarni saqlash
-        db.session.commit()
-
-        logger.info(f"Tozalandi: {len(old_transfers)} ta eski transfer")
-
-    except Exception as e:
-        logger.error(f"Transfer tozalashda xatolik: {str(e)}")
-        db.session.rollback()
-
-
 @app.route('/api/transfer/cleanup', methods=['POST'])
 @role_required('admin')
 def manual_cleanup_transfers():
-    """Qo'lda eski transferlarni tozalash"""
+    """Qo'lda eski transferlarni arxivlash (issiq muddatdan eski oylar)"""
     try:
-        # 40 kun oldini hisoblash
-        forty_days_ago = get_tashkent_time() - timedelta(days=40)
-
-        # Eski transferlarni topish
-        old_transfers = Transfer.query.filter(
-            Transfer.created_at < forty_days_ago
-        ).all()
-
-        deleted_count = len(old_transfers)
-
-        # Eski transferlarni o'chirish
-        for transfer in old_transfers:
-            db.session.delete(transfer)
-
-        # O'zgarishlarni saqlash
-        db.session.commit()
+        archived_count = history_archive.archive_expired('transfers')['transfers']
 
         return jsonify({
             'success': True,
-            'message': f'{deleted_count} ta eski transfer o\'chirildi',
-            'deleted_count': deleted_count
+            'message': f'{archived_count} ta eski transfer arxivlandi',
+            'archived_count': archived_count,
+            'deleted_count': archived_count
         })
 
     except Exception as e:
@@ -9368,28 +9112,89 @@ def manual_cleanup_transfers():
         return jsonify({'error': str(e)}), 500
 
 
+def _transfer_history_page(transfers, limit, fetch_size):
+    """Kursor rejimi uchun transferlarni to'liq daqiqalar bo'yicha kesish.
+
+    Guruhlash daqiqa aniqligida bo'lgani uchun sahifa chegarasi daqiqa boshida
+    qo'yiladi: keyingi sahifa `created_at < kursor` bilan boshlanadi.
+    Bitta daqiqa fetch_size dan katta bo'lsa - (created_at, id) kursori qaytariladi,
+    daqiqaning qolgan transferlari keyingi sahifada davom etadi.
+    Qaytaradi: (transferlar, next_cursor)
+    """
+    def minute_of(transfer):
+        return transfer.created_at.replace(second=0, microsecond=0)
+
+    # Vaqti yo'q transferlar birinchi sahifada qoladi (kursor ularni o'tkazib yuboradi)
+    dated = [t for t in transfers if t.created_at]
+    if not dated:
+        return transfers, None
+
+    # Daqiqa + joylashuv + foydalanuvchi bo'yicha guruhlar soni limitdan oshguncha yig'ish
+    kept = []
+    groups = set()
+    for transfer in transfers:
+        if transfer.created_at:
+            minute = minute_of(transfer)
+            if len(groups) >= limit and kept and kept[-1].created_at and minute != minute_of(kept[-1]):
+                return kept, encode_cursor([minute_of(kept[-1])])
+            groups.add((minute, transfer.from_location_type, transfer.from_location_id,
+                        transfer.to_location_type, transfer.to_location_id, transfer.user_name or 'N/A'))
+        kept.append(transfer)
+
+    if len(transfers) < fetch_size:
+        return kept, None
+
+    # Oxirgi daqiqa to'liq o'qilmagan bo'lishi mumkin - uni keyingi sahifaga qoldirish
+    last_minute = minute_of(dated[-1])
+    complete = [t for t in kept if not t.created_at or minute_of(t) != last_minute]
+    if complete:
+        return complete, encode_cursor([last_minute + timedelta(minutes=1)])
+    # Bitta daqiqada fetch_size dan ko'p transfer - oxirgi qatordan (created_at, id) bo'yicha davom etish
+    last = dated[-1]
+    return kept, encode_cursor([last.created_at, last.id])
+
+
 @app.route('/api/transfer-history')
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
 def get_transfer_history_formatted():
     """Transfer tarixini formatlangan ko'rinishda qaytarish"""
     try:
         limit = request.args.get('limit', 50, type=int)
-        limit = min(limit, 1000)  # Maximum 1000
+        limit = max(1, min(limit, 1000))  # Maximum 1000
+
+        # Kursor rejimi (?cursor=): sahifa chegarasi daqiqa bo'yicha - guruh ikki sahifaga bo'linmaydi.
+        # Kursor [created_at] yoki (juda katta daqiqa uchun) [created_at, id]
+        use_cursor = 'cursor' in request.args
+        cursor_values = decode_cursor(request.args.get('cursor')) if use_cursor else None
+        if cursor_values is not None and len(cursor_values) not in (1, 2):
+            raise InvalidCursor('Kursor kalitlari soni mos emas')
 
         # So'nggi transferlarni olish
-        transfers = Transfer.query.order_by(
-            Transfer.created_at.desc()
-        ).limit(limit * 5).all()  # Guruhlash uchun ko'proq olish
-
-        # M7 fix: N+1 oldini olish - barcha store/warehouse/product IDlarini bir marta yuklaymiz
-        warehouse_ids = {t.from_location_id for t in transfers if t.from_location_type == 'warehouse'} | \
-                        {t.to_location_id for t in transfers if t.to_location_type == 'warehouse'}
-        store_ids = {t.from_location_id for t in transfers if t.from_location_type == 'store'} | \
-                    {t.to_location_id for t in transfers if t.to_location_type == 'store'}
+        transfers_query = Transfer.query
+        if cursor_values and len(cursor_values) == 2:
+            transfers_query = transfers_query.filter(
+                tuple_(Transfer.created_at, Transfer.id) < tuple_(*cursor_values))
+        elif cursor_values:
+            transfers_query = transfers_query.filter(Transfer.created_at < cursor_values[0])
+        fetch_size = limit * 5  # Guruhlash uchun ko'proq olish
+        transfers = transfers_query.order_by(
+            Transfer.created_at.desc(), Transfer.id.desc()
+        ).limit(fetch_size).all()
+        if len(transfers) < fetch_size:
+            # Issiq bo'laklar tugadi - eski oylar arxivdan
+            before = tuple(cursor_values) if cursor_values else None
+            transfers += history_archive.archived_page(
+                'transfers', before=before, limit=fetch_size - len(transfers))
+
+        next_cursor = None
+        if use_cursor:
+            transfers, next_cursor = _transfer_history_page(transfers, limit, fetch_size)
+
+        # M7 fix: N+1 oldini olish - mahsulot IDlarini bir marta yuklaymiz, joylashuvlar location_directory dan
         product_ids = {t.product_id for t in transfers}
 
-        warehouses_map = {w.id: w.name for w in Warehouse.query.filter(Warehouse.id.in_(warehouse_ids)).all()} if warehouse_ids else {}
-        stores_map = {s.id: s.name for s in Store.query.filter(Store.id.in_(store_ids)).all()} if store_ids else {}
+        warehouses_map = {loc.id: loc.name for loc in location_directory.all_locations('warehouse')}
+        stores_map = {loc.id: loc.name for loc in location_directory.all_locations('store')}
         products_map = {p.id: p.name for p in Product.query.filter(Product.id.in_(product_ids)).all()} if product_ids else {}
 
         # Transferlarni guruhlash - bir xil vaqt, from_location, to_location, user
@@ -9449,14 +9254,21 @@ def get_transfer_history_formatted():
         # Vaqt bo'yicha saralash (eng yangi birinchi)
         history_list.sort(key=lambda x: x['created_at'] if x['created_at'] else '', reverse=True)
 
-        # Limit qo'llash
-        history_list = history_list[:limit]
+        # Limit qo'llash (kursor rejimida sahifa allaqachon daqiqa chegarasida kesilgan)
+        if not use_cursor:
+            history_list = history_list[:limit]
 
-        return jsonify({
+        response = {
             'transfers': history_list,
             'count': len(history_list)
-        })
+        }
+        if use_cursor:
+            response['next_cursor'] = next_cursor
+            response['has_next'] = next_cursor is not None
+        return jsonify(response)
 
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Transfer tarixini olishda xatolik: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -9522,6 +9334,7 @@ def manage_pending_transfer(pending_id=None):
             )
 
             db.session.add(pending)
+            change_feed.publish('transfers')
             db.session.commit()
 
             return jsonify({
@@ -9559,6 +9372,7 @@ def manage_pending_transfer(pending_id=None):
             pending.to_location_id = data['to_location_id']
             pending.items = data['items']
 
+            change_feed.publish('transfers', pending_id=pending.id)
             db.session.commit()
 
             return jsonify({
@@ -9591,6 +9405,7 @@ def manage_pending_transfer(pending_id=None):
                             continue
                         db.session.delete(p)
 
+            change_feed.publish('transfers')
             db.session.commit()
 
             return jsonify({
@@ -9626,6 +9441,7 @@ def send_transfer_to_warehouse(pending_id):
         from datetime import datetime
         pending.status = 'sent'
         pending.sent_at = datetime.utcnow()
+        change_feed.publish('transfers', pending_id=pending.id)
         db.session.commit()
 
         return jsonify({'success': True, 'message': 'Transfer omborchiga yuborildi', 'status': 'sent'})
@@ -9659,6 +9475,7 @@ def warehouse_confirm_transfer(pending_id):
         pending.status = 'dispatched'
         pending.dispatched_at = datetime.utcnow()
         pending.dispatched_by_id = current_user.id
+        change_feed.publish('transfers', pending_id=pending.id)
         db.session.commit()
 
         return jsonify({'success': True, 'message': 'Transfer tasdiqlandi, sotuvchiga yuborildi', 'status': 'dispatched'})
@@ -9689,6 +9506,7 @@ def start_picking_transfer(pending_id):
             return jsonify({'error': 'Faqat yuborilgan transferni yig\'ish boshlash mumkin'}), 400
 
         pending.status = 'picking'
+        change_feed.publish('transfers', pending_id=pending.id)
         db.session.commit()
 
         return jsonify({'success': True, 'message': 'Yig\'ish boshlandi', 'status': 'picking'})
@@ -9750,12 +9568,9 @@ def receiver_confirm_transfer(pending_id):
         to_type = pending.to_location_type
         to_id = pending.to_location_id
 
-        for item in pending.items:
-            product_id = item.get('id') or item.get('product_id')
-            if not product_id:
-                continue
-            product_id = int(product_id)
-            sent_qty = Decimal(str(item.get('quantity', 0)))
+        lines = []
+        for product_id, sent_qty in pending_transfer_lines(pending.id):
+            sent_qty = Decimal(str(sent_qty or 0))
             # Agar received_items berilgan bo'lsa - undan ol, aks holda to'liq qabul
             if received_items_input:
                 received_qty = received_map.get(product_id, Decimal('0'))
@@ -9775,45 +9590,12 @@ def receiver_confirm_transfer(pending_id):
             if received_qty <= 0:
                 continue
 
-            # FROM (omborchi joyi) - received_qty kamaytirish
-            if from_type == 'store':
-                stock = StoreStock.query.filter_by(store_id=from_id, product_id=product_id).with_for_update().first()
-                if not stock or stock.quantity < received_qty:
-                    return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{product_id}'}), 400
-                stock.quantity -= received_qty
-            elif from_type == 'warehouse':
-                stock = WarehouseStock.query.filter_by(warehouse_id=from_id, product_id=product_id).with_for_update().first()
-                if not stock or stock.quantity < received_qty:
-                    return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{product_id}'}), 400
-                stock.quantity -= received_qty
-
-            # TO (sotuvchi joyi) - received_qty qo'shish
-            if to_type == 'store':
-                to_stock = StoreStock.query.filter_by(store_id=to_id, product_id=product_id).with_for_update().first()
-                if to_stock:
-                    to_stock.quantity += received_qty
-                else:
-                    to_stock = StoreStock(store_id=to_id, product_id=product_id, quantity=received_qty)
-                    db.session.add(to_stock)
-            elif to_type == 'warehouse':
-                to_stock = WarehouseStock.query.filter_by(warehouse_id=to_id, product_id=product_id).first()
-                if to_stock:
-                    to_stock.quantity += received_qty
-                else:
-                    to_stock = WarehouseStock(warehouse_id=to_id, product_id=product_id, quantity=received_qty)
-                    db.session.add(to_stock)
+            # FROM (omborchi joyi) -> TO (sotuvchi joyi), received_qty bilan
+            lines.append(transfer_engine.TransferLine(
+                product_id, from_type, from_id, to_type, to_id, received_qty))
 
-            # Transfer tarixi (received_qty bilan)
-            transfer_record = Transfer(
-                product_id=product_id,
-                from_location_type=from_type,
-                from_location_id=from_id,
-                to_location_type=to_type,
-                to_location_id=to_id,
-                quantity=received_qty,
-                user_name=current_user.username
-            )
-            db.session.add(transfer_record)
+        # Stock ko'chirish va Transfer tarixi - barcha qatorlar bir nechta so'rovda
+        transfer_engine.apply_transfers(lines, user_name=current_user.username)
 
         # Pending'ni completed deb belgilash va o'chirish (eskicha)
         pending.status = 'completed'
@@ -9823,6 +9605,7 @@ def receiver_confirm_transfer(pending_id):
         pending.receiver_confirmed_at = datetime.utcnow()
 
         db.session.delete(pending)
+        change_feed.publish('transfers', pending_id=pending_id)
         db.session.commit()
 
         return jsonify({
@@ -9831,6 +9614,11 @@ def receiver_confirm_transfer(pending_id):
             'received_items': final_received,
         })
 
+    except transfer_engine.TransferError as e:
+        db.session.rollback()
+        if e.line is None:
+            return jsonify({'error': str(e)}), e.status
+        return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{e.line.product_id}'}), 400
     except Exception as e:
         db.session.rollback()
         logger.error(f"Qabul tasdiqlashda xatolik: {str(e)}")
@@ -9857,6 +9645,7 @@ def reject_transfer(pending_id):
             return jsonify({'error': 'Faqat yo\'ldagi (dispatched) transferni rad etish mumkin'}), 400
 
         pending.status = 'sent'
+        change_feed.publish('transfers', pending_id=pending.id)
         db.session.commit()
 
         return jsonify({'success': True, 'message': 'Transfer rad etildi, omborchiga qaytarildi'})
@@ -9885,22 +9674,12 @@ def direct_complete_transfer(pending_id):
 
         # Ikki tomonlama ruxsat tekshirish (faqat admin emas — roldan qat\'i nazar)
         if current_user.role not in ('admin', 'kassir'):
-            transfer_locs = current_user.transfer_locations or []
-            allowed_locs = current_user.allowed_locations or []
-            all_locs = transfer_locs + allowed_locs
+            principal = principal_cache.get_principal(current_user.id)
 
             def _has_loc(loc_type, loc_id):
-                for loc in all_locs:
-                    if isinstance(loc, dict):
-                        try:
-                            lid = int(loc.get('id', -1))
-                        except (TypeError, ValueError):
-                            lid = -1
-                        if lid == loc_id and loc.get('type') == loc_type:
-                            return True
-                    elif isinstance(loc, int) and loc == loc_id:
-                        return True
-                return False
+                # transfer_locations yoki allowed_locations - (tur, id) juftligi bo'yicha
+                return (principal.can('transfer', loc_type, loc_id) or
+                        principal.can('allowed', loc_type, loc_id))
 
             if not (_has_loc(pending.from_location_type, pending.from_location_id) and
                     _has_loc(pending.to_location_type, pending.to_location_id)):
@@ -9915,57 +9694,28 @@ def direct_complete_transfer(pending_id):
         to_type = pending.to_location_type
         to_id = pending.to_location_id
 
-        for item in pending.items:
-            product_id = item.get('id') or item.get('product_id')
-            if not product_id:
-                continue
-            product_id = int(product_id)
-            qty = Decimal(str(item.get('quantity', 0)))
+        lines = []
+        for product_id, qty in pending_transfer_lines(pending.id):
+            qty = Decimal(str(qty or 0))
             if qty <= 0:
                 continue
+            lines.append(transfer_engine.TransferLine(
+                product_id, from_type, from_id, to_type, to_id, qty))
 
-            # FROM stokdan kamaytirish
-            if from_type == 'store':
-                stock = StoreStock.query.filter_by(store_id=from_id, product_id=product_id).with_for_update().first()
-                if not stock or stock.quantity < qty:
-                    return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{product_id}'}), 400
-                stock.quantity -= qty
-            elif from_type == 'warehouse':
-                stock = WarehouseStock.query.filter_by(warehouse_id=from_id, product_id=product_id).with_for_update().first()
-                if not stock or stock.quantity < qty:
-                    return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{product_id}'}), 400
-                stock.quantity -= qty
-
-            # TO stokga qo'shish
-            if to_type == 'store':
-                to_stock = StoreStock.query.filter_by(store_id=to_id, product_id=product_id).with_for_update().first()
-                if to_stock:
-                    to_stock.quantity += qty
-                else:
-                    db.session.add(StoreStock(store_id=to_id, product_id=product_id, quantity=qty))
-            elif to_type == 'warehouse':
-                to_stock = WarehouseStock.query.filter_by(warehouse_id=to_id, product_id=product_id).first()
-                if to_stock:
-                    to_stock.quantity += qty
-                else:
-                    db.session.add(WarehouseStock(warehouse_id=to_id, product_id=product_id, quantity=qty))
-
-            # Transfer tarixi
-            db.session.add(Transfer(
-                product_id=product_id,
-                from_location_type=from_type,
-                from_location_id=from_id,
-                to_location_type=to_type,
-                to_location_id=to_id,
-                quantity=qty,
-                user_name=current_user.username
-            ))
+        # Stock ko'chirish va Transfer tarixi - barcha qatorlar bir nechta so'rovda
+        transfer_engine.apply_transfers(lines, user_name=current_user.username)
 
         db.session.delete(pending)
+        change_feed.publish('transfers', pending_id=pending_id)
         db.session.commit()
 
         return jsonify({'success': True, 'message': 'Transfer muvaffaqiyatli yakunlandi!'})
 
+    except transfer_engine.TransferError as e:
+        db.session.rollback()
+        if e.line is None:
+            return jsonify({'error': str(e)}), e.status
+        return jsonify({'error': f'Yetarli miqdor yo\'q: mahsulot #{e.line.product_id}'}), 400
     except Exception as e:
         db.session.rollback()
         logger.error(f"Direct complete transferda xatolik: {str(e)}")
@@ -10041,6 +9791,7 @@ def manage_pending_product_batch(batch_id=None):
 
 @app.route('/api/all-pending-transfers', methods=['GET'])
 @role_required('admin', 'kassir', 'sotuvchi', 'omborchi')
+@etag_cached('pending_transfers', 'locations', 'users')
 def get_all_pending_transfers():
     """Barcha tasdiqlanmagan transferlarni olish"""
     try:
@@ -10048,9 +9799,9 @@ def get_all_pending_transfers():
         if not current_user:
             return jsonify({'error': 'Foydalanuvchi topilmadi'}), 401
 
-        # Barcha omborlar va do'konlarni 2 ta so'rovda oldindan yuklash (N+1 ni oldini olish)
-        warehouses_map = {w.id: w.name for w in Warehouse.query.with_entities(Warehouse.id, Warehouse.name).all()}
-        stores_map = {s.id: s.name for s in Store.query.with_entities(Store.id, Store.name).all()}
+        # Barcha omborlar va do'konlar nomlari - location_directory keshidan (N+1 ni oldini olish)
+        warehouses_map = {loc.id: loc.name for loc in location_directory.all_locations('warehouse')}
+        stores_map = {loc.id: loc.name for loc in location_directory.all_locations('store')}
 
         base_q = PendingTransfer.query.options(
             db.joinedload(PendingTransfer.user),
@@ -10073,8 +9824,25 @@ def get_all_pending_transfers():
             ).all()
             pending_transfers = [p for p in all_pendings if user_can_manage_transfer(current_user, p)]
 
+        # Qatorlar soni va jami miqdor - bitta GROUP BY (qatorlarning o'zi yuklanmaydi,
+        # "Ko'rish" oynasi ularni /api/pending-transfer/<id> dan oladi)
+        line_totals = {}
+        if pending_transfers:
+            line_totals = {
+                pending_id: (count, total)
+                for pending_id, count, total in db.session.query(
+                    PendingTransferItem.pending_transfer_id,
+                    db.func.count(PendingTransferItem.id),
+                    db.func.coalesce(db.func.sum(PendingTransferItem.quantity), 0)
+                ).filter(
+                    PendingTransferItem.pending_transfer_id.in_([p.id for p in pending_transfers])
+                ).group_by(PendingTransferItem.pending_transfer_id)
+            }
+
         result = []
         for pending in pending_transfers:
+            items_count, total_quantity = line_totals.get(pending.id, (0, 0))
+
             # Dict lookup — qo'shimcha SQL so'rovi yo'q
             if pending.from_location_type == 'warehouse':
                 from_location_name = warehouses_map.get(pending.from_location_id, f"Ombor #{pending.from_location_id}")
@@ -10099,7 +9867,8 @@ def get_all_pending_transfers():
                 'to_location': to_location_name,
                 'to_location_id': pending.to_location_id,
                 'to_location_type': pending.to_location_type,
-                'items': pending.items,
+                'items_count': items_count,
+                'total_quantity': float(total_quantity),
                 'status': pending.status or 'draft',
                 'sent_at': pending.sent_at.isoformat() if pending.sent_at else None,
                 'dispatched_at': pending.dispatched_at.isoformat() if pending.dispatched_at else None,
@@ -10191,7 +9960,7 @@ def get_customers():
 
             if allowed_locations:
                 # Faqat store ID'larni olish (mijozlar faqat do'konlarda bo'ladi)
-                allowed_store_ids = extract_location_ids(allowed_locations, 'store')
+                allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
                 logger.debug(f"🔍 Allowed store IDs for customers: {allowed_store_ids}")
 
                 if allowed_store_ids:
@@ -10199,18 +9968,11 @@ def get_customers():
                     query = Customer.query.filter(
                         Customer.store_id.in_(allowed_store_ids))
 
-                    # Qisman so'zlar bilan qidirish
-                    if search:
-                        search_words = search.lower().split()
-                        for word in search_words:
-                            if word:
-                                query = query.filter(
-                                    db.or_(
-                                        Customer.name.ilike(f'%{word}%'),
-                                        Customer.phone.ilike(f'%{word}%'),
-                                        Customer.email.ilike(f'%{word}%')
-                                    )
-                                )
+                    # Qisman so'zlar bilan qidirish (trigram indeks)
+                    search_condition = customer_search_condition(search)
+                    if search_condition is not None:
+                        query = query.filter(search_condition).order_by(
+                            customer_similarity(search).desc())
 
                     customers = query.all()
                     logger.debug(
@@ -10226,18 +9988,11 @@ def get_customers():
             # Admin barcha mijozlarni ko'radi
             query = Customer.query
 
-            # Qisman so'zlar bilan qidirish
-            if search:
-                search_words = search.lower().split()
-                for word in search_words:
-                    if word:
-                        query = query.filter(
-                            db.or_(
-                                Customer.name.ilike(f'%{word}%'),
-                                Customer.phone.ilike(f'%{word}%'),
-                                Customer.email.ilike(f'%{word}%')
-                            )
-                        )
+            # Qisman so'zlar bilan qidirish (trigram indeks)
+            search_condition = customer_search_condition(search)
+            if search_condition is not None:
+                query = query.filter(search_condition).order_by(
+                    customer_similarity(search).desc())
 
             customers = query.all()
             logger.debug(f" Admin user, returning all {len(customers)} customers")
@@ -10383,8 +10138,6 @@ def api_add_customer():
             f"🔍 Customer API - Received store_id: {store_id} (type: {type(store_id)})")
         logger.debug(
             f"🔍 Customer API - Current user: {current_user.username}, role: {current_user.role}")
-        logger.debug(
-            f"🔍 Customer API - User allowed_locations: {current_user.allowed_locations}")
         if store_id:
             # Dokon mavjudligini tekshirish
             store = Store.query.get(store_id)
@@ -10393,12 +10146,11 @@ def api_add_customer():
 
             # Sotuvchi uchun ruxsat tekshirish
             if current_user.role == 'sotuvchi':
-                allowed_locations = current_user.allowed_locations or []
                 store_id_int = int(store_id)  # String'dan integer'ga o'tkazish
-                # extract_location_ids bilan eski va yangi formatlarni qo'llab-quvvatlash
-                allowed_store_ids = extract_location_ids(allowed_locations, 'store')
+                # user_locations dan (eski va yangi formatlar normallashtirilgan)
+                allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
                 logger.debug(
-                    f"🔍 Customer API - Checking if {store_id_int} in allowed_store_ids={allowed_store_ids} (raw: {allowed_locations})")
+                    f"🔍 Customer API - Checking if {store_id_int} in allowed_store_ids={allowed_store_ids}")
                 if store_id_int not in allowed_store_ids:
                     logger.debug(
                         f"❌ Customer API - Store {store_id_int} not in allowed store ids {allowed_store_ids}")
@@ -10416,12 +10168,12 @@ def api_add_customer():
         )
 
         db.session.add(customer)
-        db.session.commit()
+        db.session.flush()  # yangi id tarix yozuvi uchun
 
         # OperationHistory logini yozish
         try:
-            store = Store.query.get(store_id) if store_id else None
-            history = OperationHistory(
+            store = location_directory.get('store', store_id)
+            audit_log.record(
                 operation_type='create_customer',
                 table_name='customers',
                 record_id=customer.id,
@@ -10436,11 +10188,11 @@ def api_add_customer():
                 location_name=store.name if store else None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         return jsonify({
             'success': True,
             'message': 'Mijoz muvaffaqiyatli qo\'shildi',
@@ -10460,11 +10212,8 @@ def get_customer_orders(customer_id):
         sales = Sale.query.filter_by(customer_id=customer_id).order_by(
             Sale.sale_date.desc()).all()
 
-        orders_list = []
-        for sale in sales:
-            # Sale to_dict() metodini ishlatamiz
-            sale_dict = sale.to_dict()
-            orders_list.append(sale_dict)
+        # Sale.to_dict() formatida, lekin butun ro'yxat uchun o'zgarmas sondagi so'rovlar
+        orders_list = serialize_sales(sales)
 
         return jsonify({
             'success': True,
@@ -10504,12 +10253,11 @@ def delete_customer(customer_id):
 
         # Mijozni o'chirish (Savdo tarixi saqlanadi, chunki Sale jadvalida customer_id nullable)
         db.session.delete(customer)
-        db.session.commit()
 
         # OperationHistory logini yozish
         try:
-            store = Store.query.get(customer_store_id) if customer_store_id else None
-            history = OperationHistory(
+            store = location_directory.get('store', customer_store_id)
+            audit_log.record(
                 operation_type='delete_customer',
                 table_name='customers',
                 record_id=customer_id,
@@ -10524,11 +10272,11 @@ def delete_customer(customer_id):
                 location_name=store.name if store else None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         message = f'Mijoz "{customer_name}" muvaffaqiyatli o\'chirildi'
         if sales_count > 0:
             message += f' (Savdo tarixi saqlanadi: {sales_count} ta savdo)'
@@ -10594,12 +10342,10 @@ def update_customer(customer_id):
         else:
             customer.store_id = None
 
-        db.session.commit()
-
         # OperationHistory logini yozish
         try:
-            store = Store.query.get(customer.store_id) if customer.store_id else None
-            history = OperationHistory(
+            store = location_directory.get('store', customer.store_id)
+            audit_log.record(
                 operation_type='edit_customer',
                 table_name='customers',
                 record_id=customer_id,
@@ -10614,11 +10360,11 @@ def update_customer(customer_id):
                 location_name=store.name if store else None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         return jsonify({
             'success': True,
             'message': 'Mijoz ma\'lumotlari muvaffaqiyatli yangilandi',
@@ -10737,15 +10483,11 @@ def api_add_user():
         )
 
         db.session.add(new_user)
-        db.session.commit()
-
-        logger.debug(f" User created successfully: {new_user.username}")
-        logger.debug(f" Final permissions: {new_user.permissions}")
-        logger.debug(f" Final allowed_locations: {new_user.allowed_locations}")
+        db.session.flush()  # yangi id tarix yozuvi uchun
 
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='create_user',
                 table_name='users',
                 record_id=new_user.id,
@@ -10760,11 +10502,15 @@ def api_add_user():
                 location_name=None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
+        logger.debug(f" User created successfully: {new_user.username}")
+        logger.debug(f" Final permissions: {new_user.permissions}")
+        logger.debug(f" Final allowed_locations: {new_user.allowed_locations}")
+
         return jsonify({
             'success': True,
             'message': 'Foydalanuvchi muvaffaqiyatli qo\'shildi',
@@ -10857,16 +10603,15 @@ def delete_user(user_id):
 
         # Foydalanuvchiga tegishli stock check sessions'larini o'chirish
         StockCheckSession.query.filter_by(user_id=user_id).delete()
+        badge_counters.invalidate()
+        response_cache.bump('stock_check_sessions')
 
         # Foydalanuvchini o'chirish
         db.session.delete(user)
-        db.session.commit()
-
-        app.logger.info(f"✅ User {user_id}, uning session'lari va stock check sessions'lari o'chirildi")
 
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='delete_user',
                 table_name='users',
                 record_id=user_id,
@@ -10881,11 +10626,13 @@ def delete_user(user_id):
                 location_name=None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
+        app.logger.info(f"✅ User {user_id}, uning session'lari va stock check sessions'lari o'chirildi")
+
         return jsonify({
             'success': True,
             'message': 'Foydalanuvchi muvaffaqiyatli o\'chirildi'
@@ -10946,8 +10693,7 @@ def get_active_user_sessions():
             session_dict = session_obj.to_dict()
             # User relationship orqali store_name qo'shish
             if session_obj.user and session_obj.user.store_id:
-                store = Store.query.get(session_obj.user.store_id)
-                session_dict['store_name'] = store.name if store else 'Noma\'lum'
+                session_dict['store_name'] = location_directory.resolve('store', session_obj.user.store_id, 'Noma\'lum')
             else:
                 session_dict['store_name'] = 'Barcha dokonlar'
 
@@ -11087,11 +10833,9 @@ def update_user(user_id):
             user.store_id = None
             logger.debug("🚫 No primary location set")
 
-        db.session.commit()
-
         # OperationHistory logini yozish
         try:
-            history = OperationHistory(
+            audit_log.record(
                 operation_type='edit_user',
                 table_name='users',
                 record_id=user_id,
@@ -11106,11 +10850,11 @@ def update_user(user_id):
                 location_name=None,
                 amount=None
             )
-            db.session.add(history)
-            db.session.commit()
         except Exception as log_error:
             logger.error(f"OperationHistory log xatoligi: {log_error}")
 
+        db.session.commit()
+
         return jsonify({
             'success': True,
             'message': 'Foydalanuvchi ma\'lumotlari muvaffaqiyatli yangilandi',
@@ -11290,23 +11034,18 @@ def api_sales_history():
                 )
                 logger.debug(f"🏭 Location filtri: warehouse_id={warehouse_filter_id}")
 
-        # Qidiruv filtri (mahsulot nomi bo'yicha - bir nechta so'z bilan)
-        if search_term and search_term.strip():
-            search_term_cleaned = search_term.strip()
-            # Bo'sh joy bo'yicha so'zlarga ajratish
-            search_words = search_term_cleaned.split()
-
-            # Har bir so'z mahsulot nomida bo'lishi kerak (AND logic)
-            search_conditions = [Product.name.ilike(f'%{word}%') for word in search_words]
-
-            query = query.join(SaleItem).join(Product).filter(
-                db.and_(*search_conditions)
-            ).distinct()
-            logger.debug(f"🔍 Qidiruv: '{search_term_cleaned}' ({len(search_words)} ta so'z)")
-
-        # STATISTIKA: SQL aggregate funksiyalari bilan optimal hisoblash
-        from sqlalchemy import func
-
+        # Qidiruv filtri (mahsulot nomi bo'yicha - bir nechta so'z bilan, trigram indeks)
+        search_condition = product_search_condition(search_term, include_barcode=False)
+        if search_condition is not None:
+            # Har bir so'z mahsulot nomida bo'lishi kerak (AND logic).
+            # JOIN + DISTINCT o'rniga EXISTS - sotuvlar qatorlari ko'paymaydi
+            matching_items = db.session.query(SaleItem.id).join(
+                Product, SaleItem.product_id == Product.id
+            ).filter(SaleItem.sale_id == Sale.id, search_condition)
+            query = query.filter(matching_items.exists())
+            logger.debug(f"🔍 Qidiruv: '{search_term.strip()}'")
+
+        # STATISTIKA: sales_statistics moduli - bir nechta guruhlangan so'rov, filtrlar bo'yicha keshlanadi
         # Base query'ni statistics uchun saqlash (ORDER BY siz)
         base_stats_query = query
 
@@ -11330,35 +11069,36 @@ def api_sales_history():
             stats_filtered_query = base_stats_query
             logger.info("📊 Statistika: Barcha savdolar")
 
-        # Asosiy statistika (count, sum) - aggregate qilish
-        stats_aggregate_result = stats_filtered_query.with_entities(
-            func.count(Sale.id).label('total_count'),
-            func.sum(Sale.total_amount).label('total_revenue'),
-            func.sum(Sale.total_profit).label('total_profit')
-        ).first()
-
-        total_sales_count = stats_aggregate_result.total_count or 0
-        total_revenue = float(stats_aggregate_result.total_revenue or 0)
-        total_profit = float(stats_aggregate_result.total_profit or 0)
-
-        # Davrdagi qarzli mijozlar soni (debt_usd > 0 bo'lgan unique customerlar)
-        debt_customers_count = stats_filtered_query.filter(
-            Sale.debt_usd > 0,
-            Sale.customer_id.isnot(None)
-        ).with_entities(func.count(func.distinct(Sale.customer_id))).scalar() or 0
+        top_n = request.args.get('top_n', 10, type=int)
 
-        logger.info(f"📊 Jami savdolar: {total_sales_count}")
-        logger.info(f"💰 Jami daromad: ${total_revenue:.2f}")
-        logger.info(f"💵 Jami foyda: ${total_profit:.2f}")
+        # Statistika faqat filtrlar o'zgarganda qayta hisoblanadi (sahifalashda emas)
+        stats_cache_key = (
+            current_user.id, current_user.role, start_date, end_date, customer_id, store_id,
+            payment_status, payment_method, location_filter, search_term, sale_id_filter, top_n,
+            get_tashkent_time().date() if stats_date_filter == 'today' else None,
+        )
+        cached_stats = get_cached_statistics(stats_cache_key)
+        if cached_stats is not None:
+            statistics, list_total = cached_stats
+            logger.debug("📊 Statistika keshdan olindi")
+        else:
+            statistics = compute_sales_statistics(
+                stats_filtered_query, stats_date_filter, start_date, end_date,
+                location_filter, top_n
+            )
+            list_total = query.order_by(None).count()
+            store_cached_statistics(stats_cache_key, (statistics, list_total))
 
         # Order by date descending (yangi savdolardan eski savdolarga)
         # Bu pagination uchun kerak
-        query = query.order_by(Sale.sale_date.desc())
+        query = query.order_by(Sale.sale_date.desc(), Sale.id.desc())
 
         # Pagination parametrlarini olish
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 20, type=int)  # ✅ Optimizatsiya: 50->20
-        per_page = min(per_page, 100)  # Maximum 100 limit
+        per_page = max(1, min(per_page, 100))  # Maximum 100 limit
+        # Kursor rejimi: ?cursor= (birinchi sahifa uchun bo'sh) - (sale_date, id) bo'yicha keyset
+        use_cursor = 'cursor' in request.args
 
         # ✅ Eager loading - N+1 query muammosini hal qilish
         from sqlalchemy.orm import joinedload
@@ -11369,17 +11109,24 @@ def api_sales_history():
             joinedload(Sale.items).joinedload(SaleItem.product)
         )
 
-        # Execute query with pagination
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-        sales = pagination.items
+        # Execute query with pagination - jami son keshdan (har sahifada COUNT(*) yo'q)
+        if use_cursor:
+            keyset_page = keyset_paginate(
+                query, (Sale.sale_date, Sale.id),
+                cursor=request.args.get('cursor'), per_page=per_page)
+            sales = keyset_page.items
+        else:
+            pagination = query.paginate(page=page, per_page=per_page, error_out=False, count=False)
+            sales = pagination.items
+        total_pages = (list_total + per_page - 1) // per_page
 
         logger.info(f"📄 Ma'lumotlar bazasidan topildi: {len(sales)} ta savdo (sahifa {page}, {per_page} ta per sahifa)")
-        logger.info(f"📊 Jami sahifalar: {pagination.pages}, Jami savdolar: {pagination.total}")
+        logger.info(f"📊 Jami sahifalar: {total_pages}, Jami savdolar: {list_total}")
 
         # Qarz savdolar uchun maxsus log
         if payment_status == 'partial':
-            logger.info(f"💳 QARZ SAVDOLAR: {pagination.total} ta")
-            if pagination.total == 0:
+            logger.info(f"💳 QARZ SAVDOLAR: {list_total} ta")
+            if list_total == 0:
                 logger.warning(f"⚠️ QARZ SAVDOLAR TOPILMADI! User: {current_user.username}, Role: {current_user.role}")
 
         # Debug: Query parametrlarini ko'rsatish
@@ -11395,322 +11142,20 @@ def api_sales_history():
             sale_ids = [sale.id for sale in sales[:3]]
             logger.debug(f"   - Birinchi 3 ta savdo ID: {sale_ids}")
 
-        # STATISTIKA: Subquery ishlatish - xotira sarfini kamaytirish
-        # ✅ Optimizatsiya: filtered_sale_ids list o'rniga subquery
-        from sqlalchemy.orm import aliased
-        sale_ids_subquery = stats_filtered_query.with_entities(Sale.id).subquery()
-
-        # Jami mahsulotlar soni - subquery bilan
-        total_items = 0
-        items_count_query = db.session.query(
-            func.sum(SaleItem.quantity)
-        ).filter(
-            SaleItem.sale_id.in_(select(sale_ids_subquery.c.id))
-        )
-        total_items = float(items_count_query.scalar() or 0)
-
-        # Kirim summasi: osha davr mobaynida joylashuvlarga qo'shilgan mahsulotlar tan narxi
-        incoming_q = db.session.query(
-            func.sum(ProductAddHistory.cost_price * ProductAddHistory.quantity)
-        )
-        if stats_date_filter == 'today':
-            today = get_tashkent_time().date()
-            today_start = datetime.combine(today, datetime.min.time())
-            today_end = datetime.combine(today, datetime.max.time())
-            incoming_q = incoming_q.filter(
-                ProductAddHistory.added_date >= today_start,
-                ProductAddHistory.added_date <= today_end
-            )
-        else:
-            if start_date:
-                incoming_q = incoming_q.filter(ProductAddHistory.added_date >= start_date)
-            if end_date:
-                incoming_q = incoming_q.filter(ProductAddHistory.added_date <= end_date + ' 23:59:59')
-        # Joylashuv filtri
-        if location_filter and location_filter != 'all':
-            if location_filter.startswith('store_'):
-                _loc_id = int(location_filter.replace('store_', ''))
-                _store = Store.query.get(_loc_id)
-                if _store:
-                    incoming_q = incoming_q.filter(
-                        ProductAddHistory.location_name == _store.name,
-                        ProductAddHistory.location_type == 'store'
-                    )
-            elif location_filter.startswith('warehouse_'):
-                _loc_id = int(location_filter.replace('warehouse_', ''))
-                _wh = Warehouse.query.get(_loc_id)
-                if _wh:
-                    incoming_q = incoming_q.filter(
-                        ProductAddHistory.location_name == _wh.name,
-                        ProductAddHistory.location_type == 'warehouse'
-                    )
-        total_cost = float(incoming_q.scalar() or 0)
-
-        # Average order value
-        avg_order_value = total_revenue / total_sales_count if total_sales_count > 0 else 0
-
-        # Profit margin
-        profit_margin = (
-            (total_profit / total_revenue * 100) if total_revenue > 0 else 0
-        )
-
-        # Payment method breakdown - SQL GROUP BY bilan optimal
-        # stats_filtered_query ishlatamiz (bugungi kun filtri bilan)
-        payment_stats_query = stats_filtered_query.with_entities(
-            Sale.payment_method,
-            func.count(Sale.id).label('count'),
-            func.sum(Sale.total_amount).label('total')
-        ).group_by(Sale.payment_method)
-
-        payment_methods = {}
-        for method, count, total in payment_stats_query.all():
-            method_name = method or 'Unknown'
-            payment_methods[method_name] = {
-                'count': count,
-                'amount': float(total or 0)
-            }
-
-        # Top selling products - subquery bilan optimizatsiya
-        top_products = []
-        Product_alias = aliased(Product)
-        top_n = request.args.get('top_n', 10, type=int)
-        top_n = max(1, min(top_n, 500))  # 1-500 oralig'ida cheklash
-
-        # ✅ Subquery ishlatish - list o'rniga
-        top_products_query = db.session.query(
-            Product_alias.name,
-            func.sum(SaleItem.quantity).label('quantity'),
-            func.sum(SaleItem.total_price).label('revenue')
-        ).join(
-            SaleItem, SaleItem.product_id == Product_alias.id
-        ).filter(
-            SaleItem.sale_id.in_(select(sale_ids_subquery.c.id))
-        ).group_by(
-            Product_alias.name
-        ).order_by(
-            func.sum(SaleItem.quantity).desc()
-        ).limit(top_n)
-
-        for name, quantity, revenue in top_products_query.all():
-            top_products.append({
-                'name': name or 'Noma\'lum',
-                'quantity': float(quantity or 0),
-                'revenue': float(revenue or 0)
-            })
-
-        # Store + Warehouse performance - location_id/location_type asosida
-        store_performance = []
-        Warehouse_alias = aliased(Warehouse)
-        Store_alias = aliased(Store)
-
-        # Do'konlar (store)
-        store_perf_query = db.session.query(
-            Store_alias.name,
-            func.count(Sale.id).label('sales'),
-            func.sum(Sale.total_amount).label('revenue'),
-            func.sum(Sale.total_profit).label('profit')
-        ).join(
-            Store_alias, db.and_(Sale.location_id == Store_alias.id, Sale.location_type == 'store')
-        ).filter(
-            Sale.id.in_(select(sale_ids_subquery.c.id))
-        ).group_by(
-            Store_alias.name
-        ).order_by(
-            func.sum(Sale.total_amount).desc()
-        )
-        for name, sales_count, revenue, profit in store_perf_query.all():
-            store_performance.append({
-                'name': name or 'Noma\'lum',
-                'sales': sales_count,
-                'revenue': float(revenue or 0),
-                'profit': float(profit or 0)
-            })
-
-        # Omborlar (warehouse)
-        wh_perf_query = db.session.query(
-            Warehouse_alias.name,
-            func.count(Sale.id).label('sales'),
-            func.sum(Sale.total_amount).label('revenue'),
-            func.sum(Sale.total_profit).label('profit')
-        ).join(
-            Warehouse_alias, db.and_(Sale.location_id == Warehouse_alias.id, Sale.location_type == 'warehouse')
-        ).filter(
-            Sale.id.in_(select(sale_ids_subquery.c.id))
-        ).group_by(
-            Warehouse_alias.name
-        ).order_by(
-            func.sum(Sale.total_amount).desc()
-        )
-        for name, sales_count, revenue, profit in wh_perf_query.all():
-            store_performance.append({
-                'name': name or 'Noma\'lum',
-                'sales': sales_count,
-                'revenue': float(revenue or 0),
-                'profit': float(profit or 0)
-            })
-
-        # Revenue bo'yicha tartiblash
-        store_performance.sort(key=lambda x: x['revenue'], reverse=True)
-
-        # Joylashuv × To'lov usuli kombinatsiya breakdown
-        Store_alias2 = aliased(Store)
-        Warehouse_alias2 = aliased(Warehouse)
-        loc_pm_dict = {}
-
-        store_loc_pm = db.session.query(
-            Store_alias2.name,
-            func.sum(Sale.cash_usd).label('cash'),
-            func.sum(Sale.click_usd).label('click'),
-            func.sum(Sale.terminal_usd).label('terminal'),
-            func.sum(Sale.debt_usd).label('debt'),
-            func.sum(Sale.total_profit).label('profit')
-        ).join(
-            Store_alias2, db.and_(Sale.location_id == Store_alias2.id, Sale.location_type == 'store')
-        ).filter(
-            Sale.id.in_(select(sale_ids_subquery.c.id))
-        ).group_by(Store_alias2.name).all()
-
-        wh_loc_pm = db.session.query(
-            Warehouse_alias2.name,
-            func.sum(Sale.cash_usd).label('cash'),
-            func.sum(Sale.click_usd).label('click'),
-            func.sum(Sale.terminal_usd).label('terminal'),
-            func.sum(Sale.debt_usd).label('debt'),
-            func.sum(Sale.total_profit).label('profit')
-        ).join(
-            Warehouse_alias2, db.and_(Sale.location_id == Warehouse_alias2.id, Sale.location_type == 'warehouse')
-        ).filter(
-            Sale.id.in_(select(sale_ids_subquery.c.id))
-        ).group_by(Warehouse_alias2.name).all()
-
-        for name, cash, click, terminal, debt, profit in store_loc_pm:
-            loc_name = name or 'Noma\'lum'
-            payments = {}
-            if float(cash or 0) > 0:
-                payments['cash'] = float(cash)
-            if float(click or 0) > 0:
-                payments['click'] = float(click)
-            if float(terminal or 0) > 0:
-                payments['terminal'] = float(terminal)
-            if float(debt or 0) > 0:
-                payments['debt'] = float(debt)
-            loc_pm_dict[('store', loc_name)] = {'payments': payments, 'profit': float(profit or 0)}
-
-        for name, cash, click, terminal, debt, profit in wh_loc_pm:
-            loc_name = name or 'Noma\'lum'
-            payments = {}
-            if float(cash or 0) > 0:
-                payments['cash'] = float(cash)
-            if float(click or 0) > 0:
-                payments['click'] = float(click)
-            if float(terminal or 0) > 0:
-                payments['terminal'] = float(terminal)
-            if float(debt or 0) > 0:
-                payments['debt'] = float(debt)
-            loc_pm_dict[('warehouse', loc_name)] = {'payments': payments, 'profit': float(profit or 0)}
-
-        location_payment_breakdown = [
-            {'name': k[1], 'location_type': k[0], 'payments': v['payments'], 'total': sum(v['payments'].values()), 'profit': v['profit']}
-            for k, v in loc_pm_dict.items()
-        ]
-        location_payment_breakdown.sort(key=lambda x: x['total'], reverse=True)
-
-        # Har bir joylashuv uchun xarajatlarni qo'shish
-        total_expense_all = 0
+        # Sales list conversion - butun sahifa bitta paketda (har savdoga alohida qarz so'rovi yo'q)
         try:
-            exp_q = db.session.query(
-                Expense.location_type,
-                Expense.location_id,
-                func.coalesce(func.sum(Expense.amount_usd), 0).label('total_usd')
-            ).filter(Expense.location_type.isnot(None), Expense.location_id.isnot(None))
-            if start_date and start_date.strip():
-                exp_q = exp_q.filter(Expense.expense_date >= start_date)
-            if end_date and end_date.strip():
-                exp_q = exp_q.filter(Expense.expense_date <= end_date + ' 23:59:59')
-            if location_filter and location_filter != 'all':
-                if location_filter.startswith('store_'):
-                    _loc_id = int(location_filter.replace('store_', ''))
-                    exp_q = exp_q.filter(Expense.location_type == 'store', Expense.location_id == _loc_id)
-                elif location_filter.startswith('warehouse_'):
-                    _loc_id = int(location_filter.replace('warehouse_', ''))
-                    exp_q = exp_q.filter(Expense.location_type == 'warehouse', Expense.location_id == _loc_id)
-            exp_q = exp_q.group_by(Expense.location_type, Expense.location_id)
-            exp_by_loc = {}
-            for loc_type, loc_id, total_usd in exp_q.all():
-                if loc_type == 'store':
-                    obj = Store.query.get(loc_id)
-                else:
-                    obj = Warehouse.query.get(loc_id)
-                if obj:
-                    exp_by_loc[(loc_type, obj.name)] = float(total_usd)
-
-            # Savdosi yo'q ammo xarajati bor joylashuvlarni ham qo'shish
-            existing_keys = {(item['location_type'], item['name']) for item in location_payment_breakdown}
-            for (loc_type, loc_name), exp_amt in exp_by_loc.items():
-                if (loc_type, loc_name) not in existing_keys:
-                    location_payment_breakdown.append({
-                        'name': loc_name,
-                        'location_type': loc_type,
-                        'payments': {},
-                        'total': 0,
-                        'profit': 0,
-                        'expense': exp_amt
-                    })
-
-            for item in location_payment_breakdown:
-                item['expense'] = exp_by_loc.get((item['location_type'], item['name']), 0)
-
-            # Barcha xarajatlar jami (joylashuvdan qat'iy nazar)
-            all_exp_q = db.session.query(func.coalesce(func.sum(Expense.amount_usd), 0))
-            if start_date and start_date.strip():
-                all_exp_q = all_exp_q.filter(Expense.expense_date >= start_date)
-            if end_date and end_date.strip():
-                all_exp_q = all_exp_q.filter(Expense.expense_date <= end_date + ' 23:59:59')
-            if location_filter and location_filter != 'all':
-                if location_filter.startswith('store_'):
-                    _loc_id = int(location_filter.replace('store_', ''))
-                    all_exp_q = all_exp_q.filter(Expense.location_type == 'store', Expense.location_id == _loc_id)
-                elif location_filter.startswith('warehouse_'):
-                    _loc_id = int(location_filter.replace('warehouse_', ''))
-                    all_exp_q = all_exp_q.filter(Expense.location_type == 'warehouse', Expense.location_id == _loc_id)
-            total_expense_all = float(all_exp_q.scalar() or 0)
-        except Exception:
-            for item in location_payment_breakdown:
-                item['expense'] = 0
-            total_expense_all = 0
-
-        # Davrdagi qarzli mijozlar ro'yxati (faqat tanlangan davrda debt_usd > 0 bo'lgan)
-        Customer_alias = aliased(Customer)
-        debt_customers_query = db.session.query(
-            Customer_alias.name,
-            func.sum(Sale.debt_usd).label('period_debt')
-        ).join(
-            Customer_alias, Sale.customer_id == Customer_alias.id
-        ).filter(
-            Sale.id.in_(select(sale_ids_subquery.c.id)),
-            Sale.debt_usd > 0
-        ).group_by(
-            Customer_alias.name
-        ).order_by(
-            func.sum(Sale.debt_usd).desc()
-        )
-        debt_customers = []
-        for name, period_debt in debt_customers_query.all():
-            debt_customers.append({
-                'customer_name': name or 'Noma\'lum',
-                'total_debt': float(period_debt or 0)
-            })
-
-        # Sales list conversion with error handling
-        sales_list = []
-        for sale in sales:
-            try:
-                sales_list.append(sale.to_dict())
-            except Exception as e:
-                app.logger.error(f"Error converting sale {sale.id} to dict: {str(e)}")
-                app.logger.exception("Full traceback:")
-                # Skip this sale and continue
-                continue
+            sales_list = serialize_sales(sales)
+        except Exception as e:
+            app.logger.error(f"Error converting sales page to dict: {str(e)}")
+            sales_list = []
+            for sale in sales:
+                try:
+                    sales_list.append(sale.to_dict())
+                except Exception as e:
+                    app.logger.error(f"Error converting sale {sale.id} to dict: {str(e)}")
+                    app.logger.exception("Full traceback:")
+                    # Skip this sale and continue
+                    continue
 
         logger.debug(f" API javobida yuborilayotgan sales: {len(sales_list)} ta")
         if sales_list:
@@ -11720,36 +11165,27 @@ def api_sales_history():
             if len(sales_list) > 2:
                 logger.debug(f" Uchinchi sale sample: {sales_list[2]}")
 
+        if use_cursor:
+            pagination_meta = keyset_page.meta(per_page)
+            pagination_meta.update({'total': list_total, 'total_pages': total_pages})
+        else:
+            pagination_meta = {
+                'page': page,
+                'per_page': per_page,
+                'total': list_total,
+                'total_pages': total_pages,
+                'has_prev': page > 1,
+                'has_next': page < total_pages,
+                'prev_num': page - 1 if page > 1 else None,
+                'next_num': page + 1 if page < total_pages else None
+            }
+
         return jsonify({
             'success': True,
             'data': {
                 'sales': sales_list,
-                'pagination': {
-                    'page': page,
-                    'per_page': per_page,
-                    'total': pagination.total,
-                    'total_pages': pagination.pages,
-                    'has_prev': pagination.has_prev,
-                    'has_next': pagination.has_next,
-                    'prev_num': pagination.prev_num,
-                    'next_num': pagination.next_num
-                },
-                'statistics': {
-                    'total_sales': total_sales_count,  # Filtr qo'llanilgan barcha savdolar soni
-                    'total_revenue': round(total_revenue, 2),
-                    'total_profit': round(total_profit, 2),
-                    'total_cost': round(total_cost, 2),
-                    'total_items': total_items,
-                    'avg_order_value': round(avg_order_value, 2),
-                    'profit_margin': round(profit_margin, 2),
-                    'payment_methods': payment_methods,
-                    'top_products': top_products,
-                    'store_performance': store_performance,
-                    'location_payment_breakdown': location_payment_breakdown,
-                    'total_expense': round(total_expense_all, 2),
-                    'debt_customers_count': debt_customers_count,
-                    'debt_customers': debt_customers
-                },
+                'pagination': pagination_meta,
+                'statistics': statistics,
                 'filters': {
                     'start_date': start_date,
                     'end_date': end_date,
@@ -11761,6 +11197,8 @@ def api_sales_history():
             }
         })
 
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         app.logger.error(f"Error fetching sales history: {str(e)}")
         app.logger.exception("Full traceback for sales history error:")
@@ -11854,29 +11292,21 @@ def finalize_sale(sale_id):
                     fin_customer.balance = max(Decimal('0'), old_bal - Decimal(str(balance_used_fin)))
                     logger.debug(f"💳 Finalize: Mijoz balansidan ${balance_used_fin} ayirildi. Yangi balans: ${float(fin_customer.balance)}")
 
-        db.session.commit()
-
-        logger.info(f"✅ Savdo yakunlandi: Sale ID {sale_id}, Status: {payment_status}, Location: {sale.location_id}/{sale.location_type}")
-
         # Chek formatini olish
         receipt_format = data.get('receipt_format', 'both')  # 'usd', 'uzs', yoki 'both'
         logger.info(f"📄 Tanlangan chek formati: {receipt_format}")
 
-        # Telegram xabar yuborish (mijoz telegram_chat_id bor bo'lsa)
+        # Telegram xabar navbatga (mijoz telegram_chat_id bor bo'lsa) - savdo bilan BIR commit'da
         if customer_id:
             try:
                 customer = Customer.query.get(customer_id)
                 if customer and customer.telegram_chat_id:
-                    from telegram_bot import get_bot_instance
-                    bot = get_bot_instance(db=db)
 
                     # Joylashuv nomini olish
                     if sale.location_type == 'warehouse':
-                        warehouse_obj = Warehouse.query.get(sale.location_id)
-                        location_name = warehouse_obj.name if warehouse_obj else "Ombor"
+                        location_name = location_directory.resolve('warehouse', sale.location_id, "Ombor")
                     else:
-                        store_obj = Store.query.get(sale.location_id)
-                        location_name = store_obj.name if store_obj else "Do'kon"
+                        location_name = location_directory.resolve('store', sale.location_id, "Do'kon")
 
                     # To'lov summalari (USD) — total = savdoning haqiqiy jami (balance ham kiritilgan)
                     balance_usd_fin = float(sale.balance_usd) if sale.balance_usd else 0
@@ -11904,8 +11334,9 @@ def finalize_sale(sale_id):
                             'total': float(item.total_price) * float(sale.currency_rate)  # Backward compatibility
                         })
 
-                    # Telegram xabar yuborish
-                    bot.send_sale_notification_sync(
+                    # Telegram xabar navbatga (PDF va yuborish run_telegram_bot.py worker'ida)
+                    notification_queue.enqueue(
+                        'sale_receipt',
                         chat_id=customer.telegram_chat_id,
                         customer_name=customer.name,
                         customer_id=customer.id,
@@ -11931,9 +11362,9 @@ def finalize_sale(sale_id):
                         balance_uzs=balance_uzs_fin,
                         balance_usd=balance_usd_fin
                     )
-                    logger.info(f"✅ Telegram xabar va PDF yuborildi (finalize): {customer.name}")
+                    logger.info(f"📨 Telegram xabar va PDF navbatga qo'yildi (finalize): {customer.name}")
             except Exception as telegram_error:
-                logger.warning(f"⚠️ Telegram xabar yuborishda xatolik (finalize): {telegram_error}")
+                logger.warning(f"⚠️ Telegram xabarni navbatga qo'yishda xatolik (finalize): {telegram_error}")
                 # Telegram xatosi savdoni to'xtatmasin
 
         # OperationHistory ga har bir SaleItem uchun log yozish
@@ -11941,11 +11372,9 @@ def finalize_sale(sale_id):
             current_user_fin = get_current_user()
             fin_loc_name = ''
             if sale.location_type == 'store':
-                s_obj = Store.query.get(sale.location_id)
-                fin_loc_name = s_obj.name if s_obj else ''
+                fin_loc_name = location_directory.resolve('store', sale.location_id, '')
             elif sale.location_type == 'warehouse':
-                w_obj = Warehouse.query.get(sale.location_id)
-                fin_loc_name = w_obj.name if w_obj else ''
+                fin_loc_name = location_directory.resolve('warehouse', sale.location_id, '')
 
             fin_username = (f"{current_user_fin.first_name} {current_user_fin.last_name}".strip()
                             if current_user_fin else session.get('username', 'System'))
@@ -11955,7 +11384,7 @@ def finalize_sale(sale_id):
                 p = si.product
                 if not p:
                     continue
-                fin_op = OperationHistory(
+                audit_log.record(
                     operation_type='sale',
                     table_name='products',
                     record_id=si.product_id,
@@ -11976,12 +11405,19 @@ def finalize_sale(sale_id):
                     location_name=fin_loc_name,
                     amount=float(si.total_price * (sale.currency_rate or 1))
                 )
-                db.session.add(fin_op)
-            db.session.commit()
             logger.info(f"Finalize savdo #{sale_id} uchun {len(sale.items)} ta OperationHistory yozildi")
         except Exception as log_err:
             logger.warning(f"Finalize OperationHistory log xatoligi: {log_err}")
 
+        # Pending savdo stock'ni allaqachon ushlab turibdi - korzina rezervlari faqat o'chiriladi
+        if data.get('cart_id'):
+            stock_reservations.consume_cart(data['cart_id'])
+
+        change_feed.publish('pending_sales', sale_id=sale_id)
+        db.session.commit()
+
+        logger.info(f"✅ Savdo yakunlandi: Sale ID {sale_id}, Status: {payment_status}, Location: {sale.location_id}/{sale.location_type}")
+
         # CustomerTimelineSnapshot yozish (pending sale finalize qilinganda)
         if sale.customer_id:
             try:
@@ -12004,8 +11440,8 @@ def finalize_sale(sale_id):
                     for si in sale.items
                 ]
                 fin_seller = f'{sale.seller.first_name} {sale.seller.last_name}'.strip() if sale.seller else ''
-                fin_loc_obj = Store.query.get(sale.location_id) if sale.location_type == 'store' else Warehouse.query.get(sale.location_id)
-                fin_loc_name = fin_loc_obj.name if fin_loc_obj else ''
+                fin_loc_name = location_directory.resolve(
+                    'store' if sale.location_type == 'store' else 'warehouse', sale.location_id, '')
                 fin_snap = CustomerTimelineSnapshot(
                     customer_id=sale.customer_id,
                     event_type='sale',
@@ -12229,6 +11665,8 @@ def create_sale():
         original_sale_id = data.get('original_sale_id')
         # Tahrirlash rejimi belgisi
         is_edit_mode = data.get('is_edit_mode', False)  # Tahrirlash rejimi
+        # /api/reserve-stock/batch orqali rezerv qilingan korzina
+        cart_id = data.get('cart_id')
 
         logger.debug(f" Customer ID: {customer_id} (type: {type(customer_id)})")
         logger.info(f" Original Sale ID: {original_sale_id}")
@@ -12256,17 +11694,14 @@ def create_sale():
         # Sotuvchi uchun joylashuv ruxsatini tekshirish
         user_role = session.get('role')
         if user_role == 'sotuvchi':
-            user_id = session.get('user_id')
-            user = User.query.get(user_id)
+            principal = principal_cache.get_principal(session.get('user_id'))
 
-            if not user or not user.allowed_locations:
+            if not principal or not principal.locations['allowed']:
                 return jsonify({
                     'success': False,
                     'error': 'Sizga ruxsat etilgan joylashuvlar mavjud emas'
                 }), 403
 
-            allowed_locations = user.allowed_locations
-
             # Joylashuvlarni tekshirish
             if multi_location:
                 for item in items:
@@ -12274,10 +11709,7 @@ def create_sale():
                     item_location_type = item.get('location_type', 'store')
 
                     if item_location_id:
-                        # Extract allowed IDs for this location type
-                        allowed_ids = extract_location_ids(allowed_locations, item_location_type)
-
-                        if item_location_id not in allowed_ids:
+                        if not principal.can('allowed', item_location_type, item_location_id):
                             return jsonify({
                                 'success': False,
                                 'error': f'"{item.get("name", "")}" mahsuloti uchun tanlangan joylashuvga ruxsatingiz yo\'q'
@@ -12287,10 +11719,7 @@ def create_sale():
                 location_type = data.get('location_type', 'store')
 
                 if location_id:
-                    # Extract allowed IDs for this location type
-                    allowed_ids = extract_location_ids(allowed_locations, location_type)
-
-                    if location_id not in allowed_ids:
+                    if not principal.can('allowed', location_type, location_id):
                         return jsonify({
                             'success': False,
                             'error': 'Tanlangan joylashuvga ruxsatingiz yo\'q'
@@ -12490,6 +11919,20 @@ def create_sale():
             sale_location_id = location_id
             sale_location_type = location_type
 
+        # Korzinani oldindan yuklash: mahsulotlar, stock, joylashuvlar va asl
+        # savdo miqdorlari bir nechta IN (...) so'rovida (qatorma-qator emas)
+        def sale_line_location(item):
+            if multi_location:
+                return item.get('location_type'), item.get('location_id')
+            return location_type, location_id
+
+        try:
+            cart = load_sale_cart(
+                items, sale_line_location,
+                original_sale_id=original_sale_id if is_edit_mode else None)
+        except SaleCartError as e:
+            return jsonify({'success': False, 'error': str(e)}), e.status
+
         # TAHRIRLASH yoki YANGI SAVDO?
         if is_edit_mode and original_sale_id:
             logger.debug(f"\n🔄 TAHRIRLASH REJIMI: Sale ID={original_sale_id}")
@@ -12535,178 +11978,57 @@ def create_sale():
             # Yangi savdo yaratish
             logger.debug("\n✅ YANGI SAVDO yaratilmoqda")
 
-            current_sale = Sale(
-                customer_id=final_customer_id,
-                store_id=store.id,
-                location_id=sale_location_id,
-                location_type=sale_location_type,
-                seller_id=current_user.id,
-                payment_method=payment_method,
-                payment_status=final_payment_status,
-                # UZS summalar
-                cash_amount=Decimal(str(cash_amount)),
-                click_amount=Decimal(str(click_amount)),
-                terminal_amount=Decimal(str(terminal_amount)),
-                debt_amount=Decimal(str(debt_amount)),
-                # USD summalar
-                cash_usd=Decimal(str(cash_usd)),
-                click_usd=Decimal(str(click_usd)),
-                terminal_usd=Decimal(str(terminal_usd)),
-                debt_usd=Decimal(str(debt_usd)),
-                balance_usd=Decimal(str(balance_used)),
-                notes=f'Multi-location savdo - {len(items)} ta mahsulot' if multi_location else None,
-                currency_rate=current_rate,
-                created_by=f'{current_user.first_name} {current_user.last_name}',
-                payment_due_date=payment_due_date
-            )
-            db.session.add(current_sale)
-            db.session.flush()  # ID ni olish uchun
-
-        total_profit = Decimal('0')
-        total_revenue = Decimal('0')
-        total_cost = Decimal('0')
-
-        # Har bir mahsulot uchun SaleItem yaratish (ham yangi, ham tahrirlashda bir xil)
-        for item in items:
-            # product_id ni id yoki product_id dan olish
-            product_id = item.get('product_id') or item.get('id')
-            quantity = Decimal(str(item.get('quantity', 0)))
-            unit_price_usd = float(item.get('unit_price') or item.get('price', 0))
-
-            logger.debug(f" Processing item: {item}")
-            logger.debug(f" Product ID: {product_id} (type: {type(product_id)})")
-
-            if quantity <= 0:
-                continue
-
-            # Multi-location rejimida har bir mahsulot uchun joylashuv
-            if multi_location:
-                item_location_id = item.get('location_id')
-                item_location_type = item.get('location_type')
-            else:
-                item_location_id = location_id
-                item_location_type = location_type
-
-            # Mahsulotni topish
-            product = Product.query.get(product_id)
-            if not product:
-                return jsonify({
-                    'success': False,
-                    'error': f'Mahsulot topilmadi: {product_id}'
-                }), 404
-
-            # Stock tekshirish va yangilash (har bir mahsulot o'z
-            # joylashuvidan)
-            if item_location_type == 'store':
-                # Store stock tekshirish
-                stock = StoreStock.query.filter_by(
-                    store_id=item_location_id,
-                    product_id=product_id
-                ).first()
-
-                if not stock:
-                    store_obj = Store.query.get(item_location_id)
-                    store_name = store_obj.name if store_obj else 'noma\'lum'
-                    return jsonify({
-                        'success': False,
-                        'error': (f'{store_name} do\'konida {product.name} '
-                                  f'mahsuloti mavjud emas')
-                    }), 400
-
-                # Tahrirlash rejimida asl savdo miqdorini hisobga olish
-                available_quantity = stock.quantity
-                logger.debug(
-                    f"🔍 Store stock tekshiruvi: product_id={product_id}, current_stock={stock.quantity}")
-                logger.debug(
-                    f"🔍 Tahrirlash rejimi: is_edit_mode={is_edit_mode}, original_sale_id={original_sale_id}")
-
-                if is_edit_mode and original_sale_id:
-                    # Asl savdoda bu mahsulotning miqdorini topish
-                    original_sale_item = db.session.query(SaleItem).filter_by(
-                        sale_id=original_sale_id,
-                        product_id=product_id
-                    ).first()
-
-                    logger.debug(f" Asl savdo item topildi: {original_sale_item}")
-                    if original_sale_item:
-                        logger.debug(
-                            f"🔍 Asl savdo miqdori: {original_sale_item.quantity}")
-                        # Asl savdo miqdorini qo'shish (chunki tahrirlashda
-                        # qaytariladi)
-                        available_quantity += original_sale_item.quantity
-                        logger.debug(
-                            f"📝 Tahrirlash rejimi: mahsulot {product_id} uchun asl miqdor {original_sale_item.quantity} qo'shildi")
-                        logger.debug(
-                            f"📊 Mavjud miqdor: {stock.quantity} + {original_sale_item.quantity} = {available_quantity}")
-                        logger.info(f" Kerakli miqdor: {quantity}")
-                        logger.info(f" Farq: {available_quantity - quantity}")
-                    else:
-                        logger.debug(
-                            f"⚠️ Asl savdoda mahsulot {product_id} topilmadi")
-
-                # Stock tekshirish olib tashlandi - stock allaqachon rezerv
-                # qilingan
-                logger.debug(
-                    f"ℹ️ Stock validation o'tkazildi: available={available_quantity}, required={quantity}")
-
-                # Stock allaqachon korzinaga qo'shilganda ayirilgan
-                logger.debug(
-                    "ℹ️ Store stock dan ayirilmaydi (allaqachon rezerv qilingan)")
-
-            elif item_location_type == 'warehouse':
-                # Warehouse stock tekshirish
-                stock = WarehouseStock.query.filter_by(
-                    warehouse_id=item_location_id,
-                    product_id=product_id
-                ).first()
-
-                if not stock:
-                    warehouse_obj = Warehouse.query.get(item_location_id)
-                    warehouse_name = warehouse_obj.name if warehouse_obj else 'noma\'lum'
-                    return jsonify({
-                        'success': False,
-                        'error': (f'{warehouse_name} omborida {product.name} '
-                                  f'mahsuloti mavjud emas')
-                    }), 400
-
-                # Tahrirlash rejimida asl savdo miqdorini hisobga olish
-                available_quantity = stock.quantity
-                logger.debug(
-                    f"🔍 Warehouse stock tekshiruvi: product_id={product_id}, current_stock={stock.quantity}")
-                logger.debug(
-                    f"🔍 Tahrirlash rejimi: is_edit_mode={is_edit_mode}, original_sale_id={original_sale_id}")
-
-                if is_edit_mode and original_sale_id:
-                    # Asl savdoda bu mahsulotning miqdorini topish
-                    original_sale_item = db.session.query(SaleItem).filter_by(
-                        sale_id=original_sale_id,
-                        product_id=product_id
-                    ).first()
-
-                    logger.debug(f" Asl savdo item topildi: {original_sale_item}")
-                    if original_sale_item:
-                        logger.debug(
-                            f"🔍 Asl savdo miqdori: {original_sale_item.quantity}")
-                        # Asl savdo miqdorini qo'shish
-                        available_quantity += original_sale_item.quantity
-                        logger.debug(
-                            f"📝 Warehouse tahrirlash: mahsulot {product_id} uchun asl miqdor {original_sale_item.quantity} qo'shildi")
-                        logger.debug(
-                            f"📊 Mavjud miqdor: {stock.quantity} + {original_sale_item.quantity} = {available_quantity}")
-                        logger.info(f" Kerakli miqdor: {quantity}")
-                        logger.info(f" Farq: {available_quantity - quantity}")
-                    else:
-                        logger.debug(
-                            f"⚠️ Asl savdoda mahsulot {product_id} topilmadi")
+            current_sale = Sale(
+                customer_id=final_customer_id,
+                store_id=store.id,
+                location_id=sale_location_id,
+                location_type=sale_location_type,
+                seller_id=current_user.id,
+                payment_method=payment_method,
+                payment_status=final_payment_status,
+                # UZS summalar
+                cash_amount=Decimal(str(cash_amount)),
+                click_amount=Decimal(str(click_amount)),
+                terminal_amount=Decimal(str(terminal_amount)),
+                debt_amount=Decimal(str(debt_amount)),
+                # USD summalar
+                cash_usd=Decimal(str(cash_usd)),
+                click_usd=Decimal(str(click_usd)),
+                terminal_usd=Decimal(str(terminal_usd)),
+                debt_usd=Decimal(str(debt_usd)),
+                balance_usd=Decimal(str(balance_used)),
+                notes=f'Multi-location savdo - {len(items)} ta mahsulot' if multi_location else None,
+                currency_rate=current_rate,
+                created_by=f'{current_user.first_name} {current_user.last_name}',
+                payment_due_date=payment_due_date
+            )
+            db.session.add(current_sale)
+            db.session.flush()  # ID ni olish uchun
 
-                # Stock tekshirish olib tashlandi - stock allaqachon rezerv
-                # qilingan
-                logger.debug(
-                    f"ℹ️ Warehouse stock validation o'tkazildi: available={available_quantity}, required={quantity}")
+        total_profit = Decimal('0')
+        total_revenue = Decimal('0')
+        total_cost = Decimal('0')
+        sold_lines = []  # Korzina rezervini yakunlash uchun
+
+        # Har bir mahsulot uchun SaleItem yaratish (ham yangi, ham tahrirlashda bir xil).
+        # Mahsulot/stock/joylashuvlar yuqorida load_sale_cart() bilan oldindan yuklangan.
+        sale_items = []
+        for line in cart.lines:
+            item = line.item
+            product = line.product
+            product_id = product.id
+            quantity = line.quantity
+            item_location_type = line.location_type
+            item_location_id = line.location_id
+            unit_price_usd = float(item.get('unit_price') or item.get('price', 0))
 
-                # Stock allaqachon korzinaga qo'shilganda ayirilgan
+            if line.stock is not None:
+                # Stock tekshirish olib tashlandi - stock allaqachon korzinaga
+                # qo'shilganda ayirilgan (rezerv qilingan)
+                available_quantity = line.stock.quantity + (line.original_quantity or 0)
                 logger.debug(
-                    "ℹ️ Warehouse stock dan ayirilmaydi (allaqachon rezerv qilingan)")
+                    f"ℹ️ {item_location_type} stock: product_id={product_id}, "
+                    f"available={available_quantity}, required={quantity} (ayirilmaydi)")
 
             # Savdo summasini hisoblash
             total_amount_usd = Decimal(str(unit_price_usd)) * quantity  # USD da
@@ -12722,16 +12044,8 @@ def create_sale():
             unit_price_uzs = Decimal(str(item.get('price_uzs', 0) or 0))
             total_price_uzs = unit_price_uzs * quantity
 
-            # Location ma'lumotini yaratish
-            if item_location_type == 'warehouse':
-                warehouse_obj = Warehouse.query.get(item_location_id)
-                location_info = f'Ombor: {warehouse_obj.name} (ID: {warehouse_obj.id})'
-            else:
-                store_obj = Store.query.get(item_location_id)
-                location_info = f'Dokon: {store_obj.name} (ID: {store_obj.id})'
-
             # SaleItem yaratish
-            sale_item = SaleItem(
+            sale_items.append(SaleItem(
                 sale_id=current_sale.id,  # Yangi yoki tahrirlangan sale ID
                 product_id=product_id,
                 quantity=quantity,
@@ -12743,40 +12057,47 @@ def create_sale():
                 profit=profit_usd,  # USD da (allaqachon Decimal)
                 source_type=item_location_type,
                 source_id=item_location_id,
-                notes=f'{product.name} | {location_info}'
-            )
-
-            db.session.add(sale_item)
+                notes=f'{product.name} | {cart.location_info(line)}'
+            ))
+            sold_lines.append({'product_id': product_id, 'quantity': quantity,
+                               'location_type': item_location_type,
+                               'location_id': item_location_id})
             total_profit += profit_usd
             total_revenue += total_amount_usd  # USD da
             total_cost += total_cost_price_usd
 
+        # Bitta flush'da - SQLAlchemy bir jadvalga INSERT'larni to'plab (executemany) yuboradi
+        db.session.add_all(sale_items)
+
         # Savdo jami summasini yangilash (ham yangi, ham tahrirlash uchun)
         current_sale.total_amount = Decimal(str(total_revenue))  # USD da
         current_sale.total_cost = Decimal(str(total_cost))  # USD da
         current_sale.total_profit = Decimal(str(total_profit))  # USD da
 
-        # Ma'lumotlar bazasiga saqlash
-        db.session.commit()
-
-        action_text = 'tahrirlandi' if is_edit_mode else 'yaratildi'
-        logger.debug(f"✅ Savdo {action_text}: ID={current_sale.id}, Items={len(items)}, Total=${total_revenue}")
+        # Korzina rezervini yakunlash: sweeper sotilgan stock'ni qaytarmasligi uchun.
+        # Tahrirlashda asl savdo miqdorlari allaqachon ayirilgan - rezervlar o'chiriladi,
+        # sweeper muddati tugagani uchun qaytargan miqdorlar (released_quantity) qayta ayiriladi.
+        if cart_id:
+            try:
+                stock_reservations.consume_cart(
+                    cart_id, None if is_edit_mode else sold_lines)
+            except stock_reservations.ReservationError as e:
+                db.session.rollback()
+                return jsonify({'success': False, 'error': str(e), 'shortages': e.lines}), 400
 
-        # Telegram xabar yuborish (yangi savdo yaratilganda yoki tahrirlanganda, mijoz telegram_chat_id bor bo'lsa)
+        # Telegram xabar navbatga (yangi savdo yaratilganda yoki tahrirlanganda, mijoz telegram_chat_id bor bo'lsa).
+        # Outbox yozuvi savdo bilan BIR commit'da saqlanadi - savdo bo'lmasa xabar ham yo'q.
+        # Mahsulotlar load_sale_cart() dan sessiyada - item.product qo'shimcha so'rovsiz.
         if final_customer_id:
             try:
                 customer = Customer.query.get(final_customer_id)
                 if customer and customer.telegram_chat_id:
-                    from telegram_bot import get_bot_instance
-                    bot = get_bot_instance(db=db)
 
                     # Joylashuv nomini olish
                     if sale_location_type == 'warehouse':
-                        warehouse_obj = Warehouse.query.get(sale_location_id)
-                        location_name = warehouse_obj.name if warehouse_obj else "Ombor"
+                        location_name = location_directory.resolve('warehouse', sale_location_id, "Ombor")
                     else:
-                        store_obj = Store.query.get(sale_location_id)
-                        location_name = store_obj.name if store_obj else "Do'kon"
+                        location_name = location_directory.resolve('store', sale_location_id, "Do'kon")
 
                     # Valyuta kursi
                     tg_exchange_rate = float(current_sale.currency_rate) if current_sale.currency_rate else 12300
@@ -12805,7 +12126,7 @@ def create_sale():
 
                     # Savdo mahsulotlarini PDF uchun tayyorlash
                     sale_items_for_pdf = []
-                    for item in current_sale.items:
+                    for item in sale_items:
                         sale_items_for_pdf.append({
                             'name': item.product.name if item.product else 'Mahsulot',
                             'seller_name': seller_name,
@@ -12818,8 +12139,9 @@ def create_sale():
                             'total': float(item.total_price) * tg_exchange_rate  # Backward compatibility
                         })
 
-                    # Telegram xabar yuborish
-                    bot.send_sale_notification_sync(
+                    # Telegram xabar navbatga (PDF va yuborish run_telegram_bot.py worker'ida)
+                    notification_queue.enqueue(
+                        'sale_receipt',
                         chat_id=customer.telegram_chat_id,
                         customer_name=customer.name,
                         customer_id=customer.id,
@@ -12846,21 +12168,24 @@ def create_sale():
                         balance_uzs=tg_balance_uzs,
                         balance_usd=tg_balance_usd
                     )
-                    logger.info(f"✅ Telegram xabar va PDF yuborildi: {customer.name}")
+                    logger.info(f"📨 Telegram xabar va PDF navbatga qo'yildi: {customer.name}")
             except Exception as telegram_error:
-                logger.warning(f"⚠️ Telegram xabar yuborishda xatolik: {telegram_error}")
+                logger.warning(f"⚠️ Telegram xabarni navbatga qo'yishda xatolik: {telegram_error}")
                 # Telegram xatosi savdo yaratishni to'xtatmasin
 
-        # OperationHistory ga yozish
+        # Telegram PDF va tarix tavsifi uchun qatorlar mahsulotlari bilan bitta yuklashda
+        # (har bir item.product alohida so'rov bo'lmasligi uchun)
+        current_sale = Sale.query.options(
+            db.selectinload(Sale.items).joinedload(SaleItem.product)
+        ).filter_by(id=current_sale.id).one()
+
+        action_text = 'tahrirlandi' if is_edit_mode else 'yaratildi'
+        logger.debug(f"✅ Savdo {action_text}: ID={current_sale.id}, Items={len(items)}, Total=${total_revenue}")
+
+        # OperationHistory ga yozish (savdo bilan bir commit'da)
         location_name = ''
-        if sale_location_type == 'store':
-            store_obj = Store.query.get(sale_location_id)
-            if store_obj:
-                location_name = store_obj.name
-        elif sale_location_type == 'warehouse':
-            warehouse_obj = Warehouse.query.get(sale_location_id)
-            if warehouse_obj:
-                location_name = warehouse_obj.name
+        if sale_location_type in ('store', 'warehouse'):
+            location_name = location_directory.resolve(sale_location_type, sale_location_id, '')
 
         # Mahsulotlar tavsifi
         products_desc = ', '.join([f"{item.product.name} ({item.quantity} ta)" for item in current_sale.items])
@@ -12868,7 +12193,7 @@ def create_sale():
         operation_type = 'sale' if not is_edit_mode else 'edit'
         description = f"Savdo yaratildi: {products_desc}" if not is_edit_mode else f"Savdo tahrirlandi: {products_desc}"
 
-        operation = OperationHistory(
+        audit_log.record(
             operation_type=operation_type,
             table_name='sales',
             record_id=current_sale.id,
@@ -12889,7 +12214,6 @@ def create_sale():
             location_name=location_name,
             amount=float(current_sale.total_amount * current_sale.currency_rate)  # UZS da
         )
-        db.session.add(operation)
 
         # Mijoz balansidan ushbu savdoda ishlatilgan summani ayirish
         if balance_used > 0 and final_customer_id:
@@ -12900,6 +12224,7 @@ def create_sale():
                 sale_customer.balance = max(Decimal('0'), old_bal - deduct)
                 logger.debug(f"💳 Mijoz balansidan ${balance_used} ayirildi. Yangi balans: ${float(sale_customer.balance)}")
 
+        # Ma'lumotlar bazasiga saqlash (savdo, tarix va balans bitta tranzaksiyada)
         db.session.commit()
 
         # CustomerTimelineSnapshot yozish (yangi va tahrirlangan savdolar uchun)
@@ -13079,17 +12404,14 @@ def get_sale(sale_id):
 
         # Sotuvchi uchun joylashuv ruxsatini tekshirish
         if current_user.role == 'sotuvchi':
-            allowed_locations = current_user.allowed_locations or []
+            principal = principal_cache.get_principal(current_user.id)
 
             # Savdo qaysi joyda amalga oshirilganini aniqlash
             sale_location_id = sale.store_id if sale.store_id else sale.warehouse_id
             sale_location_type = 'store' if sale.store_id else 'warehouse'
 
-            # Ruxsat etilgan joylashuvlardan ID larni ajratib olish
-            allowed_location_ids = extract_location_ids(allowed_locations, sale_location_type)
-
             # Agar sotuvchiga bu joylashuvda savdo qilish ruxsati bo'lmasa
-            if sale_location_id not in allowed_location_ids:
+            if not principal or not principal.can('allowed', sale_location_type, sale_location_id):
                 return jsonify({
                     'success': False,
                     'error': 'Bu savdoni ko\'rish uchun ruxsatingiz yo\'q'
@@ -13097,7 +12419,7 @@ def get_sale(sale_id):
 
         return jsonify({
             'success': True,
-            'sale': sale.to_dict()
+            'sale': serialize_sales([sale])[0]
         })
 
     except Exception as e:
@@ -13126,17 +12448,14 @@ def update_sale(sale_id):
 
         # Sotuvchi uchun joylashuv ruxsatini tekshirish
         if current_user.role == 'sotuvchi':
-            allowed_locations = current_user.allowed_locations or []
+            principal = principal_cache.get_principal(current_user.id)
 
             # Savdo qaysi joyda amalga oshirilganini aniqlash
             sale_location_id = sale.store_id if sale.store_id else sale.warehouse_id
             sale_location_type = 'store' if sale.store_id else 'warehouse'
 
-            # Ruxsat etilgan joylashuvlardan ID larni ajratib olish
-            allowed_location_ids = extract_location_ids(allowed_locations, sale_location_type)
-
             # Agar sotuvchiga bu joylashuvda savdo qilish ruxsati bo'lmasa
-            if sale_location_id not in allowed_location_ids:
+            if not principal or not principal.can('allowed', sale_location_type, sale_location_id):
                 return jsonify({
                     'success': False,
                     'error': 'Bu savdoni tahrirlash uchun ruxsatingiz yo\'q'
@@ -13256,13 +12575,18 @@ def update_sale(sale_id):
             # Tahrirlash vaqtidagi joriy kurs
             sale.currency_rate = get_current_currency_rate()
 
+        # Korzina rezervlari endi shu savdoga tegishli - sweeper ularni qaytarmasligi uchun
+        if data.get('cart_id'):
+            stock_reservations.consume_cart(data['cart_id'])
+
+        change_feed.publish('pending_sales', sale_id=sale_id)
         db.session.commit()
         app.logger.info(f"✅ Sale {sale_id} successfully updated")
 
         return jsonify({
             'success': True,
             'message': 'Savdo muvaffaqiyatli yangilandi',
-            'data': sale.to_dict()
+            'data': serialize_sales([sale])[0]
         })
 
     except Exception as e:
@@ -13296,17 +12620,14 @@ def delete_sale_with_stock_return(sale_id):
 
         # Sotuvchi uchun joylashuv ruxsatini tekshirish
         if current_user.role == 'sotuvchi':
-            allowed_locations = current_user.allowed_locations or []
+            principal = principal_cache.get_principal(current_user.id)
 
             # Savdo qaysi joyda amalga oshirilganini aniqlash
             sale_location_id = sale.store_id if sale.store_id else sale.warehouse_id
             sale_location_type = 'store' if sale.store_id else 'warehouse'
 
-            # Ruxsat etilgan joylashuvlardan ID larni ajratib olish
-            allowed_location_ids = extract_location_ids(allowed_locations, sale_location_type)
-
             # Agar sotuvchiga bu joylashuvda savdo qilish ruxsati bo'lmasa
-            if sale_location_id not in allowed_location_ids:
+            if not principal or not principal.can('allowed', sale_location_type, sale_location_id):
                 return jsonify({
                     'success': False,
                     'error': 'Bu savdoni o\'chirish uchun ruxsatingiz yo\'q'
@@ -13407,7 +12728,7 @@ def delete_sale_with_stock_return(sale_id):
 
         # OperationHistory ga yozish
         stock_returned = 'Ha' if return_stock else "Yo'q"
-        operation = OperationHistory(
+        audit_log.record(
             operation_type='delete',
             user_id=current_user.id,
             record_id=sale_id,
@@ -13417,7 +12738,6 @@ def delete_sale_with_stock_return(sale_id):
             location_type=sale.location_type,
             location_id=sale.location_id
         )
-        db.session.add(operation)
 
         # Savdoni o'chirish (cascade delete SaleItems ham o'chiradi)
         # Snapshot da o'chirilgan deb belgilash
@@ -13431,6 +12751,7 @@ def delete_sale_with_stock_return(sale_id):
             sd['deleted_at'] = get_tashkent_time().strftime('%Y-%m-%d %H:%M')
             del_snap.snapshot_data = sd
         db.session.delete(sale)
+        change_feed.publish('pending_sales', sale_id=sale_id)
         db.session.commit()
 
         return jsonify({
@@ -13583,24 +12904,27 @@ def create_pending_sale(data):
 
         # Items ni qo'shish (stock'dan ayirmasdan)
         total_amount = Decimal('0')
+        total_cost = Decimal('0')
+        total_profit = Decimal('0')
 
-        for item in items:
-            product_id = item.get('product_id') or item.get('id')
-            quantity = Decimal(str(item.get('quantity', 0)))
+        # Mahsulotlarni bitta IN (...) so'rovida yuklash
+        try:
+            cart = load_sale_cart(
+                items,
+                lambda item: (item.get('location_type', 'store'), item.get('location_id', store_id)),
+                with_stock=False)
+        except SaleCartError as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': str(e)}), e.status
+
+        sale_items = []
+        for line in cart.lines:
+            item = line.item
+            product = line.product
+            product_id = product.id
+            quantity = line.quantity
             unit_price = float(item.get('unit_price') or item.get('price', 0))
 
-            if quantity <= 0:
-                continue
-
-            # Product tekshirish
-            product = Product.query.get(product_id)
-            if not product:
-                db.session.rollback()
-                return jsonify({
-                    'success': False,
-                    'error': f'Mahsulot topilmadi: {product_id}'
-                }), 404
-
             # Cost price allaqachon USD da (products jadvalidagi qiymat)
             cost_price_usd = float(product.cost_price or Decimal('0'))
             if unit_price < cost_price_usd:
@@ -13612,8 +12936,8 @@ def create_pending_sale(data):
 
             # ESLATMA: Stock ayirish frontend'da korzinaga qo'shilganda amalga oshiriladi
             # Bu yerda faqat ma'lumot saqlash amalga oshiriladi
-            item_location_id = item.get('location_id', store_id)
-            item_location_type = item.get('location_type', 'store')
+            item_location_id = line.location_id
+            item_location_type = line.location_type
 
             logger.debug(
                 f"📦 Pending savdo item yaratilmoqda: {product.name} - {quantity} ta (Stock oldindan rezerv qilingan)")
@@ -13629,7 +12953,7 @@ def create_pending_sale(data):
             pending_unit_price_uzs = Decimal(str(item.get('price_uzs', 0) or 0))
             pending_total_price_uzs = pending_unit_price_uzs * Decimal(str(quantity))
 
-            sale_item = SaleItem(
+            sale_items.append(SaleItem(
                 sale_id=new_sale.id,
                 product_id=product_id,
                 quantity=quantity,
@@ -13642,43 +12966,49 @@ def create_pending_sale(data):
                 source_type=item_location_type,
                 source_id=item_location_id,
                 notes=f"Pending: {product.name}"
-            )
-
-            db.session.add(sale_item)
+            ))
             total_amount += total_price_usd  # USD da yig'ish
+            # Savdo jami summalarini hisoblash (USD da)
+            total_cost += Decimal(str(cost_price_usd)) * quantity
+            total_profit += profit_usd
 
-        # Savdo jami summalarini hisoblash (USD da)
-        total_cost = Decimal('0')
-        total_profit = Decimal('0')
-
-        for sale_item in new_sale.items:
-            total_cost += sale_item.cost_price * sale_item.quantity
-            total_profit += sale_item.profit
+        # Bitta flush'da - INSERT'lar to'plab (executemany) yuboriladi
+        db.session.add_all(sale_items)
 
         new_sale.total_amount = total_amount  # USD da
         new_sale.total_cost = total_cost  # USD da
         new_sale.total_profit = total_profit  # USD da
 
-        db.session.commit()
+        # Korzina rezervini yakunlash (pending savdo stock'ni band qilib turadi).
+        # Asl/eski pending savdodan kelgan korzinada miqdorlar allaqachon ayirilgan.
+        cart_id = data.get('cart_id')
+        if cart_id:
+            sold_lines = None
+            if not (original_sale_id or pending_sale_id):
+                sold_lines = [{'product_id': si.product_id, 'quantity': si.quantity,
+                               'location_type': si.source_type, 'location_id': si.source_id}
+                              for si in sale_items]
+            try:
+                stock_reservations.consume_cart(cart_id, sold_lines)
+            except stock_reservations.ReservationError as e:
+                db.session.rollback()
+                return jsonify({'success': False, 'error': str(e), 'shortages': e.lines}), 400
 
-        logger.info(f" Pending savdo yaratildi: ID={new_sale.id}")
+        # Tarix yozuvlari uchun qatorlar mahsulotlari bilan bitta yuklashda
+        new_sale = Sale.query.options(
+            db.selectinload(Sale.items).joinedload(SaleItem.product)
+        ).filter_by(id=new_sale.id).one()
 
         # OperationHistory ga pending savdoni yozish
         location_name = ''
-        if item_location_type == 'store':
-            store_obj = Store.query.get(item_location_id)
-            if store_obj:
-                location_name = store_obj.name
-        elif item_location_type == 'warehouse':
-            warehouse_obj = Warehouse.query.get(item_location_id)
-            if warehouse_obj:
-                location_name = warehouse_obj.name
+        if item_location_type in ('store', 'warehouse'):
+            location_name = location_directory.resolve(item_location_type, item_location_id, '')
 
         # Har bir mahsulot uchun alohida OperationHistory yozuvi
         sale_username = f'{current_user.first_name} {current_user.last_name}'
         for sale_item in new_sale.items:
             item_amount_uzs = float(sale_item.total_price * new_sale.currency_rate) if sale_item.total_price else None
-            op_item = OperationHistory(
+            audit_log.record(
                 operation_type='sale',
                 table_name='products',
                 record_id=sale_item.product_id,
@@ -13700,9 +13030,12 @@ def create_pending_sale(data):
                 location_name=location_name,
                 amount=item_amount_uzs
             )
-            db.session.add(op_item)
+
+        change_feed.publish('pending_sales')
         db.session.commit()
 
+        logger.info(f" Pending savdo yaratildi: ID={new_sale.id}")
+
         return jsonify({
             'success': True,
             'message': 'Savdo keyinroq tasdiqlash uchun saqlandi',
@@ -13738,9 +13071,9 @@ def get_current_currency_rate():
 # xotirasiga ega bo'lgani uchun, bir so'rov 1-worker'ga, uning
 # dublikati 2-worker'ga tushsa dedupe ISHLAMAS edi -> stock ikki
 # marta o'zgarib, ombor qoldig'i xato bo'lardi.
-# Endi ApiOperation jadvali (umumiy PostgreSQL) ishlatiladi:
-# idempotency_key ustunidagi UNIQUE constraint tufayli faqat BITTA
-# so'rov operatsiyani bajaradi.
+# Endi api_operation_keys jadvali (umumiy PostgreSQL, bo'laklanmagan)
+# ishlatiladi: idempotency_key PRIMARY KEY va ON CONFLICT DO NOTHING
+# tufayli faqat BITTA so'rov operatsiyani bajaradi.
 # ============================================================
 
 def _claim_stock_operation(idempotency_key, operation_type):
@@ -13750,25 +13083,22 @@ def _claim_stock_operation(idempotency_key, operation_type):
         True  -> birinchi marta: operatsiyani BAJARING
         False -> allaqachon bajarilgan: operatsiyani O'TKAZIB YUBORING
 
-    ApiOperation yozuvi shu yerda session'ga qo'shiladi va asosiy stock
-    o'zgarishi bilan BIR commit'da saqlanadi (atomik). Agar key allaqachon
-    mavjud bo'lsa, UNIQUE constraint IntegrityError beradi -> False.
+    Kalit claim'i (api_operation_keys) va ApiOperation yozuvi asosiy stock
+    o'zgarishi bilan BIR commit'da saqlanadi (atomik). api_operations
+    bo'lakli - uning UNIQUE (idempotency_key, created_at) dublikatni
+    ushlamaydi, shuning uchun qaror faqat claim bo'yicha.
     """
     if not idempotency_key:
         return True  # Key bo'lmasa dedupe qilib bo'lmaydi, davom etamiz
 
-    from sqlalchemy.exc import IntegrityError
-    try:
-        db.session.add(ApiOperation(
-            idempotency_key=idempotency_key,
-            operation_type=operation_type,
-            status='completed'
-        ))
-        db.session.flush()  # INSERT shu yerda -> unique violation darhol chiqadi
-        return True
-    except IntegrityError:
-        db.session.rollback()  # Key allaqachon mavjud -> dublikat
-        return False
+    if not _claim_idempotency_key(idempotency_key, operation_type):
+        return False  # Key allaqachon mavjud -> dublikat
+    db.session.add(ApiOperation(
+        idempotency_key=idempotency_key,
+        operation_type=operation_type,
+        status='completed'
+    ))
+    return True
 
 # API endpoint - Real-time stock rezerv qilish (korzinaga qo'shilganda)
 @app.route('/api/reserve-stock', methods=['POST'])
@@ -13782,12 +13112,19 @@ def api_reserve_stock():
         location_id = data.get('location_id')
         location_type = data.get('location_type')
         idempotency_key = data.get('idempotency_key')
+        # Savdo ekrani korzinasi - rezerv muddati o'tsa sweeper stock'ni qaytaradi
+        cart_id = str(data.get('cart_id') or '').strip()[:64]
 
         # Idempotency: atomik claim (DB orqali - 3 worker uchun ham xavfsiz)
         if not _claim_stock_operation(idempotency_key, 'reserve_stock'):
             logger.debug(f"✅ IDEMPOTENCY: {idempotency_key} allaqachon bajarilgan, qaytarish")
             return jsonify({'success': True, 'already_processed': True}), 200
 
+        # Korzina qulfi stock qatoridan OLDIN olinadi (batch endpoint va sweeper tartibi)
+        if cart_id:
+            stock_reservations.track_line(cart_id, location_type, location_id, product_id,
+                                          quantity, user_id=session.get('user_id'))
+
         import traceback
         logger.debug(''.join(traceback.format_stack()[-5:-1]))
         logger.debug(f"\n{'=' * 80}")
@@ -13818,16 +13155,14 @@ def api_reserve_stock():
             ).with_for_update().first()  # Row-level lock: race condition oldini oladi
 
             if not stock:
-                store_obj = Store.query.get(location_id)
-                store_name = store_obj.name if store_obj else 'noma\'lum'
+                store_name = location_directory.resolve('store', location_id, 'noma\'lum')
                 return jsonify({
                     'success': False,
                     'error': f'{store_name} do\'konida {product.name} mahsuloti stock\'i yo\'q!'
                 }), 400
 
             if stock.quantity < quantity:
-                store_obj = Store.query.get(location_id)
-                store_name = store_obj.name if store_obj else 'noma\'lum'
+                store_name = location_directory.resolve('store', location_id, 'noma\'lum')
                 return jsonify({'success': False, 'error': f'{store_name} do\'konida yetarli stock yo\'q! Mavjud: {stock.quantity}, Kerak: {quantity}'}), 400
 
             # Real-time stock'dan ayirish
@@ -13845,16 +13180,14 @@ def api_reserve_stock():
             ).with_for_update().first()  # Row-level lock: race condition oldini oladi
 
             if not stock:
-                warehouse_obj = Warehouse.query.get(location_id)
-                warehouse_name = warehouse_obj.name if warehouse_obj else 'noma\'lum'
+                warehouse_name = location_directory.resolve('warehouse', location_id, 'noma\'lum')
                 return jsonify({
                     'success': False,
                     'error': f'{warehouse_name} omborida {product.name} mahsuloti stock\'i yo\'q!'
                 }), 400
 
             if stock.quantity < quantity:
-                warehouse_obj = Warehouse.query.get(location_id)
-                warehouse_name = warehouse_obj.name if warehouse_obj else 'noma\'lum'
+                warehouse_name = location_directory.resolve('warehouse', location_id, 'noma\'lum')
                 return jsonify({'success': False, 'error': f'{warehouse_name} omborida yetarli stock yo\'q! Mavjud: {stock.quantity}, Kerak: {quantity}'}), 400
 
             # Real-time stock'dan ayirish
@@ -13879,6 +13212,9 @@ def api_reserve_stock():
             'remaining_stock': remaining_stock
         })
 
+    except stock_reservations.ReservationError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         logger.error(f" Stock tekshirishda xatolik: {str(e)}")
@@ -13898,12 +13234,18 @@ def api_return_stock():
         location_id = data.get('location_id')
         location_type = data.get('location_type')
         idempotency_key = data.get('idempotency_key')
+        cart_id = str(data.get('cart_id') or '').strip()[:64]
 
         # Idempotency: atomik claim (DB orqali - 3 worker uchun ham xavfsiz)
         if not _claim_stock_operation(idempotency_key, 'return_stock'):
             logger.debug(f"✅ IDEMPOTENCY: {idempotency_key} allaqachon bajarilgan, qaytarish")
             return jsonify({'success': True, 'already_processed': True}), 200
 
+        # Korzina rezervini kamaytirish (stock qatoridan OLDIN qulflanadi)
+        if cart_id:
+            stock_reservations.track_line(cart_id, location_type, location_id, product_id,
+                                          -quantity, user_id=session.get('user_id'))
+
         logger.debug(f"\n{'=' * 80}")
         logger.debug("↩️ RETURN-STOCK API CHAQIRILDI:")
         logger.debug(f"   Product ID: {product_id}")
@@ -13992,11 +13334,55 @@ def api_return_stock():
             'new_stock': new_stock
         })
 
+    except stock_reservations.ReservationError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         logger.error(f" Stock qaytarishda xatolik: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# API endpoint - Butun korzinani bitta tranzaksiyada rezerv qilish
+
+
+@app.route('/api/reserve-stock/batch', methods=['POST'])
+@role_required('admin', 'kassir', 'sotuvchi')
+def api_reserve_stock_batch():
+    """Korzinaning kerakli holatini (mutlaq miqdorlar) bitta commit'da rezerv qilish.
+
+    Body: {cart_id, items: [{product_id, location_type, location_id, quantity}],
+           idempotency_key?}
+    items'da yo'q qatorlar rezervi qaytariladi, bo'sh items - korzinani bo'shatish.
+    """
+    try:
+        data = request.get_json() or {}
+        cart_id = str(data.get('cart_id') or '').strip()
+        items = data.get('items') or []
+        idempotency_key = data.get('idempotency_key')
+
+        if not cart_id or len(cart_id) > 64:
+            return jsonify({'success': False, 'error': 'cart_id noto\'g\'ri'}), 400
+
+        if not _claim_stock_operation(idempotency_key, 'reserve_stock_batch'):
+            logger.debug(f"✅ IDEMPOTENCY: {idempotency_key} allaqachon bajarilgan, qaytarish")
+            return jsonify({'success': True, 'already_processed': True}), 200
+
+        result = stock_reservations.apply_cart(cart_id, items, user_id=session.get('user_id'))
+
+        # Stock + rezervlar + idempotency claim BIR commit'da
+        db.session.commit()
+        logger.debug(f"💾 DB COMMIT: Korzina {cart_id} rezervi saqlandi ({result['changed']} ta o'zgarish)")
+
+        return jsonify({'success': True, **result})
+
+    except stock_reservations.ReservationError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e), 'shortages': e.lines}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f" Korzina rezervida xatolik: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # API endpoint - Pending savdolar yaratish
 
 
@@ -14120,6 +13506,7 @@ def api_update_pending_sale(sale_id):
             )
             db.session.add(sale_item)
 
+        change_feed.publish('pending_sales', sale_id=sale_id)
         db.session.commit()
         logger.info(f" Pending savdo yangilandi: {sale_id}")
 
@@ -14168,6 +13555,7 @@ def api_delete_pending_sale(sale_id):
 
         # Savdoni o'chirish
         db.session.delete(sale)
+        change_feed.publish('pending_sales', sale_id=sale_id)
         db.session.commit()
 
         logger.info(f" Pending savdo o'chirildi: {sale_id}")
@@ -14187,6 +13575,7 @@ def api_delete_pending_sale(sale_id):
 
 @app.route('/api/currency-rate', methods=['GET'])
 @role_required('admin', 'manager', 'kassir', 'sotuvchi')
+@etag_cached('currency_rate')
 def get_currency_rate():
     """Joriy valyuta kursini olish"""
     try:
@@ -14259,6 +13648,7 @@ def update_currency_rate():
             is_active=True).update({'is_active': False})
 
         db.session.add(currency_rate)
+        change_feed.publish('currency_rate')
         db.session.commit()
 
         return jsonify({
@@ -14308,6 +13698,7 @@ def clear_currency_rate_history():
         for rate in all_rates:
             db.session.delete(rate)
 
+        change_feed.publish('currency_rate')
         db.session.commit()
 
         logger.debug(
@@ -14815,6 +14206,7 @@ def api_login():
                     )
                     app.logger.info(f"🔒 Eski session o'chirildi: User {user.username}, Session: {old_session.session_id[:8]}...")
 
+                principal_cache.invalidate(user.id)  # Xom UPDATE - ORM eventi yo'q
                 db.session.commit()  # Eski sessionlarni saqlash
 
             # Yangi session yaratish
@@ -15108,75 +14500,18 @@ def api_sales_statistics():
         date_from = request.args.get('date_from')
         date_to = request.args.get('date_to')
 
-        # Base query
-        query = """
-            SELECT
-                COUNT(*) as total_sales,
-                COALESCE(SUM(si.unit_price * si.quantity), 0) as total_revenue,
-                COALESCE(AVG(si.unit_price * si.quantity), 0) as avg_sale
-            FROM sale_items si
-            JOIN sales s ON si.sale_id = s.id
-        """
-
-        conditions = []
-        params = {}
-
-        if location_id:
-            conditions.append("s.location_id = :location_id")
-            params['location_id'] = int(location_id)
-
-        if date_from:
-            conditions.append("s.sale_date >= :date_from")
-            params['date_from'] = date_from
-
-        if date_to:
-            conditions.append("s.sale_date <= :date_to")
-            params['date_to'] = date_to
-
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-
-        # Database query bilan statistics olish
-        result = db.session.execute(text(query), params)
-        stats = result.fetchone()
-
-        # En faol joylashuvni topish
-        top_location_query = """
-            SELECT
-                CASE
-                    WHEN s.location_type = 'store' THEN st.name
-                    WHEN s.location_type = 'warehouse' THEN w.name
-                END as location_name,
-                COUNT(*) as sales_count
-            FROM sales s
-            LEFT JOIN stores st ON s.location_id = st.id AND s.location_type = 'store'
-            LEFT JOIN warehouses w ON s.location_id = w.id AND s.location_type = 'warehouse'
-        """
-
-        top_conditions = []
-        top_params = {}
-
-        if date_from:
-            top_conditions.append("s.sale_date >= :date_from")
-            top_params['date_from'] = date_from
-
-        if date_to:
-            top_conditions.append("s.sale_date <= :date_to")
-            top_params['date_to'] = date_to
-
-        if top_conditions:
-            top_location_query += " WHERE " + " AND ".join(top_conditions)
-
-        top_location_query += " GROUP BY location_name ORDER BY sales_count DESC LIMIT 1"
+        # sales_daily_rollup'dan - O(kunlar), sale_items jadvalini skanerlamaydi
+        total_sales, total_revenue, avg_sale = sales_rollup.item_summary(
+            date_from, date_to, location_id)
 
-        result = db.session.execute(text(top_location_query), top_params)
-        top_location = result.fetchone()
+        # Eng faol joylashuvni topish
+        location_counts = sales_rollup.location_sales_counts(date_from, date_to)
 
         return jsonify({
-            'total_sales': stats[0] if stats else 0,
-            'total_revenue': float(stats[1]) if stats and stats[1] else 0,
-            'avg_sale': float(stats[2]) if stats and stats[2] else 0,
-            'top_location': top_location[0] if top_location else '-'
+            'total_sales': total_sales,
+            'total_revenue': total_revenue,
+            'avg_sale': avg_sale,
+            'top_location': location_counts[0][0] if location_counts else '-'
         })
 
     except Exception as e:
@@ -15227,100 +14562,11 @@ def api_sales_chart():
             f"📅 Hisoblangan sanalar: date_from={date_from}, date_to={date_to}")
 
         # Bugun filtri uchun soat bo'yicha, boshqalar uchun kun bo'yicha
-        if period == 'today':
-            query = """
-                SELECT
-                    EXTRACT(HOUR FROM s.sale_date) as time_period,
-                    COUNT(*) as period_sales,
-                    COALESCE(SUM(s.total_amount), 0) as period_total,
-                    COALESCE(SUM(s.total_profit), 0) as period_profit,
-                    COALESCE(SUM(s.cash_usd), 0) as cash_total,
-                    COALESCE(SUM(s.click_usd), 0) as click_total,
-                    COALESCE(SUM(s.terminal_usd), 0) as terminal_total,
-                    COALESCE(SUM(s.debt_usd), 0) as debt_total,
-                    COALESCE(SUM(si_agg.total_uzs), 0) as period_total_uzs,
-                    COALESCE(SUM(s.cash_amount), 0) as cash_uzs_total,
-                    COALESCE(SUM(s.click_amount), 0) as click_uzs_total,
-                    COALESCE(SUM(s.terminal_amount), 0) as terminal_uzs_total,
-                    COALESCE(SUM(s.debt_amount), 0) as debt_uzs_total
-                FROM sales s
-                LEFT JOIN (
-                    SELECT sale_id, SUM(total_price_uzs) as total_uzs
-                    FROM sale_items
-                    GROUP BY sale_id
-                ) si_agg ON si_agg.sale_id = s.id
-                WHERE (s.cash_usd > 0 OR s.click_usd > 0 OR s.terminal_usd > 0 OR s.debt_usd > 0)
-            """
-        else:
-            query = """
-                SELECT
-                    DATE(s.sale_date) as time_period,
-                    COUNT(*) as period_sales,
-                    COALESCE(SUM(s.total_amount), 0) as period_total,
-                    COALESCE(SUM(s.total_profit), 0) as period_profit,
-                    COALESCE(SUM(s.cash_usd), 0) as cash_total,
-                    COALESCE(SUM(s.click_usd), 0) as click_total,
-                    COALESCE(SUM(s.terminal_usd), 0) as terminal_total,
-                    COALESCE(SUM(s.debt_usd), 0) as debt_total,
-                    COALESCE(SUM(si_agg.total_uzs), 0) as period_total_uzs,
-                    COALESCE(SUM(s.cash_amount), 0) as cash_uzs_total,
-                    COALESCE(SUM(s.click_amount), 0) as click_uzs_total,
-                    COALESCE(SUM(s.terminal_amount), 0) as terminal_uzs_total,
-                    COALESCE(SUM(s.debt_amount), 0) as debt_uzs_total
-                FROM sales s
-                LEFT JOIN (
-                    SELECT sale_id, SUM(total_price_uzs) as total_uzs
-                    FROM sale_items
-                    GROUP BY sale_id
-                ) si_agg ON si_agg.sale_id = s.id
-                WHERE (s.cash_usd > 0 OR s.click_usd > 0 OR s.terminal_usd > 0 OR s.debt_usd > 0)
-            """
-
-        conditions = []
-        params = {}
-
-        # Joylashuv filtri - location_id va location_type ishlatish
+        # (sales_hourly_rollup / sales_daily_rollup - butun sale_items jadvali emas)
         location_type = request.args.get('location_type')
-        if location_id:
-            if location_type == 'store':
-                conditions.append("(s.location_id = :location_id AND s.location_type = 'store')")
-                params['location_id'] = int(location_id)
-                logger.debug(f"🏪 Store filtri: location_id={location_id}, location_type=store")
-            elif location_type == 'warehouse':
-                # Warehouse'dan savdo bo'lishi mumkin (yangi tizimda)
-                conditions.append("(s.location_id = :location_id AND s.location_type = 'warehouse')")
-                params['location_id'] = int(location_id)
-                logger.debug(f"🏭 Warehouse filtri: location_id={location_id}, location_type=warehouse")
-            else:
-                # Type berilmagan, location_id bo'yicha
-                conditions.append("s.location_id = :location_id")
-                params['location_id'] = int(location_id)
-                logger.debug(f"🏢 Umumiy filtri: location_id={location_id}")
-
-        if date_from:
-            conditions.append("DATE(s.sale_date) >= :date_from")
-            params['date_from'] = date_from
-
-        if date_to:
-            conditions.append("DATE(s.sale_date) <= :date_to")
-            params['date_to'] = date_to
-
-        if conditions:
-            query += " AND " + " AND ".join(conditions)
-
-        # GROUP BY va ORDER BY
-        if period == 'today':
-            query += " GROUP BY EXTRACT(HOUR FROM s.sale_date) ORDER BY time_period"
-        else:
-            query += " GROUP BY DATE(s.sale_date) ORDER BY time_period"
-
-        # SQLAlchemy ishlatamiz
-        logger.debug(f"🔍 SQL Query: {query}")
-        logger.debug(f"🔍 Params: {params}")
-        results = db.session.execute(text(query), params).fetchall()
+        results = sales_rollup.chart_rows(
+            period == 'today', date_from, date_to, location_id, location_type)
         logger.debug(f"📊 Results count: {len(results)}")
-        for row in results:
-            logger.debug(f"  Row: {row}")
 
         labels = []
         values = []
@@ -15431,48 +14677,12 @@ def api_location_chart():
         date_from = request.args.get('date_from')
         date_to = request.args.get('date_to')
 
-        query = """
-            SELECT
-                CASE
-                    WHEN s.location_type = 'store' THEN st.name
-                    WHEN s.location_type = 'warehouse' THEN w.name
-                END as location_name,
-                COUNT(*) as sales_count
-            FROM sales s
-            LEFT JOIN stores st ON s.location_id = st.id AND s.location_type = 'store'
-            LEFT JOIN warehouses w ON s.location_id = w.id AND s.location_type = 'warehouse'
-        """
-
-        conditions = []
-        params = {}
-
-        if date_from:
-            conditions.append("s.sale_date >= :date_from")
-            params['date_from'] = date_from
-
-        if date_to:
-            conditions.append("s.sale_date <= :date_to")
-            params['date_to'] = date_to
-
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-
-        query += " GROUP BY location_name ORDER BY sales_count DESC"
-
-        result = db.session.execute(text(query), params)
-        results = result.fetchall()
-
-        labels = []
-        values = []
-
-        for row in results:
-            if row[0]:  # location_name mavjud bo'lsa
-                labels.append(row[0])
-                values.append(row[1])
+        # sales_daily_rollup'dan joylashuvlar bo'yicha savdolar soni
+        location_counts = sales_rollup.location_sales_counts(date_from, date_to)
 
         return jsonify({
-            'labels': labels,
-            'values': values
+            'labels': [name for name, _ in location_counts],
+            'values': [count for _, count in location_counts]
         })
 
     except Exception as e:
@@ -15571,16 +14781,14 @@ def get_settings():
 
         # Bazadan sozlamalarni olish
         settings_data = {}
-        settings_list = Settings.query.all()
-
-        for setting in settings_list:
+        for key, value in settings_service.all_settings().items():
             # user_language_ kalitlarini chiqarib tashlash (per-user til sozlamalari)
-            if setting.key.startswith('user_language_'):
+            if key.startswith('user_language_'):
                 continue
-            if setting.value.lower() in ['true', 'false']:
-                settings_data[setting.key] = setting.value.lower() == 'true'
+            if (value or '').lower() in ['true', 'false']:
+                settings_data[key] = value.lower() == 'true'
             else:
-                settings_data[setting.key] = setting.value
+                settings_data[key] = value
 
         # Standart sozlamalar bilan birlashtirish
         result = {**default_settings, **settings_data}
@@ -16020,10 +15228,9 @@ def api_hisobot_extra():
         for s in low_store:
             if not s.product:
                 continue
-            store_obj = Store.query.get(s.store_id)
             low_stock.append({
                 'product': s.product.name,
-                'location': store_obj.name if store_obj else 'Do\'kon',
+                'location': location_directory.resolve('store', s.store_id, 'Do\'kon'),
                 'location_type': 'store',
                 'location_id': s.store_id,
                 'qty': float(s.quantity),
@@ -16033,10 +15240,9 @@ def api_hisobot_extra():
         for s in low_wh:
             if not s.product:
                 continue
-            wh_obj = Warehouse.query.get(s.warehouse_id)
             low_stock.append({
                 'product': s.product.name,
-                'location': wh_obj.name if wh_obj else 'Ombor',
+                'location': location_directory.resolve('warehouse', s.warehouse_id, 'Ombor'),
                 'location_type': 'warehouse',
                 'location_id': s.warehouse_id,
                 'qty': float(s.quantity),
@@ -16220,18 +15426,17 @@ def api_hisobot_total_debt():
     umumiy (joriy) qarzi - customer_balances sahifasidagi kabi.
     """
     try:
+        # customer_debt_summary - faqat qarzdorlar, sales ustida GROUP BY yo'q
         rows = db.session.query(
             Customer.id.label('customer_id'),
             Customer.name.label('customer_name'),
-            db.func.coalesce(db.func.sum(Sale.debt_usd), 0).label('total_debt')
+            CustomerDebtSummary.debt_usd.label('total_debt')
         ).join(
-            Sale, Sale.customer_id == Customer.id
+            CustomerDebtSummary, CustomerDebtSummary.customer_id == Customer.id
         ).filter(
-            Sale.debt_usd > 0
-        ).group_by(
-            Customer.id, Customer.name
+            CustomerDebtSummary.debt_usd > 0
         ).order_by(
-            db.func.sum(Sale.debt_usd).desc()
+            CustomerDebtSummary.debt_usd.desc()
         ).all()
 
         customers = [{
@@ -16722,9 +15927,7 @@ def inject_settings():
     """Barcha templatelarga sozlamalarni va til tarjimalarini uzatish"""
     try:
         # stock_check_visible sozlamasini olish
-        setting = Settings.query.filter_by(key='stock_check_visible').first()
-        stock_check_visible = (setting.value.lower() == 'true'
-                               if setting else True)
+        stock_check_visible = settings_service.get_bool('stock_check_visible', True)
 
         # Hozirgi tilni olish - ISHONCHLI usul: bazadan o'qish
         current_language = session.get('language', 'uz_latin')
@@ -16733,9 +15936,9 @@ def inject_settings():
         user_id = session.get('user_id')
         if user_id:
             try:
-                user_lang = Settings.query.filter_by(key=f'user_language_{user_id}').first()
-                if user_lang and user_lang.value in ('uz_latin', 'uz_cyrillic', 'ru'):
-                    current_language = user_lang.value
+                user_lang = settings_service.user_language(user_id)
+                if user_lang:
+                    current_language = user_lang
                     # Session'ni ham yangilash
                     if session.get('language') != current_language:
                         session['language'] = current_language
@@ -16751,52 +15954,14 @@ def inject_settings():
             """Kalit bo'yicha tarjimani qaytaradi"""
             return current_translations.get(key, key)
 
-        # Qarz savdolar soni
-        debt_sales_count = 0
-        try:
-            if session.get('user_id'):
-                debt_sales_count = Sale.query.filter(
-                    Sale.payment_status == 'partial',
-                    Sale.debt_usd > 0
-                ).count()
-        except Exception:
-            debt_sales_count = 0
-
-        # Tasdiqlanmagan savdolar soni
-        pending_sales_count = 0
-        try:
-            if session.get('user_id'):
-                pending_sales_count = Sale.query.filter(
-                    Sale.payment_status == 'pending'
-                ).count()
-        except Exception:
-            pending_sales_count = 0
-
-        # Jarayondagi transferlar soni
-        pending_transfer_count = 0
-        try:
-            if session.get('user_id'):
-                pending_transfer_count = PendingTransfer.query.count()
-        except Exception:
-            pending_transfer_count = 0
-
-        # Aktiv qoldiq tekshirish sessiyalari soni
-        stock_check_count = 0
-        try:
-            if session.get('user_id'):
-                stock_check_count = StockCheckSession.query.filter(
-                    StockCheckSession.status == 'active'
-                ).count()
-        except Exception:
-            stock_check_count = 0
-
-        # Jarayondagi mahsulot qo'shish sessiyalari soni
-        pending_product_count = 0
+        # Menyu nishonlari (qarzli/pending savdolar, transferlar, tekshiruvlar,
+        # mahsulot qo'shish) - workerlar uchun umumiy keshdan (badge_counters.py)
+        counters = dict.fromkeys(badge_counters.COUNTER_NAMES, 0)
         try:
             if session.get('user_id'):
-                pending_product_count = PendingProductBatch.query.count()
-        except Exception:
-            pending_product_count = 0
+                counters = badge_counters.get_counters()
+        except Exception as counter_err:
+            logger.debug(f"Badge hisoblagichlari olinmadi: {counter_err}")
 
         return {
             'stock_check_visible': stock_check_visible,
@@ -16804,11 +15969,7 @@ def inject_settings():
             'current_language': current_language,
             't': t,  # Tarjima funksiyasi
             'translations': current_translations,
-            'debt_sales_count': debt_sales_count,
-            'pending_sales_count': pending_sales_count,
-            'pending_transfer_count': pending_transfer_count,
-            'stock_check_count': stock_check_count,
-            'pending_product_count': pending_product_count
+            **counters
         }
     except Exception as e:
         logger.error(f"Context processor error: {e}")
@@ -16902,11 +16063,9 @@ def api_send_debt_sms():
         # Joylashuv nomini olish
         location_name = "Do'kon"
         if sale_with_location.location_type == 'store':
-            store = Store.query.get(sale_with_location.location_id)
-            location_name = store.name if store else "Do'kon"
+            location_name = location_directory.resolve('store', sale_with_location.location_id, "Do'kon")
         elif sale_with_location.location_type == 'warehouse':
-            warehouse = Warehouse.query.get(sale_with_location.location_id)
-            location_name = warehouse.name if warehouse else "Ombor"
+            location_name = location_directory.resolve('warehouse', sale_with_location.location_id, "Ombor")
 
         # Eng yaqin payment_due_date ni olish
         nearest_due = db.session.query(
@@ -17013,11 +16172,9 @@ def api_send_payment_sms():
             location_name = "Do'kon"
             if sale_with_location:
                 if sale_with_location.location_type == 'store':
-                    store = Store.query.get(sale_with_location.location_id)
-                    location_name = store.name if store else "Do'kon"
+                    location_name = location_directory.resolve('store', sale_with_location.location_id, "Do'kon")
                 elif sale_with_location.location_type == 'warehouse':
-                    warehouse = Warehouse.query.get(sale_with_location.location_id)
-                    location_name = warehouse.name if warehouse else "Ombor"
+                    location_name = location_directory.resolve('warehouse', sale_with_location.location_id, "Ombor")
 
             scheduler = get_scheduler_instance(app, db)
 
@@ -17185,8 +16342,7 @@ def api_create_debt_reminder():
         customer_id = data.get('customer_id')
         reminder_date = data.get('reminder_date')  # YYYY-MM-DD
         # Agar vaqt berilmagan bo'lsa Settings'dan default vaqtni olish
-        default_time_setting = Settings.query.filter_by(key='default_reminder_time').first()
-        default_time = default_time_setting.value if default_time_setting else '10:00'
+        default_time = settings_service.get('default_reminder_time', '10:00')
         reminder_time = data.get('reminder_time', default_time)  # HH:MM
         message = data.get('message', '')
 
@@ -17360,8 +16516,7 @@ def api_check_and_send_reminders():
 
 
 # ============================================
-# Bandwidth kesh (5 daqiqa TTL)
-_bw_cache = {}
+# Bandwidth kesh (5 daqiqa TTL, shared_cache da)
 _BW_CACHE_TTL = 300
 
 # HOSTING ADMIN PANEL ROUTES
@@ -17400,18 +16555,14 @@ def api_hosting_widget_status(token):
         # Trafik ma'lumotini olish (kesh bilan, 5 daqiqa)
         traffic = None
         if client.droplet_id:
-            import time as _time
-            _cached = _bw_cache.get(client.droplet_id)
-            if _cached and (_time.time() - _cached['ts']) < _BW_CACHE_TTL:
-                traffic = _cached['data']
-            else:
-                try:
-                    from digitalocean_manager import DigitalOceanManager
-                    do_mgr = DigitalOceanManager()
-                    traffic = do_mgr.get_monthly_bandwidth_gb(client.droplet_id)
-                    _bw_cache[client.droplet_id] = {'data': traffic, 'ts': _time.time()}
-                except Exception as _e:
-                    logger.warning(f"Trafik ma'lumotini olishda xato ({client.name}): {_e}")
+            try:
+                from digitalocean_manager import DigitalOceanManager
+                traffic, _ = shared_cache.get_or_set(
+                    f'bandwidth:{client.droplet_id}',
+                    lambda: DigitalOceanManager().get_monthly_bandwidth_gb(client.droplet_id),
+                    _BW_CACHE_TTL)
+            except Exception as _e:
+                logger.warning(f"Trafik ma'lumotini olishda xato ({client.name}): {_e}")
 
         # CORS header
         response = jsonify({
@@ -17984,32 +17135,17 @@ def xarajatlar():
     """Xarajatlar sahifasi"""
     current_user = get_current_user()
     if current_user and current_user.role not in ('admin', 'kassir'):
-        allowed_locations = current_user.allowed_locations or []
-        allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-        allowed_wh_ids = extract_location_ids(allowed_locations, 'warehouse')
+        allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+        allowed_wh_ids = user_location_ids(current_user, 'allowed', 'warehouse')
         stores = [s.to_dict() for s in Store.query.filter(Store.id.in_(allowed_store_ids)).order_by(Store.name).all()] if allowed_store_ids else []
         warehouses = [w.to_dict() for w in Warehouse.query.filter(Warehouse.id.in_(allowed_wh_ids)).order_by(Warehouse.name).all()] if allowed_wh_ids else []
     else:
         stores = [s.to_dict() for s in Store.query.order_by(Store.name).all()]
         warehouses = [w.to_dict() for w in Warehouse.query.order_by(Warehouse.name).all()]
     # Kategoriyalar va dam olish kunlari - Settings jadvalidan
-    cat_setting = Settings.query.filter_by(key='expense_categories').first()
-    if cat_setting and cat_setting.value:
-        import json as _json
-        try:
-            expense_categories = _json.loads(cat_setting.value)
-        except Exception:
-            expense_categories = ['Ijara', 'Maosh', 'Kommunal', 'Transport', 'Boshqa']
-    else:
-        expense_categories = ['Ijara', 'Maosh', 'Kommunal', 'Transport', 'Boshqa']
-    rest_setting = Settings.query.filter_by(key='expense_rest_days').first()
-    if rest_setting and rest_setting.value:
-        try:
-            expense_rest_days = _json.loads(rest_setting.value)
-        except Exception:
-            expense_rest_days = []
-    else:
-        expense_rest_days = []
+    expense_categories = settings_service.get_json(
+        'expense_categories', ['Ijara', 'Maosh', 'Kommunal', 'Transport', 'Boshqa'])
+    expense_rest_days = settings_service.get_json('expense_rest_days', [])
     return render_template('xarajatlar.html', stores=stores, warehouses=warehouses,
                            expense_categories=expense_categories,
                            expense_rest_days=expense_rest_days)
@@ -18031,9 +17167,8 @@ def api_get_expenses():
 
         # Sotuvchi faqat o'ziga ruxsat etilgan joylashuvlarni ko'radi
         if current_user and current_user.role not in ('admin', 'kassir'):
-            allowed_locations = current_user.allowed_locations or []
-            allowed_store_ids = extract_location_ids(allowed_locations, 'store')
-            allowed_wh_ids = extract_location_ids(allowed_locations, 'warehouse')
+            allowed_store_ids = user_location_ids(current_user, 'allowed', 'store')
+            allowed_wh_ids = user_location_ids(current_user, 'allowed', 'warehouse')
             from sqlalchemy import or_, and_
             filters = []
             if allowed_store_ids:
@@ -18091,12 +17226,11 @@ def api_add_expense():
 
         # Sotuvchi faqat o'z joylashuviga xarajat qo'sha oladi
         if current_user and current_user.role not in ('admin', 'kassir'):
-            allowed_locations = current_user.allowed_locations or []
             req_type = data.get('location_type')
             req_id = data.get('location_id')
             if req_type and req_id:
-                allowed_ids = extract_location_ids(allowed_locations, req_type)
-                if allowed_ids is not None and int(req_id) not in allowed_ids:
+                principal = principal_cache.get_principal(current_user.id)
+                if not principal or not principal.can('allowed', req_type, req_id):
                     return jsonify({'success': False, 'error': 'Bu joylashuv uchun ruxsat yo\'q'}), 403
 
         # Title: category dan auto yoki bo'sh string
@@ -18106,12 +17240,9 @@ def api_add_expense():
         location_type = data.get('location_type')
         location_id = data.get('location_id')
         location_name = None
-        if location_type == 'store' and location_id:
-            store = Store.query.get(int(location_id))
-            location_name = store.name if store else None
-        elif location_type == 'warehouse' and location_id:
-            wh = Warehouse.query.get(int(location_id))
-            location_name = wh.name if wh else None
+        if location_type in ('store', 'warehouse'):
+            location = location_directory.get(location_type, location_id)
+            location_name = location.name if location else None
 
         if data.get('is_monthly') and data.get('expense_month'):
             import calendar
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Amaliyotlar tarixi (operations_history) yozuvlari - bufer va bitta INSERT.
+
+Avval `log_operation()` va endpointlardagi tarix bloklari har bir yozuv uchun
+`db.session.add()` + `db.session.commit()` bajarardi - ko'pincha asosiy
+commit'dan KEYIN. Bu har so'rovda ikkinchi tranzaksiya edi, xato bo'lganda
+esa `rollback()` sessiyadagi boshqa (hali commit qilinmagan) holatni ham
+o'chirib yuborardi.
+
+Endi yozuvlar sessiya buferiga yig'iladi:
+
+    audit_log.record('edit', table_name='stores', record_id=store.id, ...)
+
+- commit paytida (before_commit) bufer bitta ko'p qatorli INSERT bilan
+  o'sha tranzaksiyada yoziladi - biznes o'zgarishi bilan birga saqlanadi
+  yoki birga bekor bo'ladi (after_rollback buferni tashlaydi);
+- `record()` asosiy commit'dan OLDIN chaqiriladi (yangi obyekt id si kerak
+  bo'lsa - avval `flush()`): biznes o'zgarishi tarixsiz saqlanib qolmaydi;
+- ehtiyot chorasi: commit'dan keyin qo'shilib qolgan yozuvlar so'rov oxirida
+  (after_request) alohida ulanishda yoziladi va ogohlantirish logga
+  chiqadi (bunday chaqiruvni commit'dan oldinga ko'chirish kerak).
+  Sessiyada commit qilinmagan o'zgarishlar qolgan bo'lsa (ular teardown'da
+  bekor bo'ladi) - yozuvlar ham tashlanadi.
+"""
+import logging
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from database import db, get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = 'audit_log_entries'
+_UNCOMMITTED_KEY = 'audit_log_uncommitted_writes'
+
+_columns = None
+
+
+def _table():
+    from models import OperationHistory
+    return OperationHistory.__table__
+
+
+def _column_names():
+    global _columns
+    if _columns is None:
+        _columns = tuple(col.name for col in _table().columns if col.name != 'id')
+    return _columns
+
+
+def record(operation_type, session=None, **fields):
+    """Tarix yozuvini buferga qo'shish (OperationHistory ustunlari nomlari bilan).
+
+    Qaytaradi: yozuv (dict). Noma'lum ustun - TypeError.
+    """
+    columns = _column_names()
+    unknown = set(fields) - set(columns)
+    if unknown:
+        raise TypeError(f"OperationHistory da bunday ustun yo'q: {', '.join(sorted(unknown))}")
+
+    entry = dict.fromkeys(columns)
+    entry.update(fields)
+    entry['operation_type'] = operation_type
+    if entry['created_at'] is None:
+        # Vaqt - yozuv qo'shilgan payt (commit emas), model default'i bilan bir xil
+        entry['created_at'] = get_tashkent_time()
+    (session or db.session).info.setdefault(_PENDING_KEY, []).append(entry)
+    return entry
+
+
+def pending_count(session=None):
+    return len((session or db.session).info.get(_PENDING_KEY, ()))
+
+
+def _insert(connection, entries):
+    connection.execute(insert(_table()), entries)
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_uncommitted(session, flush_context):
+    session.info[_UNCOMMITTED_KEY] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_entries(session):
+    entries = session.info.pop(_PENDING_KEY, None)
+    if entries:
+        # Bitta executemany - psycopg2 da ko'p qatorli INSERT ... VALUES
+        _insert(session, entries)
+
+
+@event.listens_for(Session, 'after_commit')
+def _clear_uncommitted(session):
+    session.info.pop(_UNCOMMITTED_KEY, None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_entries(session):
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_UNCOMMITTED_KEY, None)
+
+
+def _has_uncommitted_writes(session):
+    return bool(session.info.get(_UNCOMMITTED_KEY) or session.new or session.deleted
+                or any(session.is_modified(obj) for obj in session.dirty))
+
+
+def write_pending(session=None):
+    """Commit'dan keyin qolgan yozuvlarni alohida ulanishda yozish. Qaytaradi: yozuvlar soni"""
+    session = session or db.session
+    entries = session.info.pop(_PENDING_KEY, None)
+    if not entries:
+        return 0
+
+    if _has_uncommitted_writes(session):
+        # Yozuvlar commit qilinmagan o'zgarishlarga tegishli - ular bekor bo'ladi
+        logger.warning(f"⚠️ {len(entries)} ta tarix yozuvi tashlandi: tranzaksiya commit qilinmadi")
+        return 0
+
+    # Bu yo'l faqat ehtiyot uchun - yozuv biznes commit'idan ajralgan (orada jarayon o'lsa yo'qoladi)
+    operation_types = ', '.join(sorted({str(entry['operation_type']) for entry in entries}))
+    logger.warning(f"⚠️ {len(entries)} ta tarix yozuvi ({operation_types}) commit'dan keyin qo'shilgan - "
+                   f"alohida tranzaksiyada yozilmoqda")
+    try:
+        with db.engine.begin() as connection:
+            _insert(connection, entries)
+    except Exception as e:
+        logger.error(f"❌ Tarix yozuvlarini saqlashda xatolik: {e}")
+        return 0
+    return len(entries)
+
+
+def init_app(app):
+    """So'rov oxirida qolgan yozuvlarni saqlash (teardown sessiyani yopishidan oldin)"""
+
+    @app.after_request
+    def _write_pending_audit_entries(response):
+        write_pending()
+        return response
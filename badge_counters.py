@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Menyu nishonlari (badge) hisoblagichlari uchun umumiy kesh.
+
+`inject_settings` har bir HTML sahifada 5 ta `COUNT(*)` bajarardi: qarzli
+(partial) savdolar, tasdiqlanmagan (pending) savdolar, jarayondagi
+transferlar, aktiv qoldiq tekshiruvlari va mahsulot qo'shish sessiyalari.
+
+Endi qiymatlar shared_cache dagi bitta kalitda (barcha gunicorn workerlari
+uchun umumiy) BADGE_TTL_SECONDS davomida saqlanadi; sahifa render'i uni
+bitta o'qish bilan oladi. Kesh o'chiriladi:
+
+- avtomatik: Sale (payment_status/debt_usd), PendingTransfer,
+  StockCheckSession (status) va PendingProductBatch o'zgargan commit'dan keyin;
+- qo'lda: ORM eventlarini chetlab o'tadigan so'rovlardan keyin
+  (`query.delete()`, xom SQL) - `invalidate()`.
+
+Parallel so'rov commit'dan oldingi qiymatni yozib qo'yishi mumkin - bunday
+eskirish TTL bilan cheklangan.
+"""
+import logging
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+import shared_cache
+from database import db
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'badge_counters'
+BADGE_TTL_SECONDS = 30
+
+COUNTER_NAMES = ('debt_sales_count', 'pending_sales_count', 'pending_transfer_count',
+                 'stock_check_count', 'pending_product_count')
+
+_INVALIDATE_KEY = 'badge_counters_invalidate'
+
+# Dirty obyektlarda hisoblagichga ta'sir qiluvchi ustunlar
+_WATCHED_FIELDS = {
+    'Sale': ('payment_status', 'debt_usd'),
+    'StockCheckSession': ('status',),
+    'PendingTransfer': (),
+    'PendingProductBatch': (),
+}
+
+
+def compute_counters():
+    """Barcha nishon qiymatlarini bitta so'rovda hisoblash"""
+    from models import Sale, PendingTransfer, StockCheckSession, PendingProductBatch
+
+    row = db.session.execute(select(
+        select(func.count(Sale.id)).where(
+            Sale.payment_status == 'partial', Sale.debt_usd > 0).scalar_subquery(),
+        select(func.count(Sale.id)).where(Sale.payment_status == 'pending').scalar_subquery(),
+        select(func.count(PendingTransfer.id)).scalar_subquery(),
+        select(func.count(StockCheckSession.id)).where(
+            StockCheckSession.status == 'active').scalar_subquery(),
+        select(func.count(PendingProductBatch.id)).scalar_subquery(),
+    )).one()
+    return {name: int(value or 0) for name, value in zip(COUNTER_NAMES, row)}
+
+
+def get_counters():
+    """Keshdan (yoki yangidan hisoblab) nishon qiymatlari"""
+    counters, _ = shared_cache.get_or_set(CACHE_KEY, compute_counters, BADGE_TTL_SECONDS)
+    return counters
+
+
+def invalidate(session=None):
+    """Joriy tranzaksiya commit bo'lgach keshni o'chirish"""
+    (session or db.session).info[_INVALIDATE_KEY] = True
+
+
+def invalidate_now():
+    shared_cache.delete(CACHE_KEY)
+
+
+# ---------- avtomatik bekor qilish ----------
+
+@event.listens_for(Session, 'after_flush')
+def _collect_badge_changes(session, flush_context):
+    if session.info.get(_INVALIDATE_KEY):
+        return
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        fields = _WATCHED_FIELDS.get(type(obj).__name__)
+        if fields is None:
+            continue
+        if obj in session.dirty:
+            state = inspect(obj)
+            if not any(state.attrs[name].history.has_changes() for name in fields):
+                continue
+        session.info[_INVALIDATE_KEY] = True
+        return
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_badge_invalidation(session):
+    if session.info.pop(_INVALIDATE_KEY, None):
+        invalidate_now()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_badge_invalidation(session):
+    session.info.pop(_INVALIDATE_KEY, None)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""O'zgarishlar oqimi (change feed) - yozuvchi tomon.
+
+Sahifalar (transfer.html, check_stock*.html, valyuta kursi, tasdiqlanmagan
+savdolar) ma'lumotni har 5-30 soniyada so'rardi; sync gunicorn workerlari
+vaqtining ko'p qismini "yangilik yo'q" javoblariga sarflardi.
+
+Endi yozuvchi endpointlar kichik xabar e'lon qiladi:
+
+    change_feed.publish('transfers', pending_id=pending.id)
+
+Xabar joriy tranzaksiya commit bo'lganda PostgreSQL `NOTIFY change_feed`
+orqali yuboriladi (rollback bo'lsa - yuborilmaydi). sse_server.py alohida
+asyncio jarayonida LISTEN qiladi va brauzerlarga Server-Sent Events bilan
+uzatadi; sahifa faqat o'zgargan qismni qayta yuklaydi
+(static/js/change_feed.js).
+
+Xabarda ma'lumot yo'q - faqat mavzu va id lar. Sahifa ma'lumotni odatdagi
+(ruxsat tekshiriladigan, ETag li) API orqali oladi.
+"""
+import json
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import change_notifier
+from database import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'change_feed'
+
+# sse_server.py va change_feed.js shu mavzularni biladi
+TOPICS = ('transfers', 'stock_check', 'currency_rate', 'pending_sales')
+
+_PENDING_KEY = 'change_feed_events'
+
+
+def publish(topic, session=None, **data):
+    """Commit bo'lgach brauzerlarga xabar (data - JSON ga aylanadigan kichik qiymatlar)"""
+    if topic not in TOPICS:
+        raise ValueError(f"Noma'lum mavzu: {topic}")
+    payload = json.dumps(dict(data, topic=topic), sort_keys=True, default=str)
+    events = (session or db.session).info.setdefault(_PENDING_KEY, [])
+    if payload not in events:
+        events.append(payload)
+
+
+@event.listens_for(Session, 'before_commit')
+def _send_change_events(session):
+    # NOTIFY tranzaksiya ichida - faqat commit bo'lsa yetkaziladi
+    for payload in session.info.pop(_PENDING_KEY, ()):
+        change_notifier.notify(session, CHANNEL, payload)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_change_events(session):
+    session.info.pop(_PENDING_KEY, None)
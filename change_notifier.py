@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Workerlar orasida kesh bekor qilish xabarlari (PostgreSQL LISTEN/NOTIFY).
+
+Har bir jarayon (gunicorn worker, run_telegram_bot.py) worker xotirasidagi
+keshlarni (settings_service, principal_cache) o'zi saqlaydi. Boshqa
+jarayondagi commit haqida bilish uchun:
+
+- `notify(session, channel, payload)` - joriy tranzaksiya ichida
+  `pg_notify` (faqat commit bo'lsa yetkaziladi);
+- `subscribe(channel, callback)` - jarayonda bitta LISTEN oqimi barcha
+  kanallarni tinglaydi va `callback(payload)` ni chaqiradi. Ulanish uzilib
+  qayta ulanganda `callback(None)` - "hammasi eskirgan bo'lishi mumkin".
+
+PostgreSQL bo'lmasa (SQLite) hech narsa yuborilmaydi - keshlar o'z TTL
+cheklovi bilan yangilanadi.
+"""
+import logging
+import os
+import select as select_module
+import threading
+import time
+
+from sqlalchemy import text
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+LISTEN_RETRY_SECONDS = 5
+
+_callbacks = {}
+_lock = threading.Lock()
+_state = {'pid': None, 'thread': None}
+
+
+def subscribe(channel, callback):
+    """Kanal uchun callback(payload) qo'shish (jarayon bo'yicha bir marta)"""
+    with _lock:
+        _callbacks.setdefault(channel, [])
+        if callback not in _callbacks[channel]:
+            _callbacks[channel].append(callback)
+
+
+def ensure_listening():
+    """LISTEN oqimini ishga tushirish (app context ichida, lazy)"""
+    pid = os.getpid()
+    if _state['pid'] == pid:
+        return
+    with _lock:
+        if _state['pid'] == pid:
+            return
+        # gunicorn fork'dan keyin ota jarayon oqimi meros qolmaydi
+        _state['pid'] = pid
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            _state['thread'] = None
+            return
+        thread = threading.Thread(target=_listen, args=(engine,), name='change-notifier', daemon=True)
+        _state['thread'] = thread
+        thread.start()
+
+
+def notify(session, channel, payload=''):
+    """Joriy tranzaksiyada xabar yuborish (commit qilmaydi)"""
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                            {'channel': channel, 'payload': str(payload)})
+    except Exception as e:
+        logger.warning(f"⚠️ '{channel}' xabari yuborilmadi: {e}")
+
+
+def _dispatch(channel, payload):
+    for callback in list(_callbacks.get(channel, ())):
+        try:
+            callback(payload)
+        except Exception as e:
+            logger.error(f"❌ '{channel}' xabarini qayta ishlashda xatolik: {e}")
+
+
+def _dispatch_all():
+    for channel in list(_callbacks):
+        _dispatch(channel, None)
+
+
+def _listen(engine):
+    while True:
+        raw = None
+        try:
+            raw = engine.raw_connection()
+            raw.detach()  # Doimiy ulanish - pool hisobidan chiqariladi
+            conn = raw.driver_connection
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                for channel in list(_callbacks):
+                    cursor.execute(f'LISTEN "{channel}"')
+            # Ulanish o'rnatilguncha o'tgan o'zgarishlar ham hisobga olinsin
+            _dispatch_all()
+            while True:
+                if select_module.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    message = conn.notifies.pop(0)
+                    _dispatch(message.channel, message.payload)
+        except Exception as e:
+            logger.warning(f"⚠️ LISTEN ulanishi uzildi: {e}")
+            _dispatch_all()
+            time.sleep(LISTEN_RETRY_SECONDS)
+        finally:
+            if raw is not None:
+                try:
+                    raw.close()
+                except Exception:
+                    pass
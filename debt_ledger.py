@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Mijozlar qarzining materiallashtirilgan yig'indisi (customer_debt_summary).
+
+Avval qarzlar sahifasi, hisobot, Sale.to_dict, qarz to'lovi, eslatmalar,
+Telegram "qarzni tekshirish" va Excel eksport har safar `sales` ustida
+`SUM(debt_usd)` hisoblardi. Endi har bir qarzdor mijoz uchun bitta qator:
+
+- debt_usd / debt_uzs / debt_sales_count - qarzi bor (debt_usd > 0 yoki
+  debt_amount > 0) barcha savdolar;
+- partial_debt_usd / partial_debt_uzs - faqat payment_status = 'partial' savdolar;
+- nearest_due_date, last_sale_date.
+
+Qarzi yo'q mijozlar uchun qator saqlanmaydi - qarzlar sahifasi faqat
+qarzdorlarni o'qiydi (migrations/create_customer_debt_summary.sql).
+
+Yangilash: Sale'ning qarzga ta'sir qiluvchi ustunlari o'zgargan har bir
+tranzaksiyada tegishli mijozlar qatori commit oldidan (yoki `sync_pending()`
+chaqirilganda) manba jadvaldan qayta hisoblanadi. Bir mijoz qatorini bir
+vaqtda faqat bitta tranzaksiya qayta hisoblaydi (pg_advisory_xact_lock), xato
+esa commit'ni to'xtatadi. Sessiyani chetlab o'tuvchi bulk UPDATE lar
+`refresh_customers()` ni o'zi chaqiradi. Tekshirish va tiklash:
+
+    python debt_ledger.py check [--fix]
+    python debt_ledger.py rebuild
+"""
+import logging
+import sys
+
+from sqlalchemy import bindparam, event, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import NO_VALUE
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = 'debt_ledger_pending'
+
+# customer_debt_summary mavjudmi (migratsiya qo'llanganmi) - jarayon uchun bir marta tekshiriladi
+_table_ready = None
+
+# Qarz yig'indisiga ta'sir qiladigan Sale ustunlari
+_SALE_FIELDS = ('customer_id', 'debt_usd', 'debt_amount', 'payment_status',
+                'payment_due_date', 'sale_date')
+
+# Tekshiruvda farq deb hisoblanadigan minimal tafovut (USD / UZS)
+CHECK_TOLERANCE = 0.0001
+
+_SUMMARY_SELECT = """
+    SELECT
+        s.customer_id,
+        COALESCE(SUM(s.debt_usd), 0) AS debt_usd,
+        COALESCE(SUM(s.debt_amount), 0) AS debt_uzs,
+        COUNT(*) AS debt_sales_count,
+        COALESCE(SUM(s.debt_usd) FILTER (WHERE s.payment_status = 'partial'), 0) AS partial_debt_usd,
+        COALESCE(SUM(s.debt_amount) FILTER (WHERE s.payment_status = 'partial'), 0) AS partial_debt_uzs,
+        MIN(s.payment_due_date) AS nearest_due_date,
+        MAX(s.sale_date) AS last_sale_date
+    FROM sales s
+    WHERE (s.debt_usd > 0 OR s.debt_amount > 0) AND s.customer_id IS NOT NULL {where}
+    GROUP BY s.customer_id
+"""
+
+_SUMMARY_COLUMNS = """
+    customer_id, debt_usd, debt_uzs, debt_sales_count,
+    partial_debt_usd, partial_debt_uzs, nearest_due_date, last_sale_date
+"""
+
+
+# ---------- yozish ----------
+
+def _lock_customers(connection, customer_ids):
+    """Mijoz qatorlarini tranzaksiya oxirigacha qulflash (tartiblangan - deadlock yo'q).
+
+    READ COMMITTED da bir mijozning ikki savdosi DELETE+INSERT ni parallel
+    bajarsa, biri PK xatosiga uchraydi; qulf bilan ikkinchisi kutadi va
+    birinchisining commit qilingan o'zgarishini ham hisoblaydi.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    for customer_id in customer_ids:
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                           {'key': f'debt_ledger:{customer_id}'})
+
+
+def refresh_customers(connection, customer_ids):
+    """Berilgan mijozlar qatorini sales jadvalidan qayta hisoblash"""
+    customer_ids = sorted({int(cid) for cid in customer_ids if cid})
+    if not customer_ids:
+        return
+    _lock_customers(connection, customer_ids)
+    params = {'customer_ids': customer_ids}
+    connection.execute(text(
+        "DELETE FROM customer_debt_summary WHERE customer_id IN :customer_ids"
+    ).bindparams(bindparam('customer_ids', expanding=True)), params)
+    connection.execute(text(
+        f"INSERT INTO customer_debt_summary ({_SUMMARY_COLUMNS}, updated_at) "
+        f"SELECT *, CURRENT_TIMESTAMP FROM ("
+        + _SUMMARY_SELECT.format(where='AND s.customer_id IN :customer_ids')
+        + ") agg"
+    ).bindparams(bindparam('customer_ids', expanding=True)), params)
+
+
+def rebuild_ledger():
+    """customer_debt_summary jadvalini butunlay qayta qurish"""
+    db.session.execute(text("DELETE FROM customer_debt_summary"))
+    db.session.execute(text(
+        f"INSERT INTO customer_debt_summary ({_SUMMARY_COLUMNS}, updated_at) "
+        f"SELECT *, CURRENT_TIMESTAMP FROM (" + _SUMMARY_SELECT.format(where='') + ") agg"
+    ))
+    db.session.commit()
+    count = db.session.execute(text("SELECT COUNT(*) FROM customer_debt_summary")).scalar()
+    logger.info(f"💳 Qarz yig'indisi qayta qurildi: {count} ta qarzdor mijoz")
+    return count
+
+
+def check_consistency(fix=False):
+    """Yig'indini sales jadvali bilan solishtirish.
+
+    Qaytaradi: farqli mijozlar ro'yxati [{'customer_id', 'expected', 'actual'}, ...]
+    fix=True bo'lsa farqli qatorlar qayta hisoblanadi.
+    """
+    expected = {row.customer_id: row for row in
+                db.session.execute(text(_SUMMARY_SELECT.format(where='')))}
+    actual = {row.customer_id: row for row in
+              db.session.execute(text(f"SELECT {_SUMMARY_COLUMNS} FROM customer_debt_summary"))}
+
+    def values(row):
+        if row is None:
+            return None
+        return {
+            'debt_usd': float(row.debt_usd or 0),
+            'debt_uzs': float(row.debt_uzs or 0),
+            'debt_sales_count': int(row.debt_sales_count or 0),
+            'partial_debt_usd': float(row.partial_debt_usd or 0),
+            'partial_debt_uzs': float(row.partial_debt_uzs or 0),
+            'nearest_due_date': row.nearest_due_date.isoformat() if row.nearest_due_date else None,
+            'last_sale_date': row.last_sale_date.isoformat() if row.last_sale_date else None,
+        }
+
+    def same(a, b):
+        if a is None or b is None:
+            return a is b
+        for key, value in a.items():
+            if isinstance(value, float):
+                if abs(value - b[key]) > CHECK_TOLERANCE:
+                    return False
+            elif value != b[key]:
+                return False
+        return True
+
+    mismatches = []
+    for customer_id in sorted(set(expected) | set(actual)):
+        exp, act = values(expected.get(customer_id)), values(actual.get(customer_id))
+        if not same(exp, act):
+            mismatches.append({'customer_id': customer_id, 'expected': exp, 'actual': act})
+
+    if mismatches:
+        logger.warning(f"⚠️ Qarz yig'indisida {len(mismatches)} ta farq topildi")
+        if fix:
+            refresh_customers(db.session.connection(), [m['customer_id'] for m in mismatches])
+            db.session.commit()
+            logger.info(f"✅ {len(mismatches)} ta mijoz qarzi tiklandi")
+    return mismatches
+
+
+# ---------- o'qish ----------
+
+def get_summary(customer_id):
+    """Bitta mijozning qarz yig'indisi (qarzi yo'q bo'lsa None)"""
+    from models import CustomerDebtSummary
+
+    if not customer_id:
+        return None
+    # Qator raw SQL bilan yangilanadi - sessiyadagi eski nusxa qayta o'qiladi
+    return db.session.get(CustomerDebtSummary, customer_id, populate_existing=True)
+
+
+def current_totals(customer_id, session=None):
+    """Mijozning joriy tranzaksiyadagi jami qarzi (debt_usd, debt_uzs) - qulfsiz.
+
+    Chek va to'lov javobi uchun tranzaksiya o'rtasida `sync_pending()` chaqirilmaydi:
+    u mijoz qulfini sales_rollup qulflaridan oldin olib, qulflar tartibini buzardi.
+    Mijoz savdolari shu tranzaksiyada o'zgargan bo'lsa yig'indi sales dan (o'z
+    yozuvlarimiz bilan) hisoblanadi, aks holda customer_debt_summary o'qiladi.
+    Qator esa odatdagidek commit oldidan yangilanadi.
+    """
+    session = session or db.session
+    if not customer_id:
+        return 0, 0
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    if customer_id not in session.info.get(_PENDING_KEY, ()):
+        summary = get_summary(customer_id)
+        if summary is None:
+            return 0, 0
+        return summary.debt_usd or 0, summary.debt_uzs or 0
+    row = session.execute(text("""
+        SELECT COALESCE(SUM(debt_usd), 0) AS debt_usd, COALESCE(SUM(debt_amount), 0) AS debt_uzs
+        FROM sales
+        WHERE customer_id = :customer_id AND (debt_usd > 0 OR debt_amount > 0)
+    """), {'customer_id': customer_id}).one()
+    return row.debt_usd, row.debt_uzs
+
+
+def partial_debt_totals(customer_ids):
+    """{customer_id: (partial_debt_usd, partial_debt_uzs)} - bitta IN so'rovi"""
+    from models import CustomerDebtSummary
+
+    customer_ids = {cid for cid in customer_ids if cid}
+    if not customer_ids:
+        return {}
+    rows = db.session.query(
+        CustomerDebtSummary.customer_id,
+        CustomerDebtSummary.partial_debt_usd,
+        CustomerDebtSummary.partial_debt_uzs
+    ).filter(CustomerDebtSummary.customer_id.in_(customer_ids)).all()
+    return {cid: (float(usd or 0), float(uzs or 0)) for cid, usd, uzs in rows}
+
+
+# ---------- avtomatik yangilash ----------
+
+def _customer_ids(state):
+    history = state.attrs.customer_id.history
+    ids = list(history.deleted)
+    current = state.dict.get('customer_id', NO_VALUE)
+    if current is not NO_VALUE:
+        ids.append(current)
+    return [cid for cid in ids if cid]
+
+
+def _ledger_table_ready(connection):
+    """Migratsiya qo'llanmagan bo'lsa - ogohlantirish va yangilashni o'tkazib yuborish"""
+    global _table_ready
+    if _table_ready is None:
+        _table_ready = inspect(connection).has_table('customer_debt_summary')
+        if not _table_ready:
+            logger.warning("⚠️ customer_debt_summary jadvali yo'q - "
+                           "migrations/create_customer_debt_summary.sql ni qo'llang")
+    return _table_ready
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_debt_changes(session, flush_context):
+    """Qarzi o'zgargan savdolarning mijozlarini commit'gacha yig'ish"""
+    from models import Sale
+
+    pending = None
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Sale):
+            continue
+        state = inspect(obj)
+        if obj in session.dirty and not any(
+                state.attrs[name].history.has_changes() for name in _SALE_FIELDS):
+            continue
+        if pending is None:
+            pending = session.info.setdefault(_PENDING_KEY, set())
+        pending.update(_customer_ids(state))
+
+
+def sync_pending(session=None):
+    """Kutilayotgan o'zgarishlarni hoziroq qo'llash (commit'dan oldin yangi qiymatni o'qish uchun)"""
+    session = session or db.session
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    connection = session.connection()
+    if _ledger_table_ready(connection):
+        # Xato asosiy tranzaksiyani ham to'xtatadi - yig'indi jim siljimasligi uchun
+        refresh_customers(connection, pending)
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_debt_changes(session):
+    sync_pending(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_debt_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+if __name__ == '__main__':
+    commands = ('rebuild', 'check')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Foydalanish: python debt_ledger.py rebuild | check [--fix]")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        if sys.argv[1] == 'rebuild':
+            count = rebuild_ledger()
+            print(f"✅ {count} ta qarzdor mijoz yig'indisi yozildi")
+        else:
+            mismatches = check_consistency(fix='--fix' in sys.argv)
+            for m in mismatches[:50]:
+                print(f"❌ Mijoz #{m['customer_id']}: kutilgan={m['expected']} mavjud={m['actual']}")
+            if mismatches:
+                print(f"Jami farqlar: {len(mismatches)}")
+                sys.exit(0 if '--fix' in sys.argv else 2)
+            print("✅ Qarz yig'indisi sales jadvali bilan mos")
@@ -19,6 +19,7 @@ import sys
 sys.path.append(os.path.dirname(__file__))
 
 from telegram_bot import get_bot_instance
+import metrics
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -58,7 +59,21 @@ class DebtScheduler:
 
         with self.app.app_context():
             try:
-                from app import Customer, Sale, Store, Warehouse
+                from app import Customer, CustomerDebtSummary, Sale
+                import location_directory
+
+                # Nomzodlar: customer_debt_summary'dan Telegram'ga ulangan qarzdorlar (butun sales emas)
+                debtors = {
+                    customer.id: customer for customer in Customer.query.join(
+                        CustomerDebtSummary, CustomerDebtSummary.customer_id == Customer.id
+                    ).filter(
+                        CustomerDebtSummary.partial_debt_usd > self.minimum_debt_amount,
+                        Customer.telegram_chat_id.isnot(None)
+                    ).all()
+                }
+                if not debtors:
+                    logger.info("📊 0 ta qarzli mijoz topildi")
+                    return []
 
                 # Qarzli savdolarni olish
                 # FAQAT payment_due_date belgilanmagan qarzlar.
@@ -71,6 +86,7 @@ class DebtScheduler:
                     self.db.func.sum(Sale.debt_usd).label('total_debt_usd'),
                     self.db.func.sum(Sale.debt_amount).label('total_debt_uzs')
                 ).filter(
+                    Sale.customer_id.in_(list(debtors)),
                     Sale.payment_status == 'partial',
                     Sale.debt_usd > self.minimum_debt_amount,
                     Sale.payment_due_date.is_(None)
@@ -81,23 +97,21 @@ class DebtScheduler:
                     Sale.sale_date
                 ).all()
 
+                # Joylashuv nomlari - location_directory keshidan, bitta yuklash bilan
+                location_names = location_directory.resolve_many(
+                    {(d.location_type, d.location_id) for d in debts
+                     if d.location_type in ('store', 'warehouse') and d.location_id})
+
                 result = []
                 for debt in debts:
-                    if not debt.customer_id:
-                        continue
-
-                    customer = Customer.query.get(debt.customer_id)
-                    if not customer or not customer.telegram_chat_id:
+                    customer = debtors.get(debt.customer_id)
+                    if not customer:
                         continue
 
                     # Location nomini olish
                     location_name = "Noma'lum"
-                    if debt.location_type == 'store' and debt.location_id:
-                        store = Store.query.get(debt.location_id)
-                        location_name = store.name if store else "Do'kon"
-                    elif debt.location_type == 'warehouse' and debt.location_id:
-                        warehouse = Warehouse.query.get(debt.location_id)
-                        location_name = warehouse.name if warehouse else "Ombor"
+                    if (debt.location_type, debt.location_id) in location_names:
+                        location_name = location_names[(debt.location_type, debt.location_id)]
 
                     result.append({
                         'customer_id': customer.id,
@@ -122,10 +136,10 @@ class DebtScheduler:
         if self.app:
             try:
                 with self.app.app_context():
-                    from app import Settings
-                    setting = Settings.query.filter_by(key='default_reminder_time').first()
-                    if setting and setting.value:
-                        return setting.value
+                    import settings_service
+                    reminder_time = settings_service.get('default_reminder_time')
+                    if reminder_time:
+                        return reminder_time
             except Exception:
                 pass
         return os.getenv('DEBT_REMINDER_TIME', '10:00')
@@ -313,7 +327,7 @@ class DebtScheduler:
         try:
             # Kunlik eslatmalar — har daqiqa DB dagi vaqtni tekshiradi
             self.scheduler.add_job(
-                self._check_and_run_daily_reminders,
+                metrics.timed_job('daily_reminders', self._check_and_run_daily_reminders),
                 CronTrigger(minute='*'),
                 id='daily_reminders',
                 name='Kunlik qarz eslatmalari (DB vaqti)',
@@ -324,13 +338,30 @@ class DebtScheduler:
 
             # Individual eslatmalarni tekshirish (har 5 daqiqada)
             self.scheduler.add_job(
-                self.check_scheduled_reminders,
+                metrics.timed_job('scheduled_reminders', self.check_scheduled_reminders),
                 CronTrigger(minute='*/5'),
                 id='scheduled_reminders',
                 name='Belgilangan eslatmalarni tekshirish',
                 replace_existing=True
             )
             logger.info("✅ Belgilangan eslatmalar: har 5 daqiqada tekshiriladi")
+
+            # Tashlab ketilgan korzinalar rezervini qaytarish (har daqiqa)
+            self.scheduler.add_job(
+                metrics.timed_job('stock_reservation_sweeper', self._release_expired_reservations),
+                CronTrigger(minute='*'),
+                id='stock_reservation_sweeper',
+                name='Muddati o\'tgan korzina rezervlarini qaytarish',
+                replace_existing=True
+            )
+            # Tarix jadvallari: kelgusi oy bo'laklari va eski oylarni arxivlash (har kuni 03:30)
+            self.scheduler.add_job(
+                metrics.timed_job('history_maintenance', self._maintain_history_tables),
+                CronTrigger(hour=3, minute=30),
+                id='history_maintenance',
+                name='Tarix bo\'laklari va arxivi',
+                replace_existing=True
+            )
             # 09:20 muddatli eslatmalar olib tashlandi — endi 10:00 da send_daily_reminders ichida ishlaydi
 
             # Schedulerni boshlash
@@ -340,6 +371,32 @@ class DebtScheduler:
         except Exception as e:
             logger.error(f"❌ Scheduler ishga tushirishda xatolik: {e}")
 
+    def _release_expired_reservations(self):
+        """Muddati o'tgan korzina rezervlarini stock'ga qaytarish (stock_reservations.py)"""
+        if not self.app or not self.db:
+            return
+
+        with self.app.app_context():
+            try:
+                import stock_reservations
+                stock_reservations.release_expired()
+            except Exception as e:
+                self.db.session.rollback()
+                logger.error(f"❌ Rezervlarni qaytarishda xatolik: {e}")
+
+    def _maintain_history_tables(self):
+        """Tarix jadvallari bo'laklari va arxivi (history_archive.py)"""
+        if not self.app or not self.db:
+            return
+
+        with self.app.app_context():
+            try:
+                import history_archive
+                history_archive.run_maintenance()
+            except Exception as e:
+                self.db.session.rollback()
+                logger.error(f"❌ Tarix arxivlashda xatolik: {e}")
+
     def check_scheduled_reminders(self):
         """Foydalanuvchi belgilagan eslatmalarni tekshirish va yuborish (sinxron)"""
         if not self.app or not self.db:
@@ -380,7 +437,7 @@ class DebtScheduler:
                         continue
 
                     # Mijozning hali qarzi bormi va qaysi do'kondan
-                    from app import Store, Warehouse
+                    import location_directory
 
                     debt_sales = Sale.query.filter(
                         Sale.customer_id == reminder.customer_id,
@@ -399,14 +456,9 @@ class DebtScheduler:
                     location_name = "Do'kon"
                     if debt_sales:
                         sale = debt_sales[0]
-                        if sale.location_type == 'store' and sale.location_id:
-                            store = Store.query.get(sale.location_id)
-                            if store:
-                                location_name = store.name
-                        elif sale.location_type == 'warehouse' and sale.location_id:
-                            warehouse = Warehouse.query.get(sale.location_id)
-                            if warehouse:
-                                location_name = warehouse.name
+                        if sale.location_type in ('store', 'warehouse'):
+                            location_name = location_directory.resolve(
+                                sale.location_type, sale.location_id, location_name)
 
                     # Kurs
                     rate = CurrencyRate.query.order_by(CurrencyRate.id.desc()).first()
@@ -463,7 +515,8 @@ class DebtScheduler:
 
         with self.app.app_context():
             try:
-                from app import Sale, Customer, Store, Warehouse, CurrencyRate, get_tashkent_time
+                from app import Sale, Customer, CurrencyRate, get_tashkent_time
+                import location_directory
 
                 now = get_tashkent_time()
                 today = now.date()
@@ -498,14 +551,9 @@ class DebtScheduler:
 
                     # Do'kon nomini olish
                     location_name = "Do'kon"
-                    if sale.location_type == 'store' and sale.location_id:
-                        store = Store.query.get(sale.location_id)
-                        if store:
-                            location_name = store.name
-                    elif sale.location_type == 'warehouse' and sale.location_id:
-                        warehouse = Warehouse.query.get(sale.location_id)
-                        if warehouse:
-                            location_name = warehouse.name
+                    if sale.location_type in ('store', 'warehouse'):
+                        location_name = location_directory.resolve(
+                            sale.location_type, sale.location_id, location_name)
 
                     # Qaysi xabar turini aniqlash
                     message_type = None
@@ -708,7 +756,8 @@ class DebtScheduler:
             return
 
         try:
-            from app import Customer, Store, Warehouse
+            from app import Customer
+            import location_directory
 
             due_today_list = []
             overdue_list = []
@@ -724,14 +773,9 @@ class DebtScheduler:
                 debt_usd = float(sale.debt_usd or 0)
 
                 location_name = "Do'kon"
-                if sale.location_type == 'store' and sale.location_id:
-                    store = Store.query.get(sale.location_id)
-                    if store:
-                        location_name = store.name
-                elif sale.location_type == 'warehouse' and sale.location_id:
-                    warehouse = Warehouse.query.get(sale.location_id)
-                    if warehouse:
-                        location_name = warehouse.name
+                if sale.location_type in ('store', 'warehouse'):
+                    location_name = location_directory.resolve(
+                        sale.location_type, sale.location_id, location_name)
 
                 entry = {
                     'name': customer.name,
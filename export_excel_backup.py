@@ -117,14 +117,12 @@ def main():
     style_header(ws, headers)
     cur.execute("""
         SELECT c.id, c.name, COALESCE(c.phone, '-'),
-               ROUND(COALESCE(
-                   (SELECT SUM(debt_usd) FROM sales
-                    WHERE customer_id = c.id AND payment_status = 'partial'), 0
-               )::numeric, 2),
+               ROUND(COALESCE(d.partial_debt_usd, 0)::numeric, 2),
                ROUND(COALESCE(c.balance, 0)::numeric, 2),
                COALESCE(TO_CHAR(c.last_debt_payment_date, 'YYYY-MM-DD'), '-'),
                TO_CHAR(c.created_at, 'YYYY-MM-DD')
         FROM customers c
+        LEFT JOIN customer_debt_summary d ON d.customer_id = c.id
         ORDER BY c.name
     """)
     add_rows(ws, cur.fetchall())
@@ -153,7 +151,7 @@ def main():
     add_rows(ws, rows)
     # Jami qator
     if rows:
-        cur.execute("SELECT ROUND(SUM(debt_usd)::numeric,2), ROUND(SUM(debt_amount)::numeric,0) FROM sales WHERE payment_status='partial' AND debt_usd > 0")
+        cur.execute("SELECT ROUND(SUM(partial_debt_usd)::numeric,2), ROUND(SUM(partial_debt_uzs)::numeric,0) FROM customer_debt_summary")
         totals = cur.fetchone()
         last = len(rows) + 2
         ws.cell(row=last, column=3, value='JAMI:').font = Font(bold=True)
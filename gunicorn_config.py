@@ -47,4 +47,18 @@ certfile = None
 # Gunicorn workerlarida scheduler ISHGA TUSHIRILMAYDI (duplicate xabar bo'lmasligi uchun)
 def on_starting(server):
     """Gunicorn ishga tushganda scheduler ni boshlash"""
-    pass
+    # Prometheus multiprocess katalogi - oldingi (o'lik) workerlar fayllarini tozalash.
+    # run_telegram_bot.py jarayoni fayllari (tirik) saqlanadi
+    import metrics
+    removed = metrics.cleanup_dead_processes()
+    server.log.info(f"Metrics katalogi: {metrics.MULTIPROC_DIR} ({removed} ta eski fayl o'chirildi)")
+
+    # Yangi kod - JSON tuzilishi o'zgargan bo'lishi mumkin, brauzerlardagi eski ETag lar yaroqsiz
+    import response_cache
+    response_cache.reset()
+
+
+def child_exit(server, worker):
+    """Worker chiqqanda uning jonli gauge qiymatlarini hisobdan chiqarish"""
+    import metrics
+    metrics.mark_process_dead(worker.pid)
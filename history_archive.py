@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""Tarix jadvallarini oylik bo'laklash va arxivlash.
+
+operations_history, transfers, stock_changes va api_operations har bir savdo,
+to'lov va tahrirda o'sadi (old_data/new_data JSON bilan). Avval eski
+transferlar har `/api/transfer/history` chaqiruvida qatorma-qator o'chirilardi,
+qolgan jadvallar esa cheksiz o'sardi - indeks va VACUUM narxi har oy oshardi.
+
+migrations/partition_history_tables.sql jadvallarni vaqt ustuni bo'yicha
+oylik bo'laklarga (<jadval>_pYYYYMM) ajratadi. Bu modul:
+
+- `ensure_partitions()` - kelgusi oylar uchun bo'laklarni oldindan yaratadi;
+- `archive_expired()` - "issiq" muddatdan (HOT_MONTHS) eski oylarni arxivlaydi:
+  bo'lak DETACH qilinadi, qatorlari HISTORY_ARCHIVE_DIR ga siqilgan
+  `.jsonl.gz` faylga yoziladi, history_archives ga qayd qilinadi va bo'lak
+  DROP qilinadi (butun oy bitta metadata amali - DELETE/VACUUM yo'q).
+  Bo'laklanmagan jadval (migratsiyadan oldin, SQLite) - oy qatorlari
+  eksport qilinib DELETE qilinadi;
+- `archived_page()` / `archived_rows()` / `archived_count()` - tarix
+  endpointlari issiq jadval tugagach arxivdan (vaqt, id) kamayish tartibida
+  davom etadi. Qatorlar sessiyaga qo'shilmagan model obyektlari sifatida
+  qaytadi, shuning uchun mavjud formatlash kodi o'zgarmaydi.
+
+Scheduler har kuni `run_maintenance()` ni chaqiradi; qo'lda:
+
+    python history_archive.py partitions
+    python history_archive.py archive [jadval]
+    python history_archive.py verify
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import column, delete, select, table as sa_table, text
+
+from database import db, get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR', '/var/backups/xurshid/history_archive')
+
+# Kelgusi oylar uchun oldindan yaratiladigan bo'laklar soni
+PARTITIONS_AHEAD = 3
+
+EXPORT_BATCH_SIZE = 2000
+
+
+class HistoryTable:
+    """Bo'laklanadigan tarix jadvali: model, vaqt ustuni va issiq saqlash muddati"""
+
+    def __init__(self, name, model_name, time_column, hot_months):
+        self.name = name
+        self.model_name = model_name
+        self.time_column = time_column
+        # HISTORY_HOT_MONTHS_TRANSFERS=6 kabi o'zgaruvchi bilan almashtirish mumkin
+        self.hot_months = int(os.getenv(f'HISTORY_HOT_MONTHS_{name.upper()}', str(hot_months)))
+
+    @property
+    def model(self):
+        import models
+        return getattr(models, self.model_name)
+
+    def key(self, obj):
+        """(vaqt, id) - issiq va arxiv qatorlari uchun umumiy tartib kaliti"""
+        return (getattr(obj, self.time_column) or datetime.min, obj.id or 0)
+
+
+TABLES = {
+    'operations_history': HistoryTable('operations_history', 'OperationHistory', 'created_at', 12),
+    # /api/transfer/history 40 kunni ko'rsatadi - u doim issiq bo'laklardan o'qiladi
+    'transfers': HistoryTable('transfers', 'Transfer', 'created_at', 3),
+    'stock_changes': HistoryTable('stock_changes', 'StockChange', 'change_date', 6),
+    # Idempotency kalitlari faqat qayta yuborish oynasida kerak
+    'api_operations': HistoryTable('api_operations', 'ApiOperation', 'created_at', 1),
+}
+
+
+# ---------- yordamchi ----------
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table_name, month):
+    return f'{table_name}_p{month:%Y%m}'
+
+
+def _naive(value):
+    """Jadvallardagi vaqt ustunlari tz siz (Toshkent vaqti) - chegaralar ham shunday solishtiriladi"""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+
+def _get_table(table_name):
+    try:
+        return TABLES[table_name]
+    except KeyError:
+        raise ValueError(f"Noma'lum tarix jadvali: {table_name}")
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def is_partitioned(table_name):
+    if not _is_postgres():
+        return False
+    return db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))"
+    ), {'name': table_name}).scalar()
+
+
+def _partition_state(parent, name):
+    """'attached' | 'detached' | None - bo'lak jadvali holati"""
+    row = db.session.execute(text(
+        "SELECT to_regclass(:name) IS NOT NULL, EXISTS ("
+        " SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:name)"
+        " AND inhparent = to_regclass(:parent))"
+    ), {'name': name, 'parent': parent}).one()
+    if not row[0]:
+        return None
+    return 'attached' if row[1] else 'detached'
+
+
+def _lock(table_name, month):
+    """Bir oyni bir vaqtda faqat bitta jarayon arxivlaydi (tranzaksiya oxirigacha)"""
+    if _is_postgres():
+        db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                           {'key': f'history_archive:{partition_name(table_name, month)}'})
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} JSON ga aylanmaydi')
+
+
+def _decoders(history_table):
+    """Ustun nomi -> fayldagi satr qiymatini Python turiga qaytaruvchi funksiya"""
+    decoders = {}
+    for col in history_table.model.__table__.columns:
+        python_type = None
+        try:
+            python_type = col.type.python_type
+        except NotImplementedError:
+            pass
+        if python_type is datetime:
+            decoders[col.name] = datetime.fromisoformat
+        elif python_type is date:
+            decoders[col.name] = date.fromisoformat
+        elif python_type is Decimal:
+            decoders[col.name] = Decimal
+    return decoders
+
+
+# ---------- bo'laklar ----------
+
+def ensure_partitions(months_ahead=PARTITIONS_AHEAD):
+    """Joriy va kelgusi oylar bo'laklarini yaratish (DEFAULT bo'lak to'lmasin).
+
+    Qaytaradi: yaratilgan bo'laklar soni
+    """
+    if not _is_postgres():
+        return 0
+    created = 0
+    current = month_start(get_tashkent_time())
+    for history_table in TABLES.values():
+        if not is_partitioned(history_table.name):
+            continue
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if db.session.execute(text("SELECT history_create_partition(:table, :month)"),
+                                  {'table': history_table.name, 'month': month.date()}).scalar():
+                created += 1
+                logger.info(f"🧩 Yangi bo'lak: {partition_name(history_table.name, month)}")
+    db.session.commit()
+    return created
+
+
+# ---------- arxivlash ----------
+
+def _write_archive(history_table, month, rows):
+    """Qatorlarni .jsonl.gz faylga yozish. Qaytaradi: HistoryArchive (saqlanmagan) yoki None"""
+    from models import HistoryArchive
+
+    directory = os.path.join(ARCHIVE_DIR, history_table.name)
+    os.makedirs(directory, exist_ok=True)
+    stamp = get_tashkent_time().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(directory, f'{history_table.name}_{month:%Y_%m}_{stamp}.jsonl.gz')
+    tmp_path = path + '.part'
+
+    count = 0
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as archive_file:
+            for row in rows:
+                archive_file.write(json.dumps(dict(row), default=_json_default, ensure_ascii=False))
+                archive_file.write('\n')
+                count += 1
+        if not count:
+            os.remove(tmp_path)
+            return None
+        with open(tmp_path, 'rb') as archive_file:
+            os.fsync(archive_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return HistoryArchive(
+        table_name=history_table.name,
+        period_start=month,
+        period_end=add_months(month, 1),
+        path=path,
+        row_count=count,
+        size_bytes=os.path.getsize(path),
+        sha256=_file_sha256(path),
+    )
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as archive_file:
+        for chunk in iter(lambda: archive_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _export_rows(source, history_table, where=None):
+    time_col = source.c[history_table.time_column]
+    stmt = select(source).order_by(time_col, source.c.id)
+    if where is not None:
+        stmt = stmt.where(where)
+    return db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)).mappings()
+
+
+def _archive_partition(history_table, month):
+    """Bo'lakni ajratish, faylga yozish va o'chirish. Qaytaradi: arxivlangan qatorlar soni"""
+    name = partition_name(history_table.name, month)
+
+    _lock(history_table.name, month)
+    if _partition_state(history_table.name, name) == 'attached':
+        # Qisqa ACCESS EXCLUSIVE qulf - faqat metadata; eksport ajratilgan jadvaldan
+        db.session.execute(text(f'ALTER TABLE "{history_table.name}" DETACH PARTITION "{name}"'))
+        db.session.commit()
+        logger.info(f"📦 Bo'lak ajratildi: {name}")
+
+    _lock(history_table.name, month)
+    if _partition_state(history_table.name, name) != 'detached':
+        db.session.rollback()
+        return 0
+
+    columns = [column(col.name) for col in history_table.model.__table__.columns]
+    archive = _write_archive(history_table, month, _export_rows(sa_table(name, *columns), history_table))
+    if archive is not None:
+        db.session.add(archive)
+    db.session.execute(text(f'DROP TABLE "{name}"'))
+    db.session.commit()
+    return archive.row_count if archive is not None else 0
+
+
+def _archive_rows(history_table, month):
+    """Oy qatorlarini (bo'laklanmagan jadval yoki DEFAULT bo'lak) eksport qilib o'chirish"""
+    source = history_table.model.__table__
+    time_col = source.c[history_table.time_column]
+    in_month = (time_col >= month) & (time_col < add_months(month, 1))
+
+    _lock(history_table.name, month)
+    max_id = db.session.execute(select(db.func.max(source.c.id)).where(in_month)).scalar()
+    if max_id is None:
+        db.session.rollback()
+        return 0
+
+    # Eksportdan keyin qo'shilgan qator (katta id) o'chirilmaydi - keyingi safar arxivlanadi
+    where = in_month & (source.c.id <= max_id)
+    archive = _write_archive(history_table, month, _export_rows(source, history_table, where))
+    if archive is None:
+        db.session.rollback()
+        return 0
+    db.session.add(archive)
+    db.session.execute(delete(source).where(where))
+    db.session.commit()
+    return archive.row_count
+
+
+def archive_month(table_name, month):
+    """Bir oyni arxivlash. Qaytaradi: arxivga ko'chirilgan qatorlar soni"""
+    history_table = _get_table(table_name)
+    month = month_start(month)
+    try:
+        count = 0
+        if is_partitioned(history_table.name):
+            count += _archive_partition(history_table, month)
+        count += _archive_rows(history_table, month)
+    except Exception:
+        db.session.rollback()
+        raise
+    if count:
+        logger.info(f"🗄️ {history_table.name} {month:%Y-%m}: {count} ta qator arxivlandi")
+    return count
+
+
+def _oldest_month(history_table):
+    """Issiq jadvaldagi eng eski oy - qatorlar yoki bo'sh bo'laklar bo'yicha (yo'q bo'lsa None)"""
+    source = history_table.model.__table__
+    oldest = db.session.execute(select(db.func.min(source.c[history_table.time_column]))).scalar()
+    months = [month_start(oldest)] if oldest else []
+
+    if is_partitioned(history_table.name):
+        prefix = f'{history_table.name}_p'
+        children = db.session.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+            " WHERE i.inhparent = to_regclass(:parent)"
+        ), {'parent': history_table.name}).scalars()
+        for child in children:
+            suffix = child[len(prefix):]
+            if child.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+                months.append(datetime.strptime(suffix, '%Y%m'))
+    return min(months) if months else None
+
+
+def archive_expired(table_name=None):
+    """Issiq muddatdan eski barcha oylarni arxivlash. Qaytaradi: {jadval: qatorlar soni}"""
+    names = [table_name] if table_name else list(TABLES)
+    cutoff_now = month_start(get_tashkent_time())
+    result = {}
+    for name in names:
+        history_table = _get_table(name)
+        cutoff = add_months(cutoff_now, -history_table.hot_months)
+        month = _oldest_month(history_table)
+        total = 0
+        while month is not None and month < cutoff:
+            total += archive_month(name, month)
+            month = add_months(month, 1)
+        result[name] = total
+    return result
+
+
+def prune_idempotency_keys():
+    """api_operations issiq muddatidan eski claim'larni (api_operation_keys) o'chirish. Qaytaradi: soni"""
+    from models import ApiOperationKey
+
+    # Kalitlar bo'laklanmagan - qayta yuborish oynasidan keyin ular kerak emas
+    cutoff = add_months(month_start(get_tashkent_time()), -TABLES['api_operations'].hot_months)
+    keys = ApiOperationKey.__table__
+    try:
+        count = db.session.execute(delete(keys).where(keys.c.created_at < cutoff)).rowcount
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"⚠️ api_operation_keys tozalanmadi: {e}")
+        return 0
+    return count
+
+
+def run_maintenance():
+    """Scheduler vazifasi: bo'laklarni oldindan yaratish, eski oylarni arxivlash, eski claim'lar"""
+    created = ensure_partitions()
+    archived = archive_expired()
+    pruned = prune_idempotency_keys()
+    if pruned:
+        logger.info(f"🗄️ {pruned} ta eski idempotency kaliti o'chirildi")
+    total = sum(archived.values())
+    if created or total:
+        logger.info(f"🗄️ Tarix arxivi: {created} ta yangi bo'lak, {total} ta qator arxivlandi")
+    return archived
+
+
+# ---------- arxivdan o'qish ----------
+
+def _archives(table_name, since=None, until=None):
+    """Oraliqqa tegadigan arxiv fayllari - oylar bo'yicha guruhlangan, eng yangisi birinchi"""
+    from models import HistoryArchive
+
+    query = HistoryArchive.query.filter(HistoryArchive.table_name == table_name)
+    if since is not None:
+        query = query.filter(HistoryArchive.period_end > since)
+    if until is not None:
+        query = query.filter(HistoryArchive.period_start < until)
+    months = {}
+    for archive in query.order_by(HistoryArchive.period_start.desc(), HistoryArchive.id).all():
+        months.setdefault(archive.period_start, []).append(archive)
+    return list(months.values())
+
+
+def _read_file(history_table, archive, decoders):
+    model = history_table.model
+    known = set(model.__table__.columns.keys())
+    with gzip.open(archive.path, 'rt', encoding='utf-8') as archive_file:
+        for line in archive_file:
+            values = json.loads(line)
+            for name, decode in decoders.items():
+                if values.get(name) is not None:
+                    values[name] = decode(values[name])
+            # Sessiyaga qo'shilmaydi - faqat o'qish uchun
+            yield model(**{name: value for name, value in values.items() if name in known})
+
+
+def _in_range(history_table, obj, since, until, before, where):
+    moment = getattr(obj, history_table.time_column)
+    if since is not None and (moment is None or moment < since):
+        return False
+    if until is not None and (moment is None or moment >= until):
+        return False
+    if before is not None:
+        key = history_table.key(obj)
+        if key[:len(before)] >= tuple(before):
+            return False
+    return where is None or where(obj)
+
+
+def archived_rows(table_name, since=None, until=None, before=None, where=None):
+    """Arxiv qatorlari (vaqt, id) kamayish tartibida - model obyektlari.
+
+    since/until - vaqt oralig'i [since, until); before - kursor kaliti
+    ((vaqt, id) yoki (vaqt,)), undan kichik qatorlar; where - qo'shimcha filtr.
+    Fayllar oyma-oy o'qiladi, kerakli qatorlar olingach to'xtatish mumkin.
+    """
+    history_table = _get_table(table_name)
+    since, until = _naive(since), _naive(until)
+    if before is not None:
+        before = (_naive(before[0]),) + tuple(before[1:])
+    files_until = until
+    if before is not None:
+        # Kursor vaqtining o'zi ham kerak (xuddi shu vaqtdagi kichik id lar)
+        bound = before[0] + timedelta(microseconds=1)
+        files_until = bound if files_until is None else min(files_until, bound)
+    decoders = _decoders(history_table)
+    for month_archives in _archives(table_name, since, files_until):
+        rows = [
+            obj
+            for archive in month_archives
+            for obj in _read_file(history_table, archive, decoders)
+            if _in_range(history_table, obj, since, until, before, where)
+        ]
+        rows.sort(key=history_table.key, reverse=True)
+        yield from rows
+
+
+def archived_page(table_name, since=None, until=None, before=None, where=None, limit=50, offset=0):
+    """archived_rows() dan `offset` tashlab `limit` tasi"""
+    page = []
+    for index, obj in enumerate(archived_rows(table_name, since, until, before, where)):
+        if index < offset:
+            continue
+        page.append(obj)
+        if len(page) >= limit:
+            break
+    return page
+
+
+def archived_count(table_name, since=None, until=None, where=None, estimate=False):
+    """Oraliqdagi arxiv qatorlari soni. Qaytaradi: (son, taxminiymi).
+
+    Filtr bo'lmasa va oy to'liq oraliq ichida bo'lsa - history_archives dagi
+    row_count. estimate=True da qolgan oylar ham row_count bilan (yuqori baho).
+    """
+    since, until = _naive(since), _naive(until)
+    total = 0
+    is_estimate = False
+    for month_archives in _archives(table_name, since, until):
+        first = month_archives[0]
+        whole_month = ((since is None or first.period_start >= since)
+                       and (until is None or first.period_end <= until))
+        if whole_month and where is None:
+            total += sum(archive.row_count for archive in month_archives)
+        elif estimate:
+            total += sum(archive.row_count for archive in month_archives)
+            is_estimate = True
+        else:
+            history_table = _get_table(table_name)
+            decoders = _decoders(history_table)
+            total += sum(
+                1
+                for archive in month_archives
+                for obj in _read_file(history_table, archive, decoders)
+                if _in_range(history_table, obj, since, until, None, where)
+            )
+    return total, is_estimate
+
+
+def continue_keyset_page(page, table_name, cursor_values, per_page, since=None, until=None,
+                         where=None, count='none'):
+    """Issiq jadval sahifasini (pagination.KeysetPage) arxiv bilan to'ldirish.
+
+    Kursor formati o'zgarmaydi ((vaqt, id)): issiq qatorlar tugagach keyingi
+    kursorlar arxivdan davom etadi, issiq so'rov esa bo'sh qaytadi.
+    """
+    from pagination import KeysetPage, encode_cursor
+
+    total = page.total
+    total_is_estimate = page.total_is_estimate
+    if count != 'none' and total is not None:
+        archived_total, archived_estimate = archived_count(
+            table_name, since, until, where, estimate=(count == 'estimate'))
+        total += archived_total
+        total_is_estimate = total_is_estimate or archived_estimate
+
+    if page.has_next:
+        return KeysetPage(page.items, page.next_cursor, total, total_is_estimate)
+
+    history_table = _get_table(table_name)
+    items = list(page.items)
+    before = history_table.key(items[-1]) if items else (tuple(cursor_values) if cursor_values else None)
+    need = per_page - len(items)
+    extra = archived_page(table_name, since, until, before, where, limit=need + 1)
+
+    has_next = len(extra) > need
+    items.extend(extra[:need])
+    next_cursor = encode_cursor(list(history_table.key(items[-1]))) if has_next and items else None
+    return KeysetPage(items, next_cursor, total, total_is_estimate)
+
+
+# ---------- tekshirish ----------
+
+def verify_archives():
+    """Arxiv fayllari mavjudligi va sha256 ni tekshirish. Qaytaradi: buzilgan fayllar ro'yxati"""
+    from models import HistoryArchive
+
+    broken = []
+    for archive in HistoryArchive.query.order_by(HistoryArchive.table_name, HistoryArchive.period_start).all():
+        if not os.path.exists(archive.path):
+            broken.append((archive.path, 'fayl topilmadi'))
+        elif _file_sha256(archive.path) != archive.sha256:
+            broken.append((archive.path, 'sha256 mos emas'))
+    return broken
+
+
+if __name__ == '__main__':
+    commands = ('partitions', 'archive', 'verify')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Foydalanish: python history_archive.py partitions | archive [jadval] | verify")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        if sys.argv[1] == 'partitions':
+            print(f"✅ {ensure_partitions()} ta yangi bo'lak yaratildi")
+        elif sys.argv[1] == 'archive':
+            for name, count in archive_expired(sys.argv[2] if len(sys.argv) > 2 else None).items():
+                print(f"✅ {name}: {count} ta qator arxivlandi")
+        else:
+            problems = verify_archives()
+            for path, reason in problems:
+                print(f"❌ {path}: {reason}")
+            if problems:
+                sys.exit(1)
+            print("✅ Barcha arxiv fayllari joyida")
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Joylashuvlar (do'kon/ombor) ma'lumotnomasi - worker ichidagi yagona kesh.
+
+Avval joylashuv nomlari har joyda alohida olinardi: database.py dagi
+`_get_location_name_cached` (kalit bo'yicha 5 daqiqa), `api_all_locations`
+ning `_all_locations_cache` i, hisobot/savdo tarixi/debt_scheduler
+tsikllari ichidagi `Store.query.get` / `Warehouse.query.get`. Keshlar faqat
+o'sha workerda va faqat ba'zi endpointlarda tozalanardi - boshqa workerlar
+nomi o'zgargan do'konni 5 daqiqagacha eski nom bilan ko'rsatardi.
+
+Endi barcha do'kon va omborlar bitta joyda, ikkita so'rov bilan yuklanadi
+(shared_cache da barcha workerlar uchun umumiy nusxa, worker xotirasida esa
+tezkor nusxa):
+
+- `resolve(type, id)` / `resolve_many([(type, id), ...])` - nomlar;
+- `get(type, id)` - Location (id, type, name, address, manager_name, phone);
+- `all_locations(type=None)` - ro'yxat (nom bo'yicha tartiblangan).
+
+Store yoki Warehouse o'zgargan commit'dan keyin umumiy nusxa va joriy
+worker keshi darhol, boshqa workerlar change_notifier orqali tozalanadi
+(ular DB dan qayta yuklaydi); ehtiyot uchun MAX_AGE_SECONDS dan keyin
+baribir qayta yuklanadi. Yuklash davomida tozalash kelsa, natija keshlanmaydi
+(worker ichida `_generation`, umumiy nusxada shared_cache avlodlari).
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import change_notifier
+import shared_cache
+from database import db
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'locations_changed'
+SHARED_KEY = 'location_directory'
+MAX_AGE_SECONDS = 300
+
+LOCATION_TYPES = ('store', 'warehouse')
+
+UNKNOWN_NAMES = {
+    'store': "Noma'lum do'kon",
+    'warehouse': "Noma'lum ombor",
+}
+UNKNOWN_NAME = "Noma'lum"
+
+_CHANGED_KEY = 'locations_changed'
+
+
+class Location:
+    """Do'kon yoki ombor (DB ga bog'lanmagan nusxa)"""
+
+    __slots__ = ('id', 'type', 'name', 'address', 'manager_name', 'phone')
+
+    def __init__(self, id, type, name, address, manager_name, phone):
+        self.id = id
+        self.type = type
+        self.name = name
+        self.address = address
+        self.manager_name = manager_name
+        self.phone = phone
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'name': self.name,
+            'address': self.address,
+            'manager_name': self.manager_name,
+            'phone': self.phone,
+        }
+
+
+class _LocationDirectory:
+    def __init__(self):
+        self._entries = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._refresh = False
+        self._generations = itertools.count(1)
+        self._generation = 0
+
+    def invalidate(self, refresh=False):
+        """refresh=True - keyingi yuklash umumiy nusxani chetlab DB dan"""
+        if refresh:
+            self._refresh = True
+        self._generation = next(self._generations)
+        self._entries = None
+
+    def entries(self):
+        if self._pid != os.getpid():
+            # gunicorn fork'dan keyin - ota jarayon keshi meros qolmaydi
+            self._pid = os.getpid()
+            self._entries = None
+        entries = self._entries
+        if entries is None or time.monotonic() - self._loaded_at > MAX_AGE_SECONDS:
+            entries = self._load()
+        return entries
+
+    def _load(self):
+        with self._lock:
+            change_notifier.ensure_listening()
+            generation = self._generation
+            refresh, self._refresh = self._refresh, False
+            rows, remaining = shared_cache.get_or_set(SHARED_KEY, _fetch_locations, MAX_AGE_SECONDS,
+                                                      refresh=refresh)
+            entries = {(row['type'], row['id']): Location(**row) for row in rows}
+            if generation != self._generation:
+                # Yuklash davomida tozalandi - faqat shu chaqiruv uchun
+                return entries
+            self._entries = entries
+            # Umumiy nusxa qancha oldin yuklangan bo'lsa, worker ham shuncha kam ushlab turadi
+            self._loaded_at = time.monotonic() - (MAX_AGE_SECONDS - remaining)
+            return entries
+
+
+def _fetch_locations():
+    from models import Store, Warehouse
+
+    rows = []
+    for location_type, model in (('store', Store), ('warehouse', Warehouse)):
+        for row in db.session.query(
+                model.id, model.name, model.address, model.manager_name, model.phone
+        ).order_by(model.name).all():
+            rows.append(Location(row.id, location_type, row.name, row.address,
+                                 row.manager_name, row.phone).to_dict())
+    logger.debug(f"📍 Joylashuvlar ma'lumotnomasi yuklandi: {len(rows)} ta")
+    return rows
+
+
+_directory = _LocationDirectory()
+change_notifier.subscribe(NOTIFY_CHANNEL, lambda payload: _directory.invalidate(refresh=True))
+
+
+def _key(location_type, location_id):
+    try:
+        return location_type, int(location_id)
+    except (TypeError, ValueError):
+        return location_type, location_id
+
+
+def get(location_type, location_id):
+    """Location yoki None"""
+    if not location_id:
+        return None
+    return _directory.entries().get(_key(location_type, location_id))
+
+
+def resolve(location_type, location_id, default=None):
+    """Joylashuv nomi. Topilmasa default (berilmasa "Noma'lum do'kon/ombor")"""
+    location = get(location_type, location_id)
+    if location:
+        return location.name
+    if default is not None:
+        return default
+    return UNKNOWN_NAMES.get(location_type, UNKNOWN_NAME)
+
+
+def resolve_many(pairs, default=None):
+    """{(type, id): nom} - bir nechta joylashuv uchun (keshdan, bitta yuklash bilan)"""
+    entries = _directory.entries()
+    result = {}
+    for location_type, location_id in pairs:
+        location = entries.get(_key(location_type, location_id))
+        if location:
+            result[(location_type, location_id)] = location.name
+        else:
+            result[(location_type, location_id)] = (
+                default if default is not None else UNKNOWN_NAMES.get(location_type, UNKNOWN_NAME))
+    return result
+
+
+def all_locations(location_type=None):
+    """Barcha joylashuvlar (har tur ichida nom bo'yicha)"""
+    return [location for key, location in _directory.entries().items()
+            if location_type is None or key[0] == location_type]
+
+
+def invalidate():
+    """Umumiy nusxa va joriy worker keshini tozalash"""
+    shared_cache.delete(SHARED_KEY)
+    _directory.invalidate()
+
+
+# ---------- avtomatik bekor qilish ----------
+
+# Dirty obyektlarda keshdagi ustunlar
+_WATCHED_FIELDS = ('name', 'address', 'manager_name', 'phone')
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_location_changes(session, flush_context):
+    from models import Store, Warehouse
+
+    if session.info.get(_CHANGED_KEY):
+        return
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        if not isinstance(obj, (Store, Warehouse)):
+            continue
+        if obj in session.dirty:
+            state = inspect(obj)
+            if not any(state.attrs[name].history.has_changes() for name in _WATCHED_FIELDS):
+                continue
+        session.info[_CHANGED_KEY] = True
+        return
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_location_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    if session.info.get(_CHANGED_KEY):
+        change_notifier.notify(session, NOTIFY_CHANNEL)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_location_changes(session):
+    if session.info.pop(_CHANGED_KEY, None):
+        invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_location_changes(session):
+    session.info.pop(_CHANGED_KEY, None)
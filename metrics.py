@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Prometheus metrikalari (/metrics) - barcha gunicorn workerlari bo'yicha.
+
+Avval `/monitoring/status` dagi so'rovlar statistikasi access.log ning
+oxirgi 1000 qatoridan "taxmin" qilinardi. Endi haqiqiy metrikalar:
+
+- `http_requests_total`, `http_request_duration_seconds` - route, method va
+  status bo'yicha;
+- `db_pool_checkout_wait_seconds` - pool'dan ulanish olish kutish vaqti;
+  `db_pool_size`, `db_pool_checked_out`, `db_pool_overflow` - hozirgi holat;
+- `telegram_send_duration_seconds` - navbatdagi xabarlarni yuborish
+  (notification_queue, run_telegram_bot.py jarayonida);
+- `scheduler_job_duration_seconds` - debt_scheduler vazifalari.
+
+prometheus_client multiprocess rejimida ishlaydi: har bir jarayon o'z
+qiymatlarini PROMETHEUS_MULTIPROC_DIR dagi mmap fayllariga yozadi, `/metrics`
+ularni birlashtiradi. Katalogni gunicorn_config.py ishga tushishda o'lik
+jarayonlar fayllaridan tozalaydi, worker chiqqanda `mark_process_dead`
+chaqiriladi.
+
+`/metrics` ga kirish: METRICS_TOKEN berilgan bo'lsa - `Authorization: Bearer
+<token>`; aks holda faqat serverning o'zidan (nginx orqali emas) yoki admin
+sessiyasi bilan.
+"""
+import logging
+import os
+import re
+import tempfile
+import time
+
+# prometheus_client import qilinishidan oldin - multiprocess rejimi shu o'zgaruvchiga qaraydi
+MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'xurshid_metrics'))
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', "HTTP so'rovlar soni", ('method', 'route', 'status'))
+HTTP_LATENCY = Histogram(
+    'http_request_duration_seconds', "HTTP so'rov javob vaqti", ('method', 'route', 'status'),
+    buckets=LATENCY_BUCKETS)
+
+DB_POOL_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', "Pool'dan ulanish olish kutish vaqti", buckets=POOL_WAIT_BUCKETS)
+# livesum - tirik jarayonlar yig'indisi
+DB_POOL_SIZE = Gauge('db_pool_size', "Pool hajmi (doimiy ulanishlar)", multiprocess_mode='livesum')
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', "Hozir band ulanishlar", multiprocess_mode='livesum')
+DB_POOL_OVERFLOW = Gauge('db_pool_overflow', "Ishlatilayotgan qo'shimcha (overflow) ulanishlar",
+                         multiprocess_mode='livesum')
+
+TELEGRAM_SEND = Histogram(
+    'telegram_send_duration_seconds', "Telegram xabarini yuborish vaqti", ('kind', 'result'),
+    buckets=LATENCY_BUCKETS)
+SCHEDULER_JOB = Histogram(
+    'scheduler_job_duration_seconds', "Scheduler vazifasi bajarilish vaqti", ('job', 'result'),
+    buckets=JOB_BUCKETS)
+
+_PID_FILE_RE = re.compile(r'_(\d+)\.db$')
+
+
+# ---------- jarayonlar (gunicorn_config.py) ----------
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cleanup_dead_processes():
+    """O'lik jarayonlar mmap fayllarini o'chirish (gunicorn master ishga tushganda)"""
+    removed = 0
+    for name in os.listdir(MULTIPROC_DIR):
+        match = _PID_FILE_RE.search(name)
+        if match and not _pid_alive(int(match.group(1))):
+            try:
+                os.remove(os.path.join(MULTIPROC_DIR, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def mark_process_dead(pid):
+    """Worker chiqqanda - uning livesum gauge qiymatlari hisobga olinmaydi"""
+    multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+# ---------- o'lchash ----------
+
+def observe_telegram_send(kind, ok, seconds):
+    TELEGRAM_SEND.labels(kind=kind, result='ok' if ok else 'error').observe(seconds)
+
+
+def timed_job(job_id, func):
+    """Scheduler vazifasini bajarilish vaqti bilan o'rash"""
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            value = func(*args, **kwargs)
+            result = 'ok'
+            return value
+        finally:
+            SCHEDULER_JOB.labels(job=job_id, result=result).observe(time.perf_counter() - started)
+    wrapper.__name__ = getattr(func, '__name__', job_id)
+    return wrapper
+
+
+def _instrument_pool(engine):
+    pool = engine.pool
+    original_connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return original_connect()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started)
+
+    # Engine ulanishni pool.connect() orqali oladi - kutish vaqti shu yerda
+    pool.connect = timed_connect
+
+    def update_gauges(*args):
+        # SQLite (NullPool va boshqalar) da bu usullar bo'lmasligi mumkin
+        if hasattr(pool, 'checkedout'):
+            DB_POOL_CHECKED_OUT.set(pool.checkedout())
+        if hasattr(pool, 'overflow'):
+            DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+        if hasattr(pool, 'size'):
+            DB_POOL_SIZE.set(pool.size())
+
+    from sqlalchemy import event
+    event.listen(pool, 'checkout', update_gauges)
+    event.listen(pool, 'checkin', update_gauges)
+    update_gauges()
+
+
+# ---------- Flask ----------
+
+def _allowed(request, session):
+    if METRICS_TOKEN:
+        return request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}'
+    if session.get('role') == 'admin':
+        return True
+    # nginx orqali kelgan so'rovlar (X-Forwarded-For) - tashqaridan
+    return (request.remote_addr in ('127.0.0.1', '::1')
+            and not request.headers.get('X-Forwarded-For'))
+
+
+def collect():
+    """Barcha jarayonlar metrikalari bitta registry da"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    return registry
+
+
+def request_totals():
+    """{'total': ..., 'errors': ...} - barcha workerlar bo'yicha HTTP so'rovlar"""
+    total = errors = 0
+    for family in collect().collect():
+        if family.name != 'http_requests':
+            continue
+        for sample in family.samples:
+            if not sample.name.endswith('_total'):
+                continue
+            total += sample.value
+            if sample.labels.get('status', '').startswith('5'):
+                errors += sample.value
+    return {'total': int(total), 'errors': int(errors)}
+
+
+def init_app(app, db):
+    """So'rov metrikalari, pool kuzatuvi va /metrics route"""
+    from flask import Response, g, request, session
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request_metrics(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None and request.endpoint != 'static':
+            labels = {
+                'method': request.method,
+                # Faqat route shabloni - label qiymatlari soni cheklangan bo'lsin
+                'route': request.url_rule.rule if request.url_rule else '<unmatched>',
+                'status': str(response.status_code),
+            }
+            HTTP_REQUESTS.labels(**labels).inc()
+            HTTP_LATENCY.labels(**labels).observe(time.perf_counter() - started)
+        return response
+
+    with app.app_context():
+        try:
+            _instrument_pool(db.engine)
+        except Exception as e:
+            logger.warning(f"⚠️ DB pool metrikalari ulanmadi: {e}")
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        if not _allowed(request, session):
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        return Response(generate_latest(collect()), mimetype=CONTENT_TYPE_LATEST)
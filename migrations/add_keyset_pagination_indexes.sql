@@ -0,0 +1,12 @@
+-- Migration: Keyset (cursor) pagination indexes
+-- Purpose: ?cursor= rejimidagi WHERE (a, id) < (:a, :id) ORDER BY a DESC, id DESC
+--          so'rovlari indeksdan to'g'ridan-to'g'ri boshlanishi uchun
+-- Date: 2026-10-16
+
+CREATE INDEX IF NOT EXISTS idx_sales_sale_date_id ON sales(sale_date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_operations_history_created_at_id ON operations_history(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_transfers_created_at_id ON transfers(created_at DESC, id DESC);
+
+ANALYZE sales;
+ANALYZE operations_history;
+ANALYZE transfers;
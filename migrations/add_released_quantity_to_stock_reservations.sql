@@ -0,0 +1,10 @@
+-- Migration: stock_reservations.released_quantity
+-- Purpose: Sweeper muddati o'tgan rezervni stock'ga qaytarganda qatorni o'chirmaydi -
+--          qaytarilgan miqdorni released_quantity ga yozadi. Tahrirlanayotgan yoki
+--          pending savdo korzinasi keyin yakunlansa, consume_cart() shu miqdorni
+--          stock'dan qayta ayiradi (aks holda tahrirda qo'shilgan qatorlar ayirilmasdi).
+--          Bir kundan eski bo'sh (quantity = 0) qatorlarni sweeper o'chiradi.
+-- Date: 2026-10-17
+-- Safe: can be run repeatedly
+
+ALTER TABLE stock_reservations ADD COLUMN IF NOT EXISTS released_quantity DECIMAL(10, 2) NOT NULL DEFAULT 0;
@@ -0,0 +1,26 @@
+-- Migration: pg_trgm asosidagi qidiruv ustunlari va GIN indekslar
+-- Purpose: Mahsulot nomi/barcode va mijoz nomi/telefoni bo'yicha '%so'z%' qidiruvini
+--          indeks orqali bajarish (butun jadvalni skanerlash o'rniga)
+-- Date: 2026-10-16
+-- Safe: uses IF NOT EXISTS, can be run repeatedly
+--
+-- Migratsiyadan keyin ustunlarni to'ldirish:
+--   python search_backend.py rebuild
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- normalize_search(name) natijasi (ilova tomonidan sinxronlanadi)
+ALTER TABLE products ADD COLUMN IF NOT EXISTS search_name TEXT;
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS search_text TEXT;
+
+-- Trigram GIN indekslar - LIKE/ILIKE '%...%' va similarity() uchun
+CREATE INDEX IF NOT EXISTS idx_products_search_name_trgm
+    ON products USING gin (search_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_products_barcode_trgm
+    ON products USING gin (barcode gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_customers_search_text_trgm
+    ON customers USING gin (search_text gin_trgm_ops);
+
+-- Statistikani yangilash
+ANALYZE products;
+ANALYZE customers;
@@ -0,0 +1,61 @@
+-- Migration: store_stocks / warehouse_stocks - (joylashuv, mahsulot) bo'yicha yagona qator
+-- Purpose: transfer_engine.py stock'ni bitta INSERT ... ON CONFLICT (location_id, product_id)
+--          bilan ayiradi/qo'shadi - buning uchun UNIQUE indeks kerak. Avval takroriy
+--          qatorlar birlashtiriladi: miqdorlar eng kichik id li qatorga qo'shiladi,
+--          qolganlari o'chiriladi. Eski (takroriy) kompozit indekslar UNIQUE indeks
+--          bilan almashtiriladi.
+-- Date: 2026-10-16
+-- Safe: can be run repeatedly
+
+BEGIN;
+
+-- Birlashtirish paytida yangi qator qo'shilmasin
+LOCK TABLE store_stocks, warehouse_stocks IN SHARE ROW EXCLUSIVE MODE;
+
+UPDATE store_stocks s
+SET quantity = d.total_quantity
+FROM (
+    SELECT MIN(id) AS keep_id, SUM(quantity) AS total_quantity
+    FROM store_stocks
+    GROUP BY store_id, product_id
+    HAVING COUNT(*) > 1
+) d
+WHERE s.id = d.keep_id;
+
+DELETE FROM store_stocks s
+USING store_stocks k
+WHERE s.store_id = k.store_id
+  AND s.product_id = k.product_id
+  AND s.id > k.id;
+
+UPDATE warehouse_stocks s
+SET quantity = d.total_quantity
+FROM (
+    SELECT MIN(id) AS keep_id, SUM(quantity) AS total_quantity
+    FROM warehouse_stocks
+    GROUP BY warehouse_id, product_id
+    HAVING COUNT(*) > 1
+) d
+WHERE s.id = d.keep_id;
+
+DELETE FROM warehouse_stocks s
+USING warehouse_stocks k
+WHERE s.warehouse_id = k.warehouse_id
+  AND s.product_id = k.product_id
+  AND s.id > k.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_store_stocks_store_product
+    ON store_stocks(store_id, product_id);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_warehouse_stocks_warehouse_product
+    ON warehouse_stocks(warehouse_id, product_id);
+
+-- UNIQUE indeks bir xil ustunlarni qoplaydi
+DROP INDEX IF EXISTS idx_store_stocks_store_prod;
+DROP INDEX IF EXISTS idx_store_stocks_store_product;
+DROP INDEX IF EXISTS idx_warehouse_stocks_wh_prod;
+DROP INDEX IF EXISTS idx_warehouse_stocks_warehouse_product;
+
+COMMIT;
+
+ANALYZE store_stocks;
+ANALYZE warehouse_stocks;
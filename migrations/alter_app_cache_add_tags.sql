@@ -0,0 +1,11 @@
+-- Migration: app_cache - umumiy kesh backend'i uchun teglar
+-- Purpose: shared_cache.py (SHARED_CACHE_BACKEND=postgres) app_cache jadvalini
+--          barcha keshlar va Flask-Limiter hisoblagichlari uchun ishlatadi.
+--          invalidate_tag() bir guruh kalitlarni (masalan, barcha principal:*)
+--          bitta DELETE bilan o'chirishi uchun tags ustuni qo'shiladi.
+-- Date: 2026-10-16
+
+ALTER TABLE app_cache ADD COLUMN IF NOT EXISTS tags TEXT[] NOT NULL DEFAULT '{}';
+
+CREATE INDEX IF NOT EXISTS idx_app_cache_tags ON app_cache USING GIN (tags);
+CREATE INDEX IF NOT EXISTS idx_app_cache_expires_at ON app_cache(expires_at);
@@ -0,0 +1,32 @@
+-- Migration: Idempotency kalitlari uchun claim jadvali (api_operation_keys)
+-- Purpose: api_operations oylik bo'laklarga ajratilgach UNIQUE (idempotency_key,
+--          created_at) bo'ldi - mikrosoniyali created_at tufayli bir xil kalit hech
+--          qachon to'qnashmaydi va qayta yuborilgan reserve-stock / return-stock /
+--          batch so'rovlari ikki marta bajarilardi. Bu bo'laklanmagan jadvalda
+--          kalit PRIMARY KEY: ilova `INSERT ... ON CONFLICT DO NOTHING RETURNING`
+--          bilan kalitni asosiy o'zgarish tranzaksiyasida band qiladi.
+--          Eski kalitlarni history_archive.run_maintenance() api_operations issiq
+--          muddati bo'yicha o'chiradi.
+-- Date: 2026-10-17
+-- Safe: can be run repeatedly
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS api_operation_keys (
+    idempotency_key VARCHAR(100) PRIMARY KEY,
+    operation_type VARCHAR(50) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_api_operation_keys_created_at ON api_operation_keys(created_at);
+
+-- Mavjud (issiq) operatsiyalar kalitlari - migratsiya paytidagi qayta yuborishlar ham aniqlanadi
+INSERT INTO api_operation_keys (idempotency_key, operation_type, created_at)
+SELECT DISTINCT ON (idempotency_key) idempotency_key, operation_type, created_at
+FROM api_operations
+ORDER BY idempotency_key, created_at
+ON CONFLICT (idempotency_key) DO NOTHING;
+
+COMMIT;
+
+ANALYZE api_operation_keys;
@@ -0,0 +1,12 @@
+-- Migration: Workerlar uchun umumiy kesh jadvali (app_cache)
+-- Purpose: inject_settings dagi menyu nishonlari (qarzli/pending savdolar, transferlar,
+--          qoldiq tekshiruvlari, mahsulot qo'shish sessiyalari) har sahifada COUNT(*)
+--          o'rniga shu jadvaldan o'qiladi (badge_counters.py).
+--          UNLOGGED - kesh yo'qolsa qayta hisoblanadi, WAL yozuvi kerak emas.
+-- Date: 2026-10-16
+
+CREATE UNLOGGED TABLE IF NOT EXISTS app_cache (
+    key VARCHAR(200) PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
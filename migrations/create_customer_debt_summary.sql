@@ -0,0 +1,31 @@
+-- Migration: Mijozlar qarzi yig'indisi (customer_debt_summary)
+-- Purpose: Qarzlar sahifasi, hisobot, Sale.to_dict, qarz to'lovi, eslatmalar va
+--          Telegram qarz tekshiruvi sales ustida SUM(debt_usd) o'rniga shu jadvalni o'qiydi.
+--          Jadval debt_ledger.py tomonidan har bir savdo/to'lov tranzaksiyasida yangilanadi.
+-- Date: 2026-10-16
+--
+-- Migratsiyadan keyin:
+--     python debt_ledger.py rebuild
+--     python debt_ledger.py check
+
+CREATE TABLE IF NOT EXISTS customer_debt_summary (
+    customer_id INTEGER PRIMARY KEY REFERENCES customers(id) ON DELETE CASCADE,
+    debt_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    debt_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    debt_sales_count INTEGER NOT NULL DEFAULT 0,
+    partial_debt_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    partial_debt_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    nearest_due_date DATE,
+    last_sale_date TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Qarzlar sahifasi: faqat qarzdorlar, oxirgi savdo bo'yicha
+CREATE INDEX IF NOT EXISTS idx_customer_debt_summary_debtors
+    ON customer_debt_summary(last_sale_date DESC) WHERE debt_usd > 0;
+
+-- Eslatmalar: tasdiqlangan nasiya qarzdorlari
+CREATE INDEX IF NOT EXISTS idx_customer_debt_summary_partial
+    ON customer_debt_summary(partial_debt_usd) WHERE partial_debt_usd > 0;
+
+ANALYZE customer_debt_summary;
@@ -0,0 +1,23 @@
+-- Migration: Telegram xabarlari navbati (notification_outbox)
+-- Purpose: Savdo cheklari (PDF) va to'lov tasdiqlari endi HTTP so'rov ichida emas,
+--          run_telegram_bot.py jarayonidagi worker tomonidan yuboriladi
+--          (qayta urinish, eksponensial kechikish, tezlik cheklovi bilan).
+-- Date: 2026-10-16
+
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    chat_id BIGINT NOT NULL,
+    payload JSON NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- Worker: yuborish vaqti kelgan xabarlar
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+    ON notification_outbox(status, next_attempt_at);
@@ -0,0 +1,80 @@
+-- Migration: Tasdiqlanmagan transfer qatorlari (pending_transfer_items)
+-- Purpose: pending_transfers.items JSON massivini alohida qatorlarga ko'chirish.
+--          Qabul/yakunlash qatorlarni bitta so'rov bilan o'qiydi (JSON parse yo'q),
+--          /api/all-pending-transfers esa faqat soni va jami miqdorni (GROUP BY) oladi.
+--          Eski JSON ko'rinishi kerak bo'lgan o'quvchilar (hisobotlar, eksport) uchun
+--          pending_transfers_json ko'rinishi (VIEW) - `items` ustuni avvalgidek.
+-- Date: 2026-10-16
+-- Safe: can be run repeatedly
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS pending_transfer_items (
+    id SERIAL PRIMARY KEY,
+    pending_transfer_id INTEGER NOT NULL REFERENCES pending_transfers(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL DEFAULT 0,
+    product_id INTEGER,
+    name VARCHAR(255),
+    price DECIMAL(10, 5),
+    quantity DECIMAL(10, 2) NOT NULL DEFAULT 0,
+    extra JSON
+);
+
+CREATE INDEX IF NOT EXISTS ix_pending_transfer_items_pending_transfer_id
+    ON pending_transfer_items(pending_transfer_id);
+
+-- Mavjud JSON qatorlarini ko'chirish va eski ustunni olib tashlash (faqat birinchi marta)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'pending_transfers' AND column_name = 'items'
+    ) THEN
+        INSERT INTO pending_transfer_items
+            (pending_transfer_id, position, product_id, name, price, quantity, extra)
+        SELECT
+            pt.id,
+            e.ord - 1,
+            CASE WHEN COALESCE(NULLIF(NULLIF(e.item->>'product_id', ''), '0'), e.item->>'id') ~ '^[0-9]+$'
+                 THEN COALESCE(NULLIF(NULLIF(e.item->>'product_id', ''), '0'), e.item->>'id')::INTEGER
+            END,
+            e.item->>'name',
+            CASE WHEN e.item->>'price' ~ '^-?[0-9]+(\.[0-9]+)?$' THEN (e.item->>'price')::DECIMAL(10, 5) END,
+            CASE WHEN e.item->>'quantity' ~ '^-?[0-9]+(\.[0-9]+)?$' THEN (e.item->>'quantity')::DECIMAL(10, 2)
+                 ELSE 0
+            END,
+            NULLIF(e.item::jsonb - 'id' - 'product_id' - 'name' - 'price' - 'quantity', '{}'::jsonb)::json
+        FROM pending_transfers pt
+        CROSS JOIN LATERAL json_array_elements(
+            CASE WHEN json_typeof(pt.items) = 'array' THEN pt.items ELSE '[]'::json END
+        ) WITH ORDINALITY AS e(item, ord)
+        WHERE json_typeof(e.item) = 'object';
+
+        ALTER TABLE pending_transfers DROP COLUMN items;
+    END IF;
+END $$;
+
+-- Eski JSON ko'rinishi: pending_transfers + items ([{id, product_id, name, price, quantity, ...}])
+CREATE OR REPLACE VIEW pending_transfers_json AS
+SELECT
+    pt.*,
+    COALESCE(li.items, '[]'::json) AS items
+FROM pending_transfers pt
+LEFT JOIN LATERAL (
+    SELECT json_agg(
+        (COALESCE(i.extra::jsonb, '{}'::jsonb) || jsonb_build_object(
+            'id', i.product_id,
+            'product_id', i.product_id,
+            'name', i.name,
+            'price', COALESCE(i.price, 0),
+            'quantity', i.quantity
+        ))::json
+        ORDER BY i.position, i.id
+    ) AS items
+    FROM pending_transfer_items i
+    WHERE i.pending_transfer_id = pt.id
+) li ON TRUE;
+
+COMMIT;
+
+ANALYZE pending_transfer_items;
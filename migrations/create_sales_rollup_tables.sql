@@ -0,0 +1,58 @@
+-- Migration: Kunlik va soatlik savdo rollup jadvallari
+-- Purpose: /api/sales-chart, /api/location-chart va /api/sales-statistics
+--          butun sale_items jadvalini emas, oldindan hisoblangan yig'indilarni o'qiydi.
+--          Jadvallar sales_rollup.py tomonidan har bir savdo o'zgarishida yangilanadi.
+-- Date: 2026-10-16
+--
+-- Migratsiyadan keyin mavjud savdolar uchun:
+--     python sales_rollup.py rebuild
+
+CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+    day DATE NOT NULL,
+    location_type VARCHAR(20) NOT NULL DEFAULT '',
+    location_id INTEGER NOT NULL DEFAULT 0,
+    payment_method VARCHAR(20) NOT NULL DEFAULT '',
+    sales_count INTEGER NOT NULL DEFAULT 0,
+    items_count INTEGER NOT NULL DEFAULT 0,
+    items_revenue DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    chart_sales_count INTEGER NOT NULL DEFAULT 0,
+    total_amount DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    total_profit DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    total_amount_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    cash_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    click_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    terminal_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    debt_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    cash_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    click_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    terminal_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    debt_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, location_type, location_id, payment_method)
+);
+
+CREATE TABLE IF NOT EXISTS sales_hourly_rollup (
+    hour TIMESTAMP NOT NULL,
+    location_type VARCHAR(20) NOT NULL DEFAULT '',
+    location_id INTEGER NOT NULL DEFAULT 0,
+    payment_method VARCHAR(20) NOT NULL DEFAULT '',
+    sales_count INTEGER NOT NULL DEFAULT 0,
+    items_count INTEGER NOT NULL DEFAULT 0,
+    items_revenue DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    chart_sales_count INTEGER NOT NULL DEFAULT 0,
+    total_amount DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    total_profit DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    total_amount_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    cash_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    click_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    terminal_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    debt_usd DECIMAL(20, 10) NOT NULL DEFAULT 0,
+    cash_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    click_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    terminal_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    debt_uzs DECIMAL(20, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, location_type, location_id, payment_method)
+);
+
+-- Joylashuv bo'yicha filtrlar uchun (PRIMARY KEY sana bilan boshlanadi)
+CREATE INDEX IF NOT EXISTS idx_sales_daily_rollup_location ON sales_daily_rollup(location_id, location_type, day);
+CREATE INDEX IF NOT EXISTS idx_sales_hourly_rollup_location ON sales_hourly_rollup(location_id, location_type, hour);
@@ -0,0 +1,28 @@
+-- Migration: Korzina stock rezervlari (stock_reservations)
+-- Purpose: /api/reserve-stock/batch butun korzinani bitta tranzaksiyada rezerv qiladi.
+--          Har bir qator cart_id va expires_at bilan saqlanadi; muddati o'tgan
+--          rezervlarni scheduler (yoki `python stock_reservations.py sweep`) qaytaradi.
+-- Date: 2026-10-16
+
+CREATE TABLE IF NOT EXISTS stock_reservations (
+    id SERIAL PRIMARY KEY,
+    cart_id VARCHAR(64) NOT NULL,
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    location_type VARCHAR(20) NOT NULL,
+    location_id INTEGER NOT NULL,
+    quantity DECIMAL(10, 2) NOT NULL,
+    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_stock_reservation_line UNIQUE (cart_id, location_type, location_id, product_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_cart_id ON stock_reservations(cart_id);
+
+-- Sweeper: muddati o'tganlarni tez topish
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_expires_at ON stock_reservations(expires_at);
+
+-- Batch rezerv stock qatorlarini (joylashuv, mahsulot) bo'yicha qulflaydi
+CREATE INDEX IF NOT EXISTS idx_store_stocks_store_product ON store_stocks(store_id, product_id);
+CREATE INDEX IF NOT EXISTS idx_warehouse_stocks_warehouse_product ON warehouse_stocks(warehouse_id, product_id);
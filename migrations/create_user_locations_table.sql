@@ -0,0 +1,55 @@
+-- Migration: Foydalanuvchi joylashuv ruxsatlari (user_locations)
+-- Purpose: users.allowed_locations / transfer_locations / stock_check_locations JSON
+--          ro'yxatlarini (user_id, scope, location_type, location_id) qatorlariga
+--          normallashtirish. Eski [1, 2, 3] formatidagi ID lar stores/warehouses
+--          jadvallari bo'yicha turga ajratiladi. Keyingi o'zgarishlarni
+--          user_locations.py avtomatik sinxronlaydi (`python user_locations.py rebuild`).
+-- Date: 2026-10-16
+
+CREATE TABLE IF NOT EXISTS user_locations (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    scope VARCHAR(20) NOT NULL,
+    location_type VARCHAR(20) NOT NULL,
+    location_id INTEGER NOT NULL,
+    CONSTRAINT uq_user_location UNIQUE (user_id, scope, location_type, location_id)
+);
+
+-- "Bu joylashuvga kimlar ruxsatli" so'rovlari uchun
+CREATE INDEX IF NOT EXISTS idx_user_locations_location ON user_locations(location_type, location_id);
+
+-- Mavjud JSON ro'yxatlaridan to'ldirish
+WITH elements AS (
+    SELECT u.id AS user_id, s.scope, e AS element
+    FROM users u
+    CROSS JOIN LATERAL (VALUES
+        ('allowed', u.allowed_locations::json),
+        ('transfer', u.transfer_locations::json),
+        ('stock_check', u.stock_check_locations::json)
+    ) AS s(scope, locations)
+    CROSS JOIN LATERAL json_array_elements(
+        CASE WHEN json_typeof(s.locations) = 'array' THEN s.locations ELSE '[]'::json END
+    ) AS e
+)
+INSERT INTO user_locations (user_id, scope, location_type, location_id)
+-- Yangi format: {"id": 1, "type": "store"}
+SELECT user_id, scope, element->>'type', (element->>'id')::int
+FROM elements
+WHERE json_typeof(element) = 'object'
+  AND element->>'type' IN ('store', 'warehouse')
+  AND element->>'id' ~ '^[0-9]+$'
+UNION
+-- Eski format: 1 yoki "1" - mavjud do'kon ID si
+SELECT el.user_id, el.scope, 'store', st.id
+FROM elements el
+JOIN stores st ON st.id = (el.element #>> '{}')::int
+WHERE json_typeof(el.element) IN ('number', 'string')
+  AND el.element #>> '{}' ~ '^[0-9]+$'
+UNION
+-- Eski format: mavjud ombor ID si
+SELECT el.user_id, el.scope, 'warehouse', w.id
+FROM elements el
+JOIN warehouses w ON w.id = (el.element #>> '{}')::int
+WHERE json_typeof(el.element) IN ('number', 'string')
+  AND el.element #>> '{}' ~ '^[0-9]+$'
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,180 @@
+-- Migration: Tarix jadvallarini oylik bo'laklarga (partition) ajratish
+-- Purpose: operations_history, transfers, stock_changes va api_operations cheksiz o'sadi -
+--          indekslar va VACUUM har oy qimmatlashadi, /api/transfer/cleanup esa eski
+--          transferlarni qatorma-qator DELETE qilardi. Endi har jadval vaqt ustuni
+--          bo'yicha oylik bo'laklarga ajratiladi (<jadval>_pYYYYMM + <jadval>_default).
+--          Eski bo'laklarni history_archive.py ajratib (DETACH), siqilgan fayllarga
+--          (jsonl.gz) yozadi va o'chiradi; history_archives - arxiv fayllari ro'yxati.
+--          Mavjud qatorlar yangi jadvalga ko'chiriladi (id lar va sequence saqlanadi).
+--          Bo'lakli jadvalda PRIMARY KEY / UNIQUE vaqt ustunini ham o'z ichiga oladi:
+--          (id, vaqt); api_operations.idempotency_key endi oddiy indeks + UNIQUE
+--          (idempotency_key, created_at) - bu kalitni takrorlanishdan HIMOYA QILMAYDI,
+--          dublikatlar create_api_operation_keys_table.sql dagi bo'laklanmagan
+--          api_operation_keys jadvali orqali aniqlanadi (avval o'shani qo'llang).
+-- Date: 2026-10-16
+-- Safe: can be run repeatedly (bo'laklangan jadvallar o'tkazib yuboriladi).
+--       Jadvallar ko'chirish davomida qulflanadi - texnik oynada ishga tushiring.
+
+BEGIN;
+
+-- Arxiv fayllari ro'yxati (history_archive.py yozadi va o'qiydi)
+CREATE TABLE IF NOT EXISTS history_archives (
+    id SERIAL PRIMARY KEY,
+    table_name VARCHAR(50) NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    period_end TIMESTAMP NOT NULL,
+    path VARCHAR(500) NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    size_bytes BIGINT NOT NULL DEFAULT 0,
+    sha256 VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_history_archives_table_period
+    ON history_archives(table_name, period_start);
+
+-- Bitta oylik bo'lak: <jadval>_pYYYYMM. DEFAULT bo'lakka tushib qolgan shu oy
+-- qatorlari yangi bo'lakka ko'chiriladi (aks holda bo'lak yaratib bo'lmaydi).
+-- history_archive.ensure_partitions() ham shu funksiyani chaqiradi.
+CREATE OR REPLACE FUNCTION history_create_partition(p_table TEXT, p_month DATE)
+RETURNS BOOLEAN AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_month)::DATE;
+    v_to DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::DATE;
+    v_name TEXT := p_table || '_p' || to_char(p_month, 'YYYYMM');
+    v_default TEXT := p_table || '_default';
+    v_column TEXT;
+BEGIN
+    IF to_regclass(v_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    IF to_regclass(v_default) IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                       v_name, p_table, v_from, v_to);
+        RETURN TRUE;
+    END IF;
+
+    SELECT a.attname INTO v_column
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = p_table::regclass;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING STORAGE)', v_name, p_table);
+    EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) '
+                   'INSERT INTO %I SELECT * FROM moved',
+                   v_default, v_column, v_from, v_column, v_to, v_name);
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   p_table, v_name, v_from, v_to);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Oddiy jadvalni bo'lakli jadvalga aylantirish: eski jadval <jadval>_legacy deb
+-- qayta nomlanadi, bo'lakli nusxa yaratiladi (eng eski oydan joriy oy + 3 gacha
+-- va DEFAULT), qatorlar ko'chiriladi, sequence yangi jadvalga o'tkaziladi.
+-- Indekslar ko'chirishdan keyin quriladi (tezroq, nomlar to'qnashmaydi).
+CREATE OR REPLACE FUNCTION pg_temp.history_partition_table(p_table TEXT, p_column TEXT)
+RETURNS VOID AS $$
+DECLARE
+    v_legacy TEXT := p_table || '_legacy';
+    v_sequence TEXT;
+    v_month DATE;
+    v_last DATE := (date_trunc('month', CURRENT_DATE) + INTERVAL '3 months')::DATE;
+    v_moved BIGINT;
+BEGIN
+    IF to_regclass(p_table) IS NULL THEN
+        RAISE NOTICE '% jadvali yo''q - o''tkazib yuborildi', p_table;
+        RETURN;
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(p_table)) THEN
+        RAISE NOTICE '% allaqachon bo''laklangan', p_table;
+        RETURN;
+    END IF;
+
+    v_sequence := pg_get_serial_sequence(p_table, 'id');
+
+    EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', p_table);
+    -- Bo'lak kaliti NULL bo'lolmaydi
+    EXECUTE format('UPDATE %I SET %I = CURRENT_TIMESTAMP WHERE %I IS NULL', p_table, p_column, p_column);
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', p_table, v_legacy);
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING STORAGE) PARTITION BY RANGE (%I)',
+                   p_table, v_legacy, p_column);
+    EXECUTE format('ALTER TABLE %I ALTER COLUMN %I SET NOT NULL', p_table, p_column);
+
+    EXECUTE format('SELECT date_trunc(''month'', MIN(%I))::DATE FROM %I', p_column, v_legacy) INTO v_month;
+    v_month := date_trunc('month', LEAST(COALESCE(v_month, CURRENT_DATE), CURRENT_DATE))::DATE;
+    WHILE v_month <= v_last LOOP
+        PERFORM history_create_partition(p_table, v_month);
+        v_month := (v_month + INTERVAL '1 month')::DATE;
+    END LOOP;
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', p_table || '_default', p_table);
+
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', p_table, v_legacy);
+    GET DIAGNOSTICS v_moved = ROW_COUNT;
+
+    IF v_sequence IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', v_sequence, p_table);
+    END IF;
+    EXECUTE format('DROP TABLE %I', v_legacy);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, %I)', p_table, p_column);
+
+    RAISE NOTICE '% -> oylik bo''laklar, % ta qator ko''chirildi', p_table, v_moved;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Tashqi kalitlar (LIKE ularni ko'chirmaydi) - mavjud bo'lsa qayta tekshirilmaydi
+CREATE OR REPLACE FUNCTION pg_temp.history_add_fk(p_table TEXT, p_name TEXT, p_definition TEXT)
+RETURNS VOID AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = p_table::regclass AND conname = p_name) THEN
+        EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s', p_table, p_name, p_definition);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ---------- operations_history ----------
+SELECT pg_temp.history_partition_table('operations_history', 'created_at');
+SELECT pg_temp.history_add_fk('operations_history', 'operations_history_user_id_fkey',
+    'FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL');
+CREATE INDEX IF NOT EXISTS idx_operations_history_created_at_id
+    ON operations_history(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_operations_history_operation_type
+    ON operations_history(operation_type);
+
+-- ---------- transfers ----------
+SELECT pg_temp.history_partition_table('transfers', 'created_at');
+SELECT pg_temp.history_add_fk('transfers', 'transfers_product_id_fkey',
+    'FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE');
+CREATE INDEX IF NOT EXISTS idx_transfers_created_at_id
+    ON transfers(created_at DESC, id DESC);
+
+-- ---------- stock_changes ----------
+SELECT pg_temp.history_partition_table('stock_changes', 'change_date');
+SELECT pg_temp.history_add_fk('stock_changes', 'stock_changes_product_id_fkey',
+    'FOREIGN KEY (product_id) REFERENCES products(id)');
+SELECT pg_temp.history_add_fk('stock_changes', 'stock_changes_warehouse_id_fkey',
+    'FOREIGN KEY (warehouse_id) REFERENCES warehouses(id)');
+SELECT pg_temp.history_add_fk('stock_changes', 'stock_changes_store_id_fkey',
+    'FOREIGN KEY (store_id) REFERENCES stores(id)');
+SELECT pg_temp.history_add_fk('stock_changes', 'stock_changes_user_id_fkey',
+    'FOREIGN KEY (user_id) REFERENCES users(id)');
+CREATE INDEX IF NOT EXISTS idx_stock_changes_change_date_id
+    ON stock_changes(change_date DESC, id DESC);
+
+-- ---------- api_operations ----------
+SELECT pg_temp.history_partition_table('api_operations', 'created_at');
+SELECT pg_temp.history_add_fk('api_operations', 'api_operations_user_id_fkey',
+    'FOREIGN KEY (user_id) REFERENCES users(id)');
+CREATE INDEX IF NOT EXISTS ix_api_operations_idempotency_key
+    ON api_operations(idempotency_key);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_api_operations_idempotency_key_created_at
+    ON api_operations(idempotency_key, created_at);
+
+COMMIT;
+
+ANALYZE operations_history;
+ANALYZE transfers;
+ANALYZE stock_changes;
+ANALYZE api_operations;
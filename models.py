@@ -6,13 +6,15 @@ database.py modulidan import qilinadi (aylanma importni oldini olish uchun).
 """
 import logging
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 
 from database import (
     db,
     get_tashkent_time,
     DEFAULT_PHONE_PLACEHOLDER,
-    _get_location_name_cached,
 )
+import debt_ledger
+import location_directory
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +62,7 @@ class Product(db.Model):
         nullable=False)  # Tekshirilganlik holati
     image_path = db.Column(db.String(255), nullable=True)  # Mahsulot rasmi
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='SET NULL'), nullable=True)  # Kategoriya
+    search_name = db.Column(db.Text, nullable=True)  # normalize_search(name) - trigram qidiruv uchun
 
     # Relationships
     warehouse_stocks = db.relationship('WarehouseStock',
@@ -202,6 +205,11 @@ class WarehouseStock(db.Model):
     min_stock = db.Column(db.Integer, default=10)  # Minimal zaxira
     last_updated = db.Column(db.DateTime, default=db.func.current_timestamp())
 
+    # transfer_engine: INSERT ... ON CONFLICT (warehouse_id, product_id)
+    __table_args__ = (
+        db.UniqueConstraint('warehouse_id', 'product_id', name='uq_warehouse_stocks_warehouse_product'),
+    )
+
     # Relationships
     warehouse = db.relationship('Warehouse', backref='stocks')
     product = db.relationship('Product', overlaps="warehouse_stocks")
@@ -242,6 +250,11 @@ class StoreStock(db.Model):
     min_stock = db.Column(db.Integer, default=10)  # Minimal zaxira
     last_updated = db.Column(db.DateTime, default=db.func.current_timestamp())
 
+    # transfer_engine: INSERT ... ON CONFLICT (store_id, product_id)
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'product_id', name='uq_store_stocks_store_product'),
+    )
+
     # Relationships
     store = db.relationship('Store', backref='stocks')
     product = db.relationship('Product', overlaps="store_stocks")
@@ -258,7 +271,7 @@ class StoreStock(db.Model):
         return {
             'id': self.id,
             'store_id': self.store_id,
-            'store_name': self.store.name if self.store else 'Noma\'lum',
+            'store_name': location_directory.resolve('store', self.store_id, 'Noma\'lum'),
             'product_id': self.product_id,
             'product_name': self.product.name if self.product else 'Noma\'lum',
             'quantity': float(self.quantity) if self.quantity else 0,
@@ -285,7 +298,8 @@ class Transfer(db.Model):
     to_location_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.DECIMAL(precision=10, scale=2), nullable=False)
     user_name = db.Column(db.String(100), default='Admin')
-    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # Oylik bo'lak kaliti (migrations/partition_history_tables.sql)
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
 
     # Relationships
     product = db.relationship('Product', backref='transfers')
@@ -295,16 +309,16 @@ class Transfer(db.Model):
 
     @property
     def from_location_name(self):
-        """Qayerdan joylashuv nomi (keshdan olish - N+1 oldini oladi)"""
+        """Qayerdan joylashuv nomi (location_directory dan - N+1 oldini oladi)"""
         if self.from_location_type and self.from_location_id:
-            return _get_location_name_cached(self.from_location_type, self.from_location_id)
+            return location_directory.resolve(self.from_location_type, self.from_location_id)
         return "Noma'lum"
 
     @property
     def to_location_name(self):
-        """Qayerga joylashuv nomi (keshdan olish - N+1 oldini oladi)"""
+        """Qayerga joylashuv nomi (location_directory dan - N+1 oldini oladi)"""
         if self.to_location_type and self.to_location_id:
-            return _get_location_name_cached(self.to_location_type, self.to_location_id)
+            return location_directory.resolve(self.to_location_type, self.to_location_id)
         return "Noma'lum"
 
     def to_dict(self):
@@ -333,7 +347,6 @@ class PendingTransfer(db.Model):
     from_location_id = db.Column(db.Integer, nullable=False)
     to_location_type = db.Column(db.String(20), nullable=False)  # 'store' yoki 'warehouse'
     to_location_id = db.Column(db.Integer, nullable=False)
-    items = db.Column(db.JSON, nullable=False)  # [{product_id, name, price, quantity, available}, ...]
     status = db.Column(db.String(20), default='draft')  # draft | sent | picking | dispatched | completed
     sent_at = db.Column(db.DateTime, nullable=True)
     dispatched_at = db.Column(db.DateTime, nullable=True)
@@ -349,10 +362,26 @@ class PendingTransfer(db.Model):
     # Relationship
     user = db.relationship('User', backref='pending_transfers', foreign_keys=[user_id])
     dispatched_by = db.relationship('User', foreign_keys=[dispatched_by_id])
+    # Mahsulot qatorlari (pending_transfer_items) - o'chirishda DB ON DELETE CASCADE
+    lines = db.relationship('PendingTransferItem', order_by='PendingTransferItem.position',
+                            cascade='all, delete-orphan', passive_deletes=True,
+                            back_populates='pending_transfer')
 
     def __repr__(self):
         return f'<PendingTransfer {self.id}: User {self.user_id}>'
 
+    @property
+    def items(self):
+        """Qatorlar eski JSON ko'rinishida: [{id, product_id, name, price, quantity, ...}, ...]"""
+        return [line.to_item() for line in self.lines]
+
+    @items.setter
+    def items(self, value):
+        self.lines = [PendingTransferItem.from_item(item, position)
+                      for position, item in enumerate(value or [])]
+        # Faqat qatorlar o'zgarsa ham ro'yxatdagi tartib (updated_at) yangilansin
+        self.updated_at = db.func.current_timestamp()
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -376,6 +405,73 @@ class PendingTransfer(db.Model):
         }
 
 
+def _to_decimal(value):
+    """JSON qiymatini Decimal ga (noto'g'ri yoki bo'sh bo'lsa None)"""
+    if value is None or value == '':
+        return None
+    try:
+        number = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return None
+    return number if number.is_finite() else None
+
+
+# Tasdiqlanmagan transfer qatorlari (avval pending_transfers.items JSON edi)
+class PendingTransferItem(db.Model):
+    __tablename__ = 'pending_transfer_items'
+
+    # Ustunga ega maydonlar; qolganlari (available, unitType, ...) extra da saqlanadi
+    ITEM_FIELDS = ('id', 'product_id', 'name', 'price', 'quantity')
+
+    id = db.Column(db.Integer, primary_key=True)
+    pending_transfer_id = db.Column(
+        db.Integer,
+        db.ForeignKey('pending_transfers.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Ro'yxatdagi tartib
+    product_id = db.Column(db.Integer, nullable=True)  # FK yo'q - JSON dagi kabi mahsulot o'chsa ham qator qoladi
+    name = db.Column(db.String(255))
+    price = db.Column(db.DECIMAL(precision=10, scale=5))
+    quantity = db.Column(db.DECIMAL(precision=10, scale=2), nullable=False, default=0)
+    extra = db.Column(db.JSON)
+
+    pending_transfer = db.relationship('PendingTransfer', back_populates='lines')
+
+    def __repr__(self):
+        return f'<PendingTransferItem {self.pending_transfer_id}: P:{self.product_id} Q:{self.quantity}>'
+
+    @classmethod
+    def from_item(cls, item, position=0):
+        """Eski JSON qatoridan ({id/product_id, name, price, quantity, ...}) yaratish"""
+        if not isinstance(item, dict):
+            raise ValueError(f"Transfer qatori noto'g'ri: {item}")
+        try:
+            product_id = int(item.get('product_id') or item.get('id'))
+        except (TypeError, ValueError):
+            product_id = None
+        extra = {key: value for key, value in item.items() if key not in cls.ITEM_FIELDS}
+        return cls(
+            position=position,
+            product_id=product_id,
+            name=item.get('name'),
+            price=_to_decimal(item.get('price')),
+            quantity=_to_decimal(item.get('quantity')) or Decimal('0'),
+            extra=extra or None
+        )
+
+    def to_item(self):
+        item = dict(self.extra or {})
+        item.update({
+            'id': self.product_id,
+            'product_id': self.product_id,
+            'name': self.name,
+            'price': float(self.price) if self.price is not None else 0,
+            'quantity': float(self.quantity) if self.quantity is not None else 0,
+        })
+        return item
+
+
 # Tugallanmagan mahsulot qo'shish sessiyalari modeli
 class PendingProductBatch(db.Model):
     __tablename__ = 'pending_product_batches'
@@ -423,6 +519,7 @@ class Customer(db.Model):
     last_debt_payment_date = db.Column(db.DateTime, nullable=True)
     last_debt_payment_rate = db.Column(db.Numeric(10, 2), default=13000)
     balance = db.Column(db.DECIMAL(precision=15, scale=4), nullable=False, default=0)  # Mijoz balansi (ortiqcha to'lov)
+    search_text = db.Column(db.Text, nullable=True)  # Nom + telefon + email - trigram qidiruv uchun
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(
         db.DateTime,
@@ -438,12 +535,9 @@ class Customer(db.Model):
     def to_dict(self):
         try:
             store_name = 'Umumiy'
-            if self.store_id and self.store:
-                store_name = self.store.name
-            elif self.store_id:
-                # Agar store_id bor lekin relationship yuklanmagan bo'lsa
-                store = Store.query.get(self.store_id)
-                store_name = store.name if store else 'Umumiy'
+            if self.store_id:
+                # location_directory dan - store relationship'ni yuklamasdan
+                store_name = location_directory.resolve('store', self.store_id, 'Umumiy')
         except Exception as e:
             store_name = 'Umumiy'
             logger.error(f"Error getting store name for customer {self.id}: {str(e)}")
@@ -462,6 +556,25 @@ class Customer(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None}
 
 
+# Mijoz qarzlari yig'indisi (debt_ledger.py yangilaydi) - faqat qarzdorlar uchun qator bor
+class CustomerDebtSummary(db.Model):
+    __tablename__ = 'customer_debt_summary'
+
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id', ondelete='CASCADE'), primary_key=True)
+    # debt_usd > 0 bo'lgan barcha savdolar bo'yicha (qarzlar sahifasi, hisobot)
+    debt_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    debt_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    debt_sales_count = db.Column(db.Integer, nullable=False, default=0)
+    # Faqat tasdiqlangan nasiya (payment_status = 'partial') savdolar bo'yicha
+    partial_debt_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    partial_debt_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    nearest_due_date = db.Column(db.Date, nullable=True)
+    last_sale_date = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=lambda: get_tashkent_time(), onupdate=lambda: get_tashkent_time())
+
+    customer = db.relationship('Customer', backref=db.backref('debt_summary', uselist=False, passive_deletes=True))
+
+
 # Qarz to'lovlari tarixi modeli
 class DebtPayment(db.Model):
     __tablename__ = 'debt_payments'
@@ -623,7 +736,7 @@ class User(db.Model):
             'role': self.role,
             'role_display': self.get_role_display(),
             'store_id': self.store_id,
-            'store_name': self.store.name if self.store else 'Barcha do\'konlar',
+            'store_name': location_directory.resolve('store', self.store_id, 'Barcha do\'konlar'),
             'permissions': self.permissions or {},
             'allowed_locations': self.allowed_locations or [],
             'transfer_locations': self.transfer_locations or [],
@@ -651,17 +764,93 @@ class ApiOperation(db.Model):
     __tablename__ = 'api_operations'
 
     id = db.Column(db.Integer, primary_key=True)
-    idempotency_key = db.Column(db.String(100), unique=True, nullable=False, index=True)
+    # Bo'lakli jadvalda UNIQUE (idempotency_key, created_at) - kalit bo'yicha oddiy indeks,
+    # takrorlanish ApiOperationKey (api_operation_keys) orqali aniqlanadi
+    idempotency_key = db.Column(db.String(100), nullable=False, index=True)
     operation_type = db.Column(db.String(50), nullable=False)  # 'transfer', 'sale', 'payment'
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     status = db.Column(db.String(20), default='completed')  # 'completed', 'failed'
     result_data = db.Column(db.Text)  # JSON natija
-    created_at = db.Column(db.DateTime, default=get_tashkent_time)
+    created_at = db.Column(db.DateTime, nullable=False, default=get_tashkent_time)  # oylik bo'lak kaliti
 
     def __repr__(self):
         return f'<ApiOperation {self.operation_type} - {self.idempotency_key}>'
 
 
+class ApiOperationKey(db.Model):
+    """Idempotency kaliti claim'i - bo'laklanmagan jadval, kalit PRIMARY KEY.
+
+    api_operations bo'lakli (UNIQUE kalit + created_at) bo'lgani uchun dublikatni
+    faqat shu jadval aniqlaydi. Eski kalitlarni history_archive o'chiradi.
+    """
+    __tablename__ = 'api_operation_keys'
+
+    idempotency_key = db.Column(db.String(100), primary_key=True)
+    operation_type = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=get_tashkent_time, index=True)
+
+    def __repr__(self):
+        return f'<ApiOperationKey {self.operation_type} - {self.idempotency_key}>'
+
+
+class NotificationOutbox(db.Model):
+    """Yuborilishi kutilayotgan Telegram xabarlari (notification_queue.py worker yuboradi)"""
+    __tablename__ = 'notification_outbox'
+    __table_args__ = (
+        db.Index('idx_notification_outbox_due', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # 'sale_receipt', 'payment_confirmation'
+    chat_id = db.Column(db.BigInteger, nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)  # bot metodi argumentlari
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=get_tashkent_time)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=get_tashkent_time)
+    updated_at = db.Column(db.DateTime, default=get_tashkent_time, onupdate=get_tashkent_time)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<NotificationOutbox {self.id} {self.kind} {self.status}>'
+
+
+class StockReservation(db.Model):
+    """Korzina (cart) uchun rezerv qilingan stock - muddati o'tsa sweeper qaytaradi"""
+    __tablename__ = 'stock_reservations'
+    __table_args__ = (
+        db.UniqueConstraint('cart_id', 'location_type', 'location_id', 'product_id',
+                            name='uq_stock_reservation_line'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.String(64), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    location_type = db.Column(db.String(20), nullable=False)  # 'store' yoki 'warehouse'
+    location_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.DECIMAL(precision=10, scale=2), nullable=False)
+    # Sweeper stock'ga qaytargan miqdor - korzina savdoga o'tsa consume_cart() qayta ayiradi
+    released_quantity = db.Column(db.DECIMAL(precision=10, scale=2), nullable=False, default=0)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=get_tashkent_time)
+    updated_at = db.Column(db.DateTime, default=get_tashkent_time, onupdate=get_tashkent_time)
+
+    def __repr__(self):
+        return (f'<StockReservation {self.cart_id} {self.location_type}:{self.location_id} '
+                f'P:{self.product_id} Q:{self.quantity}>')
+
+    def to_dict(self):
+        return {
+            'product_id': self.product_id,
+            'location_type': self.location_type,
+            'location_id': self.location_id,
+            'quantity': float(self.quantity) if self.quantity else 0,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+        }
+
+
 class OperationHistory(db.Model):
     """Barcha tizim amaliyotlarini saqlash uchun audit log"""
     __tablename__ = 'operations_history'
@@ -680,12 +869,33 @@ class OperationHistory(db.Model):
     location_type = db.Column(db.String(20))  # 'store' yoki 'warehouse'
     location_name = db.Column(db.String(200))  # Joylashuv nomi (cache)
     amount = db.Column(db.Numeric(15, 2))  # Summa (agar mavjud bo'lsa)
-    created_at = db.Column(db.DateTime, default=get_tashkent_time, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=get_tashkent_time, index=True)  # oylik bo'lak kaliti
 
     def __repr__(self):
         return f'<OperationHistory {self.operation_type} by {self.username}>'
 
 
+class HistoryArchive(db.Model):
+    """Tarix jadvalidan ajratilgan bir oylik arxiv fayli (history_archive.py)"""
+    __tablename__ = 'history_archives'
+    __table_args__ = (
+        db.Index('idx_history_archives_table_period', 'table_name', 'period_start'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)  # 'operations_history', 'transfers', ...
+    period_start = db.Column(db.DateTime, nullable=False)  # oy boshi (kiradi)
+    period_end = db.Column(db.DateTime, nullable=False)  # keyingi oy boshi (kirmaydi)
+    path = db.Column(db.String(500), nullable=False)  # .jsonl.gz fayl
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    size_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    sha256 = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=get_tashkent_time)
+
+    def __repr__(self):
+        return f'<HistoryArchive {self.table_name} {self.period_start:%Y-%m} ({self.row_count})>'
+
+
 # Foydalanuvchi session'lari modeli
 class UserSession(db.Model):
     __tablename__ = 'user_sessions'
@@ -722,6 +932,29 @@ class UserSession(db.Model):
         }
 
 
+class UserLocation(db.Model):
+    """Foydalanuvchi joylashuv ruxsatlari - users.*_locations JSON ustunlarining normallashgan nusxasi.
+
+    scope: 'allowed' (allowed_locations), 'transfer' (transfer_locations),
+    'stock_check' (stock_check_locations). user_locations.py sinxronlaydi.
+    """
+    __tablename__ = 'user_locations'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'scope', 'location_type', 'location_id',
+                            name='uq_user_location'),
+        db.Index('idx_user_locations_location', 'location_type', 'location_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    scope = db.Column(db.String(20), nullable=False)
+    location_type = db.Column(db.String(20), nullable=False)  # 'store' yoki 'warehouse'
+    location_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<UserLocation U:{self.user_id} {self.scope} {self.location_type}:{self.location_id}>'
+
+
 # Sozlamalar modeli
 class Settings(db.Model):
     __tablename__ = 'settings'
@@ -843,7 +1076,7 @@ class SaleItem(db.Model):
         location_name = "Noma'lum"
         try:
             if self.source_type and self.source_id:
-                base_name = _get_location_name_cached(self.source_type, self.source_id)
+                base_name = location_directory.resolve(self.source_type, self.source_id)
                 prefix = 'Ombor' if self.source_type == 'warehouse' else 'Dokon'
                 location_name = f"{prefix}: {base_name}"
         except Exception as e:
@@ -952,32 +1185,8 @@ class Sale(db.Model):
                 operation_type='return'
             ).all()
 
-            returned_items = []
-            for op in returned_ops:
-                if op.new_data and isinstance(op.new_data, dict):
-                    # Narxni old_data dan olish (unit_price va total_price)
-                    unit_price = 0
-                    total_price = 0
-                    if op.old_data and isinstance(op.old_data, dict):
-                        old_quantity = op.old_data.get('quantity', 0)
-                        old_total = op.old_data.get('total_price', 0)
-                        if old_quantity > 0:
-                            unit_price = old_total / old_quantity
-
-                    returned_quantity = op.new_data.get('returned_quantity', 0)
-                    total_price = unit_price * returned_quantity
-
-                    returned_items.append({
-                        'product_id': op.new_data.get('product_id'),
-                        'product_name': op.new_data.get('product_name'),
-                        'returned_quantity': returned_quantity,
-                        'unit_price': float(unit_price),
-                        'total_price': float(total_price),
-                        'location_name': op.location_name if op.location_name else 'Noma\'lum',
-                        'return_date': op.created_at.isoformat() if op.created_at else None
-                    })
-
-            return returned_items
+            return [_returned_product_dict(op) for op in returned_ops
+                    if op.new_data and isinstance(op.new_data, dict)]
         except Exception as e:
             logger.error(f"Error getting returned products for sale {self.id}: {str(e)}")
             return []
@@ -990,27 +1199,20 @@ class Sale(db.Model):
                 operation_type='payment_refund'
             ).all()
 
-            refunds = []
-            for op in refund_ops:
-                if op.new_data and isinstance(op.new_data, dict):
-                    refunds.append({
-                        'payment_type': op.new_data.get('payment_type'),
-                        'refund_amount_usd': op.new_data.get('refund_amount_usd', 0),
-                        'refund_amount_uzs': op.new_data.get('refund_amount_uzs', 0),
-                        'refund_date': op.created_at.isoformat() if op.created_at else None
-                    })
-
-            return refunds
+            return [_payment_refund_dict(op) for op in refund_ops
+                    if op.new_data and isinstance(op.new_data, dict)]
         except Exception as e:
             logger.error(f"Error getting payment refunds for sale {self.id}: {str(e)}")
             return []
 
-    def to_dict(self, include_items=True, include_details=False):
+    def to_dict(self, include_items=True, include_details=False, prefetched=None):
         """Sale obyektini dict ga aylantirish
 
         Args:
             include_items: SaleItem'larni qo'shish (default: True)
             include_details: Qo'shimcha ma'lumotlar (returned_products, payment_refunds, debt_payments)
+            prefetched: serialize_sales() oldindan yig'gan ma'lumotlar (qarz yig'indilari,
+                qaytarishlar). Berilmasa - har bir savdo uchun alohida so'rov.
         """
         # Mijoz nomini va telefon raqamini aniqlash
         if self.customer:
@@ -1032,25 +1234,16 @@ class Sale(db.Model):
         total_debt_usd = 0.0
         total_debt_uzs = 0.0
 
-        if self.customer_id:
+        if self.customer_id and prefetched is not None:
+            # serialize_sales() butun sahifa uchun bitta GROUP BY bilan hisoblagan
+            total_debt_usd, total_debt_uzs = prefetched['debt_totals'].get(self.customer_id, (0.0, 0.0))
+            previous_debt_usd = total_debt_usd - float(self.debt_usd or 0)
+            previous_debt_uzs = total_debt_uzs - float(self.debt_amount or 0)
+        elif self.customer_id:
             try:
-                # Jami qarzni hisoblash
-                total_debt_result = db.session.execute(
-                    db.text("""
-                        SELECT
-                            COALESCE(SUM(debt_usd), 0) as total_debt_usd,
-                            COALESCE(SUM(debt_amount), 0) as total_debt_uzs
-                        FROM sales
-                        WHERE customer_id = :customer_id
-                        AND payment_status = 'partial'
-                        AND (debt_usd > 0 OR debt_amount > 0)
-                    """),
-                    {"customer_id": self.customer_id}
-                ).fetchone()
-
-                if total_debt_result:
-                    total_debt_usd = float(total_debt_result[0] or 0)
-                    total_debt_uzs = float(total_debt_result[1] or 0)
+                # Jami qarz - customer_debt_summary'dan (sales ustida SUM emas)
+                total_debt_usd, total_debt_uzs = debt_ledger.partial_debt_totals(
+                    [self.customer_id]).get(self.customer_id, (0.0, 0.0))
 
                 # Oldingi qarz = Jami qarz - Joriy savdo qarzi
                 previous_debt_usd = total_debt_usd - float(self.debt_usd or 0)
@@ -1065,7 +1258,7 @@ class Sale(db.Model):
             'customer_phone': customer_phone,
             'customer_balance': float(self.customer.balance or 0) if self.customer else 0.0,
             'store_id': self.store_id,
-            'store_name': self.store.name if self.store else '🚫 O\'chirilgan do\'kon',
+            'store_name': location_directory.resolve('store', self.store_id, '🚫 O\'chirilgan do\'kon'),
             'location_id': self.location_id if self.location_id else self.store_id,
             'location_type': self.location_type if self.location_type else ('store' if self.store_id else None),
             'seller_id': self.seller_id,
@@ -1118,8 +1311,12 @@ class Sale(db.Model):
 
         # ✅ Optional: Qo'shimcha ma'lumotlar (xotira tejash uchun)
         if include_details:
-            result['returned_products'] = self._get_returned_products()
-            result['payment_refunds'] = self._get_payment_refunds()
+            if prefetched is not None:
+                result['returned_products'] = prefetched['returned'].get(self.id, [])
+                result['payment_refunds'] = prefetched['refunds'].get(self.id, [])
+            else:
+                result['returned_products'] = self._get_returned_products()
+                result['payment_refunds'] = self._get_payment_refunds()
             result['debt_payments'] = [
                 {
                     'id': dp.id,
@@ -1141,7 +1338,180 @@ class Sale(db.Model):
         return result
 
 
+def _returned_product_dict(op):
+    """'return' turidagi OperationHistory yozuvini qaytarilgan mahsulot dict'iga aylantirish"""
+    # Narxni old_data dan olish (unit_price va total_price)
+    unit_price = 0
+    total_price = 0
+    if op.old_data and isinstance(op.old_data, dict):
+        old_quantity = op.old_data.get('quantity', 0)
+        old_total = op.old_data.get('total_price', 0)
+        if old_quantity > 0:
+            unit_price = old_total / old_quantity
+
+    returned_quantity = op.new_data.get('returned_quantity', 0)
+    total_price = unit_price * returned_quantity
+
+    return {
+        'product_id': op.new_data.get('product_id'),
+        'product_name': op.new_data.get('product_name'),
+        'returned_quantity': returned_quantity,
+        'unit_price': float(unit_price),
+        'total_price': float(total_price),
+        'location_name': op.location_name if op.location_name else 'Noma\'lum',
+        'return_date': op.created_at.isoformat() if op.created_at else None
+    }
+
+
+def _payment_refund_dict(op):
+    """'payment_refund' turidagi OperationHistory yozuvini dict'ga aylantirish"""
+    return {
+        'payment_type': op.new_data.get('payment_type'),
+        'refund_amount_usd': op.new_data.get('refund_amount_usd', 0),
+        'refund_amount_uzs': op.new_data.get('refund_amount_uzs', 0),
+        'refund_date': op.created_at.isoformat() if op.created_at else None
+    }
+
+
+def serialize_sales(sales, include_items=True, include_details=False):
+    """Savdolar ro'yxatini Sale.to_dict() bilan bir xil formatda serializatsiya qilish.
+
+    Har bir savdo uchun alohida so'rov yuborish o'rniga butun ro'yxat uchun
+    o'zgarmas sondagi so'rovlar bilan oldindan yuklaydi: mijozlarning jami
+    qarzi (bitta GROUP BY), mijoz/do'kon/sotuvchi qatorlari, savdo
+    elementlari va mahsulotlar, joylashuv nomlari hamda (include_details
+    bo'lsa) qaytarishlar, to'lov qaytarishlari va qarz to'lovlari.
+    """
+    sales = [sale for sale in sales if sale is not None]
+    if not sales:
+        return []
+
+    sale_ids = [sale.id for sale in sales]
+    customer_ids = {sale.customer_id for sale in sales if sale.customer_id}
+    seller_ids = {sale.seller_id for sale in sales if sale.seller_id}
+
+    # Mijozlarning jami qarzi - customer_debt_summary'dan bitta IN so'rovi
+    debt_totals = debt_ledger.partial_debt_totals(customer_ids)
+
+    # Many-to-one bog'lanishlar: identity map'ga yuklash (keyingi lazy load SQL yubormaydi)
+    if customer_ids:
+        Customer.query.filter(Customer.id.in_(customer_ids)).all()
+    if seller_ids:
+        User.query.filter(User.id.in_(seller_ids)).all()
+
+    if include_items:
+        _prefetch_sale_items(sales)
+
+    returned = {}
+    refunds = {}
+    if include_details:
+        ops = OperationHistory.query.filter(
+            OperationHistory.record_id.in_(sale_ids),
+            OperationHistory.operation_type.in_(('return', 'payment_refund'))
+        ).order_by(OperationHistory.id).all()
+        for op in ops:
+            if not (op.new_data and isinstance(op.new_data, dict)):
+                continue
+            if op.operation_type == 'return':
+                returned.setdefault(op.record_id, []).append(_returned_product_dict(op))
+            else:
+                refunds.setdefault(op.record_id, []).append(_payment_refund_dict(op))
+        _prefetch_debt_payments(sales)
+
+    prefetched = {'debt_totals': debt_totals, 'returned': returned, 'refunds': refunds}
+    return [
+        sale.to_dict(include_items=include_items, include_details=include_details,
+                     prefetched=prefetched)
+        for sale in sales
+    ]
+
+
+def _prefetch_sale_items(sales):
+    """Yuklanmagan Sale.items kolleksiyalarini bitta so'rov bilan to'ldirish"""
+    from sqlalchemy.orm.attributes import set_committed_value
+
+    pending = [sale for sale in sales if 'items' not in sale.__dict__]
+    if pending:
+        items = SaleItem.query.options(db.joinedload(SaleItem.product)).filter(
+            SaleItem.sale_id.in_([sale.id for sale in pending])
+        ).order_by(SaleItem.id).all()
+        by_sale = {}
+        for item in items:
+            by_sale.setdefault(item.sale_id, []).append(item)
+        for sale in pending:
+            set_committed_value(sale, 'items', by_sale.get(sale.id, []))
+
+    # Oldindan yuklangan elementlarning mahsulotlari
+    product_ids = {
+        item.product_id for sale in sales for item in sale.items
+        if item.product_id and 'product' not in item.__dict__
+    }
+    if product_ids:
+        Product.query.filter(Product.id.in_(product_ids)).all()
+
+
+def _prefetch_debt_payments(sales):
+    """Sale.debt_payments kolleksiyalarini bitta so'rov bilan to'ldirish"""
+    from sqlalchemy.orm.attributes import set_committed_value
+
+    pending = [sale for sale in sales if 'debt_payments' not in sale.__dict__]
+    if not pending:
+        return
+    payments = DebtPayment.query.filter(
+        DebtPayment.sale_id.in_([sale.id for sale in pending])
+    ).order_by(DebtPayment.id).all()
+    by_sale = {}
+    for payment in payments:
+        by_sale.setdefault(payment.sale_id, []).append(payment)
+    for sale in pending:
+        set_committed_value(sale, 'debt_payments', by_sale.get(sale.id, []))
+
+
 # Valyuta kursi modeli
+class _SalesRollupColumns:
+    """Savdo rollup jadvallarining umumiy ustunlari (sales_rollup.py yangilaydi).
+
+    location_type/location_id/payment_method NULL bo'lsa '' / 0 saqlanadi.
+    chart_* va to'lov ustunlari faqat biror to'lov summasi > 0 bo'lgan savdolar
+    bo'yicha (grafikning avvalgi WHERE sharti), sales_count va items_* esa barcha
+    savdolar bo'yicha.
+    """
+    location_type = db.Column(db.String(20), primary_key=True, default='')
+    location_id = db.Column(db.Integer, primary_key=True, default=0)
+    payment_method = db.Column(db.String(20), primary_key=True, default='')
+
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    items_count = db.Column(db.Integer, nullable=False, default=0)
+    items_revenue = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+
+    chart_sales_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    total_profit = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    total_amount_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    cash_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    click_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    terminal_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    debt_usd = db.Column(db.DECIMAL(precision=20, scale=10), nullable=False, default=0)
+    cash_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    click_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    terminal_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+    debt_uzs = db.Column(db.DECIMAL(precision=20, scale=2), nullable=False, default=0)
+
+
+class SalesDailyRollup(_SalesRollupColumns, db.Model):
+    """Kunlik savdo yig'indilari (joylashuv + to'lov usuli bo'yicha)"""
+    __tablename__ = 'sales_daily_rollup'
+
+    day = db.Column(db.Date, primary_key=True)
+
+
+class SalesHourlyRollup(_SalesRollupColumns, db.Model):
+    """Soatlik savdo yig'indilari (joylashuv + to'lov usuli bo'yicha)"""
+    __tablename__ = 'sales_hourly_rollup'
+
+    hour = db.Column(db.DateTime, primary_key=True)  # soat boshiga kesilgan sale_date
+
+
 class StockChange(db.Model):
     """Stock o'zgarishlari tarixi - qo'shish, ayirish, transfer"""
     __tablename__ = 'stock_changes'
@@ -1154,7 +1524,7 @@ class StockChange(db.Model):
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=True)
     store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    change_date = db.Column(db.DateTime, default=lambda: get_tashkent_time())
+    change_date = db.Column(db.DateTime, nullable=False, default=lambda: get_tashkent_time())  # oylik bo'lak kaliti
     notes = db.Column(db.Text, nullable=True)
 
     # Relationships (backref olib tashlandi - delete muammosini keltirib chiqaradi)
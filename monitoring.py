@@ -2,26 +2,68 @@
 """
 Server Monitoring va Health Check System
 Digital Ocean serverda sayt holatini kuzatish
+
+Server va DB ko'rsatkichlarini `SystemSampler` fon oqimi har
+SAMPLE_INTERVAL soniyada o'lchaydi va shared_cache dagi halqali buferga
+(oxirgi HISTORY_SIZE ta o'lchov) yozadi - `/monitoring/status` o'lchov
+kutmasdan oxirgi qiymatlar va grafiklar uchun qisqa tarixni qaytaradi.
 """
 
 import logging
 import os
 import psutil
+import threading
 import time
 from datetime import datetime, timedelta
 from functools import wraps
 from flask import jsonify, render_template, request, session, redirect, url_for
 from sqlalchemy import text
 
+import metrics
+import query_profiler
+import shared_cache
+
 logger = logging.getLogger(__name__)
 
+SAMPLE_INTERVAL = int(os.getenv('MONITORING_SAMPLE_INTERVAL', '10'))
+HISTORY_SIZE = 180          # 30 daqiqa (10 soniyalik o'lchovlar)
+CHART_POINTS = 60           # /monitoring/status grafiklari uchun oxirgi 10 daqiqa
+HISTORY_KEY = 'monitoring:system_samples'
+HISTORY_TTL = 3600
+TURN_KEY_PREFIX = 'monitoring:sample_turn:'
+
+LOG_TAIL_BLOCK = 8192
+MAX_LOG_LINES = 5000
+
+
+def tail_lines(path, count, block_size=LOG_TAIL_BLOCK):
+    """Faylning oxirgi count qatori - oxiridan bloklab o'qiladi (butun fayl emas)"""
+    if count <= 0:
+        return []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        blocks = []
+        newlines = 0
+        # count + 1 ta '\n' - birinchi qator ham to'liq bo'lishi uchun
+        while position > 0 and newlines <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+    data = b''.join(reversed(blocks))
+    return [line.decode('utf-8', errors='replace') for line in data.splitlines()[-count:]]
+
+
 class ServerMonitor:
     """Server resurslarini monitoring qilish"""
 
     @staticmethod
     def get_cpu_usage():
-        """CPU ishlatilishi (%)"""
-        return psutil.cpu_percent(interval=1)
+        """CPU ishlatilishi (%) - oldingi chaqiruvdan beri (kutmaydi)"""
+        return psutil.cpu_percent(interval=None)
 
     @staticmethod
     def get_memory_usage():
@@ -100,19 +142,20 @@ class DatabaseMonitor:
             query = text("""
                 SELECT
                     pid,
-                    now() - query_start as duration,
-                    query,
+                    EXTRACT(EPOCH FROM now() - query_start) as duration,
+                    LEFT(query, 500) as query,
                     state
                 FROM pg_stat_activity
                 WHERE state != 'idle'
-                AND now() - query_start > interval ':threshold seconds'
+                AND now() - query_start > make_interval(secs => :threshold)
                 ORDER BY duration DESC
             """)
             result = self.db.session.execute(
                 query,
                 {'threshold': threshold_seconds}
             ).fetchall()
-            return [dict(row._mapping) for row in result]
+            return [{'pid': row.pid, 'duration': round(float(row.duration), 1),
+                     'query': row.query, 'state': row.state} for row in result]
         except Exception as e:
             logger.error(f"Error getting slow queries: {e}")
             return []
@@ -141,8 +184,7 @@ class ApplicationMonitor:
                 return []
 
             # Oxirgi 100 qatorni o'qish
-            with open(log_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()[-100:]
+            lines = tail_lines(log_file, 100)
 
             errors = []
             for line in lines:
@@ -154,34 +196,152 @@ class ApplicationMonitor:
             logger.error(f"Error reading error log: {e}")
             return []
 
-    def get_request_stats(self):
-        """Access log statistikasi"""
+    def get_request_stats(self, history):
+        """HTTP so'rovlar statistikasi (metrics.py, SystemSampler o'lchovlaridan)"""
+        samples = [sample for sample in history if sample.get('requests')]
+        if not samples:
+            return {'total': 0, 'errors_5xx': 0, 'recent_5min': 0}
+        latest = samples[-1]
+        base = next(sample for sample in samples if latest['t'] - sample['t'] <= 300)
+        # Worker qayta ishga tushsa hisoblagich kamayishi mumkin
+        recent = max(latest['requests']['total'] - base['requests']['total'], 0)
+        return {
+            'total': latest['requests']['total'],
+            'errors_5xx': latest['requests']['errors'],
+            'recent_5min': recent,
+        }
+
+
+class SystemSampler:
+    """Fon oqimi: server, DB va so'rovlar ko'rsatkichlarini davriy o'lchash.
+
+    Har bir workerda oqim bor, lekin har bir interval uchun o'lchovni
+    faqat bittasi (shared_cache.incr bo'yicha birinchisi) oladi.
+    """
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db_monitor = DatabaseMonitor(db)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Joriy jarayonda oqimni ishga tushirish (lazy, fork'dan keyin qayta)"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            # cpu_percent(interval=None) oldingi chaqiruvga nisbatan hisoblaydi
+            psutil.cpu_percent(interval=None)
+            threading.Thread(target=self._run, name='system-sampler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            # Barcha workerlar bir xil interval chegarasida uyg'onadi
+            time.sleep(SAMPLE_INTERVAL - time.time() % SAMPLE_INTERVAL)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.warning(f"⚠️ Tizim o'lchovi yozilmadi: {e}")
+
+    def tick(self):
+        # CPU hisobini har bir worker yangilab turadi - navbat kimga tushsa ham
+        # qiymat aynan oxirgi intervalniki bo'ladi
+        cpu = psutil.cpu_percent(interval=None)
+        slot = int(time.time() // SAMPLE_INTERVAL)
         try:
-            log_file = 'logs/access.log'
-            if not os.path.exists(log_file):
-                return {'total': 0, 'recent': 0}
+            turn, _ = shared_cache.incr(f'{TURN_KEY_PREFIX}{slot}', 1, SAMPLE_INTERVAL * 3)
+        except Exception as e:
+            logger.debug(f"O'lchov navbati aniqlanmadi: {e}")
+            turn = 1
+        if turn == 1:
+            self.record(cpu)
+
+    def record(self, cpu):
+        """O'lchab, halqali buferga qo'shish"""
+        history = self.history()
+        sample = self._measure(cpu, history[-1] if history else None)
+        history.append(sample)
+        shared_cache.set(HISTORY_KEY, history[-HISTORY_SIZE:], HISTORY_TTL)
+        return sample
+
+    def history(self):
+        return shared_cache.get(HISTORY_KEY) or []
+
+    def latest(self):
+        """(oxirgi o'lchov, tarix). Oqim hali o'lchamagan bo'lsa - shu yerda, kutmasdan"""
+        history = self.history()
+        if history and time.time() - history[-1]['t'] <= SAMPLE_INTERVAL * 3:
+            return history[-1], history
+        sample = self.record(ServerMonitor.get_cpu_usage())
+        return sample, self.history()
+
+    def _measure(self, cpu, previous):
+        now = time.time()
+        network = ServerMonitor.get_network_stats()
+        if previous and now > previous['t']:
+            elapsed = now - previous['t']
+            before = previous['server']['network']
+            network['sent_kbps'] = round(max(network['bytes_sent'] - before['bytes_sent'], 0) * 1024 / elapsed, 1)
+            network['recv_kbps'] = round(max(network['bytes_recv'] - before['bytes_recv'], 0) * 1024 / elapsed, 1)
+        else:
+            network['sent_kbps'] = network['recv_kbps'] = 0
+
+        with self.app.app_context():
+            database = {
+                'connection': self.db_monitor.check_connection(),
+                'active_connections': self.db_monitor.get_connection_count(),
+                'size': self.db_monitor.get_database_size(),
+                'slow_queries': self.db_monitor.get_slow_queries(),
+            }
 
-            # Oxirgi 1000 qatorni o'qish
-            with open(log_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()[-1000:]
+        try:
+            requests_total = metrics.request_totals()
+        except Exception as e:
+            logger.debug(f"So'rovlar hisoblagichi o'qilmadi: {e}")
+            requests_total = None
 
-            total = len(lines)
+        return {
+            't': now,
+            'time': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'server': {
+                'cpu_percent': cpu,
+                'memory': ServerMonitor.get_memory_usage(),
+                'disk': ServerMonitor.get_disk_usage(),
+                'network': network,
+            },
+            'database': database,
+            'requests': requests_total,
+        }
 
-            # Oxirgi 5 daqiqadagi requestlar
-            recent = min(100, total)  # Soddalashtirilgan hisoblash
 
-            return {'total': total, 'recent_5min': recent}
-        except Exception as e:
-            logger.error(f"Error reading access log: {e}")
-            return {'total': 0, 'recent_5min': 0}
+def chart_points(history, limit=CHART_POINTS):
+    """Grafiklar uchun ixcham tarix (eskidan yangiga)"""
+    return [{
+        'time': sample['time'],
+        'cpu': sample['server']['cpu_percent'],
+        'memory': sample['server']['memory']['percent'],
+        'disk': sample['server']['disk']['percent'],
+        'net_sent_kbps': sample['server']['network']['sent_kbps'],
+        'net_recv_kbps': sample['server']['network']['recv_kbps'],
+        'db_active': sample['database']['active_connections'],
+        'requests': sample['requests']['total'] if sample.get('requests') else None,
+    } for sample in history[-limit:]]
 
 
 def setup_monitoring_routes(app, db):
     """Monitoring route'larni qo'shish"""
 
-    server_monitor = ServerMonitor()
-    db_monitor = DatabaseMonitor(db)
     app_monitor = ApplicationMonitor(db)
+    sampler = SystemSampler(app, db)
+
+    @app.before_request
+    def _ensure_system_sampler():
+        # Faqat gunicorn workerlarida (app ni import qiladigan bot jarayonida emas)
+        sampler.ensure_started()
 
     @app.route('/api/monitoring/health')
     def monitoring_health_check():
@@ -203,25 +363,21 @@ def setup_monitoring_routes(app, db):
             return jsonify({'error': 'Unauthorized'}), 401
 
         try:
+            sample, history = sampler.latest()
             status = {
                 'timestamp': datetime.now().isoformat(),
-                'server': {
-                    'cpu_percent': server_monitor.get_cpu_usage(),
-                    'memory': server_monitor.get_memory_usage(),
-                    'disk': server_monitor.get_disk_usage(),
-                    'network': server_monitor.get_network_stats()
-                },
-                'database': {
-                    'connection': db_monitor.check_connection(),
-                    'active_connections': db_monitor.get_connection_count(),
-                    'size': db_monitor.get_database_size(),
-                    'slow_queries': db_monitor.get_slow_queries()
-                },
+                'sampled_at': sample['time'],
+                'server': sample['server'],
+                'database': sample['database'],
                 'application': {
                     'uptime': app_monitor.get_uptime(),
                     'recent_errors': app_monitor.get_recent_errors(),
-                    'requests': app_monitor.get_request_stats()
-                }
+                    'requests': app_monitor.get_request_stats(history)
+                },
+                # Grafiklar uchun oxirgi CHART_POINTS ta o'lchov
+                'history': chart_points(history),
+                # Endpointlar: javob vaqti p50/p95/p99, SQL soni, N+1 (query_profiler.py)
+                'profiler': query_profiler.endpoint_report()
             }
 
             return jsonify(status), 200
@@ -257,14 +413,13 @@ def setup_monitoring_routes(app, db):
                 return jsonify({'error': 'Log file not found'}), 404
 
             # Oxirgi N qatorni o'qish
-            lines = int(request.args.get('lines', 100))
-            with open(log_file, 'r', encoding='utf-8') as f:
-                content = f.readlines()[-lines:]
+            lines = min(max(int(request.args.get('lines', 100)), 1), MAX_LOG_LINES)
+            content = tail_lines(log_file, lines)
 
             return jsonify({
                 'log_type': log_type,
                 'lines': len(content),
-                'content': ''.join(content)
+                'content': '\n'.join(content) + ('\n' if content else '')
             }), 200
         except Exception as e:
             logger.error(f"Error reading log {log_type}: {e}")
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Telegram xabarlari uchun chiqish navbati (notification_outbox).
+
+Avval create_sale, savdoni yakunlash va qarz to'lovi commit'dan keyin
+`send_sale_notification_sync()` / `send_payment_confirmation_sync()` ni
+to'g'ridan-to'g'ri chaqirardi: PDF chek yaratish va 30 soniyalik timeout'li
+bir nechta `requests.post` gunicorn sync worker ichida bajarilardi -
+Telegram sekinlashsa 3 ta workerdan biri har savdoda band bo'lib qolardi.
+
+Endi HTTP so'rov faqat `enqueue()` bilan navbatga yozadi. Xabarlarni
+run_telegram_bot.py jarayonidagi `NotificationWorker` yuboradi:
+
+- bir nechta worker bo'lsa ham har xabar bir marta olinadi (FOR UPDATE SKIP LOCKED);
+- muvaffaqiyatsiz yuborish eksponensial kechikish bilan qayta uriniladi,
+  MAX_ATTEMPTS dan keyin 'failed';
+- tezlik cheklovi: umumiy (GLOBAL_RATE_PER_SECOND) va har bir chat uchun
+  (PER_CHAT_INTERVAL) - Telegram API limitlari;
+- worker yiqilsa 'sending' holatida qolgan xabarlar STALE_SENDING_AFTER dan
+  keyin qayta olinadi.
+
+Qo'lda yuborish: python notification_queue.py drain
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import and_, or_
+
+import debt_ledger
+import metrics
+from database import db, get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+STALE_SENDING_AFTER = timedelta(minutes=10)
+
+BATCH_SIZE = 20
+POLL_INTERVAL_SECONDS = 2
+GLOBAL_RATE_PER_SECOND = 20
+PER_CHAT_INTERVAL = 1.0
+
+KINDS = {
+    # kind -> DebtTelegramBot metodi
+    'sale_receipt': 'send_sale_notification_sync',
+    'payment_confirmation': 'send_payment_confirmation_sync',
+}
+
+# Payload ichida datetime sifatida qayta tiklanadigan argumentlar
+_DATETIME_ARGS = ('sale_date',)
+
+
+# ---------- navbatga yozish ----------
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def customer_debt_totals(customer_id):
+    """Mijozning hozirgi jami qarzi (USD, UZS) - chekdagi "oldingi/jami qarz" uchun.
+
+    debt_ledger.current_totals dan o'qiladi - joriy tranzaksiyadagi savdo/to'lov
+    hisobga olinadi, mijoz qulfi esa olinmaydi.
+    """
+    debt_usd, debt_uzs = debt_ledger.current_totals(customer_id)
+    return float(debt_usd or 0), float(debt_uzs or 0)
+
+
+def enqueue(kind, chat_id, **kwargs):
+    """Xabarni navbatga qo'shish (commit QILMAYDI - chaqiruvchi savdo/to'lov commit'idan
+    OLDIN chaqiradi, xabar shu tranzaksiya bilan birga saqlanadi yoki bekor bo'ladi).
+
+    kwargs - KINDS[kind] bot metodining argumentlari (chat_id dan tashqari).
+    Savdo cheki uchun jami qarz shu paytda olinadi - qayta urinishda ham chek
+    savdo paytidagi holatni ko'rsatadi.
+    """
+    from models import NotificationOutbox
+
+    if kind not in KINDS:
+        raise ValueError(f"Noma'lum xabar turi: {kind}")
+    if not chat_id:
+        return None
+    if kind == 'sale_receipt' and kwargs.get('customer_id') and 'total_debt_usd' not in kwargs:
+        kwargs['total_debt_usd'], kwargs['total_debt_uzs'] = customer_debt_totals(kwargs['customer_id'])
+    notification = NotificationOutbox(
+        kind=kind,
+        chat_id=chat_id,
+        payload=_json_value(kwargs),
+        status='pending',
+        attempts=0,
+        next_attempt_at=get_tashkent_time(),
+    )
+    db.session.add(notification)
+    return notification
+
+
+# ---------- yuborish ----------
+
+def _backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0), BACKOFF_MAX_SECONDS))
+
+
+def claim_batch(limit=BATCH_SIZE):
+    """Yuborish vaqti kelgan xabarlarni 'sending' qilib olish (o'z tranzaksiyasida)"""
+    from models import NotificationOutbox
+
+    now = get_tashkent_time()
+    rows = NotificationOutbox.query.filter(or_(
+        and_(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= now),
+        and_(NotificationOutbox.status == 'sending', NotificationOutbox.updated_at < now - STALE_SENDING_AFTER),
+    )).order_by(NotificationOutbox.id).with_for_update(skip_locked=True).limit(limit).all()
+    for row in rows:
+        row.status = 'sending'
+        row.attempts = (row.attempts or 0) + 1
+        row.updated_at = now
+    db.session.commit()
+    return rows
+
+
+def _call_bot(bot, notification):
+    kwargs = dict(notification.payload or {})
+    for name in _DATETIME_ARGS:
+        if isinstance(kwargs.get(name), str):
+            kwargs[name] = datetime.fromisoformat(kwargs[name])
+    method = getattr(bot, KINDS[notification.kind])
+    return method(chat_id=notification.chat_id, **kwargs)
+
+
+class _RateLimiter:
+    """Umumiy va har bir chat uchun minimal oraliq"""
+
+    def __init__(self, per_second=GLOBAL_RATE_PER_SECOND, per_chat_interval=PER_CHAT_INTERVAL):
+        self.interval = 1.0 / per_second
+        self.per_chat_interval = per_chat_interval
+        self._last = 0.0
+        self._last_by_chat = {}
+
+    def wait(self, chat_id):
+        now = time.monotonic()
+        ready_at = max(self._last + self.interval,
+                       self._last_by_chat.get(chat_id, 0.0) + self.per_chat_interval)
+        if ready_at > now:
+            time.sleep(ready_at - now)
+        self._last = self._last_by_chat[chat_id] = time.monotonic()
+        if len(self._last_by_chat) > 10000:
+            self._last_by_chat.clear()
+
+
+def process_batch(bot, rate_limiter=None, limit=BATCH_SIZE):
+    """Bitta partiyani yuborish. Qaytaradi: (yuborildi, qayta_urinish, xato)"""
+    rate_limiter = rate_limiter or _RateLimiter()
+    sent = retried = failed = 0
+    for notification in claim_batch(limit):
+        rate_limiter.wait(notification.chat_id)
+        error = None
+        started = time.perf_counter()
+        try:
+            ok = _call_bot(bot, notification)
+            if not ok:
+                error = 'Bot xabarni yubormadi'
+        except Exception as e:
+            ok = False
+            error = str(e)
+        metrics.observe_telegram_send(notification.kind, ok, time.perf_counter() - started)
+
+        now = get_tashkent_time()
+        if ok:
+            notification.status = 'sent'
+            notification.sent_at = now
+            notification.last_error = None
+            sent += 1
+        elif notification.attempts >= MAX_ATTEMPTS:
+            notification.status = 'failed'
+            notification.last_error = error
+            failed += 1
+            logger.error(f"❌ Xabar #{notification.id} ({notification.kind}) "
+                         f"{notification.attempts} urinishdan keyin yuborilmadi: {error}")
+        else:
+            notification.status = 'pending'
+            notification.next_attempt_at = now + _backoff(notification.attempts)
+            notification.last_error = error
+            retried += 1
+            logger.warning(f"⚠️ Xabar #{notification.id} qayta yuboriladi "
+                           f"({notification.attempts}/{MAX_ATTEMPTS}): {error}")
+        db.session.commit()
+    return sent, retried, failed
+
+
+class NotificationWorker(threading.Thread):
+    """Navbatni fon oqimida yuboruvchi worker (run_telegram_bot.py ishga tushiradi)"""
+
+    def __init__(self, app, poll_interval=POLL_INTERVAL_SECONDS):
+        super().__init__(name='notification-worker', daemon=True)
+        self.app = app
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._rate_limiter = _RateLimiter()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        from telegram_bot import get_bot_instance
+
+        logger.info("📨 Xabarlar navbati worker'i ishga tushdi")
+        while not self._stop_event.is_set():
+            busy = False
+            with self.app.app_context():
+                try:
+                    bot = get_bot_instance(db=db)
+                    sent, retried, failed = process_batch(bot, self._rate_limiter)
+                    busy = (sent + retried + failed) > 0
+                    if busy:
+                        logger.info(f"📨 Navbat: {sent} yuborildi, {retried} qayta urinish, {failed} xato")
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"❌ Xabarlar navbatida xatolik: {e}")
+                finally:
+                    db.session.remove()
+            # Navbatda xabar bo'lsa kutmasdan davom etamiz
+            if not busy:
+                self._stop_event.wait(self.poll_interval)
+
+
+def start_worker(app):
+    worker = NotificationWorker(app)
+    worker.start()
+    return worker
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'drain':
+        print("Foydalanish: python notification_queue.py drain")
+        sys.exit(1)
+
+    from app import app
+    from telegram_bot import get_bot_instance
+
+    with app.app_context():
+        bot = get_bot_instance(db=db)
+        totals = [0, 0, 0]
+        while True:
+            batch = process_batch(bot)
+            totals = [a + b for a, b in zip(totals, batch)]
+            if not any(batch):
+                break
+        print(f"✅ {totals[0]} yuborildi, {totals[1]} qayta urinishga qoldi, {totals[2]} xato")
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Kursor (keyset) asosidagi sahifalash.
+
+`query.paginate()` har sahifada butun filtrlangan to'plam ustida `COUNT(*)` va
+`OFFSET` skanerini bajaradi - chuqur sahifalar (masalan, 200-sahifa) sekinlashadi.
+Keyset sahifalashda keyingi sahifa oldingi sahifaning oxirgi qatori kaliti
+(`(sale_date, id)`, `(created_at, id)` ...) bo'yicha `WHERE (a, b) < (:a, :b)`
+sharti bilan olinadi va indeks bo'yicha to'g'ridan-to'g'ri boshlanadi.
+
+Kursor mijoz uchun shaffof emas (opaque) - base64 ichidagi JSON kalit qiymatlari.
+Jami son ixtiyoriy: `count=exact|estimate|none`.
+"""
+import base64
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import tuple_
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Taxminiy son shu qiymatdan kichik bo'lsa aniq COUNT(*) arzon - uni bajaramiz
+EXACT_COUNT_THRESHOLD = 10000
+
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+
+class InvalidCursor(ValueError):
+    """Kursor noto'g'ri yoki buzilgan"""
+
+
+# ---------- kursor kodlash ----------
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'n': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+        if 'n' in value:
+            return Decimal(value['n'])
+        raise InvalidCursor('Noma\'lum kursor qiymati')
+    return value
+
+
+def encode_cursor(values):
+    """Kalit qiymatlarini shaffof bo'lmagan kursor satriga aylantirish"""
+    payload = json.dumps([_encode_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size=None):
+    """Kursor satridan kalit qiymatlarini olish (bo'sh kursor - None)"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list):
+            raise InvalidCursor('Kursor formati noto\'g\'ri')
+        values = [_decode_value(v) for v in values]
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, UnicodeError) as e:
+        raise InvalidCursor(f'Kursor formati noto\'g\'ri: {e}')
+    if size is not None and len(values) != size:
+        raise InvalidCursor('Kursor kalitlari soni mos emas')
+    return values
+
+
+def parse_count_mode(value, default='exact'):
+    """`count` parametri: exact | estimate | none"""
+    value = (value or '').strip().lower()
+    return value if value in COUNT_MODES else default
+
+
+# ---------- sahifalash ----------
+
+class KeysetPage:
+    """Bitta keyset sahifasi natijasi"""
+
+    def __init__(self, items, next_cursor, total=None, total_is_estimate=False):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    def meta(self, per_page):
+        """JSON javobi uchun sahifalash ma'lumotlari"""
+        return {
+            'per_page': per_page,
+            'next_cursor': self.next_cursor,
+            'has_next': self.has_next,
+            'total': self.total,
+            'total_is_estimate': self.total_is_estimate,
+        }
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=50, descending=True, count='none'):
+    """Query'ni `keys` (masalan `(Sale.sale_date, Sale.id)`) bo'yicha sahifalash.
+
+    Kalitlar birgalikda qatorni yagona aniqlashi kerak (oxirgisi odatda `id`).
+    Kalit ifodalari query'ga qo'shimcha ustun sifatida qo'shiladi, shuning uchun
+    hisoblangan ifodalar (`coalesce(cnt, 0)`) ham ishlatilishi mumkin.
+    """
+    keys = list(keys)
+    values = decode_cursor(cursor, size=len(keys))
+
+    total = None
+    total_is_estimate = False
+    if count != 'none':
+        total, total_is_estimate = count_query(query, estimate=(count == 'estimate'))
+
+    page_query = query.order_by(None)
+    if values is not None:
+        if descending:
+            page_query = page_query.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            page_query = page_query.filter(tuple_(*keys) > tuple_(*values))
+    page_query = page_query.order_by(*[k.desc() if descending else k.asc() for k in keys])
+
+    rows = page_query.add_columns(*keys).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    items = [row[0] for row in rows]
+    next_cursor = encode_cursor(list(rows[-1][1:])) if has_next and rows else None
+    return KeysetPage(items, next_cursor, total, total_is_estimate)
+
+
+def count_query(query, estimate=False):
+    """Jami son: aniq yoki PostgreSQL rejalashtiruvchisi bahosi.
+
+    Qaytaradi: (son, taxminiymi)
+    """
+    count_q = query.order_by(None).enable_eagerloads(False)
+    if estimate:
+        estimated = estimate_count(count_q)
+        if estimated is not None and estimated > EXACT_COUNT_THRESHOLD:
+            return estimated, True
+    return count_q.count(), False
+
+
+def estimate_count(query):
+    """EXPLAIN bo'yicha qatorlar bahosi (PostgreSQL), aniqlab bo'lmasa None"""
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return None
+    try:
+        compiled = query.statement.compile(
+            dialect=bind.dialect, compile_kwargs={'render_postcompile': True})
+        # Alohida ulanish - xato bo'lsa joriy tranzaksiya buzilmaydi
+        with bind.connect() as conn:
+            plan = conn.exec_driver_sql(
+                f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception as e:
+        logger.warning(f"Taxminiy sonni aniqlab bo'lmadi: {e}")
+        return None
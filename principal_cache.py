@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""Tizimga kirgan foydalanuvchi (principal) uchun worker ichidagi kesh.
+
+`check_user_status` har bir brauzer oynasi uchun 10 soniyada bir
+`UserSession` va `User` ni o'qirdi, keyin `location_permission_required`,
+`create_sale` va boshqalar o'sha `User` qatorini yana yuklab, JSON
+ro'yxatlarini `extract_location_ids` bilan (eski int formatda Store/Warehouse
+so'rovlari bilan) qayta-qayta ajratardi.
+
+`get_principal(user_id)` foydalanuvchi roli, faolligi, faol session_id lari
+va joylashuv ruxsatlarini (user_locations jadvalidan) scope bo'yicha
+{(type, id)} to'plamlari sifatida qaytaradi - `can(scope, type, id)` O(1).
+Yuklangan principal shared_cache ga ham yoziladi - boshqa workerlar uni DB
+ga bormasdan oladi.
+
+Kesh bekor qilinadi:
+
+- avtomatik: User yoki UserSession o'zgargan commit'dan keyin (update_user,
+  toggle_user_status, delete_user, logout, login) - umumiy nusxa va joriy
+  worker darhol, boshqa workerlar change_notifier orqali (DB dan qayta
+  yuklab);
+- qo'lda: ORM eventlarini chetlab o'tadigan so'rovlardan keyin - `invalidate(user_id)`;
+- ehtiyot uchun PRINCIPAL_TTL_SECONDS dan keyin baribir qayta yuklanadi.
+
+Yuklash davomida bekor qilish kelsa (commit yoki NOTIFY), eski natija
+keshlanmaydi: umumiy nusxa shared_cache avlodlari, worker nusxasi esa
+`_generation` hisoblagichi bilan himoyalangan.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import change_notifier
+import shared_cache
+import user_locations
+from database import db
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'principal_changed'
+SHARED_TAG = 'principal'
+PRINCIPAL_TTL_SECONDS = 60
+MAX_ENTRIES = 5000
+
+_CHANGED_KEY = 'principal_changed_ids'
+
+
+class Principal:
+    """Foydalanuvchining ruxsatlar uchun kerakli ma'lumotlari (DB ga bog'lanmagan)"""
+
+    __slots__ = ('user_id', 'username', 'role', 'is_active', 'session_ids', 'locations')
+
+    def __init__(self, user_id, username, role, is_active, session_ids, locations):
+        self.user_id = user_id
+        self.username = username
+        self.role = role
+        self.is_active = is_active
+        self.session_ids = session_ids
+        self.locations = locations
+
+    def location_set(self, kind, fallback=False):
+        """{(type, id)} - fallback=True bo'lsa bo'sh ro'yxat o'rniga allowed_locations"""
+        locations = self.locations[kind]
+        if not locations and fallback:
+            return self.locations['allowed']
+        return locations
+
+    def location_ids(self, kind, location_type, fallback=False):
+        """Berilgan turdagi ruxsat etilgan ID lar (tartiblangan ro'yxat)"""
+        return sorted(loc_id for loc_type, loc_id in self.location_set(kind, fallback)
+                      if loc_type == location_type)
+
+    def can(self, kind, location_type, location_id, fallback=False):
+        """Joylashuvga ruxsat bormi (kind - user_locations scope)"""
+        try:
+            location_id = int(location_id)
+        except (TypeError, ValueError):
+            return False
+        return (location_type, location_id) in self.location_set(kind, fallback)
+
+    def allows_id(self, kind, location_id):
+        """Joylashuv turi noma'lum bo'lganda (URL parametri) - faqat ID bo'yicha"""
+        return any(loc_id == location_id for _, loc_id in self.locations[kind])
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'username': self.username,
+            'role': self.role,
+            'is_active': self.is_active,
+            'session_ids': sorted(self.session_ids),
+            'locations': {scope: sorted(locations) for scope, locations in self.locations.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['user_id'], data['username'], data['role'], data['is_active'],
+                   frozenset(data['session_ids']),
+                   {scope: frozenset(tuple(loc) for loc in locations)
+                    for scope, locations in data['locations'].items()})
+
+
+def load_principal(user_id):
+    """DB dan yuklash (keshsiz). Foydalanuvchi yo'q bo'lsa None"""
+    from models import User, UserSession, UserLocation
+
+    user = db.session.query(
+        User.id, User.username, User.role, User.is_active,
+        *[getattr(User, column) for column in user_locations.SCOPES.values()]
+    ).filter(User.id == user_id).first()
+    if not user:
+        return None
+    session_ids = frozenset(row.session_id for row in db.session.query(UserSession.session_id).filter(
+        UserSession.user_id == user_id, UserSession.is_active.is_(True)))
+
+    rows = db.session.query(UserLocation.scope, UserLocation.location_type, UserLocation.location_id).filter(
+        UserLocation.user_id == user_id).all()
+    raw = {scope: getattr(user, column) for scope, column in user_locations.SCOPES.items()}
+    if not rows and any(raw.values()):
+        # Jadval hali to'ldirilmagan (rebuild qilinmagan) - JSON dan
+        logger.debug(f"user_locations bo'sh (user_id={user_id}) - JSON ustunlardan o'qildi")
+        rows = user_locations.normalize(raw)
+    locations = {scope: frozenset((location_type, location_id)
+                                  for row_scope, location_type, location_id in rows if row_scope == scope)
+                 for scope in user_locations.SCOPES}
+    return Principal(user.id, user.username, user.role, bool(user.is_active), session_ids, locations)
+
+
+def _shared_key(user_id):
+    return f'principal:{user_id}'
+
+
+def _fetch_principal(user_id):
+    principal = load_principal(user_id)
+    return principal.to_dict() if principal else None
+
+
+class _PrincipalCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        # Umumiy nusxani chetlab DB dan yuklanadiganlar (boshqa workerdagi commit'dan keyin)
+        self._refresh_ids = set()
+        self._generations = itertools.count(1)
+        self._generation = 0
+
+    def get(self, user_id):
+        if self._pid != os.getpid():
+            # gunicorn fork'dan keyin - ota jarayon keshi meros qolmaydi
+            self._pid = os.getpid()
+            self._entries = {}
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] <= PRINCIPAL_TTL_SECONDS:
+            return entry[1]
+
+        change_notifier.ensure_listening()
+        with self._lock:
+            generation = self._generation
+            refresh = user_id in self._refresh_ids
+            self._refresh_ids.discard(user_id)
+        data, remaining = shared_cache.get_or_set(
+            _shared_key(user_id), lambda: _fetch_principal(user_id), PRINCIPAL_TTL_SECONDS,
+            tags=(SHARED_TAG,), refresh=refresh)
+        principal = Principal.from_dict(data) if data else None
+        with self._lock:
+            if generation != self._generation:
+                # Yuklash davomida bekor qilindi - natija eski bo'lishi mumkin
+                return principal
+            if len(self._entries) >= MAX_ENTRIES:
+                self._entries.clear()
+            # Umumiy nusxa qancha oldin yuklangan bo'lsa, worker ham shuncha kam ushlab turadi
+            self._entries[user_id] = (time.monotonic() - (PRINCIPAL_TTL_SECONDS - remaining), principal)
+        return principal
+
+    def invalidate(self, user_id=None, refresh=False):
+        """refresh=True - keyingi yuklash umumiy nusxani chetlab DB dan"""
+        with self._lock:
+            self._generation = next(self._generations)
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+                if refresh:
+                    self._refresh_ids.add(user_id)
+        if user_id is None and refresh:
+            # Barcha principal'lar ishonchsiz - umumiy nusxalar ham
+            shared_cache.invalidate_tag(SHARED_TAG)
+
+
+_cache = _PrincipalCache()
+
+
+def _on_notify(payload):
+    try:
+        _cache.invalidate(int(payload) if payload else None, refresh=True)
+    except ValueError:
+        _cache.invalidate(refresh=True)
+
+
+change_notifier.subscribe(NOTIFY_CHANNEL, _on_notify)
+
+
+def get_principal(user_id):
+    """Keshdan (yoki DB dan) principal. Noto'g'ri ID yoki foydalanuvchi yo'q - None"""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    # Mavjud bo'lmagan foydalanuvchi ham (None) TTL davomida keshlanadi
+    return _cache.get(user_id)
+
+
+def invalidate(user_id, session=None):
+    """Joriy tranzaksiya commit bo'lgach foydalanuvchi keshini o'chirish"""
+    (session or db.session).info.setdefault(_CHANGED_KEY, set()).add(int(user_id))
+
+
+# ---------- avtomatik bekor qilish ----------
+
+def _changed_user_id(obj):
+    from models import User, UserSession
+
+    if isinstance(obj, User):
+        return obj.id
+    if isinstance(obj, UserSession):
+        return obj.user_id
+    return None
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_principal_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        user_id = _changed_user_id(obj)
+        if user_id is not None:
+            session.info.setdefault(_CHANGED_KEY, set()).add(user_id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_principal_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    for user_id in session.info.get(_CHANGED_KEY, ()):
+        change_notifier.notify(session, NOTIFY_CHANNEL, user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_principal_changes(session):
+    for user_id in session.info.pop(_CHANGED_KEY, ()):
+        shared_cache.delete(_shared_key(user_id))
+        _cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_principal_changes(session):
+    session.info.pop(_CHANGED_KEY, None)
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""Mahsulotlar uchun xotiradagi (in-memory) qidiruv indeksi.
+
+Har bir gunicorn worker `products` jadvalidan bir marta indeks quradi va
+keyin mahsulot yaratilganda, tahrirlanganda yoki o'chirilganda uni
+SQLAlchemy session eventlari orqali bosqichma-bosqich yangilaydi. Boshqa
+workerlardagi o'zgarishlar change_notifier orqali keladi: o'zgargan mahsulotlar
+keyingi qidiruvda DB dan qayta o'qiladi, ko'p o'zgarish (yoki LISTEN uzilishi)
+bo'lsa indeks fon oqimida qayta quriladi - so'rov eski indeks bilan xizmat qiladi.
+
+Indeks tarkibi:
+- normalizatsiya qilingan so'zlar lug'ati (so'z -> mahsulot ID'lari)
+- so'zlar uchun bigram indeksi (qisman so'z / substring qidiruvi uchun)
+- raqamli tokenlar (E8 vs E9 farqini ajratish uchun)
+- barcode prefiks xaritasi (saralangan ro'yxat + bisect)
+
+Natijalar mavjud `fuzzy_score` mantiqi bilan tartiblanadi, shuning uchun
+"zmre8h7" so'rovi "E8 PRO-H7" ni topadi. `ILIKE '%so'z%'` kabi butun
+jadvalni skanerlash o'rniga faqat nomzodlar ballanadi.
+"""
+import bisect
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import current_app
+from rapidfuzz import process as fuzz_process, fuzz as rfuzz
+from sqlalchemy import case, event
+from sqlalchemy.orm import Session
+
+import change_notifier
+from database import db
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'products_changed'
+
+# Bitta commit'da bundan ko'p mahsulot o'zgarsa - ID lar o'rniga "hammasi" xabari
+MAX_NOTIFY_IDS = 200
+
+# Ehtiyot uchun (LISTEN ishlamasa) indeks shu vaqtdan keyin fonda qayta quriladi
+REBUILD_INTERVAL = 300  # 5 daqiqa
+
+# fuzzy_score bilan to'liq ballanadigan nomzodlarning minimal soni
+MIN_SCORED_CANDIDATES = 100
+
+# Barcode prefiksi bo'yicha qidirish uchun minimal uzunlik (qisqasi faqat aniq moslik)
+MIN_BARCODE_PREFIX = 4
+
+_DIGITS_RE = re.compile(r'\d+')
+
+
+def normalize_search(text):
+    """
+    Qidiruv matnini normalizatsiya qilish:
+    - faqat 2+ harfli guruh oldida/keyin raqam bo'lsa ajratish: "zimmerE8" → "zimmer E8"
+      (yakkа harfli tokenlar yaratilmaydi: "50*30m" → "50*30m", "e8h7" → "e8h7")
+    - pastki chiziqni bo'sh joy bilan almashtirish: "pro_h7" → "pro h7"
+    """
+    text = text.replace('_', ' ')
+    text = re.sub(r'([a-zA-Z]{2,})(\d)', r'\1 \2', text)
+    text = re.sub(r'(\d)([a-zA-Z]{2,})', r'\1 \2', text)
+    # digit->yakka harf->digit: "h11e8" -> "h11 e8", "e8h7" -> "e8 h7"
+    text = re.sub(r'(\d)([a-zA-Z])(\d)', r'\1 \2\3', text)
+    text = re.sub(r'(\d)([a-zA-Z])(\d)', r'\1 \2\3', text)
+    return re.sub(r'\s+', ' ', text).lower().strip()
+
+
+def _search_words(normalized):
+    """fuzzy_score hisobga oladigan so'zlar (2+ belgili)"""
+    return [w for w in normalized.split() if len(w) >= 2]
+
+
+def _score_normalized(q, q_words, q_digits, n, n_words, n_digits):
+    """fuzzy_score ning oldindan normalizatsiya qilingan qiymatlar bilan ishlaydigan yadrosi"""
+    if not q_words or not n_words:
+        return 0
+
+    def word_match(qw, n_words):
+        if any(qw in nw for nw in n_words):
+            return True
+        return max((rfuzz.ratio(qw, nw) for nw in n_words), default=0) >= 60
+
+    word_hits = sum(1 for qw in q_words if word_match(qw, n_words))
+    coverage = word_hits / len(q_words)
+    if coverage == 0:
+        return 0
+
+    s1 = rfuzz.partial_ratio(q, n)
+    s2 = rfuzz.token_set_ratio(q, n)
+    s3 = rfuzz.partial_token_set_ratio(q, n)
+
+    # Umumiy raqam tokenlar bonusi: "8","7" mos → +20; faqat "7" mos → +10
+    digit_bonus = len(q_digits & n_digits) * 10
+
+    return coverage * 60 + max(s1, s2, s3) * 0.4 + digit_bonus
+
+
+def fuzzy_score(query, name):
+    """
+    So'z darajasida moslik (substring OR ratio>=60%) + fuzzy ball + raqam bonusi.
+    - coverage: query tokenlarining qanchasi nomda mos keladi
+    - digit_bonus: query va nom umumiy raqamlari (+10 har biri)
+      "zmre8h7" → digits={8,7}; E8 PRO-H7 → {8,7} → +20; E9 PRO-H7 → {9,7} → +10
+    Shu bonus E8 vs E9 farqini aniq ajratadi.
+    """
+    q = normalize_search(query)
+    n = normalize_search(name)
+    return _score_normalized(
+        q, _search_words(q), set(_DIGITS_RE.findall(query)),
+        n, _search_words(n), set(_DIGITS_RE.findall(name)),
+    )
+
+
+def _bigrams(word):
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+class _Entry:
+    """Indeksdagi bitta mahsulot (normalizatsiya natijalari keshlangan)"""
+    __slots__ = ('name', 'barcode', 'norm', 'words', 'digits')
+
+    def __init__(self, name, barcode):
+        self.name = name or ''
+        self.barcode = (barcode or '').strip() or None
+        self.norm = normalize_search(self.name)
+        self.words = _search_words(self.norm)
+        self.digits = set(_DIGITS_RE.findall(self.name))
+
+
+class ProductSearchIndex:
+    """Worker ichidagi mahsulot qidiruv indeksi (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}        # product_id -> _Entry
+        self._word_ids = {}       # so'z -> {product_id}
+        self._gram_words = {}     # bigram -> {so'z}
+        self._digit_ids = {}      # raqam -> {product_id}
+        self._barcodes = []       # [(barcode, product_id)] saralangan
+        self._loaded_at = None
+        self._pid = None
+        self._stale_ids = set()   # boshqa workerda o'zgargan mahsulotlar
+        self._stale_all = False   # to'liq qayta qurish kerak
+        self._rebuilding = False
+
+    # ---------- qurish va yangilash ----------
+
+    def rebuild(self):
+        """Indeksni `products` jadvalidan to'liq qayta qurish (qidiruvni to'xtatmaydi)"""
+        from models import Product
+
+        started = time.time()
+        self._stale_all = False
+        rows = db.session.query(Product.id, Product.name, Product.barcode).all()
+        fresh = ProductSearchIndex()
+        for product_id, name, barcode in rows:
+            fresh._add(product_id, _Entry(name, barcode))
+        fresh._barcodes.sort()
+        with self._lock:
+            self._entries = fresh._entries
+            self._word_ids = fresh._word_ids
+            self._gram_words = fresh._gram_words
+            self._digit_ids = fresh._digit_ids
+            self._barcodes = fresh._barcodes
+            self._loaded_at = time.time()
+        logger.info(f"🔎 Mahsulot qidiruv indeksi qurildi: {len(rows)} ta mahsulot, "
+                    f"{(time.time() - started) * 1000:.0f}ms")
+
+    def ensure_loaded(self):
+        """Indeks bo'lmasa qurish; eskirgan bo'lsa fonda qayta qurish"""
+        if self._pid != os.getpid():
+            # gunicorn fork'dan keyin - ota jarayon indeksi meros qolmaydi
+            self._pid = os.getpid()
+            self._loaded_at = None
+        change_notifier.ensure_listening()
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            # Worker'dagi birinchi qidiruv - indeks hali yo'q
+            self.rebuild()
+        elif self._stale_all or time.time() - loaded_at > REBUILD_INTERVAL:
+            self._rebuild_in_background()
+        if self._stale_ids:
+            self._reload(self._take_stale_ids())
+
+    def _take_stale_ids(self):
+        with self._lock:
+            ids, self._stale_ids = self._stale_ids, set()
+        return ids
+
+    def _reload(self, product_ids):
+        """Boshqa workerda o'zgargan mahsulotlarni DB dan qayta o'qish"""
+        from models import Product
+
+        rows = db.session.query(Product.id, Product.name, Product.barcode).filter(
+            Product.id.in_(product_ids)).all()
+        found = set()
+        for product_id, name, barcode in rows:
+            found.add(product_id)
+            self.upsert(product_id, name, barcode)
+        for product_id in set(product_ids) - found:
+            self.remove(product_id)
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        app = current_app._get_current_object()
+        threading.Thread(target=self._background_rebuild, args=(app,),
+                         name='product-search-rebuild', daemon=True).start()
+
+    def _background_rebuild(self, app):
+        try:
+            with app.app_context():
+                try:
+                    self.rebuild()
+                except Exception as e:
+                    logger.error(f"❌ Mahsulot qidiruv indeksini qayta qurishda xatolik: {e}")
+                finally:
+                    db.session.remove()
+        finally:
+            self._rebuilding = False
+
+    def invalidate(self):
+        """Keyingi qidiruvda indeksni qayta qurishga majburlash"""
+        self._loaded_at = None
+
+    def mark_stale(self, product_ids=None):
+        """Boshqa jarayondagi o'zgarish: ID lar keyingi qidiruvda qayta o'qiladi.
+
+        product_ids=None - qaysilari o'zgargani noma'lum, indeks fonda qayta quriladi.
+        """
+        with self._lock:
+            if product_ids is None:
+                self._stale_all = True
+            else:
+                self._stale_ids.update(product_ids)
+
+    def upsert(self, product_id, name, barcode):
+        """Bitta mahsulotni qo'shish yoki yangilash"""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._remove(product_id)
+            self._add(product_id, _Entry(name, barcode), keep_sorted=True)
+            if self._rebuilding:
+                # Fondagi qurish eski nusxani almashtiradi - qurilgach qayta o'qiladi
+                self._stale_ids.add(product_id)
+
+    def remove(self, product_id):
+        """Bitta mahsulotni indeksdan olib tashlash"""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._remove(product_id)
+            if self._rebuilding:
+                self._stale_ids.add(product_id)
+
+    def _add(self, product_id, entry, keep_sorted=False):
+        self._entries[product_id] = entry
+        for word in entry.words:
+            ids = self._word_ids.get(word)
+            if ids is None:
+                ids = self._word_ids[word] = set()
+                for gram in _bigrams(word):
+                    self._gram_words.setdefault(gram, set()).add(word)
+            ids.add(product_id)
+        for digit in entry.digits:
+            self._digit_ids.setdefault(digit, set()).add(product_id)
+        if entry.barcode:
+            if keep_sorted:
+                bisect.insort(self._barcodes, (entry.barcode, product_id))
+            else:
+                self._barcodes.append((entry.barcode, product_id))
+
+    def _remove(self, product_id):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        for word in entry.words:
+            ids = self._word_ids.get(word)
+            if ids is None:
+                continue
+            ids.discard(product_id)
+            if not ids:
+                del self._word_ids[word]
+                for gram in _bigrams(word):
+                    words = self._gram_words.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self._gram_words[gram]
+        for digit in entry.digits:
+            ids = self._digit_ids.get(digit)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self._digit_ids[digit]
+        if entry.barcode:
+            pos = bisect.bisect_left(self._barcodes, (entry.barcode, product_id))
+            if pos < len(self._barcodes) and self._barcodes[pos] == (entry.barcode, product_id):
+                del self._barcodes[pos]
+
+    # ---------- qidiruv ----------
+
+    def _words_containing(self, query_word):
+        """query_word ni o'z ichiga olgan lug'at so'zlari (bigram kesishmasi orqali)"""
+        if len(query_word) < 2:
+            return set()
+        candidates = None
+        for gram in sorted(_bigrams(query_word),
+                           key=lambda g: len(self._gram_words.get(g, ()))):
+            words = self._gram_words.get(gram)
+            if not words:
+                return set()
+            candidates = set(words) if candidates is None else candidates & words
+            if not candidates:
+                return set()
+        return {w for w in candidates if query_word in w}
+
+    def _similar_words(self, query_word):
+        """fuzzy_score dagi ratio>=60 shartiga mos lug'at so'zlari"""
+        matches = fuzz_process.extract(
+            query_word, list(self._word_ids), scorer=rfuzz.ratio,
+            score_cutoff=60, limit=None
+        )
+        return {match[0] for match in matches}
+
+    def _barcode_prefix(self, prefix, limit, candidates=None):
+        pos = bisect.bisect_left(self._barcodes, (prefix,))
+        found = []
+        while pos < len(self._barcodes) and len(found) < limit:
+            barcode, product_id = self._barcodes[pos]
+            if not barcode.startswith(prefix):
+                break
+            if candidates is None or product_id in candidates:
+                found.append(product_id)
+            pos += 1
+        return found
+
+    def search_scored(self, query, limit=50, candidates=None):
+        """So'rov bo'yicha [(product_id, ball)] ro'yxati (eng mosi birinchi).
+
+        candidates - ruxsat etilgan mahsulot ID lari (joylashuv/kategoriya filtri);
+        boshqalari tartiblash va `limit` bilan kesishdan oldin chiqarib tashlanadi.
+        """
+        query = (query or '').strip()
+        if not query:
+            return []
+        self.ensure_loaded()
+
+        with self._lock:
+            q = normalize_search(query)
+            q_words = _search_words(q)
+            q_digits = set(_DIGITS_RE.findall(query))
+
+            # 1. Barcode prefiks mosligi - eng yuqori ustuvorlik
+            results = {}
+            compact = query.replace(' ', '')
+            if len(compact) >= MIN_BARCODE_PREFIX:
+                for product_id in self._barcode_prefix(compact, limit, candidates):
+                    exact = self._entries[product_id].barcode == compact
+                    results[product_id] = 1000 if exact else 500
+            else:
+                for product_id in self._barcode_prefix(compact, limit, candidates):
+                    if self._entries[product_id].barcode == compact:
+                        results[product_id] = 1000
+
+            exact_barcode = any(score >= 1000 for score in results.values())
+            if q_words and not exact_barcode:
+                # 2. Har bir so'z uchun mos mahsulotlar (substring, bo'lmasa fuzzy)
+                hits = {}
+                for qw in q_words:
+                    words = self._words_containing(qw)
+                    if not words:
+                        words = self._similar_words(qw)
+                    matched = set()
+                    for word in words:
+                        matched |= self._word_ids[word]
+                    if candidates is not None:
+                        matched &= candidates
+                    for product_id in matched:
+                        hits[product_id] = hits.get(product_id, 0) + 1
+
+                # 3. Arzon dastlabki ball: so'z qoplami + umumiy raqamlar
+                digit_hits = {}
+                for digit in q_digits:
+                    for product_id in self._digit_ids.get(digit, ()):
+                        if product_id in hits:
+                            digit_hits[product_id] = digit_hits.get(product_id, 0) + 1
+                pool_size = max(limit * 4, MIN_SCORED_CANDIDATES)
+                pool = heapq.nlargest(
+                    pool_size, hits,
+                    key=lambda pid: hits[pid] * 100 + digit_hits.get(pid, 0) * 10
+                )
+
+                # 4. Yakuniy tartib - fuzzy_score mantiqi
+                for product_id in pool:
+                    entry = self._entries[product_id]
+                    score = _score_normalized(q, q_words, q_digits,
+                                              entry.norm, entry.words, entry.digits)
+                    if score > 0:
+                        results[product_id] = max(results.get(product_id, 0), score)
+
+            ranked = sorted(
+                results.items(),
+                key=lambda item: (-item[1], self._entries[item[0]].name)
+            )
+        return ranked[:limit]
+
+    def search(self, query, limit=50, candidates=None):
+        """So'rov bo'yicha mahsulot ID'lari (eng mosi birinchi)"""
+        return [product_id for product_id, _ in self.search_scored(query, limit, candidates)]
+
+
+# Har bir worker uchun yagona indeks
+product_index = ProductSearchIndex()
+
+
+def _on_notify(payload):
+    # None - LISTEN qayta ulandi, '' - juda ko'p o'zgarish: to'liq qayta qurish
+    if not payload:
+        product_index.mark_stale()
+        return
+    try:
+        product_index.mark_stale({int(payload)})
+    except ValueError:
+        product_index.mark_stale()
+
+
+change_notifier.subscribe(NOTIFY_CHANNEL, _on_notify)
+
+
+def rank_order(column, ids):
+    """ID'lar ro'yxatidagi tartibni SQL ORDER BY ifodasiga aylantirish"""
+    if not ids:
+        return column
+    return case({product_id: pos for pos, product_id in enumerate(ids)},
+                value=column, else_=len(ids))
+
+
+# ---------- SQLAlchemy eventlari orqali bosqichma-bosqich yangilash ----------
+
+_PENDING_KEY = 'product_search_pending'
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_product_changes(session, flush_context):
+    """Flush qilingan mahsulot o'zgarishlarini commit'gacha yig'ib turish"""
+    from models import Product
+
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Product) and obj.id is not None:
+            pending[obj.id] = (obj.name, obj.barcode)
+    for obj in session.deleted:
+        if isinstance(obj, Product) and obj.id is not None:
+            pending[obj.id] = None
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_product_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    pending = session.info.get(_PENDING_KEY)
+    if not pending:
+        return
+    if len(pending) > MAX_NOTIFY_IDS:
+        change_notifier.notify(session, NOTIFY_CHANNEL)
+        return
+    for product_id in pending:
+        change_notifier.notify(session, NOTIFY_CHANNEL, product_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_product_changes(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    for product_id, values in pending.items():
+        if values is None:
+            product_index.remove(product_id)
+        else:
+            product_index.upsert(product_id, *values)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_product_changes(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""So'rov (request) bo'yicha SQL profiler va sekin endpointlar hisoboti.
+
+`timeout_monitor` faqat qo'llangan joyda umumiy vaqtni yozadi. Bu modul
+SQLAlchemy `before_cursor_execute` / `after_cursor_execute` eventlari
+orqali har bir HTTP so'rov uchun hisoblaydi:
+
+- SQL so'rovlar soni, DB vaqti va qaytgan qatorlar;
+- N+1 ehtimoli - bitta so'rov ichida bir xil ko'rinishdagi (parametrlarsiz)
+  SQL N_PLUS_ONE_THRESHOLD martadan ko'p takrorlansa, log'ga yoziladi.
+
+Endpoint bo'yicha yig'ilgan statistika (javob vaqti va so'rovlar soni
+histogrammalari) worker xotirasida to'planadi va har FLUSH_SECONDS da
+shared_cache ga yoziladi - `/monitoring/status` barcha workerlar
+ma'lumotini birlashtirib p50/p95/p99 ni ko'rsatadi.
+
+Hisobot: python query_profiler.py report
+"""
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import shared_cache
+from database import get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('QUERY_PROFILER_ENABLED', 'true').lower() == 'true'
+N_PLUS_ONE_THRESHOLD = int(os.getenv('QUERY_PROFILER_N1_THRESHOLD', '10'))
+
+FLUSH_SECONDS = 15
+STATS_TTL_SECONDS = 24 * 3600
+SHARED_TAG = 'query_profile'
+
+# Histogramma chegaralari (oxirgisidan kattalar - "qolganlari" katagida)
+DURATION_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_SKIP_ENDPOINTS = ('static',)
+
+_START_KEY = 'query_profiler_start'
+
+# SQL ko'rinishi: parametrlar, sonlar va IN (...) ro'yxatlari bir xil ko'rinishga
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s|\?|:\w+|\b\d+\b|'(?:[^']|'')*'")
+_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+class RequestProfile:
+    """Bitta HTTP so'rovning SQL statistikasi"""
+
+    __slots__ = ('started', 'queries', 'db_seconds', 'rows', 'shapes')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.shapes = Counter()
+
+
+def statement_shape(statement):
+    """Parametrlarsiz SQL ko'rinishi (N+1 ni aniqlash uchun)"""
+    shape = _PARAM_RE.sub('?', statement)
+    shape = _LIST_RE.sub('?', shape)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+
+def _bucket_index(bounds, value):
+    for index, bound in enumerate(bounds):
+        if value <= bound:
+            return index
+    return len(bounds)
+
+
+def _percentile(bounds, buckets, count, fraction, maximum):
+    """Histogrammadan taxminiy percentil (katak yuqori chegarasi)"""
+    if not count:
+        return 0
+    threshold = count * fraction
+    seen = 0
+    for index, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= threshold:
+            return min(bounds[index], maximum) if index < len(bounds) else maximum
+    return maximum
+
+
+class _ProfilerState:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {}
+        self._n_plus_one = deque(maxlen=50)
+        self._flushed_at = 0.0
+        self._started_at = time.time()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # gunicorn fork'dan keyin - ota jarayon statistikasi meros qolmaydi
+            self._pid = os.getpid()
+            self._stats = {}
+            self._n_plus_one = deque(maxlen=50)
+            self._flushed_at = time.monotonic()
+            self._started_at = time.time()
+
+    def record(self, endpoint, duration_ms, profile, repeated):
+        with self._lock:
+            self._check_pid()
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'buckets': [0] * (len(DURATION_BUCKETS_MS) + 1),
+                    'queries': 0, 'max_queries': 0,
+                    'query_buckets': [0] * (len(QUERY_BUCKETS) + 1),
+                    'db_ms': 0.0, 'rows': 0, 'n_plus_one': 0,
+                }
+            stats['count'] += 1
+            stats['total_ms'] += duration_ms
+            stats['max_ms'] = max(stats['max_ms'], duration_ms)
+            stats['buckets'][_bucket_index(DURATION_BUCKETS_MS, duration_ms)] += 1
+            stats['queries'] += profile.queries
+            stats['max_queries'] = max(stats['max_queries'], profile.queries)
+            stats['query_buckets'][_bucket_index(QUERY_BUCKETS, profile.queries)] += 1
+            stats['db_ms'] += profile.db_seconds * 1000
+            stats['rows'] += profile.rows
+            if repeated:
+                stats['n_plus_one'] += 1
+                for shape, count in repeated:
+                    self._n_plus_one.append({
+                        'endpoint': endpoint, 'count': count, 'statement': shape[:300],
+                        'time': get_tashkent_time().strftime('%Y-%m-%d %H:%M:%S'),
+                    })
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'started_at': self._started_at,
+                'stats': {endpoint: dict(stats, buckets=list(stats['buckets']),
+                                         query_buckets=list(stats['query_buckets']))
+                          for endpoint, stats in self._stats.items()},
+                'n_plus_one': list(self._n_plus_one),
+            }
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self._flushed_at < FLUSH_SECONDS:
+            return
+        self._flushed_at = time.monotonic()
+        shared_cache.set(_worker_key(), self.snapshot(), STATS_TTL_SECONDS, tags=(SHARED_TAG,))
+
+
+_state = _ProfilerState()
+
+
+def _worker_key():
+    return f'query_profile:{socket.gethostname()}:{os.getpid()}'
+
+
+def _current_profile():
+    if not has_request_context():
+        return None
+    return g.get('_query_profile')
+
+
+# ---------- SQLAlchemy eventlari ----------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile() is not None:
+        conn.info.setdefault(_START_KEY, []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile()
+    starts = conn.info.get(_START_KEY)
+    if profile is None or not starts:
+        return
+    profile.db_seconds += time.perf_counter() - starts.pop()
+    profile.queries += 1
+    profile.rows += max(cursor.rowcount or 0, 0)
+    profile.shapes[statement_shape(statement)] += 1
+
+
+# ---------- Flask ----------
+
+def init_app(app):
+    """before_request / teardown_request hook'larini ulash"""
+    if not ENABLED:
+        logger.info("Query profiler o'chirilgan (QUERY_PROFILER_ENABLED=false)")
+        return
+
+    @app.before_request
+    def _start_query_profile():
+        g._query_profile = RequestProfile()
+
+    @app.teardown_request
+    def _finish_query_profile(exc):
+        profile = g.pop('_query_profile', None)
+        if profile is None or request.endpoint in _SKIP_ENDPOINTS:
+            return
+        duration_ms = (time.perf_counter() - profile.started) * 1000
+        endpoint = f"{request.method} {request.url_rule.rule if request.url_rule else '<404>'}"
+        repeated = [(shape, count) for shape, count in profile.shapes.most_common(3)
+                    if count > N_PLUS_ONE_THRESHOLD]
+        for shape, count in repeated:
+            logger.warning(f"🐌 N+1 ehtimoli: {endpoint} - bir xil SQL {count} marta: {shape[:200]}")
+        try:
+            _state.record(endpoint, duration_ms, profile, repeated)
+            _state.flush()
+        except Exception as e:
+            logger.debug(f"Query profiler statistikasi yozilmadi: {e}")
+
+
+# ---------- hisobot ----------
+
+def _merge(snapshots):
+    merged = {}
+    n_plus_one = []
+    for snapshot in snapshots:
+        n_plus_one.extend(snapshot.get('n_plus_one', ()))
+        for endpoint, stats in snapshot.get('stats', {}).items():
+            target = merged.get(endpoint)
+            if target is None:
+                merged[endpoint] = dict(stats, buckets=list(stats['buckets']),
+                                        query_buckets=list(stats['query_buckets']))
+                continue
+            for name in ('count', 'total_ms', 'queries', 'db_ms', 'rows', 'n_plus_one'):
+                target[name] += stats[name]
+            target['max_ms'] = max(target['max_ms'], stats['max_ms'])
+            target['max_queries'] = max(target['max_queries'], stats['max_queries'])
+            target['buckets'] = [a + b for a, b in zip(target['buckets'], stats['buckets'])]
+            target['query_buckets'] = [a + b for a, b in zip(target['query_buckets'], stats['query_buckets'])]
+    return merged, n_plus_one
+
+
+def endpoint_report(limit=50):
+    """Barcha workerlar bo'yicha endpointlar (jami vaqt bo'yicha kamayish tartibida)"""
+    _state.flush(force=True)
+    snapshots = shared_cache.get_tagged(SHARED_TAG)
+    # Kesh backend'i ishlamasa - hech bo'lmasa joriy worker
+    snapshots[_worker_key()] = _state.snapshot()
+    merged, n_plus_one = _merge(snapshots.values())
+
+    endpoints = []
+    for endpoint, stats in merged.items():
+        count = stats['count']
+        if not count:
+            continue
+        endpoints.append({
+            'endpoint': endpoint,
+            'count': count,
+            'total_s': round(stats['total_ms'] / 1000, 2),
+            'avg_ms': round(stats['total_ms'] / count, 1),
+            'p50_ms': _percentile(DURATION_BUCKETS_MS, stats['buckets'], count, 0.50, round(stats['max_ms'], 1)),
+            'p95_ms': _percentile(DURATION_BUCKETS_MS, stats['buckets'], count, 0.95, round(stats['max_ms'], 1)),
+            'p99_ms': _percentile(DURATION_BUCKETS_MS, stats['buckets'], count, 0.99, round(stats['max_ms'], 1)),
+            'max_ms': round(stats['max_ms'], 1),
+            'avg_queries': round(stats['queries'] / count, 1),
+            'p95_queries': _percentile(QUERY_BUCKETS, stats['query_buckets'], count, 0.95, stats['max_queries']),
+            'max_queries': stats['max_queries'],
+            'avg_db_ms': round(stats['db_ms'] / count, 1),
+            'avg_rows': round(stats['rows'] / count, 1),
+            'n_plus_one': stats['n_plus_one'],
+        })
+    endpoints.sort(key=lambda item: item['total_s'], reverse=True)
+    n_plus_one.sort(key=lambda item: item['time'], reverse=True)
+    return {
+        'workers': len(snapshots),
+        'n_plus_one_threshold': N_PLUS_ONE_THRESHOLD,
+        'endpoints': endpoints[:limit],
+        'n_plus_one': n_plus_one[:20],
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'report':
+        print("Foydalanish: python query_profiler.py report")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        report = endpoint_report(limit=30)
+        print(f"📊 Workerlar: {report['workers']}")
+        print(f"{'Endpoint':<60} {'soni':>7} {'jami,s':>9} {'p50':>7} {'p95':>7} {'p99':>7} {'SQL':>6} {'N+1':>5}")
+        for item in report['endpoints']:
+            print(f"{item['endpoint'][:60]:<60} {item['count']:>7} {item['total_s']:>9} "
+                  f"{item['p50_ms']:>7} {item['p95_ms']:>7} {item['p99_ms']:>7} "
+                  f"{item['avg_queries']:>6} {item['n_plus_one']:>5}")
+        for item in report['n_plus_one']:
+            print(f"🐌 {item['time']} {item['endpoint']} x{item['count']}: {item['statement'][:120]}")
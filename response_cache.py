@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Tez-tez so'raladigan JSON API lar uchun ETag / 304 Not Modified.
+
+Sahifalar ma'lumotni doimiy so'rab turadi: base.html valyuta kursini har 30
+soniyada, transfer.html `/api/all-pending-transfers` ni har 10 soniyada,
+check_stock.html faol sessiyalar va joylashuvlarni har 10 soniyada,
+check_stock_session.html tekshirilgan mahsulotlarni har 5 soniyada. Hech
+narsa o'zgarmagan bo'lsa ham har safar to'liq so'rovlar bajarilib, to'liq
+JSON qaytarilardi.
+
+Endi har bir resursning versiyasi (shared_cache dagi tasodifiy belgi) bor:
+resursga tegishli model o'zgargan commit'dan keyin versiya yangilanadi.
+`@etag_cached('resurs', ...)` bilan o'ralgan view:
+
+- ETag = foydalanuvchi + URL + resurslar versiyalari (hash);
+- brauzer yuborgan `If-None-Match` mos kelsa - view bajarilmaydi, 304;
+- aks holda view bajariladi va javobga ETag va `Cache-Control: private,
+  no-cache` qo'shiladi - brauzer keyingi fetch() da o'zi `If-None-Match`
+  yuboradi va 304 da keshdagi javobni beradi (JS o'zgarmaydi).
+
+Versiya view bajarilishidan OLDIN o'qiladi - parallel commit bo'lsa javob
+eski ETag bilan ketadi va keyingi so'rov yangisini oladi (eskirib qolmaydi).
+
+ORM eventlarini chetlab o'tadigan so'rovlardan keyin (`query.delete()`, xom
+SQL) - `bump(resource, scope)`. Versiyalar VERSION_TTL_SECONDS dan keyin
+baribir yangilanadi; gunicorn ishga tushganda (yangi kod) `reset()`.
+"""
+import hashlib
+import logging
+import uuid
+from collections import namedtuple
+from functools import wraps
+
+from flask import Response, make_response, request, session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import shared_cache
+from database import db
+
+logger = logging.getLogger(__name__)
+
+VERSION_TTL_SECONDS = 3600
+SHARED_TAG = 'response_version'
+
+Watch = namedtuple('Watch', ('fields', 'scope'))
+Watch.__new__.__defaults__ = (None, None)
+
+# Resurs -> {model: Watch}. fields=None - har qanday o'zgarish, () - faqat
+# qo'shish/o'chirish (masalan, qoldiq miqdori o'zgarishi versiyani yangilamaydi).
+# scope - versiya shu ustun qiymati bo'yicha alohida (masalan, sessiya bo'yicha)
+RESOURCES = {
+    'users': {'User': Watch(), 'UserLocation': Watch()},
+    'locations': {'Store': Watch(), 'Warehouse': Watch()},
+    'currency_rate': {'CurrencyRate': Watch()},
+    'pending_transfers': {'PendingTransfer': Watch(), 'PendingTransferItem': Watch()},
+    'stock_check_sessions': {
+        'StockCheckSession': Watch(),
+        'StockCheckItem': Watch(()),
+        'StoreStock': Watch(()),
+        'WarehouseStock': Watch(()),
+    },
+    'stock_check_items': {
+        'StockCheckItem': Watch(scope='session_id'),
+        'Product': Watch(('barcode', 'sell_price')),
+    },
+}
+
+_CHANGED_KEY = 'response_versions_changed'
+
+# model -> [(resurs, Watch)]
+_WATCHERS = {}
+for _resource, _models in RESOURCES.items():
+    for _model, _watch in _models.items():
+        _WATCHERS.setdefault(_model, []).append((_resource, _watch))
+
+
+def _version_key(resource, scope=None):
+    if scope is None:
+        return f'response_version:{resource}'
+    return f'response_version:{resource}:{scope}'
+
+
+def _new_version():
+    return uuid.uuid4().hex[:16]
+
+
+def version(resource, scope=None):
+    """Resurs versiyasi (yo'q bo'lsa yangisi yoziladi)"""
+    value, _ = shared_cache.get_or_set(_version_key(resource, scope), _new_version,
+                                       VERSION_TTL_SECONDS, tags=(SHARED_TAG,))
+    return value
+
+
+def bump_now(resource, scope=None):
+    shared_cache.set(_version_key(resource, scope), _new_version(), VERSION_TTL_SECONDS,
+                     tags=(SHARED_TAG,))
+
+
+def bump(resource, scope=None, session=None):
+    """Joriy tranzaksiya commit bo'lgach resurs versiyasini yangilash"""
+    (session or db.session).info.setdefault(_CHANGED_KEY, set()).add((resource, scope))
+
+
+def reset():
+    """Barcha versiyalarni o'chirish (gunicorn ishga tushganda - JSON tuzilishi o'zgargan bo'lishi mumkin)"""
+    shared_cache.invalidate_tag(SHARED_TAG)
+
+
+def current_etag(resources, scope=None):
+    user_id = session.get('user_id')
+    parts = [str(user_id), request.full_path]
+    for resource in resources:
+        parts.append(version(resource))
+        if scope is not None and any(watch.scope for watch in RESOURCES[resource].values()):
+            parts.append(version(resource, scope))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:20]
+
+
+def etag_cached(*resources, scope=None):
+    """View ni ETag bilan o'rash. scope - URL parametri nomi (masalan, 'session_id')"""
+    for resource in resources:
+        if resource not in RESOURCES:
+            raise ValueError(f"Noma'lum resurs: {resource}")
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                etag = current_etag(resources, kwargs.get(scope) if scope else None)
+            except Exception as e:
+                logger.debug(f"ETag hisoblanmadi ({request.path}): {e}")
+                return view(*args, **kwargs)
+
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+# ---------- avtomatik yangilash ----------
+
+@event.listens_for(Session, 'after_flush')
+def _collect_version_changes(session, flush_context):
+    changed = session.info.setdefault(_CHANGED_KEY, set())
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        watchers = _WATCHERS.get(type(obj).__name__)
+        if not watchers:
+            continue
+        is_dirty = obj in session.dirty
+        state = inspect(obj) if is_dirty else None
+        for resource, watch in watchers:
+            if is_dirty:
+                if watch.fields is None:
+                    if not session.is_modified(obj, include_collections=False):
+                        continue
+                elif not any(state.attrs[name].history.has_changes() for name in watch.fields):
+                    continue
+            changed.add((resource, getattr(obj, watch.scope) if watch.scope else None))
+
+
+@event.listens_for(Session, 'before_commit')
+def _flush_version_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_version_changes(session):
+    for resource, scope in session.info.pop(_CHANGED_KEY, ()):
+        bump_now(resource, scope)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_version_changes(session):
+    session.info.pop(_CHANGED_KEY, None)
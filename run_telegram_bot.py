@@ -32,6 +32,7 @@ def main():
         from app import app, db
         from telegram_bot import create_telegram_app, create_reset_bot_app
         from debt_scheduler import init_debt_scheduler
+        from notification_queue import start_worker
 
         logger.info("🤖 Telegram Bot ishga tushirilmoqda...")
 
@@ -39,6 +40,10 @@ def main():
         logger.info("📅 Scheduler ishga tushirilmoqda...")
         scheduler = init_debt_scheduler(app, db)
 
+        # Savdo cheklari va to'lov xabarlari navbati (web so'rovlar faqat navbatga yozadi)
+        logger.info("📨 Xabarlar navbati worker'i ishga tushirilmoqda...")
+        notification_worker = start_worker(app)
+
         # Asosiy bot (@Sergeli143_bot)
         logger.info("📱 Telegram application yaratilmoqda...")
         application = create_telegram_app()
@@ -86,6 +91,8 @@ def main():
         logger.info("\n⛔ Bot to'xtatildi (Ctrl+C)")
         if 'scheduler' in locals():
             scheduler.stop()
+        if 'notification_worker' in locals():
+            notification_worker.stop()
     except Exception as e:
         logger.error(f"❌ Xatolik: {e}", exc_info=True)
         sys.exit(1)
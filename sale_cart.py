@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Savdo korzinasini oldindan yuklash (create_sale / pending savdo uchun).
+
+Avval create_sale har bir qator uchun alohida `Product.query.get`,
+StoreStock/WarehouseStock qidiruvi, xato matni va izoh uchun
+`Store/Warehouse.query.get` va tahrirlashda asl SaleItem so'rovini bajarardi -
+qatoriga 4-6 ta so'rov, 100+ qatorli ulgurji savdoda bir necha soniya.
+
+`load_sale_cart()` butun korzina uchun mahsulotlar, stock qatorlari,
+joylashuv nomlari va asl savdo miqdorlarini bir nechta `IN (...)` so'rovida
+oladi; keyin qatorlar xotirada tekshiriladi.
+"""
+import logging
+from decimal import Decimal
+
+from sqlalchemy import func, tuple_
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+class SaleCartError(ValueError):
+    """Korzina qatori noto'g'ri - HTTP status bilan"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class CartLine:
+    """Korzinaning bitta tekshirilgan qatori"""
+
+    __slots__ = ('item', 'product', 'quantity', 'location_type', 'location_id',
+                 'stock', 'original_quantity')
+
+    def __init__(self, item, product, quantity, location_type, location_id,
+                 stock=None, original_quantity=None):
+        self.item = item
+        self.product = product
+        self.quantity = quantity
+        self.location_type = location_type
+        self.location_id = location_id
+        self.stock = stock
+        self.original_quantity = original_quantity
+
+
+class SaleCart:
+    """Yuklangan korzina: qatorlar + joylashuv nomlari"""
+
+    def __init__(self, lines, location_names):
+        self.lines = lines
+        self._location_names = location_names
+
+    def location_name(self, location_type, location_id):
+        return self._location_names.get((location_type, _as_int(location_id)))
+
+    def location_info(self, line):
+        """SaleItem.notes uchun joylashuv matni"""
+        if line.location_type == 'warehouse':
+            return f'Ombor: {self.location_name("warehouse", line.location_id)} (ID: {line.location_id})'
+        return f'Dokon: {self.location_name("store", line.location_id)} (ID: {line.location_id})'
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _load_stocks(keys):
+    """{(location_type, location_id, product_id): stock} - har tur uchun bitta so'rov"""
+    from models import StoreStock, WarehouseStock
+
+    stocks = {}
+    for location_type, model, location_col in (
+            ('store', StoreStock, StoreStock.store_id),
+            ('warehouse', WarehouseStock, WarehouseStock.warehouse_id)):
+        pairs = sorted({(loc_id, prod_id) for loc_type, loc_id, prod_id in keys
+                        if loc_type == location_type})
+        if not pairs:
+            continue
+        rows = model.query.filter(
+            tuple_(location_col, model.product_id).in_(pairs)
+        ).order_by(model.id).all()
+        for row in rows:
+            stocks.setdefault((location_type, getattr(row, location_col.key), row.product_id), row)
+    return stocks
+
+
+def _load_location_names(keys):
+    from models import Store, Warehouse
+
+    names = {}
+    store_ids = {loc_id for loc_type, loc_id in keys if loc_type != 'warehouse'}
+    warehouse_ids = {loc_id for loc_type, loc_id in keys if loc_type == 'warehouse'}
+    if store_ids:
+        names.update({('store', row.id): row.name for row in
+                      db.session.query(Store.id, Store.name).filter(Store.id.in_(store_ids))})
+    if warehouse_ids:
+        names.update({('warehouse', row.id): row.name for row in
+                      db.session.query(Warehouse.id, Warehouse.name).filter(Warehouse.id.in_(warehouse_ids))})
+    return names
+
+
+def load_sale_cart(items, location_for, original_sale_id=None, with_stock=True):
+    """Korzina qatorlarini yuklash va tekshirish.
+
+    location_for(item) -> (location_type, location_id) - qator joylashuvi.
+    with_stock=True bo'lsa har bir qator uchun stock qatori mavjudligi
+    tekshiriladi (create_sale), aks holda faqat mahsulotlar (pending savdo).
+    Miqdori 0 yoki manfiy qatorlar tashlab ketiladi.
+
+    Xato bo'lsa SaleCartError - avvalgi qatorma-qator tekshiruv bilan bir xil
+    matn va tartibda (birinchi noto'g'ri qator).
+    """
+    from models import Product, SaleItem
+
+    raw_lines = []
+    for item in items:
+        quantity = Decimal(str(item.get('quantity', 0)))
+        if quantity <= 0:
+            continue
+        product_id = _as_int(item.get('product_id') or item.get('id'))
+        location_type, location_id = location_for(item)
+        raw_lines.append((item, product_id, quantity, location_type, _as_int(location_id)))
+
+    product_ids = {line[1] for line in raw_lines if isinstance(line[1], int)}
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids))} if product_ids else {}
+
+    stocks = {}
+    location_names = {}
+    if with_stock:
+        stocks = _load_stocks({(line[3], line[4], line[1]) for line in raw_lines
+                               if line[1] in products and line[3] in ('store', 'warehouse')})
+        location_names = _load_location_names({(line[3], line[4]) for line in raw_lines})
+
+    original_quantities = {}
+    if original_sale_id:
+        original_quantities = dict(db.session.query(
+            SaleItem.product_id, func.sum(SaleItem.quantity)
+        ).filter(SaleItem.sale_id == original_sale_id).group_by(SaleItem.product_id).all())
+
+    lines = []
+    for item, product_id, quantity, location_type, location_id in raw_lines:
+        product = products.get(product_id)
+        if not product:
+            raise SaleCartError(f'Mahsulot topilmadi: {product_id}', 404)
+
+        stock = None
+        if with_stock and location_type in ('store', 'warehouse'):
+            stock = stocks.get((location_type, location_id, product.id))
+            if not stock:
+                name = location_names.get((location_type, location_id)) or 'noma\'lum'
+                if location_type == 'store':
+                    raise SaleCartError(f'{name} do\'konida {product.name} mahsuloti mavjud emas')
+                raise SaleCartError(f'{name} omborida {product.name} mahsuloti mavjud emas')
+
+        lines.append(CartLine(item, product, quantity, location_type, location_id,
+                              stock, original_quantities.get(product.id)))
+
+    logger.debug(f"🛒 Korzina yuklandi: {len(lines)} qator, {len(products)} mahsulot, "
+                 f"{len(stocks)} stock qatori")
+    return SaleCart(lines, location_names)
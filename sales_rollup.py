@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""Savdolarning kunlik/soatlik oldindan hisoblangan yig'indilari.
+
+`sales_daily_rollup` va `sales_hourly_rollup` jadvallari (joylashuv, kun/soat,
+to'lov usuli) bo'yicha savdo soni, summa, foyda va to'lov turlarini saqlaydi
+(migrations/create_sales_rollup_tables.sql). Dashboard grafiklari va statistikasi
+butun `sale_items` jadvalini emas, shu jadvallarni o'qiydi - O(kunlar).
+
+Yangilash avtomatik: Sale/SaleItem o'zgargan har bir tranzaksiyada (yangi savdo,
+tahrirlash, o'chirish, qaytarish, qarz to'lovi) tegishli (kun, joylashuv)
+bo'laklari commit oldidan manba jadvaldan qayta hisoblanadi - shuning uchun
+rollup hech qachon "siljimaydi". Bir bo'lakni bir vaqtda faqat bitta
+tranzaksiya qayta hisoblaydi (pg_advisory_xact_lock); yangilash xatosi commit'ni
+to'xtatadi - jim yutilmaydi. To'liq qayta qurish:
+
+    python sales_rollup.py rebuild
+"""
+import logging
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import NO_VALUE
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = 'sales_rollup_pending'
+
+# Rollup jadvallari mavjudmi (migratsiya qo'llanganmi) - jarayon uchun bir marta tekshiriladi
+_tables_ready = None
+
+# Rollup natijasiga ta'sir qiladigan ustunlar (boshqa o'zgarishlar qayta hisoblatmaydi)
+_SALE_FIELDS = (
+    'sale_date', 'location_type', 'location_id', 'payment_method',
+    'total_amount', 'total_profit',
+    'cash_usd', 'click_usd', 'terminal_usd', 'debt_usd',
+    'cash_amount', 'click_amount', 'terminal_amount', 'debt_amount',
+)
+_SALE_KEY_FIELDS = ('sale_date', 'location_type', 'location_id')
+_ITEM_FIELDS = ('sale_id', 'quantity', 'unit_price', 'total_price_uzs')
+
+# Grafik faqat biror to'lov summasi bor savdolarni ko'rsatadi
+_CHARTED = "(s.cash_usd > 0 OR s.click_usd > 0 OR s.terminal_usd > 0 OR s.debt_usd > 0)"
+
+_ROLLUP_COLUMNS = """
+    location_type, location_id, payment_method,
+    sales_count, items_count, items_revenue,
+    chart_sales_count, total_amount, total_profit, total_amount_uzs,
+    cash_usd, click_usd, terminal_usd, debt_usd,
+    cash_uzs, click_uzs, terminal_uzs, debt_uzs
+"""
+
+_ROLLUP_SELECT = """
+    SELECT
+        {bucket} AS bucket,
+        COALESCE(s.location_type, '') AS location_type,
+        COALESCE(s.location_id, 0) AS location_id,
+        COALESCE(s.payment_method, '') AS payment_method,
+        COUNT(*) AS sales_count,
+        COALESCE(SUM(si.items_count), 0) AS items_count,
+        COALESCE(SUM(si.items_revenue), 0) AS items_revenue,
+        COUNT(*) FILTER (WHERE {charted}) AS chart_sales_count,
+        COALESCE(SUM(s.total_amount) FILTER (WHERE {charted}), 0) AS total_amount,
+        COALESCE(SUM(s.total_profit) FILTER (WHERE {charted}), 0) AS total_profit,
+        COALESCE(SUM(si.total_uzs) FILTER (WHERE {charted}), 0) AS total_amount_uzs,
+        COALESCE(SUM(s.cash_usd) FILTER (WHERE {charted}), 0) AS cash_usd,
+        COALESCE(SUM(s.click_usd) FILTER (WHERE {charted}), 0) AS click_usd,
+        COALESCE(SUM(s.terminal_usd) FILTER (WHERE {charted}), 0) AS terminal_usd,
+        COALESCE(SUM(s.debt_usd) FILTER (WHERE {charted}), 0) AS debt_usd,
+        COALESCE(SUM(s.cash_amount) FILTER (WHERE {charted}), 0) AS cash_uzs,
+        COALESCE(SUM(s.click_amount) FILTER (WHERE {charted}), 0) AS click_uzs,
+        COALESCE(SUM(s.terminal_amount) FILTER (WHERE {charted}), 0) AS terminal_uzs,
+        COALESCE(SUM(s.debt_amount) FILTER (WHERE {charted}), 0) AS debt_uzs
+    FROM sales s
+    LEFT JOIN (
+        SELECT
+            si.sale_id,
+            COUNT(*) AS items_count,
+            SUM(si.unit_price * si.quantity) AS items_revenue,
+            SUM(si.total_price_uzs) AS total_uzs
+        FROM sale_items si
+        JOIN sales s ON s.id = si.sale_id
+        WHERE {where}
+        GROUP BY si.sale_id
+    ) si ON si.sale_id = s.id
+    WHERE {where}
+    GROUP BY 1, 2, 3, 4
+"""
+
+_TABLES = (
+    # (jadval, bo'lak ustuni, bo'lak ifodasi)
+    ('sales_daily_rollup', 'day', 'CAST(s.sale_date AS DATE)'),
+    ('sales_hourly_rollup', 'hour', "date_trunc('hour', s.sale_date)"),
+)
+
+_BUCKET_WHERE = """
+    s.sale_date IS NOT NULL
+    AND s.sale_date >= :day_start AND s.sale_date < :day_end
+    AND COALESCE(s.location_type, '') = :location_type
+    AND COALESCE(s.location_id, 0) = :location_id
+"""
+
+
+# ---------- yozish ----------
+
+def _lock_bucket(connection, day, location_type, location_id):
+    """Bo'lakni tranzaksiya oxirigacha qulflash.
+
+    READ COMMITTED da bir kun/do'kondagi ikki savdo DELETE+INSERT ni parallel
+    bajarsa, biri PK xatosiga uchraydi. Qulf bilan ikkinchisi kutadi va
+    qayta hisoblashda birinchisining commit qilingan savdosini ham ko'radi.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                           {'key': f'sales_rollup:{day.isoformat()}:{location_type}:{location_id}'})
+
+
+def refresh_buckets(connection, buckets):
+    """(kun, location_type, location_id) bo'laklarini manba jadvaldan qayta hisoblash"""
+    # Tartiblangan qulflash - ikki tranzaksiya bir-birini kutib qolmaydi (deadlock yo'q)
+    for day, location_type, location_id in sorted(buckets):
+        _lock_bucket(connection, day, location_type, location_id)
+        day_start = datetime.combine(day, datetime.min.time())
+        params = {
+            'day_start': day_start,
+            'day_end': day_start + timedelta(days=1),
+            'location_type': location_type,
+            'location_id': location_id,
+        }
+        for table, bucket_column, bucket_expr in _TABLES:
+            connection.execute(text(f"""
+                DELETE FROM {table}
+                WHERE {bucket_column} >= :day_start AND {bucket_column} < :day_end
+                  AND location_type = :location_type AND location_id = :location_id
+            """), params)
+            connection.execute(text(
+                f"INSERT INTO {table} ({bucket_column}, {_ROLLUP_COLUMNS}) "
+                + _ROLLUP_SELECT.format(bucket=bucket_expr, charted=_CHARTED, where=_BUCKET_WHERE)
+            ), params)
+
+
+def rebuild_rollups():
+    """Ikkala rollup jadvalini butun savdolar tarixidan qayta qurish"""
+    for table, bucket_column, bucket_expr in _TABLES:
+        db.session.execute(text(f"DELETE FROM {table}"))
+        db.session.execute(text(
+            f"INSERT INTO {table} ({bucket_column}, {_ROLLUP_COLUMNS}) "
+            + _ROLLUP_SELECT.format(bucket=bucket_expr, charted=_CHARTED,
+                                    where='s.sale_date IS NOT NULL')
+        ))
+    db.session.commit()
+    count = db.session.execute(text("SELECT COUNT(*) FROM sales_daily_rollup")).scalar()
+    logger.info(f"📊 Savdo rollup qayta qurildi: {count} ta kunlik qator")
+    return count
+
+
+# ---------- o'qish ----------
+
+def parse_day(value):
+    """'YYYY-MM-DD' (yoki undan uzunroq ISO satr) -> date, noto'g'ri bo'lsa None"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip()[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def _location_conditions(location_id, location_type, conditions, params):
+    if location_id:
+        conditions.append("r.location_id = :location_id")
+        params['location_id'] = int(location_id)
+        if location_type in ('store', 'warehouse'):
+            conditions.append("r.location_type = :location_type")
+            params['location_type'] = location_type
+
+
+def chart_rows(hourly, date_from=None, date_to=None, location_id=None, location_type=None):
+    """Grafik qatorlari - /api/sales-chart avvalgi SQL natijasi bilan bir xil tartibda:
+
+    (davr, soni, summa, foyda, cash, click, terminal, qarz, summa_uzs,
+     cash_uzs, click_uzs, terminal_uzs, qarz_uzs)
+    """
+    if hourly:
+        table, period = 'sales_hourly_rollup', 'EXTRACT(HOUR FROM r.hour)'
+        bucket_start = 'r.hour >= :date_from'
+        bucket_end = 'r.hour < :date_to_next'
+    else:
+        table, period = 'sales_daily_rollup', 'r.day'
+        bucket_start = 'r.day >= :date_from'
+        bucket_end = 'r.day < :date_to_next'
+
+    conditions = []
+    params = {}
+    start, end = parse_day(date_from), parse_day(date_to)
+    if start:
+        conditions.append(bucket_start)
+        params['date_from'] = start
+    if end:
+        conditions.append(bucket_end)
+        params['date_to_next'] = end + timedelta(days=1)
+    _location_conditions(location_id, location_type, conditions, params)
+
+    query = f"""
+        SELECT
+            {period} AS time_period,
+            SUM(r.chart_sales_count),
+            SUM(r.total_amount), SUM(r.total_profit),
+            SUM(r.cash_usd), SUM(r.click_usd), SUM(r.terminal_usd), SUM(r.debt_usd),
+            SUM(r.total_amount_uzs),
+            SUM(r.cash_uzs), SUM(r.click_uzs), SUM(r.terminal_uzs), SUM(r.debt_uzs)
+        FROM {table} r
+        WHERE r.chart_sales_count > 0
+    """
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+    query += " GROUP BY 1 ORDER BY 1"
+    return db.session.execute(text(query), params).fetchall()
+
+
+def item_summary(date_from=None, date_to=None, location_id=None):
+    """Mahsulot qatorlari soni, jami summasi va o'rtachasi (/api/sales-statistics)"""
+    conditions = []
+    params = {}
+    start, end = parse_day(date_from), parse_day(date_to)
+    if start:
+        conditions.append("r.day >= :date_from")
+        params['date_from'] = start
+    if end:
+        conditions.append("r.day <= :date_to")
+        params['date_to'] = end
+    _location_conditions(location_id, None, conditions, params)
+
+    query = """
+        SELECT COALESCE(SUM(r.items_count), 0), COALESCE(SUM(r.items_revenue), 0)
+        FROM sales_daily_rollup r
+    """
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    items_count, revenue = db.session.execute(text(query), params).fetchone()
+    items_count = int(items_count or 0)
+    revenue = float(revenue or 0)
+    return items_count, revenue, (revenue / items_count if items_count else 0)
+
+
+def location_sales_counts(date_from=None, date_to=None):
+    """Joylashuv nomi bo'yicha savdolar soni, ko'pidan kamiga: [(nom, soni), ...]"""
+    from models import Store, Warehouse
+
+    conditions = []
+    params = {}
+    start, end = parse_day(date_from), parse_day(date_to)
+    if start:
+        conditions.append("r.day >= :date_from")
+        params['date_from'] = start
+    if end:
+        conditions.append("r.day <= :date_to")
+        params['date_to'] = end
+
+    query = """
+        SELECT r.location_type, r.location_id, SUM(r.sales_count)
+        FROM sales_daily_rollup r
+        WHERE r.location_type IN ('store', 'warehouse')
+    """
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+    query += " GROUP BY r.location_type, r.location_id"
+    rows = db.session.execute(text(query), params).fetchall()
+
+    store_ids = {row[1] for row in rows if row[0] == 'store'}
+    warehouse_ids = {row[1] for row in rows if row[0] == 'warehouse'}
+    names = {}
+    if store_ids:
+        names.update({('store', s.id): s.name for s in
+                      db.session.query(Store.id, Store.name).filter(Store.id.in_(store_ids))})
+    if warehouse_ids:
+        names.update({('warehouse', w.id): w.name for w in
+                      db.session.query(Warehouse.id, Warehouse.name).filter(Warehouse.id.in_(warehouse_ids))})
+
+    # Bir xil nomli joylashuvlar birlashtiriladi (avvalgi GROUP BY location_name kabi)
+    counts = {}
+    for location_type, location_id, sales_count in rows:
+        name = names.get((location_type, location_id))
+        if name:
+            counts[name] = counts.get(name, 0) + int(sales_count or 0)
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)
+
+
+# ---------- avtomatik yangilash ----------
+
+def _day_bucket(sale_date, location_type, location_id):
+    if sale_date is None:
+        return None
+    return (sale_date.date() if isinstance(sale_date, datetime) else sale_date,
+            location_type or '', location_id or 0)
+
+
+def _changed(state, fields):
+    return any(state.attrs[name].history.has_changes() for name in fields)
+
+
+def _old_key_values(state):
+    """O'zgarishdan oldingi (sale_date, location_type, location_id), noma'lum bo'lsa None"""
+    values = []
+    for name in _SALE_KEY_FIELDS:
+        history = state.attrs[name].history
+        if history.deleted:
+            values.append(history.deleted[0])
+        else:
+            value = state.dict.get(name, NO_VALUE)
+            if value is NO_VALUE:
+                return None
+            values.append(value)
+    return values
+
+
+def _rollup_tables_ready(connection):
+    """Migratsiya qo'llanmagan bo'lsa - ogohlantirish va yangilashni o'tkazib yuborish"""
+    global _tables_ready
+    if _tables_ready is None:
+        inspector = inspect(connection)
+        _tables_ready = all(inspector.has_table(table) for table, _, _ in _TABLES)
+        if not _tables_ready:
+            logger.warning("⚠️ Savdo rollup jadvallari yo'q - "
+                           "migrations/create_sales_rollup_tables.sql ni qo'llang")
+    return _tables_ready
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_rollup_changes(session, flush_context):
+    """Flush qilingan savdo o'zgarishlaridan ta'sirlangan bo'laklarni yig'ish"""
+    from models import Sale, SaleItem
+
+    pending = None
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Sale):
+            state = inspect(obj)
+            if obj in session.dirty and not _changed(state, _SALE_FIELDS):
+                continue
+            if pending is None:
+                pending = session.info.setdefault(_PENDING_KEY, {'buckets': set(), 'sale_ids': set()})
+            old_values = _old_key_values(state)
+            if old_values is not None:
+                bucket = _day_bucket(*old_values)
+                if bucket:
+                    pending['buckets'].add(bucket)
+            if obj.id is not None and obj not in session.deleted:
+                pending['sale_ids'].add(obj.id)
+        elif isinstance(obj, SaleItem):
+            state = inspect(obj)
+            if obj in session.dirty and not _changed(state, _ITEM_FIELDS):
+                continue
+            if pending is None:
+                pending = session.info.setdefault(_PENDING_KEY, {'buckets': set(), 'sale_ids': set()})
+            history = state.attrs.sale_id.history
+            pending['sale_ids'].update(
+                sale_id for sale_id in list(history.deleted) + [state.dict.get('sale_id')]
+                if sale_id is not None and sale_id is not NO_VALUE
+            )
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_rollup_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+
+    from models import Sale
+
+    connection = session.connection()
+    if not _rollup_tables_ready(connection):
+        return
+
+    # Xato savdo tranzaksiyasini ham to'xtatadi - rollup jim siljimasligi uchun
+    buckets = set(pending['buckets'])
+    if pending['sale_ids']:
+        rows = connection.execute(
+            select(Sale.sale_date, Sale.location_type, Sale.location_id)
+            .where(Sale.id.in_(pending['sale_ids'])).distinct()
+        )
+        buckets.update(b for b in (_day_bucket(*row) for row in rows) if b)
+    refresh_buckets(connection, buckets)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rollup_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print("Foydalanish: python sales_rollup.py rebuild")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        count = rebuild_rollups()
+        print(f"✅ Savdo rollup qayta qurildi: {count} ta kunlik qator")
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""/api/sales-history statistikasi - filtrlangan savdolar ustida bir o'tishda hisoblash.
+
+Avval har bir sahifa almashganda bir xil savdolar to'plami ustida o'ndan ortiq
+alohida aggregate so'rov yuborilardi. Endi:
+
+1. Savdolar bo'yicha barcha ko'rsatkichlar (jami, to'lov usullari, joylashuvlar,
+   qarzdor mijozlar) bitta CTE + UNION ALL so'rovida;
+2. Mahsulotlar (jami miqdor va top mahsulotlar) bitta GROUP BY + window so'rovida;
+3. Kirim summasi va xarajatlar alohida jadvallardan bittadan so'rovda;
+4. Joylashuv va mijoz nomlari IN (...) so'rovlari bilan
+
+hisoblanadi. Natija filtrlar to'plami bo'yicha qisqa muddat shared_cache da
+(barcha workerlar uchun umumiy) keshlanadi, shuning uchun sahifalash
+(page/per_page) statistikani qayta hisoblamaydi. Savdo, savdo qatori, qarz
+to'lovi, xarajat yoki kirim yozilgan tranzaksiya commit bo'lgach kesh
+o'chiriladi - yangi savdo, qaytarish va to'lovlar darhol ko'rinadi.
+"""
+import hashlib
+import logging
+from datetime import datetime
+
+from sqlalchemy import Integer, String, cast, event, func, literal, null, select, union_all
+from sqlalchemy.orm import Session
+
+import shared_cache
+from database import db, get_tashkent_time
+from models import (
+    Customer, DebtPayment, Expense, Product, ProductAddHistory, Sale, SaleItem, Store, Warehouse,
+)
+
+logger = logging.getLogger(__name__)
+
+# Statistika keshining amal qilish muddati (sekund)
+STATS_CACHE_TTL = 30
+STATS_CACHE_TAG = 'sales_statistics'
+
+_INVALIDATE_KEY = 'sales_statistics_invalidate'
+
+# Statistikaga ta'sir qiladigan modellar
+_WATCHED_MODELS = (Sale, SaleItem, DebtPayment, Expense, ProductAddHistory)
+
+
+# ---------- kesh (shared_cache - barcha workerlar uchun umumiy) ----------
+
+def _stats_key(key):
+    return 'sales_stats:' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def get_cached_statistics(key):
+    """Filtrlar kaliti bo'yicha keshlangan (statistics, list_total) yoki None"""
+    return shared_cache.get(_stats_key(key))
+
+
+def store_cached_statistics(key, value):
+    """Hisoblangan statistikani keshga yozish"""
+    shared_cache.set(_stats_key(key), value, STATS_CACHE_TTL, tags=(STATS_CACHE_TAG,))
+
+
+def invalidate_statistics():
+    """Barcha keshlangan statistikani o'chirish"""
+    shared_cache.invalidate_tag(STATS_CACHE_TAG)
+
+
+# ---------- avtomatik bekor qilish ----------
+
+@event.listens_for(Session, 'after_flush')
+def _collect_statistics_changes(session, flush_context):
+    if session.info.get(_INVALIDATE_KEY):
+        return
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        if isinstance(obj, _WATCHED_MODELS):
+            session.info[_INVALIDATE_KEY] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_statistics_invalidation(session):
+    if session.info.pop(_INVALIDATE_KEY, None):
+        try:
+            invalidate_statistics()
+        except Exception as e:
+            logger.warning(f"⚠️ Statistika keshini o'chirib bo'lmadi: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_statistics_invalidation(session):
+    session.info.pop(_INVALIDATE_KEY, None)
+
+
+# ---------- hisoblash ----------
+
+def _location_filter_parts(location_filter):
+    """'store_1' / 'warehouse_2' -> ('store', 1); boshqa holatda (None, None)"""
+    if location_filter and location_filter != 'all':
+        for loc_type in ('store', 'warehouse'):
+            if location_filter.startswith(f'{loc_type}_'):
+                return loc_type, int(location_filter.replace(f'{loc_type}_', ''))
+    return None, None
+
+
+def _sales_aggregates(stats_query):
+    """Savdo darajasidagi barcha ko'rsatkichlar - bitta CTE ustida UNION ALL"""
+    filtered = stats_query.order_by(None).with_entities(
+        Sale.id.label('id'),
+        Sale.customer_id.label('customer_id'),
+        Sale.location_type.label('location_type'),
+        Sale.location_id.label('location_id'),
+        Sale.payment_method.label('payment_method'),
+        Sale.total_amount.label('total_amount'),
+        Sale.total_profit.label('total_profit'),
+        Sale.cash_usd.label('cash_usd'),
+        Sale.click_usd.label('click_usd'),
+        Sale.terminal_usd.label('terminal_usd'),
+        Sale.debt_usd.label('debt_usd'),
+    ).cte('filtered_sales')
+    f = filtered.c
+
+    def branch(kind, key_type, key_id):
+        return select(
+            literal(kind).label('kind'),
+            key_type.label('key_type'),
+            key_id.label('key_id'),
+            func.count(f.id).label('cnt'),
+            func.sum(f.total_amount).label('revenue'),
+            func.sum(f.total_profit).label('profit'),
+            func.sum(f.cash_usd).label('cash'),
+            func.sum(f.click_usd).label('click'),
+            func.sum(f.terminal_usd).label('terminal'),
+            func.sum(f.debt_usd).label('debt'),
+        ).select_from(filtered)
+
+    no_type = cast(null(), String)
+    no_id = cast(null(), Integer)
+    statement = union_all(
+        branch('total', no_type, no_id),
+        branch('method', f.payment_method, no_id).group_by(f.payment_method),
+        branch('location', f.location_type, f.location_id).where(
+            f.location_type.in_(('store', 'warehouse'))
+        ).group_by(f.location_type, f.location_id),
+        branch('debtor', no_type, f.customer_id).where(
+            f.debt_usd > 0, f.customer_id.isnot(None)
+        ).group_by(f.customer_id),
+    )
+    return db.session.execute(statement).all()
+
+
+def _item_aggregates(sale_ids_subquery, top_n):
+    """Jami sotilgan miqdor va top mahsulotlar - bitta GROUP BY + window so'rovi"""
+    qty_sum = func.sum(SaleItem.quantity)
+    rows = db.session.query(
+        Product.name,
+        qty_sum.label('quantity'),
+        func.sum(SaleItem.total_price).label('revenue'),
+        func.sum(qty_sum).over().label('all_quantity'),
+    ).select_from(SaleItem).outerjoin(
+        Product, SaleItem.product_id == Product.id
+    ).filter(
+        SaleItem.sale_id.in_(select(sale_ids_subquery.c.id))
+    ).group_by(Product.name).order_by(qty_sum.desc()).limit(top_n + 1).all()
+
+    total_items = float(rows[0].all_quantity or 0) if rows else 0
+    top_products = [
+        {
+            'name': name or 'Noma\'lum',
+            'quantity': float(quantity or 0),
+            'revenue': float(revenue or 0)
+        }
+        for name, quantity, revenue, _ in rows if name is not None
+    ][:top_n]
+    return total_items, top_products
+
+
+def _names(model, ids):
+    if not ids:
+        return {}
+    return dict(db.session.query(model.id, model.name).filter(model.id.in_(ids)).all())
+
+
+def _incoming_cost(stats_date_filter, start_date, end_date, location_filter, store_names, warehouse_names):
+    """Davr mobaynida joylashuvlarga qo'shilgan mahsulotlar tan narxi"""
+    incoming_q = db.session.query(
+        func.sum(ProductAddHistory.cost_price * ProductAddHistory.quantity)
+    )
+    if stats_date_filter == 'today':
+        today = get_tashkent_time().date()
+        today_start = datetime.combine(today, datetime.min.time())
+        today_end = datetime.combine(today, datetime.max.time())
+        incoming_q = incoming_q.filter(
+            ProductAddHistory.added_date >= today_start,
+            ProductAddHistory.added_date <= today_end
+        )
+    else:
+        if start_date:
+            incoming_q = incoming_q.filter(ProductAddHistory.added_date >= start_date)
+        if end_date:
+            incoming_q = incoming_q.filter(ProductAddHistory.added_date <= end_date + ' 23:59:59')
+
+    loc_type, loc_id = _location_filter_parts(location_filter)
+    if loc_type:
+        names = store_names if loc_type == 'store' else warehouse_names
+        if loc_id not in names:
+            names.update(_names(Store if loc_type == 'store' else Warehouse, {loc_id}))
+        if loc_id in names:
+            incoming_q = incoming_q.filter(
+                ProductAddHistory.location_name == names[loc_id],
+                ProductAddHistory.location_type == loc_type
+            )
+    return float(incoming_q.scalar() or 0)
+
+
+def _expenses(start_date, end_date, location_filter):
+    """Xarajatlar: joylashuv bo'yicha va jami - bitta GROUP BY so'rovi"""
+    exp_q = db.session.query(
+        Expense.location_type,
+        Expense.location_id,
+        func.coalesce(func.sum(Expense.amount_usd), 0).label('total_usd')
+    )
+    if start_date and start_date.strip():
+        exp_q = exp_q.filter(Expense.expense_date >= start_date)
+    if end_date and end_date.strip():
+        exp_q = exp_q.filter(Expense.expense_date <= end_date + ' 23:59:59')
+    loc_type, loc_id = _location_filter_parts(location_filter)
+    if loc_type:
+        exp_q = exp_q.filter(Expense.location_type == loc_type, Expense.location_id == loc_id)
+    return exp_q.group_by(Expense.location_type, Expense.location_id).all()
+
+
+def compute_sales_statistics(stats_query, stats_date_filter, start_date, end_date,
+                             location_filter, top_n):
+    """Filtrlangan savdolar uchun /api/sales-history 'statistics' bloki"""
+    sale_rows = _sales_aggregates(stats_query)
+
+    total_row = next((row for row in sale_rows if row.kind == 'total'), None)
+    total_sales_count = int(total_row.cnt or 0) if total_row else 0
+    total_revenue = float(total_row.revenue or 0) if total_row else 0.0
+    total_profit = float(total_row.profit or 0) if total_row else 0.0
+
+    location_rows = [row for row in sale_rows if row.kind == 'location']
+    debtor_rows = [row for row in sale_rows if row.kind == 'debtor']
+
+    # Nomlar - IN (...) so'rovlari (har qator uchun alohida .get() emas)
+    expense_rows = []
+    try:
+        expense_rows = _expenses(start_date, end_date, location_filter)
+        expenses_ok = True
+    except Exception as e:
+        logger.error(f"Xarajatlar statistikasida xatolik: {e}")
+        db.session.rollback()
+        expenses_ok = False
+
+    store_ids = {row.key_id for row in location_rows if row.key_type == 'store'}
+    warehouse_ids = {row.key_id for row in location_rows if row.key_type == 'warehouse'}
+    for loc_type, loc_id, _ in expense_rows:
+        if loc_type == 'store' and loc_id is not None:
+            store_ids.add(loc_id)
+        elif loc_type == 'warehouse' and loc_id is not None:
+            warehouse_ids.add(loc_id)
+    store_names = _names(Store, store_ids)
+    warehouse_names = _names(Warehouse, warehouse_ids)
+    customer_names = _names(Customer, {row.key_id for row in debtor_rows})
+
+    sale_ids_subquery = stats_query.order_by(None).with_entities(Sale.id).subquery()
+    top_n = max(1, min(top_n, 500))
+    total_items, top_products = _item_aggregates(sale_ids_subquery, top_n)
+
+    total_cost = _incoming_cost(stats_date_filter, start_date, end_date, location_filter,
+                                store_names, warehouse_names)
+
+    avg_order_value = total_revenue / total_sales_count if total_sales_count > 0 else 0
+    profit_margin = (total_profit / total_revenue * 100) if total_revenue > 0 else 0
+
+    # To'lov usullari
+    payment_methods = {}
+    for row in sale_rows:
+        if row.kind == 'method':
+            payment_methods[row.key_type or 'Unknown'] = {
+                'count': row.cnt,
+                'amount': float(row.revenue or 0)
+            }
+
+    # Joylashuvlar: avval do'konlar, keyin omborlar (bir xil nomlilar birlashtiriladi)
+    performance = {}
+    loc_pm_dict = {}
+    for loc_type, names in (('store', store_names), ('warehouse', warehouse_names)):
+        for row in location_rows:
+            if row.key_type != loc_type or row.key_id not in names:
+                continue
+            loc_name = names[row.key_id] or 'Noma\'lum'
+            perf = performance.setdefault((loc_type, loc_name), {
+                'name': loc_name, 'sales': 0, 'revenue': 0.0, 'profit': 0.0
+            })
+            perf['sales'] += row.cnt
+            perf['revenue'] += float(row.revenue or 0)
+            perf['profit'] += float(row.profit or 0)
+
+            sums = loc_pm_dict.setdefault((loc_type, loc_name), {
+                'cash': 0.0, 'click': 0.0, 'terminal': 0.0, 'debt': 0.0, 'profit': 0.0
+            })
+            sums['cash'] += float(row.cash or 0)
+            sums['click'] += float(row.click or 0)
+            sums['terminal'] += float(row.terminal or 0)
+            sums['debt'] += float(row.debt or 0)
+            sums['profit'] += float(row.profit or 0)
+
+    store_performance = sorted(performance.values(), key=lambda x: x['revenue'], reverse=True)
+
+    location_payment_breakdown = []
+    for (loc_type, loc_name), sums in loc_pm_dict.items():
+        payments = {method: sums[method] for method in ('cash', 'click', 'terminal', 'debt')
+                    if sums[method] > 0}
+        location_payment_breakdown.append({
+            'name': loc_name,
+            'location_type': loc_type,
+            'payments': payments,
+            'total': sum(payments.values()),
+            'profit': sums['profit']
+        })
+    location_payment_breakdown.sort(key=lambda x: x['total'], reverse=True)
+
+    # Har bir joylashuv uchun xarajatlar
+    total_expense_all = 0
+    if expenses_ok:
+        exp_by_loc = {}
+        for loc_type, loc_id, total_usd in expense_rows:
+            total_expense_all += float(total_usd or 0)
+            names = store_names if loc_type == 'store' else warehouse_names
+            if loc_type and loc_id is not None and loc_id in names:
+                exp_by_loc[(loc_type, names[loc_id])] = float(total_usd)
+
+        # Savdosi yo'q ammo xarajati bor joylashuvlarni ham qo'shish
+        existing_keys = {(item['location_type'], item['name']) for item in location_payment_breakdown}
+        for (loc_type, loc_name), exp_amt in exp_by_loc.items():
+            if (loc_type, loc_name) not in existing_keys:
+                location_payment_breakdown.append({
+                    'name': loc_name,
+                    'location_type': loc_type,
+                    'payments': {},
+                    'total': 0,
+                    'profit': 0,
+                    'expense': exp_amt
+                })
+        for item in location_payment_breakdown:
+            item['expense'] = exp_by_loc.get((item['location_type'], item['name']), 0)
+    else:
+        for item in location_payment_breakdown:
+            item['expense'] = 0
+
+    # Davrdagi qarzli mijozlar (debt_usd > 0 bo'lgan unique mijozlar)
+    debt_customers_count = len(debtor_rows)
+    debt_by_name = {}
+    for row in debtor_rows:
+        if row.key_id in customer_names:
+            name = customer_names[row.key_id]
+            debt_by_name[name] = debt_by_name.get(name, 0.0) + float(row.debt or 0)
+    debt_customers = [
+        {'customer_name': name or 'Noma\'lum', 'total_debt': total}
+        for name, total in sorted(debt_by_name.items(), key=lambda x: x[1], reverse=True)
+    ]
+
+    logger.info(f"📊 Jami savdolar: {total_sales_count}")
+    logger.info(f"💰 Jami daromad: ${total_revenue:.2f}")
+    logger.info(f"💵 Jami foyda: ${total_profit:.2f}")
+
+    return {
+        'total_sales': total_sales_count,  # Filtr qo'llanilgan barcha savdolar soni
+        'total_revenue': round(total_revenue, 2),
+        'total_profit': round(total_profit, 2),
+        'total_cost': round(total_cost, 2),
+        'total_items': total_items,
+        'avg_order_value': round(avg_order_value, 2),
+        'profit_margin': round(profit_margin, 2),
+        'payment_methods': payment_methods,
+        'top_products': top_products,
+        'store_performance': store_performance,
+        'location_payment_breakdown': location_payment_breakdown,
+        'total_expense': round(total_expense_all, 2),
+        'debt_customers_count': debt_customers_count,
+        'debt_customers': debt_customers
+    }
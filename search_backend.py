@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""PostgreSQL pg_trgm asosidagi qidiruv backend'i (mahsulot va mijozlar uchun).
+
+`products.search_name` va `customers.search_text` ustunlari `normalize_search()`
+natijasini saqlaydi va GIN trigram indekslari bilan qoplangan
+(migrations/add_trigram_search.sql). Shu sababli `LIKE '%so'z%'` filtrlari
+butun jadvalni skanerlamaydi, natijalar esa `similarity()` bo'yicha tartiblanadi.
+
+Ustunlar ORM eventlari orqali avtomatik sinxronlanadi. Mavjud qatorlarni
+to'ldirish (backfill) uchun:
+
+    python search_backend.py rebuild
+"""
+import logging
+import re
+import sys
+
+from sqlalchemy import event, func, or_, and_
+
+from database import db
+from models import Product, Customer
+from product_search import normalize_search
+
+logger = logging.getLogger(__name__)
+
+# Telefon raqami sifatida qabul qilinadigan so'z: "+998(90)", "123-45-67"
+_PHONE_WORD_RE = re.compile(r'^[\d+()\-]+$')
+_NON_DIGIT_RE = re.compile(r'\D')
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def product_search_text(name):
+    """products.search_name qiymati"""
+    return normalize_search(name or '')
+
+
+def customer_search_text(name, phone=None, email=None):
+    """customers.search_text qiymati: nom + telefon raqamlari + email"""
+    parts = [normalize_search(name or '')]
+    phone_digits = _NON_DIGIT_RE.sub('', phone or '')
+    if phone_digits:
+        parts.append(phone_digits)
+    if email:
+        parts.append(email.strip().lower())
+    return ' '.join(p for p in parts if p)
+
+
+def _query_words(search):
+    """Qidiruv so'rovini normalizatsiya qilingan so'zlarga ajratish"""
+    words = []
+    for word in normalize_search(search or '').split():
+        if _PHONE_WORD_RE.match(word) and any(ch.isdigit() for ch in word):
+            word = _NON_DIGIT_RE.sub('', word)
+        if word:
+            words.append(word)
+    return words
+
+
+# ---------- so'rov qismlari ----------
+
+def product_search_condition(search, include_barcode=True):
+    """Mahsulot qidiruvi uchun WHERE sharti (har bir so'z AND), so'z bo'lmasa None"""
+    words = _query_words(search)
+    if not words:
+        return None
+    conditions = []
+    for word in words:
+        name_match = Product.search_name.contains(word, autoescape=True)
+        if include_barcode:
+            conditions.append(or_(name_match, Product.barcode.contains(word, autoescape=True)))
+        else:
+            conditions.append(name_match)
+    return and_(*conditions)
+
+
+def product_similarity(search):
+    """Mahsulot nomining so'rovga o'xshashligi (ORDER BY ... DESC uchun)"""
+    return func.similarity(Product.search_name, normalize_search(search or ''))
+
+
+def customer_search_condition(search):
+    """Mijoz qidiruvi uchun WHERE sharti (nom, telefon, email), so'z bo'lmasa None"""
+    words = _query_words(search)
+    if not words:
+        return None
+    return and_(*[Customer.search_text.contains(word, autoescape=True) for word in words])
+
+
+def customer_similarity(search):
+    """Mijoz ma'lumotining so'rovga o'xshashligi (ORDER BY ... DESC uchun)"""
+    return func.similarity(Customer.search_text, ' '.join(_query_words(search)))
+
+
+# ---------- ustunlarni sinxronlash ----------
+
+@event.listens_for(Product, 'before_insert')
+@event.listens_for(Product, 'before_update')
+def _sync_product_search_name(mapper, connection, target):
+    target.search_name = product_search_text(target.name)
+
+
+@event.listens_for(Customer, 'before_insert')
+@event.listens_for(Customer, 'before_update')
+def _sync_customer_search_text(mapper, connection, target):
+    target.search_text = customer_search_text(target.name, target.phone, target.email)
+
+
+def rebuild_search_columns():
+    """Barcha mahsulot va mijozlar uchun qidiruv ustunlarini qayta hisoblash"""
+    updated = 0
+    for model, columns, compute, target in (
+        (Product, (Product.id, Product.name, Product.search_name),
+         lambda row: product_search_text(row[1]), 'search_name'),
+        (Customer, (Customer.id, Customer.name, Customer.phone, Customer.email, Customer.search_text),
+         lambda row: customer_search_text(row[1], row[2], row[3]), 'search_text'),
+    ):
+        last_id = 0
+        while True:
+            rows = db.session.query(*columns).filter(columns[0] > last_id).order_by(
+                columns[0]).limit(REBUILD_BATCH_SIZE).all()
+            if not rows:
+                break
+            changes = []
+            for row in rows:
+                value = compute(row)
+                if value != row[-1]:
+                    changes.append({'id': row[0], target: value})
+            if changes:
+                db.session.bulk_update_mappings(model, changes)
+                db.session.commit()
+                updated += len(changes)
+            last_id = rows[-1][0]
+        logger.info(f"🔎 {model.__tablename__}.{target} yangilandi")
+    return updated
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print("Foydalanish: python search_backend.py rebuild")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        count = rebuild_search_columns()
+        print(f"✅ {count} ta qator yangilandi")
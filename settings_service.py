@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Settings jadvali uchun worker ichidagi kesh.
+
+`settings` kalit/qiymat jadvali deyarli har joyda so'ralardi:
+`load_user_language` (har bir so'rovda), `inject_settings` (har bir
+sahifada yana o'sha til + stock_check_visible), qarz eslatmalari vaqti,
+Telegram bot tokeni va admin ID lari...
+
+Endi barcha qatorlar bitta SELECT bilan yuklanadi, shared_cache ga (barcha
+workerlar uchun umumiy nusxa) yoziladi va worker xotirasidan beriladi.
+Yangilanish:
+
+- Settings obyekti o'zgargan commit'dan keyin umumiy nusxa va joriy worker
+  keshi darhol tozalanadi;
+- PostgreSQL'da shu tranzaksiyada `pg_notify('settings_changed')` yuboriladi -
+  boshqa workerlar (va run_telegram_bot.py jarayoni) change_notifier
+  LISTEN oqimi orqali keshni tozalaydi va DB dan qayta yuklaydi (umumiy
+  nusxa commit'dan oldin yozilgan bo'lishi mumkin);
+- ehtiyot uchun kesh MAX_AGE_SECONDS dan keyin baribir qayta yuklanadi
+  (LISTEN ulanishi uzilgan bo'lsa ham);
+- har tozalash avlod (generation) hisoblagichini oshiradi: commit'dan oldin
+  boshlangan yuklash tugaguncha keshni tozalash kelgan bo'lsa, uning (eski)
+  natijasi keshga yozilmaydi.
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+import change_notifier
+import shared_cache
+from database import db
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'settings_changed'
+SHARED_KEY = 'settings'
+MAX_AGE_SECONDS = 300
+
+VALID_LANGUAGES = ('uz_latin', 'uz_cyrillic', 'ru')
+
+_CHANGED_KEY = 'settings_changed'
+
+
+class _SettingsCache:
+    def __init__(self):
+        self._values = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._refresh = False
+        # next() atomik - LISTEN oqimi va so'rov oqimi bir vaqtda oshira oladi
+        self._generations = itertools.count(1)
+        self._generation = 0
+
+    def invalidate(self, refresh=False):
+        """refresh=True - keyingi yuklash umumiy nusxani chetlab DB dan"""
+        if refresh:
+            self._refresh = True
+        self._generation = next(self._generations)
+        self._values = None
+
+    def values(self):
+        if self._pid != os.getpid():
+            # gunicorn fork'dan keyin - ota jarayon keshi meros qolmaydi
+            self._pid = os.getpid()
+            self._values = None
+        values = self._values
+        if values is None or time.monotonic() - self._loaded_at > MAX_AGE_SECONDS:
+            values = self._load()
+        return values
+
+    def _load(self):
+        with self._lock:
+            change_notifier.ensure_listening()
+            generation = self._generation
+            refresh, self._refresh = self._refresh, False
+            values, remaining = shared_cache.get_or_set(SHARED_KEY, _fetch_settings, MAX_AGE_SECONDS,
+                                                        refresh=refresh)
+            if generation != self._generation:
+                # Yuklash davomida tozalandi - qiymat commit'dan oldingi bo'lishi mumkin,
+                # faqat shu chaqiruv uchun qaytariladi, keyingisi qayta yuklaydi
+                logger.debug("⚙️ Sozlamalar yuklash davomida o'zgardi - natija keshlanmadi")
+                return values
+            self._values = values
+            # Umumiy nusxa qancha oldin yuklangan bo'lsa, worker ham shuncha kam ushlab turadi
+            self._loaded_at = time.monotonic() - (MAX_AGE_SECONDS - remaining)
+            return self._values
+
+
+def _fetch_settings():
+    rows = db.session.execute(text("SELECT key, value FROM settings")).all()
+    return {key: value for key, value in rows}
+
+
+_cache = _SettingsCache()
+change_notifier.subscribe(NOTIFY_CHANNEL, lambda payload: _cache.invalidate(refresh=True))
+
+
+# ---------- o'qish ----------
+
+def get(key, default=None):
+    """Sozlama qiymati (satr), yo'q yoki bo'sh bo'lsa default"""
+    value = _cache.values().get(key)
+    return value if value not in (None, '') else default
+
+
+def get_bool(key, default=False):
+    value = get(key)
+    if value is None:
+        return default
+    return str(value).lower() == 'true'
+
+
+def get_json(key, default=None):
+    value = get(key)
+    if value is None:
+        return default
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def all_settings():
+    """Barcha sozlamalar nusxasi {key: value}"""
+    return dict(_cache.values())
+
+
+def user_language(user_id):
+    """Foydalanuvchi saqlagan til (noto'g'ri yoki yo'q bo'lsa None)"""
+    if not user_id:
+        return None
+    value = _cache.values().get(f'user_language_{user_id}')
+    return value if value in VALID_LANGUAGES else None
+
+
+def invalidate():
+    """Umumiy nusxa va joriy worker keshini tozalash"""
+    shared_cache.delete(SHARED_KEY)
+    _cache.invalidate()
+
+
+# ---------- avtomatik bekor qilish ----------
+
+def _touches_settings(objects):
+    from models import Settings
+    return any(isinstance(obj, Settings) for obj in objects)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_settings_changes(session, flush_context):
+    if not session.info.get(_CHANGED_KEY) and _touches_settings(
+            list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info[_CHANGED_KEY] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_settings_changes(session):
+    # Commit'dagi oxirgi flush ham yig'ilishi uchun uni shu yerda bajaramiz
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    if not session.info.get(_CHANGED_KEY):
+        return
+    change_notifier.notify(session, NOTIFY_CHANNEL)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_settings_changes(session):
+    if session.info.pop(_CHANGED_KEY, None):
+        invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_settings_changes(session):
+    session.info.pop(_CHANGED_KEY, None)
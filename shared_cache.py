@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""Barcha gunicorn workerlari uchun umumiy kesh (tashqi servissiz).
+
+Ilova 3 ta sync worker bilan ishlaydi, keshlar esa har jarayonda alohida
+edi: har bir o'tkazib yuborish 3 marta DB ga borardi, workerlar turli
+ma'lumot ko'rsatardi, Flask-Limiter `memory://` limitlari amalda 3 barobar
+yumshoq edi. Endi barcha keshlar shu modul orqali bitta backend'da:
+
+- `get(key)`, `set(key, value, ttl, tags)`, `ttl(key)`, `delete(key)`,
+  `get_tagged(tag)`, `invalidate_tag(tag)`, `incr(key, amount, ttl)`;
+- `get_or_set(key, loader, ttl, tags, refresh)` - yo'q bo'lsa loader() bilan
+  yuklab yozish, (qiymat, qolgan_soniya) qaytaradi;
+- Flask-Limiter uchun `shared://` storage (SharedCacheStorage).
+
+Qiymatlar JSON ko'rinishida saqlanadi. Backend SHARED_CACHE_BACKEND bilan
+tanlanadi:
+
+- `sqlite` (standart) - SHARED_CACHE_PATH dagi WAL rejimidagi fayl, bitta
+  serverdagi barcha jarayonlar uchun umumiy;
+- `postgres` - app_cache UNLOGGED jadvali (bir nechta server uchun);
+- `memory` - faqat joriy jarayon (lokal ishlab chiqish).
+
+Backend xatoligi so'rovni buzmaydi: o'qish "topilmadi" deb, yozish esa
+e'tiborsiz qoldiriladi (incr bundan mustasno - limiter o'zi hal qiladi).
+
+Kalitlar avlod (generation) bilan saqlanadi: `delete(key)` qiymatni
+o'chirish bilan birga `gen:<key>` hisoblagichini oshiradi, `get_or_set` esa
+avlodni loader'dan OLDIN o'qib, natijani o'sha avlod kalitiga yozadi.
+Commit'dan oldin boshlangan (eski ma'lumotni o'qigan) loader o'z natijasini
+commit'dagi delete'dan keyin yozsa ham - u eski avlodda qoladi va hech kim
+o'qimaydi (bekor qilingan sessiya TTL davomida "tirilmaydi"). Qiymat TTL lari
+GENERATION_TTL_SECONDS dan qisqa bo'lishi kerak.
+
+Barcha kalit va teglar NAMESPACE bilan boshlanadi (standart: DB manzili va
+loyiha papkasidan hosil qilinadi, SHARED_CACHE_NAMESPACE bilan almashtiriladi),
+standart SQLite fayl nomida ham u bor - bitta serverdagi boshqa ilova yoki
+boshqa bazaga ulangan nusxa kesh yozuvlarini ko'ra olmaydi va buzmaydi.
+
+Tozalash: python shared_cache.py clear
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+
+from database import db, get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+BACKEND_NAME = os.getenv('SHARED_CACHE_BACKEND', 'sqlite').lower()
+
+
+def _default_namespace():
+    # Bir xil baza + bir xil kod papkasi = bitta ilova (barcha workerlari)
+    identity = '|'.join((os.getenv('DB_HOST', 'localhost'), os.getenv('DB_PORT', '5432'),
+                         os.getenv('DB_NAME', 'sayt_db'), os.path.dirname(os.path.abspath(__file__))))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:12]
+
+
+NAMESPACE = os.getenv('SHARED_CACHE_NAMESPACE') or _default_namespace()
+SQLITE_PATH = os.getenv('SHARED_CACHE_PATH',
+                        os.path.join(tempfile.gettempdir(), f'app_shared_cache_{NAMESPACE}.sqlite3'))
+
+# Avlod hisoblagichlari eng uzun qiymat TTL idan ancha uzoq yashashi kerak
+GENERATION_TTL_SECONDS = 7 * 24 * 3600
+
+# Muddati o'tgan yozuvlar har PURGE_EVERY ta yozuvda bir marta o'chiriladi
+PURGE_EVERY = 500
+
+
+# ---------- backendlar ----------
+
+class MemoryBackend:
+    """Joriy jarayon xotirasi (workerlar orasida umumiy emas)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._entries = {}
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        # Boshqa backendlar bilan bir xil: har o'qishda yangi nusxa
+        return json.loads(entry[0]), entry[1] - time.time()
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            self._entries[key] = (json.dumps(value), time.time() + ttl)
+            for tag in tags:
+                # dict (tartiblangan to'plam) - modul darajasidagi set() funksiyasi builtin'ni yopadi
+                self._tags.setdefault(tag, {})[key] = None
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_tagged(self, tag):
+        result = {}
+        for key in list(self._tags.get(tag, ())):
+            hit = self.get(key)
+            if hit is not None:
+                result[key] = hit[0]
+        return result
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._entries.pop(key, None)
+
+    def incr(self, key, amount, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                value, expires_at = amount, time.time() + ttl
+            else:
+                value, expires_at = int(json.loads(entry[0])) + amount, entry[1]
+            self._entries[key] = (json.dumps(value), expires_at)
+            return value, expires_at
+
+    def clear(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+            for tag in [tag for tag in self._tags if tag.startswith(prefix)]:
+                del self._tags[tag]
+
+
+class SQLiteBackend:
+    """Lokal fayl (WAL) - bitta serverdagi barcha jarayonlar uchun umumiy"""
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Ulanish fork'dan keyin meros qolmasligi kerak - jarayon/oqim bo'yicha alohida
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache_tags (
+                tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))""")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?",
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1] - time.time()
+
+    def set(self, key, value, ttl, tags=()):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), time.time() + ttl))
+            conn.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+            conn.executemany("INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                             [(tag, key) for tag in tags])
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self._purge(conn)
+
+    def _purge(self, conn):
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            conn.execute("DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache)")
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            conn.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+
+    def get_tagged(self, tag):
+        rows = self._conn().execute(
+            "SELECT c.key, c.value FROM cache c JOIN cache_tags t ON t.key = c.key "
+            "WHERE t.tag = ? AND c.expires_at > ?", (tag, time.time())).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def invalidate_tag(self, tag):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache_tags WHERE tag = ?)", (tag,))
+            conn.execute("DELETE FROM cache_tags WHERE tag = ?", (tag,))
+
+    def incr(self, key, amount, ttl):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            # IMMEDIATE - o'qish va yozish orasida boshqa jarayon hisoblagichni o'zgartira olmaydi
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires_at = amount, now + ttl
+            else:
+                value, expires_at = int(json.loads(row[0])) + amount, row[1]
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), expires_at))
+        return value, expires_at
+
+    def clear(self, prefix):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+            conn.execute("DELETE FROM cache_tags WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+
+class PostgresBackend:
+    """app_cache UNLOGGED jadvali (migrations/create_app_cache_table.sql)"""
+
+    name = 'postgres'
+
+    def __init__(self):
+        self._writes = 0
+
+    @staticmethod
+    def _now():
+        # expires_at - TIMESTAMP (vaqt zonasisiz), Toshkent vaqtida
+        return get_tashkent_time().replace(tzinfo=None)
+
+    def get(self, key):
+        now = self._now()
+        # Alohida ulanish - so'rov sessiyasi tranzaksiyasiga aralashmaslik uchun
+        with db.engine.connect() as conn:
+            row = conn.execute(text("SELECT value, expires_at FROM app_cache WHERE key = :key AND expires_at > :now"),
+                               {'key': key, 'now': now}).first()
+        if row is None:
+            return None
+        return json.loads(row.value), (row.expires_at - now).total_seconds()
+
+    def set(self, key, value, ttl, tags=()):
+        with db.engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO app_cache (key, value, expires_at, tags)
+                VALUES (:key, :value, :expires_at, :tags)
+                ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at, tags = EXCLUDED.tags
+            """), {'key': key, 'value': json.dumps(value), 'tags': list(tags),
+                   'expires_at': self._now() + timedelta(seconds=ttl)})
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                conn.execute(text("DELETE FROM app_cache WHERE expires_at <= :now"), {'now': self._now()})
+
+    def delete(self, key):
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM app_cache WHERE key = :key"), {'key': key})
+
+    def get_tagged(self, tag):
+        with db.engine.connect() as conn:
+            rows = conn.execute(text("SELECT key, value FROM app_cache WHERE :tag = ANY(tags) AND expires_at > :now"),
+                                {'tag': tag, 'now': self._now()}).all()
+        return {row.key: json.loads(row.value) for row in rows}
+
+    def invalidate_tag(self, tag):
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM app_cache WHERE :tag = ANY(tags)"), {'tag': tag})
+
+    def incr(self, key, amount, ttl):
+        now = self._now()
+        with db.engine.begin() as conn:
+            row = conn.execute(text("""
+                INSERT INTO app_cache (key, value, expires_at)
+                VALUES (:key, :amount, :expires_at)
+                ON CONFLICT (key) DO UPDATE
+                SET value = CASE WHEN app_cache.expires_at > :now
+                                 THEN (app_cache.value::bigint + :amount_int)::text
+                                 ELSE EXCLUDED.value END,
+                    expires_at = CASE WHEN app_cache.expires_at > :now
+                                      THEN app_cache.expires_at
+                                      ELSE EXCLUDED.expires_at END
+                RETURNING value, expires_at
+            """), {'key': key, 'amount': str(amount), 'amount_int': amount, 'now': now,
+                   'expires_at': now + timedelta(seconds=ttl)}).one()
+        return int(row.value), time.time() + (row.expires_at - now).total_seconds()
+
+    def clear(self, prefix):
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM app_cache WHERE left(key, :length) = :prefix"),
+                         {'length': len(prefix), 'prefix': prefix})
+
+
+_state = {'pid': None, 'backend': None}
+_lock = threading.Lock()
+
+
+def backend():
+    """Joriy jarayon backend'i (lazy, fork'dan keyin qayta yaratiladi)"""
+    if _state['pid'] != os.getpid():
+        with _lock:
+            if _state['pid'] != os.getpid():
+                if BACKEND_NAME == 'postgres':
+                    _state['backend'] = PostgresBackend()
+                elif BACKEND_NAME == 'memory':
+                    _state['backend'] = MemoryBackend()
+                else:
+                    _state['backend'] = SQLiteBackend(SQLITE_PATH)
+                _state['pid'] = os.getpid()
+    return _state['backend']
+
+
+# ---------- kalitlar ----------
+
+def _ns(name):
+    return f'{NAMESPACE}:{name}'
+
+
+def _generation(key):
+    hit = backend().get(_ns(f'gen:{key}'))
+    return int(hit[0]) if hit is not None else 0
+
+
+def _stored_key(key, generation):
+    return _ns(f'{key}#{generation}')
+
+
+def _public_key(stored_key):
+    # 'ns:key#gen' -> 'key'
+    return stored_key[len(NAMESPACE) + 1:].rpartition('#')[0]
+
+
+def _current_key(key):
+    return _stored_key(key, _generation(key))
+
+
+# ---------- API ----------
+
+def get(key, default=None):
+    """Keshdagi qiymat yoki default"""
+    try:
+        hit = backend().get(_current_key(key))
+    except Exception as e:
+        logger.debug(f"Umumiy kesh o'qilmadi ({key}): {e}")
+        return default
+    return hit[0] if hit is not None else default
+
+
+def ttl(key):
+    """Qolgan soniyalar (yo'q bo'lsa None)"""
+    try:
+        hit = backend().get(_current_key(key))
+    except Exception as e:
+        logger.debug(f"Umumiy kesh o'qilmadi ({key}): {e}")
+        return None
+    return hit[1] if hit is not None else None
+
+
+def set(key, value, ttl, tags=()):
+    """JSON ga aylantiriladigan qiymatni ttl soniyaga yozish"""
+    try:
+        _set(_current_key(key), value, ttl, tags)
+    except Exception as e:
+        logger.debug(f"Umumiy kesh yozilmadi ({key}): {e}")
+
+
+def _set(stored_key, value, ttl, tags):
+    backend().set(stored_key, value, ttl, tuple(_ns(tag) for tag in tags))
+
+
+def delete(key):
+    """Qiymatni o'chirish va avlodni oshirish - oldin boshlangan get_or_set yozuvi ko'rinmaydi"""
+    try:
+        generation, _ = backend().incr(_ns(f'gen:{key}'), 1, GENERATION_TTL_SECONDS)
+        backend().delete(_stored_key(key, generation - 1))
+    except Exception as e:
+        logger.warning(f"⚠️ Umumiy kesh o'chirilmadi ({key}): {e}")
+
+
+def get_tagged(tag):
+    """Shu teg bilan yozilgan (muddati o'tmagan) barcha qiymatlar {key: value}"""
+    try:
+        return {_public_key(key): value for key, value in backend().get_tagged(_ns(tag)).items()}
+    except Exception as e:
+        logger.debug(f"Umumiy kesh tegi o'qilmadi ({tag}): {e}")
+        return {}
+
+
+def invalidate_tag(tag):
+    """Shu teg bilan yozilgan barcha kalitlarni o'chirish"""
+    try:
+        backend().invalidate_tag(_ns(tag))
+    except Exception as e:
+        logger.debug(f"Umumiy kesh tegi o'chirilmadi ({tag}): {e}")
+
+
+def incr(key, amount=1, ttl=60):
+    """Atomik hisoblagich: (yangi_qiymat, tugash_vaqti_epoch). Muddat birinchi incr da belgilanadi"""
+    return backend().incr(_ns(key), amount, ttl)
+
+
+def get_or_set(key, loader, ttl, tags=(), refresh=False):
+    """(qiymat, qolgan_soniya). Yo'q bo'lsa (yoki refresh=True) loader() natijasi yoziladi.
+
+    Avlod loader'dan oldin olinadi: loader davomida delete(key) bo'lsa,
+    natija faqat shu chaqiruvga qaytadi (eski avlodga yoziladi).
+    """
+    try:
+        stored_key = _current_key(key)
+        hit = None if refresh else backend().get(stored_key)
+    except Exception as e:
+        logger.debug(f"Umumiy kesh o'qilmadi ({key}): {e}")
+        return loader(), ttl
+    if hit is not None:
+        return hit
+    value = loader()
+    try:
+        _set(stored_key, value, ttl, tags)
+    except Exception as e:
+        logger.debug(f"Umumiy kesh yozilmadi ({key}): {e}")
+    return value, ttl
+
+
+def clear():
+    """Joriy NAMESPACE ning barcha yozuvlarini o'chirish"""
+    backend().clear(_ns(''))
+
+
+# ---------- Flask-Limiter storage ----------
+
+try:
+    from limits.storage import Storage
+except ImportError:  # pragma: no cover - limits Flask-Limiter bilan birga o'rnatiladi
+    Storage = None
+
+if Storage is not None:
+    class SharedCacheStorage(Storage):
+        """Flask-Limiter uchun `shared://` - limitlar barcha workerlarda umumiy"""
+
+        STORAGE_SCHEME = ['shared']
+
+        def __init__(self, uri=None, wrap_exceptions=False, **options):
+            super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+        @property
+        def base_exceptions(self):
+            return Exception
+
+        def _key(self, key):
+            return _ns(f'ratelimit:{key}')
+
+        def incr(self, key, expiry, elastic_expiry=False, amount=1):
+            return backend().incr(self._key(key), amount, int(expiry))[0]
+
+        def get(self, key):
+            hit = backend().get(self._key(key))
+            return int(hit[0]) if hit is not None else 0
+
+        def get_expiry(self, key):
+            hit = backend().get(self._key(key))
+            return time.time() + (hit[1] if hit is not None else 0)
+
+        def check(self):
+            try:
+                backend().get(self._key('check'))
+                return True
+            except Exception:
+                return False
+
+        def reset(self):
+            return None
+
+        def clear(self, key):
+            backend().delete(self._key(key))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'clear':
+        print("Foydalanish: python shared_cache.py clear")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        clear()
+        print(f"✅ Umumiy kesh tozalandi ({backend().name}, {NAMESPACE})")
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""O'zgarishlar oqimi (change feed) - Server-Sent Events serveri.
+
+Alohida, yengil asyncio jarayoni (change-feed.service): sync gunicorn
+workerlari uzoq ochiq turadigan ulanishlarni ushlab turolmaydi, bu yerda
+esa bitta jarayon yuzlab brauzerga xizmat qiladi.
+
+- PostgreSQL ga bitta ulanish: `LISTEN change_feed` (change_feed.publish
+  commit'da NOTIFY qiladi);
+- `GET /events?topics=transfers,stock_check` - SSE oqimi. Har bir xabar:
+  `event: change` + `data: {"topic": ..., ...}`;
+- ulanish: Flask session cookie imzosi (SECRET_KEY) tekshiriladi -
+  `user_id` bo'lmasa 401. Xabarlarda ma'lumot yo'q, sahifa ma'lumotni
+  odatdagi API dan oladi;
+- har HEARTBEAT_SECONDS da izoh qatori (nginx/proxy ulanishni yopmasin),
+  MAX_STREAM_SECONDS dan keyin oqim yopiladi - brauzer qayta ulanadi va
+  cookie qayta tekshiriladi;
+- LISTEN ulanishi uzilsa - qayta ulanadi va barcha mijozlarga `resync`
+  (oraliqdagi xabarlar yo'qolgan bo'lishi mumkin).
+
+nginx: `location /events` -> 127.0.0.1:SSE_PORT, `proxy_buffering off`.
+
+Ishga tushirish: python sse_server.py
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+from http.cookies import SimpleCookie
+from pathlib import Path
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+sys.path.insert(0, str(Path(__file__).parent))
+load_dotenv()
+
+from change_feed import CHANNEL, TOPICS  # noqa: E402
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('sse_server')
+
+SSE_HOST = os.getenv('SSE_HOST', '127.0.0.1')
+SSE_PORT = int(os.getenv('SSE_PORT', '5002'))
+MAX_CLIENTS = int(os.getenv('SSE_MAX_CLIENTS', '500'))
+
+HEARTBEAT_SECONDS = 25
+MAX_STREAM_SECONDS = 3600
+RETRY_MS = 5000
+CLIENT_QUEUE_SIZE = 100
+HEADER_TIMEOUT_SECONDS = 10
+MAX_HEADER_BYTES = 16384
+LISTEN_RETRY_SECONDS = 5
+SESSION_MAX_AGE_SECONDS = 7200  # app.py: PERMANENT_SESSION_LIFETIME
+
+_clients = set()
+
+
+class Client:
+    """Bitta brauzer oqimi"""
+
+    def __init__(self, user_id, topics):
+        self.user_id = user_id
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.overflowed = False
+
+    def wants(self, topic):
+        return topic == 'resync' or topic.split(':', 1)[0] in self.topics
+
+    def offer(self, topic, data):
+        if not self.wants(topic):
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Sekin mijoz - oqim yopiladi, qayta ulanganda hammasini qayta yuklaydi
+            self.overflowed = True
+
+
+def _broadcast(payload):
+    try:
+        data = json.loads(payload)
+        topic = data['topic']
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"⚠️ Noto'g'ri xabar: {payload[:200]}")
+        return
+    for client in list(_clients):
+        client.offer(topic, payload)
+
+
+# ---------- PostgreSQL LISTEN ----------
+
+def _connect_listener():
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=os.getenv('DB_PORT', '5432'),
+        dbname=os.getenv('DB_NAME', 'sayt_db'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD'),
+        connect_timeout=10,
+    )
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cursor:
+        cursor.execute(f'LISTEN "{CHANNEL}"')
+    return conn
+
+
+async def listen_forever():
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        lost = loop.create_future()
+        try:
+            conn = await loop.run_in_executor(None, _connect_listener)
+
+            def on_readable():
+                try:
+                    conn.poll()
+                except Exception as e:
+                    if not lost.done():
+                        lost.set_exception(e)
+                    return
+                while conn.notifies:
+                    _broadcast(conn.notifies.pop(0).payload)
+
+            loop.add_reader(conn.fileno(), on_readable)
+            logger.info(f"✅ LISTEN {CHANNEL} - ulandi")
+            # Ulanish o'rnatilguncha o'tgan o'zgarishlar ham hisobga olinsin
+            _broadcast(json.dumps({'topic': 'resync'}))
+            await lost
+        except Exception as e:
+            logger.warning(f"⚠️ LISTEN ulanishi uzildi: {e}")
+        finally:
+            if conn is not None:
+                try:
+                    loop.remove_reader(conn.fileno())
+                except Exception:
+                    pass
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        await asyncio.sleep(LISTEN_RETRY_SECONDS)
+
+
+# ---------- HTTP / SSE ----------
+
+def _session_serializer():
+    cookie_app = Flask('sse_server')
+    cookie_app.secret_key = os.getenv('SECRET_KEY')
+    return SecureCookieSessionInterface().get_signing_serializer(cookie_app)
+
+
+_serializer = None
+
+
+def authenticate(cookie_header):
+    """Flask session cookie dan user_id (imzo va muddat tekshiriladi) yoki None"""
+    global _serializer
+    if _serializer is None:
+        _serializer = _session_serializer()
+    if _serializer is None or not cookie_header:
+        return None
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except Exception:
+        return None
+    morsel = cookies.get('session')
+    if morsel is None:
+        return None
+    try:
+        data = _serializer.loads(morsel.value, max_age=SESSION_MAX_AGE_SECONDS)
+    except Exception:
+        return None
+    return data.get('user_id')
+
+
+async def _read_request(reader):
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEADER_TIMEOUT_SECONDS)
+    if len(head) > MAX_HEADER_BYTES:
+        raise ValueError('header too large')
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+async def _respond(writer, status, body=''):
+    writer.write((
+        f'HTTP/1.1 {status}\r\n'
+        'Content-Type: text/plain; charset=utf-8\r\n'
+        f'Content-Length: {len(body.encode())}\r\n'
+        'Connection: close\r\n\r\n'
+        f'{body}'
+    ).encode())
+    await writer.drain()
+
+
+async def _stream(reader, writer, client):
+    writer.write((
+        'HTTP/1.1 200 OK\r\n'
+        'Content-Type: text/event-stream\r\n'
+        'Cache-Control: no-cache\r\n'
+        'X-Accel-Buffering: no\r\n'
+        'Connection: keep-alive\r\n\r\n'
+        f'retry: {RETRY_MS}\n\n'
+    ).encode())
+    await writer.drain()
+
+    # Brauzer so'rovdan keyin hech narsa yubormaydi - o'qish tugashi = ulanish yopildi
+    closed = asyncio.ensure_future(reader.read(1))
+    deadline = time.monotonic() + MAX_STREAM_SECONDS
+    try:
+        while time.monotonic() < deadline and not client.overflowed:
+            getter = asyncio.ensure_future(client.queue.get())
+            done, _ = await asyncio.wait({getter, closed}, timeout=HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                writer.write(f'event: change\ndata: {getter.result()}\n\n'.encode())
+            else:
+                getter.cancel()
+                if closed in done:
+                    return
+                writer.write(b': ping\n\n')
+            await writer.drain()
+    finally:
+        closed.cancel()
+
+
+async def handle_connection(reader, writer):
+    client = None
+    try:
+        method, target, headers = await _read_request(reader)
+        url = urllib.parse.urlsplit(target)
+        if method != 'GET' or url.path != '/events':
+            await _respond(writer, '404 Not Found', 'Not found\n')
+            return
+        user_id = authenticate(headers.get('cookie'))
+        if not user_id:
+            await _respond(writer, '401 Unauthorized', 'Unauthorized\n')
+            return
+        if len(_clients) >= MAX_CLIENTS:
+            await _respond(writer, '503 Service Unavailable', 'Busy\n')
+            return
+
+        requested = urllib.parse.parse_qs(url.query).get('topics', [''])[0].split(',')
+        topics = {topic for topic in requested if topic in TOPICS} or set(TOPICS)
+        client = Client(user_id, topics)
+        _clients.add(client)
+        await _stream(reader, writer, client)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.warning(f"⚠️ SSE ulanish xatosi: {e}")
+    finally:
+        if client is not None:
+            _clients.discard(client)
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+async def main():
+    if not os.getenv('SECRET_KEY'):
+        raise SystemExit("❌ SECRET_KEY o'rnatilmagan (.env)")
+    server = await asyncio.start_server(handle_connection, SSE_HOST, SSE_PORT)
+    logger.info(f"📡 SSE server: http://{SSE_HOST}:{SSE_PORT}/events")
+    listener = asyncio.create_task(listen_forever())
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            listener.cancel()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("⏹️ SSE server to'xtatildi")
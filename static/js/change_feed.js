@@ -0,0 +1,90 @@
+// O'zgarishlar oqimi (SSE) - sse_server.py dan /events
+//
+//   ChangeFeed.on('transfers', (event) => loadPendingTransfers());
+//   setInterval(() => { if (!ChangeFeed.isLive()) loadPendingTransfers(); }, 10000);
+//
+// Oqim ulangan paytda polling to'xtaydi, sahifa faqat xabar kelganda yangilanadi.
+// Ulanish (yoki qayta ulanish) da barcha handlerlar {topic: 'resync'} bilan
+// chaqiriladi - uzilish paytidagi o'zgarishlar o'tkazib yuborilmasin.
+// EventSource bo'lmasa yoki server ishlamasa - odatdagi polling davom etadi.
+window.ChangeFeed = (function() {
+    const handlers = {};
+    const RECONNECT_MIN_MS = 5000;
+    const RECONNECT_MAX_MS = 60000;
+    let source = null;
+    let live = false;
+    let connectTimer = null;
+    let reconnectDelay = RECONNECT_MIN_MS;
+
+    function dispatch(topic, event) {
+        const base = topic.split(':')[0];
+        Object.keys(handlers).forEach(name => {
+            if (topic === 'resync' || name === base) {
+                handlers[name].forEach(handler => {
+                    try {
+                        handler(event);
+                    } catch (error) {
+                        console.error('ChangeFeed handler xatosi:', error);
+                    }
+                });
+            }
+        });
+    }
+
+    function connect() {
+        connectTimer = null;
+        if (!window.EventSource || source) {
+            return;
+        }
+        const topics = Object.keys(handlers).join(',');
+        source = new EventSource('/events?topics=' + encodeURIComponent(topics));
+
+        source.onopen = () => {
+            const wasLive = live;
+            live = true;
+            reconnectDelay = RECONNECT_MIN_MS;
+            if (!wasLive) {
+                dispatch('resync', { topic: 'resync' });
+            }
+        };
+
+        source.addEventListener('change', (message) => {
+            let event;
+            try {
+                event = JSON.parse(message.data);
+            } catch (error) {
+                return;
+            }
+            dispatch(event.topic, event);
+        });
+
+        source.onerror = () => {
+            live = false;
+            // CLOSED - brauzer o'zi qayta ulanmaydi (masalan, 401/503): keyinroq qayta urinish
+            if (source.readyState === EventSource.CLOSED) {
+                source = null;
+                connectTimer = setTimeout(connect, reconnectDelay);
+                reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+            }
+        };
+    }
+
+    function on(topic, handler) {
+        const isNewTopic = !handlers[topic];
+        (handlers[topic] = handlers[topic] || []).push(handler);
+        if (isNewTopic && source) {
+            // Yangi mavzu - oqimni shu mavzu bilan qayta ochish
+            source.close();
+            source = null;
+            live = false;
+        }
+        if (!connectTimer && !source) {
+            connectTimer = setTimeout(connect, 0);
+        }
+    }
+
+    return {
+        on: on,
+        isLive: () => live
+    };
+})();
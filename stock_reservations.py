@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""Korzina (cart) bo'yicha stock rezervlari.
+
+Eski oqimda savdo ekrani har bir korzina qatori uchun alohida
+`/api/reserve-stock` / `/api/return-stock` chaqirardi - 40 ta mahsulot
+40 ta HTTP so'rov, 40 ta qator qulfi va 40 ta commit. Tashlab ketilgan
+korzinalar (yopilgan tab, o'chgan telefon) stock'i esa hech qachon qaytmasdi.
+
+Endi savdo ekrani `/api/reserve-stock/batch` ga butun korzinaning KERAKLI
+holatini yuboradi (mutlaq miqdorlar; pending savdo ushlab turgan miqdordan
+ortig'i). `apply_cart()` mavjud rezervlar bilan farqni hisoblab, faqat
+o'zgargan qatorlarni bitta tranzaksiyada ayiradi/qaytaradi:
+
+- qulflash tartibi doimiy: avval korzina rezervlari, keyin stock qatorlari
+  (store -> warehouse, har birida (location_id, product_id) bo'yicha) -
+  parallel korzinalar bir-birini deadlock qilmaydi;
+- har chaqiruvda korzina muddati (expires_at) uzaytiriladi;
+- muddati o'tgan rezervlarni `release_expired()` qaytaradi (scheduler har
+  daqiqada, yoki `python stock_reservations.py sweep`); qaytarilgan miqdor
+  qatorning `released_quantity` sida qoladi.
+
+Qatorma-qator `/api/reserve-stock` / `/api/return-stock` ham `cart_id` bilan
+chaqirilishi mumkin (savdo ekrani pending savdo ushlab turgan miqdorni
+qaytarishda): `track_line()` stock farqini shu korzina rezerviga yozadi.
+
+Savdo yaratilganda `consume_cart()` rezervlarni sotilgan miqdorlar bilan
+solishtiradi (kamini ayiradi, ortig'ini qaytaradi) va o'chiradi. Pending
+savdo saqlanganda yoki tahrirlangan savdo yakunlanganda (qolgan stock
+allaqachon savdoga tegishli) rezervlar o'chiriladi, sweeper qaytargan
+miqdor esa stock'dan qayta ayiriladi.
+"""
+import logging
+import os
+import sys
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import tuple_
+
+from database import db, get_tashkent_time
+
+logger = logging.getLogger(__name__)
+
+# Korzina rezervi muddati (daqiqa) - har batch chaqiruvida yangilanadi
+RESERVATION_TTL_MINUTES = int(os.getenv('STOCK_RESERVATION_TTL_MINUTES', '30'))
+
+# Sweeper bir tranzaksiyada qaytaradigan maksimal rezervlar soni
+SWEEP_BATCH_SIZE = 500
+
+# Qaytarilgan (quantity = 0) qatorlar tashlab ketilgan korzina deb shuncha vaqtdan keyin o'chiriladi
+RELEASED_RETENTION = timedelta(days=1)
+
+LOCATION_TYPES = ('store', 'warehouse')
+
+_ZERO = Decimal('0')
+
+
+class ReservationError(ValueError):
+    """Rezervni bajarib bo'lmadi (noto'g'ri ma'lumot yoki stock yetarli emas)"""
+
+    def __init__(self, message, lines=None):
+        super().__init__(message)
+        self.lines = lines or []
+
+
+# ---------- yordamchi ----------
+
+def normalize_lines(items):
+    """Korzina qatorlarini {(location_type, location_id, product_id): miqdor} ga aylantirish.
+
+    Bir xil mahsulot/joylashuv qatorlari qo'shiladi, 0 miqdorlilar tashlanadi.
+    """
+    lines = {}
+    for item in items or []:
+        try:
+            product_id = int(item.get('product_id'))
+            location_id = int(item.get('location_id'))
+            quantity = Decimal(str(item.get('quantity', 0)))
+        except (TypeError, ValueError, InvalidOperation):
+            raise ReservationError(f"Korzina qatori noto'g'ri: {item}")
+        location_type = item.get('location_type')
+        if location_type not in LOCATION_TYPES:
+            raise ReservationError(f"Noto'g'ri joylashuv turi: {location_type}")
+        if quantity < 0:
+            raise ReservationError(f"Miqdor manfiy bo'lishi mumkin emas: {item}")
+        key = (location_type, location_id, product_id)
+        lines[key] = lines.get(key, _ZERO) + quantity
+    return {key: qty for key, qty in lines.items() if qty > 0}
+
+
+def _lock_stocks(keys):
+    """Stock qatorlarini doimiy tartibda FOR UPDATE bilan qulflash.
+
+    Qaytaradi: {(location_type, location_id, product_id): StoreStock|WarehouseStock}
+    """
+    from models import StoreStock, WarehouseStock
+
+    stocks = {}
+    for location_type, model, location_col in (
+            ('store', StoreStock, StoreStock.store_id),
+            ('warehouse', WarehouseStock, WarehouseStock.warehouse_id)):
+        pairs = sorted((loc_id, prod_id) for loc_type, loc_id, prod_id in keys
+                       if loc_type == location_type)
+        if not pairs:
+            continue
+        rows = model.query.filter(
+            tuple_(location_col, model.product_id).in_(pairs)
+        ).order_by(location_col, model.product_id, model.id).with_for_update().all()
+        for row in rows:
+            # Takroriy stock qatori bo'lsa birinchisi ishlatiladi (eski endpointlar kabi)
+            stocks.setdefault((location_type, getattr(row, location_col.key), row.product_id), row)
+    return stocks
+
+
+def _new_stock(key, quantity):
+    from models import StoreStock, WarehouseStock
+
+    location_type, location_id, product_id = key
+    if location_type == 'store':
+        stock = StoreStock(store_id=location_id, product_id=product_id, quantity=quantity)
+    else:
+        stock = WarehouseStock(warehouse_id=location_id, product_id=product_id, quantity=quantity)
+    db.session.add(stock)
+    return stock
+
+
+def _apply_deltas(deltas):
+    """Stock'ni farqlar bo'yicha o'zgartirish: musbat - ayirish, manfiy - qaytarish.
+
+    Yetmagan qatorlar bo'lsa hech narsa o'zgartirilmaydi va ReservationError.
+    """
+    from models import Product
+
+    changed = sorted(key for key, delta in deltas.items() if delta != 0)
+    if not changed:
+        return {}
+    stocks = _lock_stocks(changed)
+
+    shortages = []
+    for key in changed:
+        delta = deltas[key]
+        stock = stocks.get(key)
+        available = Decimal(str(stock.quantity)) if stock else _ZERO
+        if delta > 0 and available < delta:
+            shortages.append({
+                'location_type': key[0],
+                'location_id': key[1],
+                'product_id': key[2],
+                'available': float(available),
+                'required': float(delta),
+            })
+    if shortages:
+        names = dict(db.session.query(Product.id, Product.name).filter(
+            Product.id.in_({s['product_id'] for s in shortages})).all())
+        for shortage in shortages:
+            shortage['product_name'] = names.get(shortage['product_id'])
+        details = ', '.join(
+            f"{s['product_name'] or s['product_id']} (mavjud: {s['available']}, kerak: {s['required']})"
+            for s in shortages)
+        raise ReservationError(f"Yetarli stock yo'q: {details}", shortages)
+
+    remaining = {}
+    for key in changed:
+        stock = stocks.get(key)
+        if stock is None:
+            # Faqat qaytarishda (delta < 0) bo'lishi mumkin - eski return-stock kabi yangi qator
+            stock = _new_stock(key, -deltas[key])
+        else:
+            stock.quantity = Decimal(str(stock.quantity)) - deltas[key]
+        remaining[key] = stock.quantity
+    return remaining
+
+
+def _lock_cart(cart_id):
+    from models import StockReservation
+
+    return StockReservation.query.filter_by(cart_id=cart_id).order_by(
+        StockReservation.location_type, StockReservation.location_id,
+        StockReservation.product_id).with_for_update().all()
+
+
+def _reservation_key(reservation):
+    return (reservation.location_type, reservation.location_id, reservation.product_id)
+
+
+# ---------- korzina ----------
+
+def apply_cart(cart_id, items, user_id=None, ttl_minutes=None):
+    """Korzina rezervlarini `items` dagi mutlaq miqdorlarga keltirish.
+
+    Commit QILMAYDI - chaqiruvchi idempotency yozuvi bilan birga commit qiladi.
+    Qaytaradi: {'expires_at', 'lines': [...], 'changed': n}
+    """
+    from models import StockReservation
+
+    if not cart_id:
+        raise ReservationError('cart_id kerak')
+    desired = normalize_lines(items)
+    existing = {_reservation_key(r): r for r in _lock_cart(cart_id)}
+
+    reserved = {key: Decimal(str(r.quantity)) for key, r in existing.items()}
+    deltas = {key: desired.get(key, _ZERO) - reserved.get(key, _ZERO)
+              for key in set(desired) | set(existing)}
+    remaining = _apply_deltas(deltas)
+
+    now = get_tashkent_time()
+    expires_at = now + timedelta(minutes=ttl_minutes or RESERVATION_TTL_MINUTES)
+    lines = []
+    for key in sorted(set(desired) | set(existing)):
+        reservation = existing.get(key)
+        quantity = desired.get(key)
+        if not quantity:
+            db.session.delete(reservation)
+            continue
+        if reservation is None:
+            reservation = StockReservation(
+                cart_id=cart_id, location_type=key[0], location_id=key[1],
+                product_id=key[2], user_id=user_id, created_at=now)
+            db.session.add(reservation)
+        reservation.quantity = quantity
+        # Mutlaq holat qayta rezerv qilindi - sweeper qaytargan miqdor endi kerak emas
+        reservation.released_quantity = _ZERO
+        reservation.expires_at = expires_at
+        line = {
+            'location_type': key[0],
+            'location_id': key[1],
+            'product_id': key[2],
+            'quantity': float(quantity),
+        }
+        if key in remaining:
+            line['remaining_stock'] = float(remaining[key])
+        lines.append(line)
+
+    changed = len(remaining)
+    logger.debug(f"🛒 Korzina {cart_id}: {len(lines)} qator, {changed} ta stock o'zgardi")
+    return {
+        'cart_id': cart_id,
+        'expires_at': expires_at.isoformat() if lines else None,
+        'lines': lines,
+        'changed': changed,
+    }
+
+
+def track_line(cart_id, location_type, location_id, product_id, delta, user_id=None, ttl_minutes=None):
+    """Qatorma-qator rezerv/qaytarishni korzina rezerviga yozish (commit qilmaydi).
+
+    Stock'ni chaqiruvchi endpoint o'zgartiradi; bu funksiya faqat korzina
+    qulfini oladi (stock qatorlaridan OLDIN - apply_cart va sweeper bilan bir
+    xil tartib) va rezerv miqdorini delta ga o'zgartiradi. Manfiy natija 0 ga
+    tenglanadi: korzinada savdoga o'tgan qator qaytarilishi mumkin; ortig'i
+    sweeper qaytargan miqdordan (released_quantity) ayiriladi.
+    Qaytaradi: korzina muddati (expires_at)
+    """
+    from models import StockReservation
+
+    if not cart_id:
+        raise ReservationError('cart_id kerak')
+    if location_type not in LOCATION_TYPES:
+        raise ReservationError(f"Noto'g'ri joylashuv turi: {location_type}")
+    try:
+        key = (location_type, int(location_id), int(product_id))
+        delta = Decimal(str(delta))
+    except (TypeError, ValueError, InvalidOperation):
+        raise ReservationError(f"Korzina qatori noto'g'ri: {product_id} / {location_id}")
+
+    reservations = _lock_cart(cart_id)
+    existing = {_reservation_key(r): r for r in reservations}
+
+    now = get_tashkent_time()
+    expires_at = now + timedelta(minutes=ttl_minutes or RESERVATION_TTL_MINUTES)
+    reservation = existing.get(key)
+    total = (Decimal(str(reservation.quantity)) if reservation else _ZERO) + delta
+    quantity = max(_ZERO, total)
+    released = _ZERO
+    if reservation is not None:
+        released = Decimal(str(reservation.released_quantity or 0))
+        if total < 0:
+            released = max(_ZERO, released + total)
+    if reservation is None and quantity > 0:
+        reservation = StockReservation(
+            cart_id=cart_id, location_type=key[0], location_id=key[1],
+            product_id=key[2], user_id=user_id, created_at=now)
+        db.session.add(reservation)
+        reservations.append(reservation)
+    elif reservation is not None and quantity == 0 and released == 0:
+        db.session.delete(reservation)
+        reservations.remove(reservation)
+        reservation = None
+    if reservation is not None:
+        reservation.quantity = quantity
+        reservation.released_quantity = released
+
+    # Korzinaning barcha qatorlari muddati birga uzayadi
+    for row in reservations:
+        row.expires_at = expires_at
+    return expires_at
+
+
+def release_cart(cart_id):
+    """Korzinaning barcha rezervlarini stock'ga qaytarish (commit qilmaydi)"""
+    return apply_cart(cart_id, [])
+
+
+def consume_cart(cart_id, sold_lines=None):
+    """Savdo yaratilganda korzina rezervlarini yakunlash (commit qilmaydi).
+
+    sold_lines berilsa rezervlar sotilgan miqdorlarga keltiriladi: rezerv
+    muddati o'tib qaytarilgan bo'lsa kami ayiriladi, ortig'i stock'ga qaytadi.
+    sold_lines yo'q (pending/tahrirlangan savdo - qolgan stock allaqachon
+    savdoniki) bo'lsa, sweeper qaytargan miqdorlar stock'dan qayta ayiriladi.
+    Keyin rezerv yozuvlari o'chiriladi - sweeper sotilgan stock'ni qaytarmaydi.
+    """
+    if not cart_id:
+        return 0
+    reservations = _lock_cart(cart_id)
+    if sold_lines is not None:
+        sold = normalize_lines(sold_lines)
+        reserved = {_reservation_key(r): Decimal(str(r.quantity)) for r in reservations}
+        deltas = {key: sold.get(key, _ZERO) - reserved.get(key, _ZERO)
+                  for key in set(sold) | set(reserved)}
+    else:
+        deltas = {_reservation_key(r): Decimal(str(r.released_quantity or 0)) for r in reservations}
+    _apply_deltas(deltas)
+    for reservation in reservations:
+        db.session.delete(reservation)
+    return len(reservations)
+
+
+# ---------- sweeper ----------
+
+def release_expired(limit=SWEEP_BATCH_SIZE):
+    """Muddati o'tgan rezervlarni stock'ga qaytarish.
+
+    Band (boshqa tranzaksiya qulflagan) korzinalar SKIP LOCKED bilan
+    o'tkazib yuboriladi - ular keyingi aylanishda qaytariladi. Qator
+    o'chirilmaydi: qaytarilgan miqdor released_quantity ga o'tadi (korzina
+    keyin savdoga o'tsa consume_cart() uni qayta ayiradi). RELEASED_RETENTION
+    dan eski bunday qatorlar o'chiriladi.
+    Qaytaradi: qaytarilgan rezervlar soni.
+    """
+    from models import StockReservation
+
+    StockReservation.query.filter(
+        StockReservation.quantity == 0,
+        StockReservation.expires_at < get_tashkent_time() - RELEASED_RETENTION
+    ).delete()
+    db.session.commit()
+
+    total = 0
+    while True:
+        expired = StockReservation.query.filter(
+            StockReservation.quantity > 0,
+            StockReservation.expires_at < get_tashkent_time()
+        ).order_by(
+            StockReservation.location_type, StockReservation.location_id,
+            StockReservation.product_id, StockReservation.id
+        ).with_for_update(skip_locked=True).limit(limit).all()
+        if not expired:
+            break
+
+        deltas = {}
+        for reservation in expired:
+            key = _reservation_key(reservation)
+            quantity = Decimal(str(reservation.quantity))
+            deltas[key] = deltas.get(key, _ZERO) - quantity
+            reservation.released_quantity = Decimal(str(reservation.released_quantity or 0)) + quantity
+            reservation.quantity = _ZERO
+        _apply_deltas(deltas)
+        db.session.commit()
+
+        total += len(expired)
+        carts = len({r.cart_id for r in expired})
+        logger.info(f"🧹 {len(expired)} ta muddati o'tgan rezerv qaytarildi ({carts} ta korzina)")
+        if len(expired) < limit:
+            break
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'sweep':
+        print("Foydalanish: python stock_reservations.py sweep")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        count = release_expired()
+        print(f"✅ {count} ta muddati o'tgan rezerv qaytarildi")
@@ -54,12 +54,11 @@ class DebtTelegramBot:
             if not self.db:
                 return None
             
-            from models import Settings
-            setting = Settings.query.filter_by(key='telegram_bot_token').first()
-            if setting and setting.value:
+            import settings_service
+            token = settings_service.get('telegram_bot_token')
+            if token:
                 logger.info("✅ Telegram bot token Settings jadvalidan olindi")
-                return setting.value
-            return None
+            return token
         except Exception as e:
             logger.debug(f"Settings'dan token olishda xato: {e}")
             return None
@@ -88,11 +87,8 @@ class DebtTelegramBot:
             if not self.db:
                 return None
             
-            from models import Settings
-            setting = Settings.query.filter_by(key='telegram_admin_chat_ids').first()
-            if setting and setting.value:
-                return setting.value
-            return None
+            import settings_service
+            return settings_service.get('telegram_admin_chat_ids')
         except Exception as e:
             logger.debug(f"Settings'dan admin IDs olishda xato: {e}")
             return None
@@ -499,7 +495,9 @@ class DebtTelegramBot:
         terminal_usd: float = 0,
         debt_usd: float = 0,
         balance_uzs: float = 0,
-        balance_usd: float = 0
+        balance_usd: float = 0,
+        total_debt_usd: Optional[float] = None,
+        total_debt_uzs: Optional[float] = None
     ) -> bool:
         """
         Savdo yakunlanganda mijozga xabar yuborish (sync versiya - Flask uchun)
@@ -525,6 +523,8 @@ class DebtTelegramBot:
             click_usd: Click to'lov (USD)
             terminal_usd: Terminal to'lov (USD)
             debt_usd: Qarz (USD)
+            total_debt_usd / total_debt_uzs: Savdo paytidagi jami qarz (navbatdan
+                yuborilganda); berilmasa database'dan hisoblanadi
 
         Returns:
             bool: Yuborildi/yuborilmadi
@@ -563,11 +563,16 @@ class DebtTelegramBot:
 
             # Oldingi va jami qarzni hisoblash (database'dan) - har doim ko'rsatish
             previous_debt_usd = 0
-            total_debt_usd = 0
             previous_debt_uzs = 0
-            total_debt_uzs = 0
-
-            if customer_id:
+            debt_snapshot = total_debt_usd is not None
+            total_debt_usd = total_debt_usd or 0
+            total_debt_uzs = total_debt_uzs or 0
+
+            if debt_snapshot:
+                # Navbatga qo'yilgan paytdagi qiymat
+                previous_debt_usd = total_debt_usd - debt_usd
+                previous_debt_uzs = total_debt_uzs - debt_uzs
+            elif customer_id:
                 try:
                     from app import app, db
                     with app.app_context():
@@ -1194,7 +1199,8 @@ async def handle_verification_code(update: Update, context: ContextTypes.DEFAULT
 
 async def check_debt_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Qarzni tekshirish tugmasi bosilganda"""
-    from app import app, db, Customer, Sale, Store, Warehouse
+    from app import app, Customer
+    import debt_ledger
 
     chat_id = update.effective_chat.id
 
@@ -1217,16 +1223,10 @@ async def check_debt_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            # Qarzlarni hisoblash - faqat USD dan
-            debts_result = db.session.query(
-                db.func.sum(Sale.debt_usd).label('total_debt_usd')
-            ).filter(
-                Sale.customer_id == customer.id,
-                Sale.payment_status == 'partial',
-                Sale.debt_usd > 0
-            ).first()
+            # Qarzlarni hisoblash - faqat USD dan (customer_debt_summary, sales ustida SUM emas)
+            debt_summary = debt_ledger.get_summary(customer.id)
 
-            if not debts_result or not debts_result.total_debt_usd or debts_result.total_debt_usd <= 0:
+            if not debt_summary or not debt_summary.partial_debt_usd or debt_summary.partial_debt_usd <= 0:
                 await update.message.reply_text(
                     f"Assalomu alaykum, {customer.name}!\n\n"
                     f"🎉 Sizda qarz yo'q!\n\n"
@@ -1235,7 +1235,7 @@ async def check_debt_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             # Qarzlar haqida xabar - jami qarzni ko'rsatish (USD)
-            total_debt_usd = float(debts_result.total_debt_usd or 0)
+            total_debt_usd = float(debt_summary.partial_debt_usd or 0)
 
             message = (
                 f"Assalomu alaykum, {customer.name}!\n\n"
@@ -1443,7 +1443,11 @@ async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
 
             # Qarzlar haqida xabar
-            from app import Store, Warehouse
+            import location_directory
+
+            location_names = location_directory.resolve_many(
+                {(debt.location_type, debt.location_id) for debt in debts
+                 if debt.location_type in ('store', 'warehouse') and debt.location_id})
 
             total_usd = 0
             total_uzs = 0
@@ -1456,13 +1460,7 @@ async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE
                 total_uzs += debt_uzs
 
                 # Location nomini olish
-                location_name = "Do'kon"
-                if debt.location_type == 'store' and debt.location_id:
-                    store = Store.query.get(debt.location_id)
-                    location_name = store.name if store else "Do'kon"
-                elif debt.location_type == 'warehouse' and debt.location_id:
-                    warehouse = Warehouse.query.get(debt.location_id)
-                    location_name = warehouse.name if warehouse else "Ombor"
+                location_name = location_names.get((debt.location_type, debt.location_id), "Do'kon")
 
                 debt_details.append(
                     f"📍 {location_name}\n"
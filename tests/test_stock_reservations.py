@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""stock_reservations: sweeper qaytargan rezervlar tahrirlash yakunida qayta ayiriladi"""
+from datetime import timedelta
+
+import pytest
+from flask import Flask
+
+from database import db
+from models import Product, StockReservation, Store, StoreStock
+import stock_reservations
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('SHARED_CACHE_PATH', str(tmp_path / 'cache.sqlite3'))
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def stock(app):
+    store = Store(name='Do\'kon', address='a', manager_name='m', phone='1')
+    product = Product(name='Mahsulot', cost_price=1, sell_price=2)
+    db.session.add_all([store, product])
+    db.session.flush()
+    stock = StoreStock(store_id=store.id, product_id=product.id, quantity=10)
+    db.session.add(stock)
+    db.session.commit()
+    return stock
+
+
+def _line(stock, quantity):
+    return [{'product_id': stock.product_id, 'location_type': 'store',
+             'location_id': stock.store_id, 'quantity': quantity}]
+
+
+def _quantity(stock):
+    db.session.expire_all()
+    return float(db.session.get(StoreStock, stock.id).quantity)
+
+
+def _sweep_expired():
+    for reservation in StockReservation.query.all():
+        reservation.expires_at -= timedelta(hours=1)
+    db.session.commit()
+    stock_reservations.release_expired()
+
+
+def test_edit_consume_re_deducts_swept_reservation(stock):
+    # Tahrirlanayotgan savdo 4 tani ushlab turibdi, tahrirda 2 ta qo'shildi
+    stock.quantity = 6
+    db.session.commit()
+    stock_reservations.apply_cart('edit', _line(stock, 2))
+    db.session.commit()
+    assert _quantity(stock) == 4
+
+    _sweep_expired()
+    assert _quantity(stock) == 6
+    reservation = StockReservation.query.one()
+    assert float(reservation.quantity) == 0
+    assert float(reservation.released_quantity) == 2
+
+    stock_reservations.consume_cart('edit')
+    db.session.commit()
+    assert _quantity(stock) == 4
+    assert StockReservation.query.count() == 0
+
+
+def test_edit_consume_after_sweep_reports_shortage(stock):
+    stock_reservations.apply_cart('edit', _line(stock, 2))
+    db.session.commit()
+    _sweep_expired()
+    stock.quantity = 1
+    db.session.commit()
+
+    with pytest.raises(stock_reservations.ReservationError):
+        stock_reservations.consume_cart('edit')
+    db.session.rollback()
+
+
+def test_re_reserved_cart_forgets_released_quantity(stock):
+    stock_reservations.apply_cart('edit', _line(stock, 1))
+    db.session.commit()
+    _sweep_expired()
+    stock_reservations.apply_cart('edit', _line(stock, 1))
+    db.session.commit()
+    assert _quantity(stock) == 9
+
+    stock_reservations.consume_cart('edit')
+    db.session.commit()
+    assert _quantity(stock) == 9
+
+
+def test_new_sale_consume_ignores_released_quantity(stock):
+    stock_reservations.apply_cart('new', _line(stock, 2))
+    db.session.commit()
+    _sweep_expired()
+    assert _quantity(stock) == 10
+
+    # Yangi savdo sold_lines bilan - yetishmagan qismni o'zi ayiradi
+    stock_reservations.consume_cart('new', _line(stock, 2))
+    db.session.commit()
+    assert _quantity(stock) == 8
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Transferlarni to'plam (set-based) holida bajarish.
+
+Avval `/api/transfer` har bir qator uchun manba stock'ni `with_for_update`
+bilan o'qir, manzil stock'ni alohida qidirar, `Product.query.get` va tavsif
+uchun joylashuv nomlarini olardi. 200 qatorli ombor -> do'kon jo'natmasi
+bitta tranzaksiyada mingga yaqin so'rov va shu vaqt davomida ushlab
+turilgan qator qulflari edi.
+
+`apply_transfers()` qator sonidan qat'i nazar bir nechta so'rov bajaradi:
+
+- mahsulot nomlari - bitta `IN (...)`;
+- barcha ta'sirlangan stock qatorlari - har jadvalga bitta
+  `SELECT ... FOR UPDATE`, doimiy tartibda (store -> warehouse, har birida
+  (location_id, product_id)) - stock_reservations bilan bir xil, parallel
+  tranzaksiyalar bir-birini deadlock qilmaydi;
+- miqdorlar xotirada qatorma-qator tekshiriladi (eski oqim kabi: oldingi
+  qator keltirgan miqdorni keyingisi jo'natishi mumkin);
+- ayirish va qo'shish - har jadvalga bitta `INSERT ... ON CONFLICT
+  (location_id, product_id) DO UPDATE SET quantity = quantity + farq`;
+- Transfer yozuvlari - bitta executemany (`RETURNING id`).
+
+ON CONFLICT uchun migrations/add_unique_stock_location_product.sql kerak.
+"""
+import logging
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+LOCATION_TYPES = ('store', 'warehouse')
+
+SHORTAGE_MESSAGES = {
+    'store': 'Do\'konda yetarli miqdor yo\'q',
+    'warehouse': 'Omborda yetarli miqdor yo\'q',
+}
+
+_ZERO = Decimal('0')
+
+
+class TransferError(ValueError):
+    """Transferni bajarib bo'lmadi - HTTP status va (stock yetmasa) qator bilan"""
+
+    def __init__(self, message, status=400, line=None):
+        super().__init__(message)
+        self.status = status
+        self.line = line
+
+
+class TransferLine:
+    """Bitta transfer qatori; apply_transfers() oldingi miqdorlar va yozuvni to'ldiradi"""
+
+    __slots__ = ('product_id', 'from_type', 'from_id', 'to_type', 'to_id', 'quantity',
+                 'product_name', 'from_before', 'to_before', 'transfer_id')
+
+    def __init__(self, product_id, from_type, from_id, to_type, to_id, quantity):
+        self.product_id = product_id
+        self.from_type = from_type
+        self.from_id = from_id
+        self.to_type = to_type
+        self.to_id = to_id
+        self.quantity = quantity
+        self.product_name = None
+        self.from_before = None
+        self.to_before = None
+        self.transfer_id = None
+
+    @property
+    def from_key(self):
+        return (self.from_type, self.from_id, self.product_id)
+
+    @property
+    def to_key(self):
+        return (self.to_type, self.to_id, self.product_id)
+
+    @property
+    def from_after(self):
+        return self.from_before - self.quantity
+
+    @property
+    def to_after(self):
+        return self.to_before + self.quantity
+
+
+# ---------- yordamchi ----------
+
+def parse_location(value):
+    """'store_3' -> ('store', 3)"""
+    try:
+        location_type, location_id = str(value).split('_', 1)
+        location_id = int(location_id)
+    except ValueError:
+        raise TransferError(f"Noto'g'ri joylashuv: {value}")
+    if location_type not in LOCATION_TYPES:
+        raise TransferError(f"Noto'g'ri joylashuv turi: {value}")
+    return location_type, location_id
+
+
+def parse_lines(items):
+    """So'rovdagi `transfers` ro'yxatini TransferLine larga aylantirish (tartib saqlanadi)"""
+    lines = []
+    for item in items or []:
+        try:
+            product_id = int(item['product_id'])
+            quantity = Decimal(str(item['quantity']))  # Decimal (0.5 litr uchun)
+            valid = quantity.is_finite() and quantity > 0
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            raise TransferError(f"Transfer qatori noto'g'ri: {item}")
+        if not valid:
+            raise TransferError(f"Miqdor musbat bo'lishi kerak: {item}")
+        from_type, from_id = parse_location(item.get('from_location'))
+        to_type, to_id = parse_location(item.get('to_location'))
+        lines.append(TransferLine(product_id, from_type, from_id, to_type, to_id, quantity))
+    return lines
+
+
+def _stock_tables():
+    from models import StoreStock, WarehouseStock
+
+    return (('store', StoreStock.__table__, 'store_id'),
+            ('warehouse', WarehouseStock.__table__, 'warehouse_id'))
+
+
+def _lock_stocks(keys):
+    """Stock qatorlarini doimiy tartibda FOR UPDATE bilan qulflash.
+
+    Qaytaradi: {(location_type, location_id, product_id): miqdor} - faqat mavjud qatorlar
+    """
+    quantities = {}
+    for location_type, table, location_column in _stock_tables():
+        pairs = sorted((location_id, product_id) for loc_type, location_id, product_id in keys
+                       if loc_type == location_type)
+        if not pairs:
+            continue
+        location_col = table.c[location_column]
+        rows = db.session.execute(
+            select(location_col, table.c.product_id, table.c.quantity)
+            .where(tuple_(location_col, table.c.product_id).in_(pairs))
+            .order_by(location_col, table.c.product_id, table.c.id)
+            .with_for_update()
+        ).all()
+        for location_id, product_id, quantity in rows:
+            # Takroriy qator bo'lsa (migratsiyadan oldingi ma'lumot) birinchisi ishlatiladi
+            quantities.setdefault((location_type, location_id, product_id),
+                                  Decimal(str(quantity or 0)))
+    return quantities
+
+
+def _upsert_stocks(deltas):
+    """Farqlarni qo'llash: har jadvalga bitta INSERT ... ON CONFLICT DO UPDATE"""
+    bind = db.session.get_bind()
+    insert = postgresql.insert if bind.dialect.name == 'postgresql' else sqlite.insert
+
+    for location_type, table, location_column in _stock_tables():
+        rows = [
+            {location_column: location_id, 'product_id': product_id, 'quantity': delta}
+            for (loc_type, location_id, product_id), delta in sorted(deltas.items())
+            if loc_type == location_type
+        ]
+        if not rows:
+            continue
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[location_column, 'product_id'],
+            set_={'quantity': table.c.quantity + stmt.excluded.quantity})
+        db.session.execute(stmt)
+
+
+# ---------- transfer ----------
+
+def apply_transfers(lines, user_name='Admin'):
+    """TransferLine larni bajarish: stock'ni ko'chirish va Transfer yozuvlarini qo'shish.
+
+    Commit QILMAYDI. Stock yetmasa hech narsa o'zgartirilmaydi va TransferError
+    (`line` - birinchi yetmagan qator). Muvaffaqiyatda har qatorda product_name,
+    from_before/to_before va transfer_id to'ldiriladi.
+    """
+    from models import Product, Transfer
+
+    if not lines:
+        return lines
+
+    names = dict(db.session.query(Product.id, Product.name).filter(
+        Product.id.in_({line.product_id for line in lines})).all())
+    for line in lines:
+        if line.product_id not in names:
+            raise TransferError(f"Mahsulot topilmadi: #{line.product_id}")
+        line.product_name = names[line.product_id]
+
+    keys = {line.from_key for line in lines} | {line.to_key for line in lines}
+    initial = _lock_stocks(keys)
+
+    current = dict(initial)
+    for line in lines:
+        available = current.get(line.from_key)
+        if available is None or available < line.quantity:
+            raise TransferError(
+                f"{SHORTAGE_MESSAGES[line.from_type]}: {line.product_name}", line=line)
+        line.from_before = available
+        current[line.from_key] = available - line.quantity
+        # Miqdor 0 bo'lsa ham stock qatori saqlanadi (o'chirilmaydi)
+        line.to_before = current.get(line.to_key, _ZERO)
+        current[line.to_key] = line.to_before + line.quantity
+
+    deltas = {key: quantity - initial.get(key, _ZERO) for key, quantity in current.items()}
+    _upsert_stocks({key: delta for key, delta in deltas.items() if delta != 0 or key not in initial})
+
+    if any(key not in initial for key in current):
+        # Xom INSERT - ORM eventlari ishlamaydi (yangi stock qatori tekshiruv sessiyalariga ta'sir qiladi)
+        import response_cache
+        response_cache.bump('stock_check_sessions')
+
+    # Transfer yozuvlari - bitta executemany: SQLAlchemy insertmanyvalues ko'p qatorli
+    # INSERT ... RETURNING yuboradi, sort_by_parameter_order=True esa id larni
+    # parametrlar (lines) tartibida qaytaradi - dialekt tartibni kafolatlamasa,
+    # SQLAlchemy o'zi sentinel ustun bo'yicha saralaydi yoki paketni bo'lib yuboradi
+    table = Transfer.__table__
+    transfer_ids = db.session.execute(
+        insert(table).returning(table.c.id, sort_by_parameter_order=True),
+        [{
+            'product_id': line.product_id,
+            'from_location_type': line.from_type,
+            'from_location_id': line.from_id,
+            'to_location_type': line.to_type,
+            'to_location_id': line.to_id,
+            'quantity': line.quantity,
+            'user_name': user_name,
+        } for line in lines]
+    ).scalars().all()
+    for line, transfer_id in zip(lines, transfer_ids):
+        line.transfer_id = transfer_id
+
+    logger.debug(f"🔄 {len(lines)} ta transfer qatori, {len(deltas)} ta stock qatori o'zgardi")
+    return lines
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Foydalanuvchi joylashuv ruxsatlari jadvali (user_locations).
+
+`users.allowed_locations` / `transfer_locations` / `stock_check_locations`
+JSON ustunlari bir necha formatda saqlangan:
+
+- yangi: [{'id': 1, 'type': 'store'}, ...];
+- eski: [1, 2, 3] - turi yozilmagan, har safar Store/Warehouse jadvallaridan
+  tekshirilardi;
+- ba'zan ID lar satr sifatida ("1").
+
+Shu sabab `extract_location_ids` har chaqiruvda ro'yxatni aylanib, eski
+formatda DB so'rovi bajarardi. Endi ular bir marta (user_id, scope,
+location_type, location_id) qatorlariga normallashtiriladi:
+
+- principal_cache ruxsatlarni shu jadvaldan bitta so'rovda yuklaydi (jadval
+  to'ldirilmagan bo'lsa - JSON ustunlardan);
+- xom SQL filtrlari (`expand_location_ids()` + `LOCATION_IDS_SQL`) ID larni
+  principal'dan oladi - ruxsat tekshiruvi bilan ro'yxat har doim bir xil;
+- JSON ustunlari manba bo'lib qoladi: User commit qilinganda (create_user,
+  update_user) qatorlar o'sha tranzaksiyada qayta yoziladi, xato bo'lsa
+  commit ham bekor bo'ladi (jadval va JSON ajralib qolmaydi).
+
+To'liq qayta qurish: python user_locations.py rebuild
+"""
+import json
+import logging
+import sys
+
+from sqlalchemy import bindparam, event, inspect, text
+from sqlalchemy.orm import Session
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# scope -> users jadvalidagi JSON ustun
+SCOPES = {
+    'allowed': 'allowed_locations',
+    'transfer': 'transfer_locations',
+    'stock_check': 'stock_check_locations',
+}
+
+LOCATION_TYPES = ('store', 'warehouse')
+
+# Xom SQL so'rovlar uchun: expand_location_ids(text("... AND c.store_id IN " + LOCATION_IDS_SQL))
+LOCATION_IDS_SQL = ':ul_location_ids'
+
+_PENDING_KEY = 'user_locations_pending'
+
+_table_ready = None
+
+
+def expand_location_ids(statement):
+    """LOCATION_IDS_SQL li text() so'rovi - ID lar ro'yxati IN (...) ga yoyiladi"""
+    return statement.bindparams(bindparam('ul_location_ids', expanding=True))
+
+
+def location_params(location_ids):
+    """LOCATION_IDS_SQL parametri - principal'dagi ID lar (user_location_ids)"""
+    return {'ul_location_ids': list(location_ids)}
+
+
+def _legacy_id(loc):
+    """Eski format elementi (int yoki raqamli satr) -> int, aks holda None"""
+    if isinstance(loc, bool):
+        return None
+    if isinstance(loc, int):
+        return loc
+    if isinstance(loc, str) and loc.strip().isdigit():
+        return int(loc.strip())
+    return None
+
+
+def normalize(raw_by_scope, connection=None):
+    """{scope: JSON ro'yxat} -> {(scope, location_type, location_id)}
+
+    Eski formatdagi ID lar Store va Warehouse jadvallaridan tekshiriladi
+    (ikkalasida bo'lsa - ikkala tur ham): barcha ro'yxatlar uchun har turga
+    bitta so'rov.
+    """
+    legacy_ids = {_legacy_id(loc) for locations in raw_by_scope.values() if locations
+                  for loc in locations} - {None}
+    store_ids = warehouse_ids = set()
+    if legacy_ids:
+        executor = connection if connection is not None else db.session
+        params = {'ids': sorted(legacy_ids)}
+        store_ids = set(executor.execute(
+            text("SELECT id FROM stores WHERE id IN :ids").bindparams(bindparam('ids', expanding=True)),
+            params).scalars())
+        warehouse_ids = set(executor.execute(
+            text("SELECT id FROM warehouses WHERE id IN :ids").bindparams(bindparam('ids', expanding=True)),
+            params).scalars())
+
+    rows = set()
+    for scope, locations in raw_by_scope.items():
+        for loc in locations or []:
+            if isinstance(loc, dict):
+                try:
+                    location_id = int(loc.get('id'))
+                except (TypeError, ValueError):
+                    continue
+                if loc.get('type') in LOCATION_TYPES:
+                    rows.add((scope, loc['type'], location_id))
+                continue
+            location_id = _legacy_id(loc)
+            if location_id in store_ids:
+                rows.add((scope, 'store', location_id))
+            if location_id in warehouse_ids:
+                rows.add((scope, 'warehouse', location_id))
+    return rows
+
+
+def sync_users(connection, user_ids):
+    """Berilgan foydalanuvchilar qatorlarini JSON ustunlardan qayta yozish"""
+    user_ids = sorted({uid for uid in user_ids if uid})
+    if not user_ids:
+        return 0
+    columns = ', '.join(SCOPES.values())
+    users = connection.execute(
+        text(f"SELECT id, {columns} FROM users WHERE id IN :ids").bindparams(
+            bindparam('ids', expanding=True)), {'ids': user_ids}).fetchall()
+
+    connection.execute(
+        text("DELETE FROM user_locations WHERE user_id IN :ids").bindparams(
+            bindparam('ids', expanding=True)), {'ids': user_ids})
+
+    values = []
+    for user in users:
+        raw = {scope: _json_list(getattr(user, column)) for scope, column in SCOPES.items()}
+        for scope, location_type, location_id in sorted(normalize(raw, connection)):
+            values.append({'user_id': user.id, 'scope': scope,
+                           'location_type': location_type, 'location_id': location_id})
+    if values:
+        connection.execute(text("""
+            INSERT INTO user_locations (user_id, scope, location_type, location_id)
+            VALUES (:user_id, :scope, :location_type, :location_id)
+        """), values)
+    return len(values)
+
+
+def _json_list(value):
+    # Xom SQL'da JSON ustun driverga qarab satr bo'lib kelishi mumkin
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return []
+    return value if isinstance(value, list) else []
+
+
+def rebuild():
+    """Barcha foydalanuvchilar uchun jadvalni qayta qurish"""
+    user_ids = [row[0] for row in db.session.execute(text("SELECT id FROM users")).fetchall()]
+    connection = db.session.connection()
+    total = 0
+    for start in range(0, len(user_ids), 500):
+        total += sync_users(connection, user_ids[start:start + 500])
+    db.session.commit()
+    return total
+
+
+# ---------- avtomatik sinxronlash ----------
+
+@event.listens_for(Session, 'after_flush')
+def _collect_location_changes(session, flush_context):
+    """Joylashuv ustunlari o'zgargan foydalanuvchilarni commit'gacha yig'ish"""
+    from models import User
+
+    pending = None
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, User):
+            continue
+        if obj in session.dirty:
+            state = inspect(obj)
+            if not any(state.attrs[column].history.has_changes() for column in SCOPES.values()):
+                continue
+        if pending is None:
+            pending = session.info.setdefault(_PENDING_KEY, set())
+        pending.add(obj.id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_location_changes(session):
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    connection = session.connection()
+    if _locations_table_ready(connection):
+        # Xato commit'ni ham to'xtatadi - eski qatorlar bilan ruxsatlar jim qolib ketmasligi uchun
+        sync_users(connection, pending)
+
+
+def _locations_table_ready(connection):
+    """Migratsiya qo'llanmagan bo'lsa - ogohlantirish (principal JSON ustunlardan o'qiydi)"""
+    global _table_ready
+    if _table_ready is None:
+        _table_ready = inspect(connection).has_table('user_locations')
+        if not _table_ready:
+            logger.warning("⚠️ user_locations jadvali yo'q - migratsiyani qo'llab "
+                           "'python user_locations.py rebuild' ni ishga tushiring")
+    return _table_ready
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_location_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print("Foydalanish: python user_locations.py rebuild")
+        sys.exit(1)
+
+    from app import app
+
+    with app.app_context():
+        count = rebuild()
+        print(f"✅ user_locations qayta qurildi: {count} ta qator")